@@ -0,0 +1,174 @@
+"""
+Measure how long it takes to compute servers_of_happiness for wide
+encodings. We compare the Edmonds-Karp flow-network computation that
+Tahoe2ServerSelector used to run on every pass of its loop (reproduced
+below, since it is no longer in the tree), a Hopcroft-Karp matching built
+from scratch, and the incremental HappinessMatching that the selector now
+keeps up to date as it places shares one at a time.
+
+python bench_happiness.py
+"""
+
+import random
+
+from pyutil import benchutil
+
+from allmydata.util.happinessutil import HappinessMatching, \
+     shares_by_server
+
+# This is the servers_of_happiness() that happinessutil used before it
+# switched to HappinessMatching, minus the comments.
+
+def edmonds_karp_happiness(sharemap):
+    if sharemap == {}:
+        return 0
+    sharemap = shares_by_server(sharemap)
+    graph = flow_network_for(sharemap)
+    dim = len(graph)
+    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
+    residual_graph, residual_function = residual_network(graph, flow_function)
+    while augmenting_path_for(residual_graph):
+        path = augmenting_path_for(residual_graph)
+        delta = min(map(lambda (u, v), rf=residual_function: rf[u][v],
+                        path))
+        for (u, v) in path:
+            flow_function[u][v] += delta
+            flow_function[v][u] -= delta
+        residual_graph, residual_function = residual_network(graph,
+                                                             flow_function)
+    num_servers = len(sharemap)
+    return sum([flow_function[0][v] for v in xrange(1, num_servers+1)])
+
+def flow_network_for(sharemap):
+    sharemap, num_shares = reindex(sharemap, base_index=1)
+    num_servers = len(sharemap)
+    graph = []
+    graph.append(sharemap.keys())
+    for k in sharemap:
+        graph.append(sharemap[k])
+    sink_num = num_servers + num_shares + 1
+    for i in xrange(num_shares):
+        graph.append([sink_num])
+    graph.append([])
+    return graph
+
+def reindex(sharemap, base_index):
+    shares  = {}
+    num = base_index
+    ret = {}
+    for k in sharemap:
+        ret[num] = sharemap[k]
+        num += 1
+    for k in ret:
+        for shnum in ret[k]:
+            if not shares.has_key(shnum):
+                shares[shnum] = num
+                num += 1
+        ret[k] = map(lambda x: shares[x], ret[k])
+    return (ret, len(shares))
+
+def residual_network(graph, f):
+    new_graph = [[] for i in xrange(len(graph))]
+    cf = [[0 for s in xrange(len(graph))] for sh in xrange(len(graph))]
+    for i in xrange(len(graph)):
+        for v in graph[i]:
+            if f[i][v] == 1:
+                new_graph[v].append(i)
+                cf[v][i] = 1
+                cf[i][v] = -1
+            else:
+                new_graph[i].append(v)
+                cf[i][v] = 1
+                cf[v][i] = -1
+    return (new_graph, cf)
+
+def augmenting_path_for(graph):
+    bfs_tree = bfs(graph, 0)
+    if bfs_tree[len(graph) - 1]:
+        n = len(graph) - 1
+        path = []
+        while n != 0:
+            path.insert(0, (bfs_tree[n], n))
+            n = bfs_tree[n]
+        return path
+    return False
+
+def bfs(graph, s):
+    WHITE = 0
+    GRAY  = 1
+    BLACK = 2
+    color        = [WHITE for i in xrange(len(graph))]
+    predecessor  = [None for i in xrange(len(graph))]
+    distance     = [-1 for i in xrange(len(graph))]
+    queue = [s]
+    color[s] = GRAY
+    distance[s] = 0
+    while queue:
+        n = queue.pop(0)
+        for v in graph[n]:
+            if color[v] == WHITE:
+                color[v] = GRAY
+                distance[v] = distance[n] + 1
+                predecessor[v] = n
+                queue.append(v)
+        color[n] = BLACK
+    return predecessor
+
+
+class B(object):
+    def __init__(self, k, n, num_servers):
+        self.k = k
+        self.n = n
+        self.num_servers = num_servers
+
+    def init(self, N):
+        # N uploads' worth of placements: each share lands on one server,
+        # and some land on a second one (as if they were already there)
+        self.placements = []
+        self.sharemaps = []
+        for i in xrange(N):
+            servers = ["server-%d" % j for j in range(self.num_servers)]
+            random.shuffle(servers)
+            placements = [(shnum, servers[shnum % self.num_servers])
+                          for shnum in range(self.n)]
+            for shnum in random.sample(range(self.n), self.n // 4):
+                placements.append((shnum, random.choice(servers)))
+            self.placements.append(placements)
+            sharemap = {}
+            for (shnum, serverid) in placements:
+                sharemap.setdefault(shnum, set()).add(serverid)
+            self.sharemaps.append(sharemap)
+
+    def run_edmonds_karp(self, N):
+        # one evaluation of a complete placement, the old way
+        for sharemap in self.sharemaps[:N]:
+            edmonds_karp_happiness(sharemap)
+
+    def run_hopcroft_karp(self, N):
+        # one evaluation of a complete placement, from scratch
+        for sharemap in self.sharemaps[:N]:
+            HappinessMatching(sharemap).get_happiness()
+
+    def run_incremental(self, N):
+        # a whole placement, asking for the happiness after every share
+        for placements in self.placements[:N]:
+            happiness = HappinessMatching()
+            for (shnum, serverid) in placements:
+                happiness.add(shnum, serverid)
+                happiness.get_happiness()
+
+benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
+print "(microseconds)"
+
+for (k, n, num_servers) in [(3, 10, 10), (30, 100, 200), (100, 255, 500)]:
+    print "%d-of-%d on %d servers" % (k, n, num_servers)
+    b = B(k, n, num_servers)
+    print " edmonds-karp, one evaluation    ",
+    benchutil.rep_bench(b.run_edmonds_karp, 1, initfunc=b.init,
+                        runreps=10, UNITS_PER_SECOND=1000000)
+    print " hopcroft-karp, one evaluation   ",
+    benchutil.rep_bench(b.run_hopcroft_karp, 1, initfunc=b.init,
+                        runreps=10, UNITS_PER_SECOND=1000000)
+    print " incremental, whole placement    ",
+    benchutil.rep_bench(b.run_incremental, 1, initfunc=b.init,
+                        runreps=10, UNITS_PER_SECOND=1000000)
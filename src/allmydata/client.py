@@ -11,6 +11,9 @@ from pycryptopp.publickey import rsa
 
 import allmydata
 from allmydata.storage.server import StorageServer
+from allmydata.storage.immutable import MAX_MAPPED_SHARES
+from allmydata.storage.backends import DiskBackend
+from allmydata.storage.packed import PackedBackend
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
@@ -173,7 +176,10 @@ class Client(node.Node, pollmixin.PollMixin):
         ic = IntroducerClient(self.tub, self.introducer_furl,
                               self.nickname,
                               str(allmydata.__full_version__),
-                              str(self.OLDEST_SUPPORTED_VERSION))
+                              str(self.OLDEST_SUPPORTED_VERSION),
+                              cache_filename=os.path.join(self.basedir,
+                                                          "private",
+                                                          "announcements.json"))
         self.introducer_client = ic
         # hold off on starting the IntroducerClient until our tub has been
         # started, so we'll have a useful address on our RemoteReference, so
@@ -244,6 +250,37 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        expire_threads = int(self.get_config("storage", "expire.threads", 0))
+        expire_iops = self.get_config("storage", "expire.max_iops", None)
+        if expire_iops is not None:
+            expire_iops = int(expire_iops)
+        expire_bps = self.get_config("storage", "expire.max_bytes_per_second",
+                                     None)
+        if expire_bps is not None:
+            expire_bps = parse_abbreviated_size(expire_bps)
+
+        mmap_threshold = self.get_config("storage", "mmap_threshold", None)
+        if mmap_threshold is not None:
+            mmap_threshold = parse_abbreviated_size(mmap_threshold)
+        max_mapped_shares = int(self.get_config("storage", "mmap_max_shares",
+                                                MAX_MAPPED_SHARES))
+
+        backend_name = self.get_config("storage", "backend", "disk")
+        if backend_name == "disk":
+            backend = DiskBackend(storedir)
+        elif backend_name == "packed":
+            max_share_size = self.get_config("storage", "packed.max_share_size",
+                                             None)
+            if max_share_size is None:
+                backend = PackedBackend(storedir)
+            else:
+                max_share_size = parse_abbreviated_size(max_share_size)
+                backend = PackedBackend(storedir,
+                                        max_share_size=max_share_size)
+        else:
+            raise ValueError("[storage]backend= must be 'disk' or 'packed',"
+                             " not '%s'" % backend_name)
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -253,7 +290,13 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           expiration_threads=expire_threads,
+                           expiration_max_iops=expire_iops,
+                           expiration_max_bytes_per_second=expire_bps,
+                           backend=backend,
+                           mmap_threshold=mmap_threshold,
+                           max_mapped_shares=max_mapped_shares)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -289,6 +332,7 @@ class Client(node.Node, pollmixin.PollMixin):
         # (and everybody else who wants to use storage servers)
         sb = storage_client.StorageFarmBroker(self.tub, permute_peers=True)
         self.storage_broker = sb
+        sb.get_connection_manager().setServiceParent(self)
 
         # load static server specifications from tahoe.cfg, if any.
         # Not quite ready yet.
@@ -370,10 +414,20 @@ class Client(node.Node, pollmixin.PollMixin):
 
     def init_helper(self):
         d = self.when_tub_ready()
+        fetch_window = int(self.get_config("helper", "fetch_window",
+                                           Helper.DEFAULT_FETCH_WINDOW))
+        max_encodes = int(self.get_config("helper", "max_concurrent_encodes",
+                                          Helper.DEFAULT_MAX_ENCODES))
+        max_temp_space = self.get_config("helper", "max_temp_space", None)
+        if max_temp_space is not None:
+            max_temp_space = parse_abbreviated_size(max_temp_space)
         def _publish(self):
             self.helper = Helper(os.path.join(self.basedir, "helper"),
                                  self.storage_broker, self._secret_holder,
-                                 self.stats_provider, self.history)
+                                 self.stats_provider, self.history,
+                                 fetch_window=fetch_window,
+                                 max_encodes=max_encodes,
+                                 max_temp_space=max_temp_space)
             # TODO: this is confusing. BASEDIR/private/helper.furl is created
             # by the helper. BASEDIR/helper.furl is consumed by the client
             # who wants to use the helper. I like having the filename be the
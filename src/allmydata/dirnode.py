@@ -15,6 +15,7 @@ from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
+from allmydata.immutable.upload import Data
 from allmydata.util import hashutil, mathutil, base32, log
 from allmydata.util.encodingutil import quote_output
 from allmydata.util.assertutil import precondition
@@ -146,6 +147,11 @@ class Adder:
     def modify(self, old_contents, servermap, first_time):
         children = self.node._unpack_contents(old_contents)
         now = time.time()
+        self._add_children(children, now)
+        new_contents = self.node._pack_contents(children)
+        return new_contents
+
+    def _add_children(self, children, now):
         for (namex, (child, new_metadata)) in self.entries.iteritems():
             name = normalize(namex)
             precondition(IFilesystemNode.providedBy(child), child)
@@ -168,9 +174,57 @@ class Adder:
                 child = self.create_readonly_node(child, name)
 
             children[name] = (child, metadata)
+
+
+class BatchModifier(Adder):
+    """I apply a batch of renames, deletions and additions to a directory in
+    a single modify() call, so the whole batch costs one publish and is
+    seen by readers either completely or not at all.
+
+    'renames' is a list of (old_name, new_name) pairs, applied in order, so
+    that a chain of renames behaves as it would if done one at a time. Each
+    renamed child keeps its metadata. 'deletes' is a list of names to
+    remove. Renames are applied first, then deletions, then additions (of
+    'entries', exactly as for Adder), so a name can be both deleted and
+    replaced in the same batch."""
+
+    def __init__(self, node, entries=None, deletes=(), renames=(),
+                 overwrite=True, create_readonly_node=None):
+        Adder.__init__(self, node, entries, overwrite=overwrite,
+                       create_readonly_node=create_readonly_node)
+        self.deletes = [normalize(namex) for namex in deletes]
+        self.renames = [(normalize(old_namex), normalize(new_namex))
+                        for (old_namex, new_namex) in renames]
+
+    def modify(self, old_contents, servermap, first_time):
+        children = self.node._unpack_contents(old_contents)
+        now = time.time()
+        for (old_name, new_name) in self.renames:
+            if old_name not in children:
+                # if this is a retry, the rename may already have happened
+                if first_time:
+                    raise NoSuchChildError(old_name)
+                continue
+            if old_name == new_name:
+                continue
+            if new_name in children:
+                if not self.overwrite:
+                    raise ExistingChildError("child %s already exists" % quote_output(new_name, encoding='utf-8'))
+                if self.overwrite == "only-files" and IDirectoryNode.providedBy(children[new_name][0]):
+                    raise ExistingChildError("child %s already exists" % quote_output(new_name, encoding='utf-8'))
+            (child, metadata) = children.pop(old_name)
+            children[new_name] = (child, update_metadata(metadata.copy(), None, now))
+        for name in self.deletes:
+            if name not in children:
+                if first_time:
+                    raise NoSuchChildError(name)
+                continue
+            del children[name]
+        self._add_children(children, now)
         new_contents = self.node._pack_contents(children)
         return new_contents
 
+
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, str), rw_uri)
     precondition(isinstance(writekey, str), writekey)
@@ -532,10 +586,11 @@ class DirectoryNode:
         d.addCallback(lambda res: child_node)
         return d
 
-    def set_children(self, entries, overwrite=True):
+    def set_children(self, entries, overwrite=True, deletes=(), renames=()):
         # this takes URIs
-        a = Adder(self, overwrite=overwrite,
-                  create_readonly_node=self._create_readonly_node)
+        a = BatchModifier(self, deletes=deletes, renames=renames,
+                          overwrite=overwrite,
+                          create_readonly_node=self._create_readonly_node)
         for (namex, e) in entries.iteritems():
             assert isinstance(namex, unicode), namex
             if len(e) == 2:
@@ -576,12 +631,13 @@ class DirectoryNode:
         d.addCallback(lambda res: child)
         return d
 
-    def set_nodes(self, entries, overwrite=True):
+    def set_nodes(self, entries, overwrite=True, deletes=(), renames=()):
         precondition(isinstance(entries, dict), entries)
         if self.is_readonly():
             return defer.fail(NotWriteableError())
-        a = Adder(self, entries, overwrite=overwrite,
-                  create_readonly_node=self._create_readonly_node)
+        a = BatchModifier(self, entries, deletes=deletes, renames=renames,
+                          overwrite=overwrite,
+                          create_readonly_node=self._create_readonly_node)
         d = self._node.modify(a.modify)
         d.addCallback(lambda res: self)
         return d
@@ -652,6 +708,12 @@ class DirectoryNode:
         current_child_name = normalize(current_child_namex)
         if new_child_namex is None:
             new_child_namex = current_child_name
+        if new_parent.get_write_uri() == self.get_write_uri():
+            # a rename within one directory can be done in a single publish
+            d = self.set_nodes({}, overwrite=overwrite,
+                               renames=[(current_child_name, new_child_namex)])
+            d.addCallback(lambda ign: None)
+            return d
         d = self.get(current_child_name)
         def sn(child):
             return new_parent.set_node(new_child_namex, child,
@@ -771,6 +833,12 @@ class DirectoryNode:
         # children for which we've got both a write-cap and a read-cap
         return self.deep_traverse(DeepStats(self))
 
+    def start_copy_tree(self, mutable=True, mutable_version=None):
+        """Make a copy of everything reachable from this directory, and
+        return a Monitor whose results will include the cap of the copy. See
+        IDirectoryNode.start_copy_tree for details."""
+        return TreeCopier(self, mutable, mutable_version).start()
+
     def start_deep_check(self, verify=False, add_lease=False):
         return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
 
@@ -909,6 +977,148 @@ class ManifestWalker(DeepStats):
                 }
 
 
+class TreeCopier:
+    """I copy a directory tree without leaving the node. Immutable files and
+    immutable directories are shared with the original, by linking the same
+    cap. The contents of each mutable file are uploaded as a new immutable
+    file. Every other directory is recreated, once all of its children have
+    been copied, with a single create_new_mutable_directory() or (for a
+    snapshot) create_immutable_directory() call.
+
+    Like deep_traverse(), I walk the tree strictly depth-first, one node at
+    a time, to bound memory use."""
+
+    def __init__(self, origin, mutable=True, mutable_version=None):
+        self.origin = origin
+        self.nodemaker = origin._nodemaker
+        self.uploader = origin._uploader
+        self.mutable = mutable
+        self.mutable_version = mutable_version
+        # maps the verifycap of each source directory we have copied to the
+        # copy, so that a directory linked in several places is copied once
+        self.copies = {}
+        self.in_progress = set()
+        self.stats = {}
+        for k in ["count-files-linked",
+                  "count-files-copied",
+                  "count-directories-linked",
+                  "count-directories-created",
+                  "count-unknown-linked",
+                  "count-skipped",
+                  ]:
+            self.stats[k] = 0
+        self.new_root = None
+
+    def start(self):
+        self.monitor = monitor = Monitor()
+        monitor.origin_si = self.origin.get_storage_index()
+        monitor.set_status(self.get_results())
+        d = self._copy_directory(self.origin)
+        def _done(new_root):
+            self.new_root = new_root
+            return self.get_results()
+        d.addCallback(_done)
+        d.addBoth(monitor.finish)
+        d.addErrback(lambda f: None)
+        return monitor
+
+    def add(self, key, value=1):
+        self.stats[key] += value
+
+    def get_results(self):
+        results = self.stats.copy()
+        results["mutable"] = self.mutable
+        results["root"] = None
+        if self.new_root:
+            results["root"] = self.new_root.get_uri()
+        return results
+
+    def _copy_directory(self, dirnode):
+        self.monitor.raise_if_cancelled()
+        d = dirnode.list()
+        d.addCallback(self._copy_children)
+        return d
+
+    def _copy_children(self, children):
+        self.monitor.raise_if_cancelled()
+        new_children = {}
+        d = defer.succeed(None)
+        for i, (name, (child, metadata)) in enumerate(sorted(children.iteritems())):
+            d.addCallback(lambda ign, name=name, child=child, metadata=metadata:
+                          self._copy_child(name, child, metadata, new_children))
+            # avoid the Deferred tail-recursion problem, as in deep_traverse
+            if i % 100 == 99:
+                d.addCallback(lambda ign: fireEventually())
+        d.addCallback(lambda ign: self._create_directory(new_children))
+        return d
+
+    def _copy_child(self, name, child, metadata, new_children):
+        d = defer.maybeDeferred(self._copy_node, child)
+        def _copied(new_child):
+            if new_child is not None:
+                new_children[name] = (new_child, metadata)
+        d.addCallback(_copied)
+        return d
+
+    def _copy_node(self, node):
+        # return the node (or a Deferred for it) that should take this one's
+        # place in the copy, or None to leave it out
+        if isinstance(node, UnknownNode):
+            if not (self.mutable or node.is_allowed_in_immutable_directory()):
+                self.add("count-skipped")
+                return None
+            self.add("count-unknown-linked")
+            return node
+        if IDirectoryNode.providedBy(node):
+            if not node.is_mutable():
+                self.add("count-directories-linked")
+                return node
+            verifier = node.get_verify_cap().to_string()
+            if verifier in self.copies:
+                return self.copies[verifier]
+            if verifier in self.in_progress:
+                # a directory that contains itself cannot be copied
+                self.add("count-skipped")
+                return None
+            self.in_progress.add(verifier)
+            d = self._copy_directory(node)
+            def _copied(new_node):
+                self.in_progress.discard(verifier)
+                self.copies[verifier] = new_node
+                return new_node
+            d.addCallback(_copied)
+            return d
+        if IMutableFileNode.providedBy(node):
+            d = node.download_best_version()
+            d.addCallback(self._upload_contents)
+            return d
+        self.add("count-files-linked")
+        return node
+
+    def _upload_contents(self, data):
+        convergence = self.nodemaker.secret_holder.get_convergence_secret()
+        d = self.uploader.upload(Data(data, convergence))
+        def _uploaded(results):
+            self.add("count-files-copied")
+            return self.nodemaker.create_from_cap(results.uri)
+        d.addCallback(_uploaded)
+        return d
+
+    def _create_directory(self, children):
+        self.monitor.raise_if_cancelled()
+        if self.mutable:
+            d = self.nodemaker.create_new_mutable_directory(children,
+                                                            version=self.mutable_version)
+        else:
+            d = self.nodemaker.create_immutable_directory(children)
+        def _created(new_node):
+            self.add("count-directories-created")
+            self.monitor.set_status(self.get_results())
+            return new_node
+        d.addCallback(_created)
+        return d
+
+
 class DeepChecker:
     def __init__(self, root, verify, repair, add_lease):
         root_si = root.get_storage_index()
@@ -623,15 +623,16 @@ class GeneralSFTPFile(PrefixingLogMixin):
     When first constructed, I am in an 'unopened' state that causes most
     operations to be delayed until 'open' is called."""
 
-    def __init__(self, userpath, flags, close_notify, convergence):
+    def __init__(self, userpath, flags, close_notify, add_file, convergence):
         PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
-        if noisy: self.log(".__init__(%r, %r = %r, %r, <convergence censored>)" %
-                           (userpath, flags, _repr_flags(flags), close_notify), level=NOISY)
+        if noisy: self.log(".__init__(%r, %r = %r, %r, %r, <convergence censored>)" %
+                           (userpath, flags, _repr_flags(flags), close_notify, add_file), level=NOISY)
 
         assert isinstance(userpath, str), userpath
         self.userpath = userpath
         self.flags = flags
         self.close_notify = close_notify
+        self.add_file = add_file
         self.convergence = convergence
         self.async = defer.Deferred()
         # Creating or truncating the file is a change, but if FXF_EXCL is set, a zero-length file has already been created.
@@ -829,7 +830,7 @@ class GeneralSFTPFile(PrefixingLogMixin):
                 def _add_file(ign):
                     self.log("_add_file childname=%r" % (childname,), level=OPERATIONAL)
                     u = FileHandle(self.consumer.get_file(), self.convergence)
-                    return parent.add_file(childname, u, metadata=self.metadata)
+                    return self.add_file(parent, childname, u, self.metadata)
                 d2.addCallback(_add_file)
 
             d2.addBoth(_committed)
@@ -939,9 +940,60 @@ class Reason:
 
 all_heisenfiles = {}
 
+# When immutable heisenfiles are committed, the links to them are
+# group-committed to their parent directory: while one update of a
+# directory is in progress, further links to that directory are queued,
+# and are then all made by the next update. 'all_directory_linkers' maps
+# from a parent_write_uri to the _DirectoryLinker that does this.
+# Updates to this dict are single-threaded.
+
+all_directory_linkers = {}
+
 def _reload():
-    global all_heisenfiles
+    global all_heisenfiles, all_directory_linkers
     all_heisenfiles = {}
+    all_directory_linkers = {}
+
+def _link_child(parent, childname, child, metadata):
+    parent_write_uri = parent.get_write_uri()
+    if parent_write_uri not in all_directory_linkers:
+        all_directory_linkers[parent_write_uri] = _DirectoryLinker(parent)
+    return all_directory_linkers[parent_write_uri].link(childname, child, metadata)
+
+class _DirectoryLinker:
+    def __init__(self, parent):
+        self.parent = parent
+        self.parent_write_uri = parent.get_write_uri()
+        self.entries = {}
+        self.waiting = []
+        self.updating = False
+
+    def link(self, childname, child, metadata):
+        d = defer.Deferred()
+        self.entries[childname] = (child, metadata)
+        self.waiting.append((d, child))
+        if not self.updating:
+            self._update()
+        return d
+
+    def _update(self):
+        (entries, self.entries) = (self.entries, {})
+        (waiting, self.waiting) = (self.waiting, [])
+        self.updating = True
+
+        d = self.parent.set_nodes(entries)
+        def _done(res):
+            self.updating = False
+            for (d2, child) in waiting:
+                if isinstance(res, Failure):
+                    eventually_errback(d2)(res)
+                else:
+                    eventually_callback(d2)(child)
+            if self.entries:
+                self._update()
+            else:
+                all_directory_linkers.pop(self.parent_write_uri, None)
+        d.addBoth(_done)
 
 class SFTPUserHandler(ConchUser, PrefixingLogMixin):
     implements(ISFTPServer)
@@ -1200,6 +1252,19 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         if noisy: self.log("all_heisenfiles = %r\nself._heisenfiles = %r" % (all_heisenfiles, self._heisenfiles), level=NOISY)
 
+    def _add_file(self, parent, childname, uploadable, metadata):
+        if noisy: self.log("._add_file(%r, %r, <uploadable>, %r)" % (parent, childname, metadata), level=NOISY)
+
+        # This is equivalent to parent.add_file(childname, uploadable, metadata=metadata),
+        # except that the link is group-committed with any others to the same directory,
+        # so that closing many files in one directory does not publish it many times.
+        if parent.is_readonly():
+            return defer.fail(NotWriteableError())
+        d = self._client.upload(uploadable)
+        d.addCallback(lambda results: self._client.create_node_from_uri(results.uri))
+        d.addCallback(lambda child: _link_child(parent, childname, child, metadata))
+        return d
+
     def _make_file(self, existing_file, userpath, flags, parent=None, childname=None, filenode=None, metadata=None):
         if noisy: self.log("._make_file(%r, %r, %r = %r, parent=%r, childname=%r, filenode=%r, metadata=%r)" %
                            (existing_file, userpath, flags, _repr_flags(flags), parent, childname, filenode, metadata),
@@ -1220,7 +1285,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
             if writing:
                 close_notify = self._remove_heisenfile
 
-            d.addCallback(lambda ign: existing_file or GeneralSFTPFile(userpath, flags, close_notify, self._convergence))
+            d.addCallback(lambda ign: existing_file or GeneralSFTPFile(userpath, flags, close_notify, self._add_file, self._convergence))
             def _got_file(file):
                 file.open(parent=parent, childname=childname, filenode=filenode, metadata=metadata)
                 if writing:
@@ -1264,7 +1329,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
         userpath = self._path_to_utf8(path)
 
         if flags & (FXF_WRITE | FXF_CREAT):
-            file = GeneralSFTPFile(userpath, flags, self._remove_heisenfile, self._convergence)
+            file = GeneralSFTPFile(userpath, flags, self._remove_heisenfile, self._add_file, self._convergence)
             self._add_heisenfile_by_path(file)
         else:
             # We haven't decided which file implementation to use yet.
@@ -1481,7 +1546,9 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
                                                     to_userpath, to_parent, to_childname, overwrite=overwrite))
 
             def _move(renamed):
-                # FIXME: use move_child_to_path to avoid possible data loss due to #943
+                # A rename within one directory is a single atomic update of that directory.
+                # FIXME: for other renames, use move_child_to_path to avoid possible data loss
+                # due to #943
                 #d3 = from_parent.move_child_to_path(from_childname, to_root, to_path, overwrite=overwrite)
 
                 d3 = from_parent.move_child_to(from_childname, to_parent, to_childname, overwrite=overwrite)
@@ -1,5 +1,6 @@
 
 from twisted.python.failure import Failure
+from twisted.internet import reactor
 from foolscap.api import eventually
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
 from allmydata.util import log
@@ -20,17 +21,27 @@ class SegmentFetcher:
     If I am unable to provide enough blocks, I will call my parent's
     fetch_failed() method with (self, f). After either of these events, I
     will shut down and do no further work. My parent can also call my stop()
-    method to have me shut down early."""
+    method to have me shut down early.
+
+    If a block request takes much longer than its server usually takes to
+    answer, I hedge: I treat the share as OVERDUE and ask another share for
+    a block too, and use whichever blocks arrive first."""
+
+    # how long to wait before hedging a request to a server that we have no
+    # history for, and the shortest wait for any server
+    DEFAULT_HEDGE_DELAY = 5.0
+    MIN_HEDGE_DELAY = 0.05
 
     def __init__(self, node, segnum, k, logparent):
         self._node = node # _Node
         self.segnum = segnum
         self._k = k
         self._shares = [] # unused Share instances, sorted by "goodness"
-                          # (RTT), then shnum. This is populated when DYHB
-                          # responses arrive, or (for later segments) at
-                          # startup. We remove shares from it when we call
-                          # sh.get_block() on them.
+                          # (the time their server is expected to take to
+                          # deliver a block), then shnum. This is populated
+                          # when DYHB responses arrive, or (for later
+                          # segments) at startup. We remove shares from it
+                          # when we call sh.get_block() on them.
         self._shares_from_server = DictOfSets() # maps server to set of
                                                 # Shares on that server for
                                                 # which we have outstanding
@@ -45,6 +56,9 @@ class SegmentFetcher:
         self._lp = logparent
         self._share_observers = {} # maps Share to EventStreamObserver for
                                    # active ones
+        self._hedge_timers = {} # maps active Share to the IDelayedCall that
+                                # will hedge its request
+        self._hedged = set() # Shares we hedged that have not completed
         self._blocks = {} # maps shnum to validated block data
         self._no_more_shares = False
         self._last_failure = None
@@ -54,6 +68,7 @@ class SegmentFetcher:
         log.msg("SegmentFetcher(%s).stop" % self._node._si_prefix,
                 level=log.NOISY, parent=self._lp, umid="LWyqpg")
         self._cancel_all_requests()
+        self._cancel_hedge_timers()
         self._running = False
         # help GC ??? XXX
         del self._shares, self._shares_from_server, self._active_share_map
@@ -67,9 +82,26 @@ class SegmentFetcher:
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        self._sort_shares()
         eventually(self.loop)
 
+    def _get_block_size(self):
+        segment_size = (self._node.segment_size or
+                        self._node.guessed_segment_size or 0)
+        return segment_size // self._k
+
+    def _sort_shares(self):
+        # prefer the servers that have answered us (and other downloads)
+        # most quickly, taking into account how busy we are keeping them.
+        # Servers we know nothing else about are ranked by their DYHB RTT.
+        block_size = self._get_block_size()
+        def _goodness(s):
+            expected = s._server.get_performance().get_expected_time(block_size)
+            if expected is None:
+                expected = s._dyhb_rtt
+            return (expected, s._shnum)
+        self._shares.sort(key=_goodness)
+
     def no_more_shares(self):
         # ShareFinder tells us it's reached the end of its list
         self._no_more_shares = True
@@ -143,8 +175,15 @@ class SegmentFetcher:
         # are we done?
         if len(set(self._blocks.keys())) >= k:
             # yay!
+            if self._hedged:
+                # the hedged requests that are still outstanding lost to the
+                # ones we sent after them
+                ds = self._node._download_status
+                ds.add_hedges_won(len(self._hedged))
             self.stop()
-            self._node.process_blocks(self.segnum, self._blocks)
+            # the decoder wants exactly k blocks
+            blocks = dict(sorted(self._blocks.items())[:k])
+            self._node.process_blocks(self.segnum, blocks)
             return
 
     def _no_shares_error(self):
@@ -188,6 +227,7 @@ class SegmentFetcher:
     def _find_and_use_share(self):
         sent_something = False
         want_more_diversity = False
+        self._sort_shares() # the servers' load may have changed
         for sh in self._shares: # find one good share to fetch
             shnum = sh._shnum ; server = sh._server # XXX
             if shnum in self._blocks:
@@ -213,6 +253,34 @@ class SegmentFetcher:
     def _start_share(self, share, shnum):
         self._share_observers[share] = o = share.get_block(self.segnum)
         o.subscribe(self._block_request_activity, share=share, shnum=shnum)
+        self._start_hedge_timer(share, shnum)
+
+    def _start_hedge_timer(self, share, shnum):
+        perf = share._server.get_performance()
+        delay = perf.get_hedge_delay(self._get_block_size())
+        if delay is None:
+            delay = self.DEFAULT_HEDGE_DELAY
+        delay = max(delay, self.MIN_HEDGE_DELAY)
+        self._hedge_timers[share] = reactor.callLater(delay, self._hedge,
+                                                      share, shnum)
+
+    def _cancel_hedge_timers(self):
+        for t in self._hedge_timers.values():
+            t.cancel()
+        self._hedge_timers = {}
+
+    def _hedge(self, share, shnum):
+        self._hedge_timers.pop(share, None)
+        if not self._running or self._active_share_map.get(shnum) is not share:
+            return
+        log.msg("SegmentFetcher(%s) hedging slow request to %s" %
+                (self._node._si_prefix, repr(share)),
+                level=log.NOISY, parent=self._lp, umid="Ve2dWQ")
+        self._node._download_status.add_hedge()
+        self._hedged.add(share)
+        # this moves the share to _overdue_share_map, so the loop will look
+        # for another one to use as well
+        self._block_request_activity(share, shnum, OVERDUE)
 
     def _ask_for_more_shares(self):
         if not self._no_more_shares:
@@ -236,15 +304,24 @@ class SegmentFetcher:
         # from all our tracking lists.
         if state in (COMPLETE, CORRUPT, DEAD, BADSEGNUM):
             self._share_observers.pop(share, None)
+            t = self._hedge_timers.pop(share, None)
+            if t:
+                t.cancel()
             server = share._server # XXX
             self._shares_from_server.discard(server, share)
             if self._active_share_map.get(shnum) is share:
                 del self._active_share_map[shnum]
             self._overdue_share_map.discard(shnum, share)
+            # a hedged request that finishes, one way or another, was not
+            # beaten by its hedge
+            self._hedged.discard(share)
 
         if state is COMPLETE:
-            # 'block' is fully validated and complete
-            self._blocks[shnum] = block
+            # 'block' is fully validated and complete. Once we hold k blocks
+            # (a hedged request and its hedge can both arrive before the
+            # loop runs), any more are surplus.
+            if shnum in self._blocks or len(self._blocks) < self._k:
+                self._blocks[shnum] = block
 
         if state is OVERDUE:
             # no longer active, but still might complete
@@ -62,8 +62,7 @@ class ShareFinder:
         # test_dirnode, which creates us with storage_broker=None
         if not self._started:
             si = self.verifycap.storage_index
-            servers = self._storage_broker.get_servers_for_psi(si)
-            self._servers = iter(servers)
+            self._servers = self._storage_broker.iter_servers_for_psi(si)
             self._started = True
 
     def log(self, *args, **kwargs):
@@ -136,6 +135,7 @@ class ShareFinder:
                       level=log.NOISY, umid="Io7pyg")
         time_sent = now()
         d_ev = self._download_status.add_dyhb_request(server, time_sent)
+        server.get_performance().request_started()
         # TODO: get the timer from a Server object, it knows best
         self.overdue_timers[req] = reactor.callLater(self.OVERDUE_TIMEOUT,
                                                      self.overdue, req)
@@ -166,6 +166,7 @@ class ShareFinder:
         time_received = now()
         d_ev.finished(shnums, time_received)
         dyhb_rtt = time_received - time_sent
+        server.get_performance().request_finished(dyhb_rtt, dyhb=True)
         if not buckets:
             self.log(format="no shares from [%(name)s]", name=server.get_name(),
                      level=log.NOISY, parent=lp, umid="U7d4JA")
@@ -218,6 +219,7 @@ class ShareFinder:
 
     def _got_error(self, f, server, req, d_ev, lp):
         d_ev.error(now())
+        server.get_performance().request_failed()
         self.log(format="got error from [%(name)s]",
                  name=server.get_name(), failure=f,
                  level=log.UNUSUAL, parent=lp, umid="zUKdCw")
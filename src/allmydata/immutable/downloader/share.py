@@ -739,10 +739,13 @@ class Share:
                          share=repr(self),
                          start=start, length=length,
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
+            time_sent = now()
             block_ev = ds.add_block_request(self._server, self._shnum,
-                                            start, length, now())
+                                            start, length, time_sent)
+            self._server.get_performance().request_started()
             d = self._send_request(start, length)
-            d.addCallback(self._got_data, start, length, block_ev, lp)
+            d.addCallback(self._got_data, start, length, block_ev, lp,
+                          time_sent)
             d.addErrback(self._got_error, start, length, block_ev, lp)
             d.addCallback(self._trigger_loop)
             d.addErrback(lambda f:
@@ -753,8 +756,11 @@ class Share:
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
-    def _got_data(self, data, start, length, block_ev, lp):
-        block_ev.finished(len(data), now())
+    def _got_data(self, data, start, length, block_ev, lp, time_sent):
+        time_received = now()
+        block_ev.finished(len(data), time_received)
+        self._server.get_performance().request_finished(
+            time_received - time_sent, len(data))
         if not self._alive:
             return
         log.msg(format="%(share)s._got_data [%(start)d:+%(length)d] -> %(datalen)d",
@@ -798,6 +804,7 @@ class Share:
 
     def _got_error(self, f, start, length, block_ev, lp):
         block_ev.error(now())
+        self._server.get_performance().request_failed()
         log.msg(format="error requesting %(start)d+%(length)d"
                 " from %(server)s for si %(si)s",
                 start=start, length=length,
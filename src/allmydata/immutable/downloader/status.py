@@ -128,6 +128,11 @@ class DownloadStatus:
         self.known_shares = [] # (server, shnum)
         self.problems = []
 
+        # block requests that took so long that we asked for another share
+        # as well, and how many of those the other share beat
+        self.hedges_issued = 0
+        self.hedges_won = 0
+
         self.misc_events = []
 
     def add_misc_event(self, what, start, finish=None):
@@ -198,6 +203,12 @@ class DownloadStatus:
     def add_problem(self, p):
         self.problems.append(p)
 
+    def add_hedge(self):
+        self.hedges_issued += 1
+
+    def add_hedges_won(self, count):
+        self.hedges_won += count
+
     # IDownloadStatus methods
     def get_counter(self):
         return self.counter
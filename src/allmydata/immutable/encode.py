@@ -201,6 +201,7 @@ class Encoder(object):
         for v in servermap.itervalues():
             assert isinstance(v, set)
         self.servermap = servermap.copy()
+        self._happiness = happinessutil.HappinessMatching(servermap)
 
     def start(self):
         """ Returns a Deferred that will fire with the verify cap (an instance of
@@ -486,11 +487,12 @@ class Encoder(object):
             self.servermap[shareid].remove(peerid)
             if not self.servermap[shareid]:
                 del self.servermap[shareid]
+            self._happiness.remove(shareid, peerid)
         else:
             # even more UNUSUAL
             self.log("they weren't in our list of landlords", parent=ln,
                      level=log.WEIRD, umid="TQGFRw")
-        happiness = happinessutil.servers_of_happiness(self.servermap)
+        happiness = self._happiness.get_happiness()
         if happiness < self.servers_of_happiness:
             peerids = set(happinessutil.shares_by_server(self.servermap).keys())
             msg = happinessutil.failure_message(len(peerids),
@@ -2,6 +2,7 @@
 import os, stat, time, weakref
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python.failure import Failure
 from foolscap.api import Referenceable, DeadReferenceError, eventually
 import allmydata # for __full_version__
 from allmydata import interfaces, uri
@@ -10,12 +11,71 @@ from allmydata.immutable import upload
 from allmydata.immutable.layout import ReadBucketProxy
 from allmydata.util.assertutil import precondition
 from allmydata.util import log, observer, fileutil, hashutil, dictutil
+from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.histogram import LogHistogram
 
 
 class NotEnoughWritersError(Exception):
     pass
 
 
+class AdmissionQueue:
+    """I hand out a limited resource ('capacity' units of it, or an
+    unlimited amount if 'capacity' is None) to the uploads that ask for it.
+    Requests that cannot be granted yet wait in a queue for each client, and
+    the clients take turns, so one client with many uploads cannot keep all
+    the others waiting. A request for more than 'capacity' is granted once
+    nothing else holds any.
+
+    acquire() returns a Deferred that fires when the request has been
+    granted, and the caller must then call release() with the same amount
+    when it is done."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self._queues = {} # maps client to list of (amount, Deferred, queued)
+        self._turns = [] # clients with queued requests, next one first
+        self.wait_times = LogHistogram(precision=0.05, minimum=1e-3)
+
+    def acquire(self, client, amount):
+        d = defer.Deferred()
+        if client not in self._queues:
+            self._queues[client] = []
+            self._turns.append(client)
+        self._queues[client].append( (amount, d, time.time()) )
+        self._grant()
+        return d
+
+    def release(self, amount):
+        self.used -= amount
+        self._grant()
+
+    def get_queue_length(self):
+        return sum([len(q) for q in self._queues.values()])
+
+    def _fits(self, amount):
+        if self.capacity is None or self.used == 0:
+            return True
+        return self.used + amount <= self.capacity
+
+    def _grant(self):
+        while self._turns:
+            client = self._turns[0]
+            (amount, d, queued) = self._queues[client][0]
+            if not self._fits(amount):
+                return
+            self._turns.pop(0)
+            self._queues[client].pop(0)
+            if self._queues[client]:
+                self._turns.append(client) # to the back of the line
+            else:
+                del self._queues[client]
+            self.used += amount
+            self.wait_times.add(time.time() - queued)
+            eventually(d.callback, None)
+
+
 class CHKCheckerAndUEBFetcher:
     """I check to see if a file is already present in the grid. I also fetch
     the URI Extension Block, which is useful for an uploading client who
@@ -159,8 +219,14 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
                                              self._log_number)
         self._reader = LocalCiphertextReader(self, storage_index, encoding_file)
         self._finished_observers = observer.OneShotObserverList()
+        # the first client to send us a reader: the Helper's admission
+        # queues make us wait our turn behind other uploads from them
+        self._client = None
+        self._reserved_space = 0
+        self._encoding = False
 
         d = self._fetcher.when_done()
+        d.addCallback(self._wait_to_encode)
         d.addCallback(lambda res: self._reader.start())
         d.addCallback(lambda res: self.start_encrypted(self._reader))
         d.addCallback(self._finished)
@@ -196,6 +262,8 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
     def remote_upload(self, reader):
         # reader is an RIEncryptedUploadable. I am specified to return an
         # UploadResults dictionary.
+        if self._client is None:
+            self._client = reader.getRemoteTubID()
 
         # let our fetcher pull ciphertext from the reader.
         self._fetcher.add_reader(reader)
@@ -205,6 +273,32 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         # and inform the client when the upload has finished
         return self._finished_observers.when_fired()
 
+    def reserve_space(self, size):
+        # called by our fetcher before it writes anything to disk
+        self._upload_status.set_status("waiting for temporary space")
+        d = self._helper.fetch_queue.acquire(self._client, size)
+        def _reserved(res):
+            self._reserved_space = size
+            self._upload_status.set_status("fetching ciphertext")
+        d.addCallback(_reserved)
+        return d
+
+    def _wait_to_encode(self, res):
+        self._upload_status.set_status("waiting to encode")
+        d = self._helper.encode_queue.acquire(self._client, 1)
+        def _admitted(res):
+            self._encoding = True
+        d.addCallback(_admitted)
+        return d
+
+    def _release(self):
+        if self._reserved_space:
+            self._helper.fetch_queue.release(self._reserved_space)
+            self._reserved_space = 0
+        if self._encoding:
+            self._helper.encode_queue.release(1)
+            self._encoding = False
+
     def _finished(self, uploadresults):
         precondition(isinstance(uploadresults.verifycapstr, str), uploadresults.verifycapstr)
         assert interfaces.IUploadResults.providedBy(uploadresults), uploadresults
@@ -217,6 +311,7 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
         r.timings["total_fetch"] = f_times["total"]
         self._reader.close()
         os.unlink(self._encoding_file)
+        self._release()
         self._finished_observers.fire(r)
         self._helper.upload_finished(self._storage_index, v.size)
         del self._reader
@@ -226,6 +321,7 @@ class CHKUploadHelper(Referenceable, upload.CHKUploader):
                  si=si_b2a(self._storage_index)[:5],
                  failure=f,
                  level=log.UNUSUAL)
+        self._release()
         self._finished_observers.fire(f)
         self._helper.upload_finished(self._storage_index, 0)
         del self._reader
@@ -317,6 +413,8 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
         # first, find out how large the file is going to be
         d = self.call("get_size")
         d.addCallback(self._got_size)
+        d.addCallback(lambda res:
+                      self._upload_helper.reserve_space(self._expected_size))
         d.addCallback(self._start_reading)
         d.addCallback(self._done)
         d.addCallback(self._done2, started)
@@ -338,77 +436,114 @@ class CHKCiphertextFetcher(AskUntilSuccessMixin):
             self.log("we do not have any ciphertext yet", level=log.NOISY)
         self.log("starting ciphertext fetch", level=log.NOISY)
         self._f = open(self._incoming_file, "ab")
-
-        # now loop to pull the data from the readers
-        d = defer.Deferred()
-        self._loop(d)
-        # this Deferred will be fired once the last byte has been written to
-        # self._f
-        return d
-
-    # read data in 50kB chunks. We should choose a more considered number
-    # here, possibly letting the client specify it. The goal should be to
-    # keep the RTT*bandwidth to be less than 10% of the chunk size, to reduce
-    # the upload bandwidth lost because this protocol is non-windowing. Too
-    # large, however, means more memory consumption for both ends. Something
-    # that can be transferred in, say, 10 seconds sounds about right. On my
-    # home DSL line (50kBps upstream), that suggests 500kB. Most lines are
-    # slower, maybe 10kBps, which suggests 100kB, and that's a bit more
-    # memory than I want to hang on to, so I'm going to go with 50kB and see
-    # how that works.
+        self._fetch_started = time.time()
+
+        # now keep a window of read requests outstanding until we have it
+        # all. This Deferred will be fired once the last byte has been
+        # written to self._f
+        self._fetch_done = defer.Deferred()
+        self._reset_window()
+        self._fetch_more()
+        return self._fetch_done
+
+    # read data in 50kB chunks, and keep several of them in flight at once
+    # (the helper's fetch_window), so that the transfer is not limited to
+    # one chunk per round trip. Clients that cannot handle more than one
+    # read at a time (those that do not say otherwise in their get_version)
+    # are asked for one chunk at a time.
     CHUNK_SIZE = 50*1024
-
-    def _loop(self, fire_when_done):
-        # this slightly weird structure is needed because Deferreds don't do
-        # tail-recursion, so it is important to let each one retire promptly.
-        # Simply chaining them will cause a stack overflow at the end of a
-        # transfer that involves more than a few hundred chunks.
-        # 'fire_when_done' lives a long time, but the Deferreds returned by
-        # the inner _fetch() call do not.
-        start = time.time()
-        d = defer.maybeDeferred(self._fetch)
-        def _done(finished):
-            elapsed = time.time() - start
-            self._times["cumulative_fetch"] += elapsed
-            if finished:
-                self.log("finished reading ciphertext", level=log.NOISY)
-                fire_when_done.callback(None)
-            else:
-                self._loop(fire_when_done)
-        def _err(f):
+    READER_VERSION_DEFAULTS = {
+        "http://allmydata.org/tahoe/protocols/helper/encrypted-uploadable/v1" :
+        { "pipelined-reads": False },
+        "application-version": "unknown: no get_version()",
+        }
+
+    def _reset_window(self):
+        # maps offset to (length, reader) for each outstanding request
+        self._pending = {}
+        # maps offset to the data that arrived before the data preceding it
+        self._received = {}
+        self._next_offset = self._have
+
+    def _get_window(self, reader):
+        v1 = reader.version["http://allmydata.org/tahoe/protocols/helper/encrypted-uploadable/v1"]
+        if v1.get("pipelined-reads"):
+            return max(1, self._upload_helper._helper.fetch_window)
+        return 1
+
+    def _fetch_more(self):
+        if self._have == self._expected_size:
+            self._upload_helper._upload_status.set_progress(1, 1.0)
+            self._times["cumulative_fetch"] += time.time() - self._fetch_started
+            self.log("finished reading ciphertext", level=log.NOISY)
+            self._fetch_done.callback(None)
+            return
+        if not self._readers:
+            f = Failure(NotEnoughWritersError("ran out of assisted uploaders, last failure was %s" % self._last_failure))
             self.log(format="[%(si)s] ciphertext read failed",
                      si=self._upload_id, failure=f, level=log.UNUSUAL)
-            fire_when_done.errback(f)
-        d.addCallbacks(_done, _err)
-        return None
-
-    def _fetch(self):
-        needed = self._expected_size - self._have
-        fetch_size = min(needed, self.CHUNK_SIZE)
-        if fetch_size == 0:
-            self._upload_helper._upload_status.set_progress(1, 1.0)
-            return True # all done
-        percent = 0.0
+            self._fetch_done.errback(f)
+            return
+        reader = self._readers[0]
+        if not hasattr(reader, "version"):
+            d = add_version_to_remote_reference(reader,
+                                                self.READER_VERSION_DEFAULTS)
+            d.addCallbacks(lambda ign: self._fetch_more(),
+                           self._read_failed, errbackArgs=(reader,))
+            d.addErrback(self._fetch_done.errback)
+            return
+        window = self._get_window(reader)
+        while (len(self._pending) < window
+               and self._next_offset < self._expected_size):
+            offset = self._next_offset
+            length = min(self.CHUNK_SIZE, self._expected_size - offset)
+            self._next_offset += length
+            self._pending[offset] = (length, reader)
+            self._request(reader, offset, length)
+
+    def _request(self, reader, offset, length):
+        self.log(format="fetching [%(si)s] %(start)d-%(end)d of %(total)d",
+                 si=self._upload_id, start=offset, end=offset+length,
+                 total=self._expected_size, level=log.NOISY)
+        d = reader.callRemote("read_encrypted", offset, length)
+        d.addCallbacks(self._got_data, self._read_failed,
+                       callbackArgs=(reader, offset),
+                       errbackArgs=(reader,))
+        d.addErrback(self._fetch_done.errback)
+
+    def _got_data(self, ciphertext_v, reader, offset):
+        if self._pending.get(offset, (None, None))[1] is not reader:
+            return # we gave up on this reader while the request was out
+        (length, reader) = self._pending.pop(offset)
+        data = "".join(ciphertext_v)
+        if len(data) != length:
+            e = ValueError("asked for %d bytes at %d, got %d"
+                           % (length, offset, len(data)))
+            self._read_failed(Failure(e), reader)
+            return
+        self._received[offset] = data
+        while self._have in self._received:
+            data = self._received.pop(self._have)
+            self._f.write(data)
+            self._have += len(data)
+            self._ciphertext_fetched += len(data)
+            self._upload_helper._helper.count("chk_upload_helper.fetched_bytes", len(data))
         if self._expected_size:
-            percent = 1.0 * (self._have+fetch_size) / self._expected_size
-        self.log(format="fetching [%(si)s] %(start)d-%(end)d of %(total)d (%(percent)d%%)",
-                 si=self._upload_id,
-                 start=self._have,
-                 end=self._have+fetch_size,
-                 total=self._expected_size,
-                 percent=int(100.0*percent),
-                 level=log.NOISY)
-        d = self.call("read_encrypted", self._have, fetch_size)
-        def _got_data(ciphertext_v):
-            for data in ciphertext_v:
-                self._f.write(data)
-                self._have += len(data)
-                self._ciphertext_fetched += len(data)
-                self._upload_helper._helper.count("chk_upload_helper.fetched_bytes", len(data))
-                self._upload_helper._upload_status.set_progress(1, percent)
-            return False # not done
-        d.addCallback(_got_data)
-        return d
+            percent = 1.0 * self._have / self._expected_size
+            self._upload_helper._upload_status.set_progress(1, percent)
+        self._fetch_more()
+
+    def _read_failed(self, f, reader):
+        if reader not in self._readers:
+            return # we have already given up on it
+        self._last_failure = f
+        self._readers.remove(reader)
+        self._upload_helper.log("call to assisted uploader %s failed" % reader,
+                                failure=f, level=log.UNUSUAL)
+        # we can try again with someone else who's left, starting from the
+        # first byte that we do not have on disk
+        self._reset_window()
+        self._fetch_more()
 
     def _done(self, res):
         self._f.close()
@@ -493,9 +628,14 @@ class Helper(Referenceable):
                 }
     chk_upload_helper_class = CHKUploadHelper
     MAX_UPLOAD_STATUSES = 10
+    # how many ciphertext reads each upload may have outstanding
+    DEFAULT_FETCH_WINDOW = 8
+    # how many uploads may be encoding (and pushing shares) at once
+    DEFAULT_MAX_ENCODES = 4
 
     def __init__(self, basedir, storage_broker, secret_holder,
-                 stats_provider, history):
+                 stats_provider, history, fetch_window=None,
+                 max_encodes=None, max_temp_space=None):
         self._basedir = basedir
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
@@ -503,7 +643,20 @@ class Helper(Referenceable):
         self._chk_encoding = os.path.join(basedir, "CHK_encoding")
         fileutil.make_dirs(self._chk_incoming)
         fileutil.make_dirs(self._chk_encoding)
+        self.fetch_window = fetch_window or self.DEFAULT_FETCH_WINDOW
+        # an upload reserves space for all of its ciphertext before it
+        # starts fetching it, and keeps it until the upload is done. Then
+        # it waits for an encoding slot. Uploads that have to wait for
+        # either are taken in turn from each client.
+        self.fetch_queue = AdmissionQueue(max_temp_space)
+        self.encode_queue = AdmissionQueue(max_encodes
+                                           or self.DEFAULT_MAX_ENCODES)
+        # uploads are keyed by storage index, so a client that asks for a
+        # file which someone else is already uploading (or which we are
+        # already checking the grid for) is attached to the same upload,
+        # and its ciphertext is not fetched a second time
         self._active_uploads = {}
+        self._pending_checks = {} # maps storage index to OneShotObserverList
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         self.stats_provider = stats_provider
         if stats_provider:
@@ -511,6 +664,7 @@ class Helper(Referenceable):
         self._counters = {"chk_upload_helper.upload_requests": 0,
                           "chk_upload_helper.upload_already_present": 0,
                           "chk_upload_helper.upload_need_upload": 0,
+                          "chk_upload_helper.upload_joined": 0,
                           "chk_upload_helper.resumes": 0,
                           "chk_upload_helper.fetched_bytes": 0,
                           "chk_upload_helper.encoded_bytes": 0,
@@ -557,7 +711,20 @@ class Helper(Referenceable):
                   'chk_upload_helper.encoding_count': enc_count,
                   'chk_upload_helper.encoding_size': enc_size,
                   'chk_upload_helper.encoding_size_old': enc_size_old,
+                  'chk_upload_helper.temp_space_reserved': self.fetch_queue.used,
+                  'chk_upload_helper.fetch_queue_length':
+                  self.fetch_queue.get_queue_length(),
+                  'chk_upload_helper.active_encodes': self.encode_queue.used,
+                  'chk_upload_helper.encode_queue_length':
+                  self.encode_queue.get_queue_length(),
                   }
+        for (name, queue) in [("fetch", self.fetch_queue),
+                              ("encode", self.encode_queue)]:
+            waits = queue.wait_times
+            stats['chk_upload_helper.%s_wait_mean' % name] = waits.get_mean()
+            stats['chk_upload_helper.%s_wait_90_0_percentile' % name] = \
+                waits.get_percentile(0.9)
+            stats['chk_upload_helper.%s_wait_max' % name] = waits.max
         stats.update(self._counters)
         return stats
 
@@ -574,8 +741,24 @@ class Helper(Referenceable):
         encoding_file = os.path.join(self._chk_encoding, si_s)
         if storage_index in self._active_uploads:
             self.log("upload is currently active", parent=lp)
+            self.count("chk_upload_helper.upload_joined")
             uh = self._active_uploads[storage_index]
             return uh.start()
+        if storage_index in self._pending_checks:
+            # someone else asked about this file a moment ago: share their
+            # answer
+            self.log("existence check is currently active", parent=lp)
+            d = self._pending_checks[storage_index].when_fired()
+            def _join(res):
+                (results, uh) = res
+                if uh is None:
+                    return res # already in the grid
+                self.count("chk_upload_helper.upload_joined")
+                return uh.start()
+            d.addCallback(_join)
+            return d
+        checked = observer.OneShotObserverList()
+        self._pending_checks[storage_index] = checked
 
         d = self._check_for_chk_already_in_grid(storage_index, r, lp)
         def _checked(already_present):
@@ -613,6 +796,11 @@ class Helper(Referenceable):
                      failure=f, level=log.WEIRD, parent=lp, umid="jDtxZg")
             return f
         d.addErrback(_err)
+        def _done(res):
+            del self._pending_checks[storage_index]
+            checked.fire(res)
+            return res
+        d.addBoth(_done)
         return d
 
     def _check_for_chk_already_in_grid(self, storage_index, results, lp):
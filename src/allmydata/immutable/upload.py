@@ -5,6 +5,8 @@ from twisted.internet import defer
 from twisted.application import service
 from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually
 
+import allmydata # for __full_version__
+
 from allmydata.util.hashutil import file_renewal_secret_hash, \
      file_cancel_secret_hash, bucket_renewal_secret_hash, \
      bucket_cancel_secret_hash, plaintext_hasher, \
@@ -13,11 +15,12 @@ from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
 from allmydata.util import base32, dictutil, idlib, log, mathutil
-from allmydata.util.happinessutil import servers_of_happiness, \
+from allmydata.util.happinessutil import HappinessMatching, \
                                          shares_by_server, merge_servers, \
                                          failure_message
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.limiter import ConcurrencyLimiter
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
@@ -112,6 +115,23 @@ class ServerTracker:
         d.addCallback(self._got_reply)
         return d
 
+    def check_full(self):
+        # An empty allocate_buckets() reply can also mean that the server is
+        # already receiving these shares from another upload, so only
+        # remember the refusal if the server says it lacks the space.
+        rref = self._server.get_rref()
+        d = rref.callRemote("get_version")
+        def _got_version(version):
+            v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            if v1["maximum-immutable-share-size"] < self.allocated_size:
+                self._server.note_share_refused(self.allocated_size)
+        d.addCallback(_got_version)
+        def _failed(f):
+            log.msg("error while checking for a full server",
+                    failure=f, level=log.UNUSUAL, umid="Jm5tIQ")
+        d.addErrback(_failed)
+        return d
+
     def ask_about_existing_shares(self):
         rref = self._server.get_rref()
         return rref.callRemote("get_buckets", self.storage_index)
@@ -151,6 +171,8 @@ def str_shareloc(shnum, bucketwriter):
     return "%s: %s" % (shnum, bucketwriter.get_servername(),)
 
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
+    # how many allocate_buckets queries we send at once
+    MAX_PARALLEL_QUERIES = 10
 
     def __init__(self, upload_id, logparent=None, upload_status=None):
         self.upload_id = upload_id
@@ -191,6 +213,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.use_trackers = set() # ServerTrackers that have shares assigned
                                   # to them
         self.preexisting_shares = {} # shareid => set(serverids) holding shareid
+        # the servers_of_happiness of preexisting_shares plus the shares
+        # assigned to use_trackers, kept up to date as they change
+        self._happiness = HappinessMatching()
 
         # These servers have shares -- any shares -- for our SI. We keep
         # track of these to write an error message with them later.
@@ -215,13 +240,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         # filter the list of servers according to which ones can accomodate
         # this request. This excludes older servers (which used a 4-byte size
         # field) from getting large shares (for files larger than about
-        # 12GiB). See #439 for details.
-        def _get_maxsize(server):
-            v0 = server.get_rref().version
-            v1 = v0["http://allmydata.org/tahoe/protocols/storage/v1"]
-            return v1["maximum-immutable-share-size"]
+        # 12GiB), see #439 for details, and servers that have recently told
+        # us (or some other upload) that they are full.
         writeable_servers = [server for server in all_servers
-                            if _get_maxsize(server) >= allocated_size]
+                            if server.get_available_space() >= allocated_size]
         readonly_servers = set(all_servers[:2*total_shares]) - set(writeable_servers)
 
         # decide upon the renewal/cancel secrets, to include them in the
@@ -311,6 +333,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     level=log.NOISY)
             for bucket in buckets:
                 self.preexisting_shares.setdefault(bucket, set()).add(serverid)
+                self._happiness.add(bucket, serverid)
                 self.homeless_shares.discard(bucket)
             self.full_count += 1
             self.bad_query_count += 1
@@ -339,7 +362,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
     def _loop(self):
         if not self.homeless_shares:
             merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._happiness.get_happiness()
             if self.servers_of_happiness <= effective_happiness:
                 msg = ("server selection successful for %s: %s: pretty_print_merged: %s, "
                        "self.use_trackers: %s, self.preexisting_shares: %s") \
@@ -382,9 +405,14 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                             self.preexisting_shares[share].remove(server)
                             if not self.preexisting_shares[share]:
                                 del self.preexisting_shares[share]
+                            self._placement_removed(share, server)
                             items.append((server, sharelist))
                         for writer in self.use_trackers:
+                            aborted = self.homeless_shares & set(writer.buckets)
                             writer.abort_some_buckets(self.homeless_shares)
+                            for share in aborted:
+                                self._placement_removed(share,
+                                                        writer.get_serverid())
                     return self._loop()
                 else:
                     # Redistribution won't help us; fail.
@@ -404,44 +432,51 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     return self._failed("%s (%s)" % (failmsg, self._get_progress_message()))
 
         if self.first_pass_trackers:
-            tracker = self.first_pass_trackers.pop(0)
-            # TODO: don't pre-convert all serverids to ServerTrackers
-            assert isinstance(tracker, ServerTracker)
-
-            shares_to_ask = set(sorted(self.homeless_shares)[:1])
-            self.homeless_shares -= shares_to_ask
-            self.query_count += 1
-            self.num_servers_contacted += 1
+            # ask each of the next few servers to hold a single share, all
+            # at once
+            num_queries = min(len(self.homeless_shares),
+                              len(self.first_pass_trackers),
+                              self.MAX_PARALLEL_QUERIES)
+            trackers = self.first_pass_trackers[:num_queries]
+            del self.first_pass_trackers[:num_queries]
+            queries = []
+            for tracker in trackers:
+                # TODO: don't pre-convert all serverids to ServerTrackers
+                assert isinstance(tracker, ServerTracker)
+                shares_to_ask = set(sorted(self.homeless_shares)[:1])
+                self.homeless_shares -= shares_to_ask
+                self.num_servers_contacted += 1
+                queries.append((tracker, shares_to_ask))
             if self._status:
                 self._status.set_status("Contacting Servers [%s] (first query),"
                                         " %d shares left.."
-                                        % (tracker.get_name(),
+                                        % (",".join([t.get_name()
+                                                     for (t,s) in queries]),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
-            d.addBoth(self._got_response, tracker, shares_to_ask,
-                      self.second_pass_trackers)
-            return d
+            return self._send_queries(queries, self.second_pass_trackers)
         elif self.second_pass_trackers:
-            # ask a server that we've already asked.
+            # ask servers that we've already asked, spreading the remaining
+            # shares evenly over them
             if not self._started_second_pass:
                 self.log("starting second pass",
                         level=log.NOISY)
                 self._started_second_pass = True
-            num_shares = mathutil.div_ceil(len(self.homeless_shares),
-                                           len(self.second_pass_trackers))
-            tracker = self.second_pass_trackers.pop(0)
-            shares_to_ask = set(sorted(self.homeless_shares)[:num_shares])
-            self.homeless_shares -= shares_to_ask
-            self.query_count += 1
+            queries = []
+            while (self.homeless_shares and self.second_pass_trackers
+                   and len(queries) < self.MAX_PARALLEL_QUERIES):
+                num_shares = mathutil.div_ceil(len(self.homeless_shares),
+                                               len(self.second_pass_trackers))
+                tracker = self.second_pass_trackers.pop(0)
+                shares_to_ask = set(sorted(self.homeless_shares)[:num_shares])
+                self.homeless_shares -= shares_to_ask
+                queries.append((tracker, shares_to_ask))
             if self._status:
                 self._status.set_status("Contacting Servers [%s] (second query),"
                                         " %d shares left.."
-                                        % (tracker.get_name(),
+                                        % (",".join([t.get_name()
+                                                     for (t,s) in queries]),
                                            len(self.homeless_shares)))
-            d = tracker.query(shares_to_ask)
-            d.addBoth(self._got_response, tracker, shares_to_ask,
-                      self.next_pass_trackers)
-            return d
+            return self._send_queries(queries, self.next_pass_trackers)
         elif self.next_pass_trackers:
             # we've finished the second-or-later pass. Move all the remaining
             # servers back into self.second_pass_trackers for the next pass.
@@ -451,7 +486,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         else:
             # no more servers. If we haven't placed enough shares, we fail.
             merged = merge_servers(self.preexisting_shares, self.use_trackers)
-            effective_happiness = servers_of_happiness(merged)
+            effective_happiness = self._happiness.get_happiness()
             if effective_happiness < self.servers_of_happiness:
                 msg = failure_message(len(self.serverids_with_shares),
                                       self.needed_shares,
@@ -472,6 +507,26 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.log(msg, level=log.OPERATIONAL)
                 return (self.use_trackers, self.preexisting_shares)
 
+    def _send_queries(self, queries, put_tracker_here):
+        # 'queries' is a list of (tracker, shares_to_ask). Servers that
+        # accept everything we ask of them are added to put_tracker_here,
+        # and we go around the loop again once they have all answered.
+        ds = []
+        for (tracker, shares_to_ask) in queries:
+            self.query_count += 1
+            d = tracker.query(shares_to_ask)
+            d.addBoth(self._got_response, tracker, shares_to_ask,
+                      put_tracker_here)
+            ds.append(d)
+        dl = defer.DeferredList(ds)
+        def _answered(results):
+            for (success, res) in results:
+                if not success:
+                    return res
+            return self._loop()
+        dl.addCallback(_answered)
+        return dl
+
     def _got_response(self, res, tracker, shares_to_ask, put_tracker_here):
         if isinstance(res, failure.Failure):
             # This is unusual, and probably indicates a bug or a network
@@ -501,8 +556,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                        tuple(sorted(alreadygot)), tuple(sorted(allocated))),
                     level=log.NOISY)
             progress = False
+            checked = None
             for s in alreadygot:
                 self.preexisting_shares.setdefault(s, set()).add(tracker.get_serverid())
+                self._happiness.add(s, tracker.get_serverid())
                 if s in self.homeless_shares:
                     self.homeless_shares.remove(s)
                     progress = True
@@ -513,6 +570,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             # that peer. We just have to remember to use them.
             if allocated:
                 self.use_trackers.add(tracker)
+                for s in allocated:
+                    self._happiness.add(s, tracker.get_serverid())
                 progress = True
 
             if allocated or alreadygot:
@@ -530,6 +589,10 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             else:
                 self.bad_query_count += 1
                 self.full_count += 1
+                if not alreadygot:
+                    # they may have no room for shares this big: if so,
+                    # don't bother asking them again for a while
+                    checked = tracker.check_full()
 
             if still_homeless:
                 # In networks with lots of space, this is very unusual and
@@ -548,10 +611,19 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 # if they *were* able to accept everything, they might be
                 # willing to accept even more.
                 put_tracker_here.append(tracker)
+            return checked
 
-        # now loop
-        return self._loop()
 
+    def _placement_removed(self, shnum, serverid):
+        # shnum has been taken out of preexisting_shares, or its bucket has
+        # been aborted, for serverid. Unless the other one still puts it on
+        # that server, it no longer counts towards our happiness.
+        if serverid in self.preexisting_shares.get(shnum, ()):
+            return
+        for tracker in self.use_trackers:
+            if tracker.get_serverid() == serverid and shnum in tracker.buckets:
+                return
+        self._happiness.remove(shnum, serverid)
 
     def _failed(self, msg):
         """
@@ -1051,9 +1123,16 @@ class LiteralUploader:
 
 class RemoteEncryptedUploadable(Referenceable):
     implements(RIEncryptedUploadable)
+    VERSION = { "http://allmydata.org/tahoe/protocols/helper/encrypted-uploadable/v1" :
+                 { "pipelined-reads": True },
+                "application-version": str(allmydata.__full_version__),
+                }
 
     def __init__(self, encrypted_uploadable, upload_status):
         self._eu = IEncryptedUploadable(encrypted_uploadable)
+        # the helper may have several reads outstanding, but we can only
+        # handle them one at a time, since we read (and hash) sequentially
+        self._read_limiter = ConcurrencyLimiter(1)
         self._offset = 0
         self._bytes_sent = 0
         self._status = IUploadStatus(upload_status)
@@ -1071,6 +1150,8 @@ class RemoteEncryptedUploadable(Referenceable):
         d.addCallback(_got_size)
         return d
 
+    def remote_get_version(self):
+        return self.VERSION
     def remote_get_size(self):
         return self.get_size()
     def remote_get_all_encoding_parameters(self):
@@ -1089,6 +1170,9 @@ class RemoteEncryptedUploadable(Referenceable):
         return d
 
     def remote_read_encrypted(self, offset, length):
+        return self._read_limiter.add(self._read_encrypted_at, offset, length)
+
+    def _read_encrypted_at(self, offset, length):
         # we don't support seek backwards, but we allow skipping forwards
         precondition(offset >= 0, offset)
         precondition(length >= 0, length)
@@ -363,11 +363,84 @@ class IStorageBucketReader(Interface):
         @return: URIExtensionData
         """
 
+class IStorageBackend(Interface):
+    """I decide where and how a StorageServer keeps its shares. Immutable
+    share objects provide sharetype="immutable", read_share_data(offset,
+    length), get_leases(), add_lease(lease_info), renew_lease(renew_secret,
+    new_expire_time), add_or_renew_lease(lease_info), cancel_lease(
+    cancel_secret), and unlink(). Mutable share objects are
+    MutableShareFile-like, and add readv(), writev(), check_testv() and
+    check_write_enabler().
+
+    I provide the following attributes: 'sharedir', where the share crawlers
+    look for bucket directories, and 'incomingdir', where partially-written
+    shares are kept."""
+
+    def get_shares(storage_index, parent=None):
+        """Yield (shnum, share) for each share (mutable or immutable) that I
+        hold for this storage index, skipping anything that is not a share.
+        'parent' is used for logging by mutable shares."""
+
+    def get_immutable_shares(storage_index):
+        """Yield (shnum, share) for each immutable share that I hold for
+        this storage index. A share with an unknown container version causes
+        UnknownImmutableContainerVersionError to be raised."""
+
+    def is_receiving(storage_index, shnum):
+        """Return True if a BucketWriter is still writing this share."""
+
+    def make_bucket_writer(ss, storage_index, shnum, max_size, lease_info,
+                           canary):
+        """Return a new BucketWriter (a RIBucketWriter) which will store a
+        new immutable share of up to max_size bytes, with the given lease,
+        and will tell the StorageServer 'ss' when it has been closed."""
+
+    def get_mutable_shares(storage_index, parent=None):
+        """Return a dict mapping shnum to mutable share object for each
+        share that I hold for this storage index."""
+
+    def create_mutable_share(storage_index, shnum, my_nodeid,
+                             write_enabler, parent=None):
+        """Create and return an empty mutable share object."""
+
+    def remove_empty_bucket(storage_index):
+        """Clean up after the last mutable share of a storage index has been
+        deleted."""
+
+    def list_packed_buckets(prefix):
+        """Return a sorted list of the base32-encoded storage indexes, which
+        start with the two-character 'prefix', for which I hold shares that
+        are not kept in a bucket directory below 'sharedir'. The share
+        crawlers visit these as well as the bucket directories."""
+
+    def get_packed_shares(storage_index):
+        """Return a list of (shnum, share) for the immutable shares of this
+        storage index that are not kept in a bucket directory below
+        'sharedir'. Each share also provides get_length(), the number of
+        bytes of share data it holds."""
+
+    def flush():
+        """Make every share that has been closed durable now, rather than
+        at the next group commit. Called when the StorageServer stops."""
+
+    def compact(max_bytes=None):
+        """Give the space of deleted shares back to the filesystem, if they
+        left any behind, copying about 'max_bytes' bytes of share data at
+        most (or as much as it takes, if None). Return a tuple of (bytes
+        copied, bytes given back). Called by the lease checker after each
+        bucket, which charges the copying to its I/O budget."""
+
 class IStorageBroker(Interface):
     def get_servers_for_psi(peer_selection_index):
         """
         @return: list of IServer instances
         """
+    def iter_servers_for_psi(peer_selection_index):
+        """
+        @return: an iterator over the same IServer instances, in the same
+        order, as get_servers_for_psi() would return, which may be cheaper
+        when only the first few are needed
+        """
     def get_connected_servers():
         """
         @return: frozenset of connected IServer instances
@@ -1184,13 +1257,22 @@ class IDirectoryNode(IFilesystemNode):
         If this directory node is read-only, the Deferred will errback with a
         NotWriteableError."""
 
-    def set_children(entries, overwrite=True):
+    def set_children(entries, overwrite=True, deletes=(), renames=()):
         """Add multiple children (by writecap+readcap) to a directory node.
         Takes a dictionary, with childname as keys and (writecap, readcap)
         tuples (or (writecap, readcap, metadata) triples) as values. Returns
         a Deferred that fires (with this dirnode) when the operation
         finishes. This is equivalent to calling set_uri() multiple times, but
         is much more efficient. All child names must be unicode strings.
+
+        The same operation can also remove and rename children. 'deletes' is
+        a list of child names to remove, and 'renames' is a list of
+        (old_name, new_name) pairs; a renamed child keeps its metadata.
+        Renames are applied first (in order), then deletions, then
+        additions, and the whole batch is published at once. If a name to be
+        deleted or renamed does not exist, the Deferred errbacks with
+        NoSuchChildError and nothing is changed. 'overwrite' applies to the
+        targets of renames as well as to added children.
         """
 
     def set_node(name, child, metadata=None, overwrite=True):
@@ -1211,13 +1293,13 @@ class IDirectoryNode(IFilesystemNode):
         If this directory node is read-only, the Deferred will errback with a
         NotWriteableError."""
 
-    def set_nodes(entries, overwrite=True):
+    def set_nodes(entries, overwrite=True, deletes=(), renames=()):
         """Add multiple children to a directory node. Takes a dict mapping
         unicode childname to (child_node, metdata) tuples. If metdata=None,
         the original metadata is left unmodified. Returns a Deferred that
         fires (with this dirnode) when the operation finishes. This is
         equivalent to calling set_node() multiple times, but is much more
-        efficient."""
+        efficient. 'deletes' and 'renames' are as for set_children()."""
 
     def add_file(name, uploadable, metadata=None, overwrite=True):
         """I upload a file (using the given IUploadable), then attach the
@@ -1252,7 +1334,10 @@ class IDirectoryNode(IFilesystemNode):
         'new_child_name', which defaults to 'current_child_name'. TODO: what
         should we do about metadata? I return a Deferred that fires when the
         operation finishes. The child name must be a unicode string. I raise
-        NoSuchChildError if I do not have a child by that name."""
+        NoSuchChildError if I do not have a child by that name.
+
+        If new_parent is this directory, the child is renamed (keeping its
+        metadata) with a single atomic update."""
 
     def build_manifest():
         """I generate a table of everything reachable from this directory.
@@ -1315,6 +1400,37 @@ class IDirectoryNode(IFilesystemNode):
         takes several minutes of 100% CPU for ~1700 directories).
         """
 
+    def start_copy_tree(mutable=True, mutable_version=None):
+        """Copy everything reachable from this directory, and return a
+        Monitor for the operation.
+
+        Immutable files and immutable directories are shared with the
+        original (their caps are simply linked into the copy), and the
+        current contents of each mutable file are uploaded as a new immutable
+        file. Every other directory is recreated once its children have been
+        copied: as a new mutable directory (of the given mutable_version, or
+        the default), or, if mutable=False, as an immutable directory, which
+        makes the copy a frozen snapshot of the tree. A directory that is
+        reachable more than once is only copied once.
+
+        The Monitor's results will be a dictionary with the following keys::
+
+           root: the cap of the new top-level directory (None until done)
+           mutable: whether the copied directories are mutable
+           count-files-linked: immutable files shared with the original
+           count-files-copied: mutable files uploaded as immutable files
+           count-directories-linked: immutable directories shared with the
+                                     original
+           count-directories-created: new directories, including the root
+           count-unknown-linked: unrecognized objects linked into the copy
+           count-skipped: unrecognized objects that are not allowed in an
+                          immutable directory, and directories that contain
+                          themselves, which were left out of the copy
+
+        The Monitor will also have an .origin_si attribute with the (binary)
+        storage index of the starting point.
+        """
+
 class ICodecEncoder(Interface):
     def set_params(data_size, required_shares, max_shares):
         """Set up the parameters of this encoder.
@@ -2604,6 +2720,14 @@ UploadResults = Any() #DictOf(str, str)
 class RIEncryptedUploadable(RemoteInterface):
     __remote_name__ = "RIEncryptedUploadable.tahoe.allmydata.com"
 
+    def get_version():
+        """
+        Return a dictionary of version information. Uploadables which
+        set 'pipelined-reads' may be sent several read_encrypted() calls
+        without waiting for the answers, and will answer them in order.
+        """
+        return DictOf(str, Any())
+
     def get_size():
         return Offset
 
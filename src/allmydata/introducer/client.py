@@ -1,4 +1,6 @@
 
+import time
+import simplejson
 from base64 import b32decode
 from zope.interface import implements
 from twisted.application import service
@@ -6,17 +8,25 @@ from foolscap.api import Referenceable, SturdyRef, eventually
 from allmydata.interfaces import InsufficientVersionError
 from allmydata.introducer.interfaces import RIIntroducerSubscriberClient, \
      IIntroducerClient
-from allmydata.util import log, idlib
+from allmydata.util import log, idlib, fileutil
 from allmydata.util.rrefutil import add_version_to_remote_reference, trap_deadref
 
 
 class IntroducerClient(service.Service, Referenceable):
     implements(RIIntroducerSubscriberClient, IIntroducerClient)
 
+    # cached announcements that the introducer has not told us about again
+    # are forgotten after this long
+    CACHE_LIFETIME = 7*24*60*60
+
     def __init__(self, tub, introducer_furl,
-                 nickname, my_version, oldest_supported):
+                 nickname, my_version, oldest_supported, cache_filename=None):
         self._tub = tub
         self.introducer_furl = introducer_furl
+        # if set, we remember the announcements we receive in this file, and
+        # hand them to our subscribers as soon as we start, before the
+        # introducer has told us anything
+        self._cache_filename = cache_filename
 
         assert type(nickname) is unicode
         self._nickname_utf8 = nickname.encode("utf-8") # we always send UTF-8
@@ -30,6 +40,10 @@ class IntroducerClient(service.Service, Referenceable):
         self._local_subscribers = [] # (servicename,cb,args,kwargs) tuples
         self._subscribed_service_names = set()
         self._subscriptions = set() # requests we've actually sent
+        # for introducers that offer delta subscriptions, this maps service
+        # name to the last AnnouncementVersion we got for it, so that when
+        # we reconnect we only need to hear about what has changed since.
+        self._announcement_versions = {}
 
         # _current_announcements remembers one announcement per
         # (servicename,serverid) pair. Anything that arrives with the same
@@ -38,6 +52,13 @@ class IntroducerClient(service.Service, Referenceable):
         # distinguish re-announcement from updates. It also provides memory
         # for clients who subscribe after startup.
         self._current_announcements = {}
+        # and this holds the announcement tuples that they were unpacked
+        # from, which is what we write to the cache
+        self._raw_announcements = {}
+        # the announcements that we loaded from the cache and have not heard
+        # about from the introducer since, mapped to the last time that we
+        # did hear about them
+        self._unconfirmed = {}
 
         self.encoding_parameters = None
 
@@ -54,6 +75,7 @@ class IntroducerClient(service.Service, Referenceable):
 
     def startService(self):
         service.Service.startService(self)
+        self._load_cache()
         self._introducer_error = None
         rc = self._tub.connectTo(self.introducer_furl, self._got_introducer)
         self._introducer_reconnector = rc
@@ -119,12 +141,20 @@ class IntroducerClient(service.Service, Referenceable):
             self.log("want to subscribe, but no introducer yet",
                      level=log.NOISY)
             return
+        v1 = self._publisher.version["http://allmydata.org/tahoe/protocols/introducer/v1"]
         for service_name in self._subscribed_service_names:
             if service_name not in self._subscriptions:
                 # there is a race here, but the subscription desk ignores
                 # duplicate requests.
                 self._subscriptions.add(service_name)
-                d = self._publisher.callRemote("subscribe", self, service_name)
+                if v1.get("delta-subscriptions"):
+                    last_seen = self._announcement_versions.get(service_name,
+                                                                ("", 0))
+                    d = self._publisher.callRemote("subscribe_delta", self,
+                                                   service_name, last_seen)
+                else:
+                    d = self._publisher.callRemote("subscribe", self,
+                                                   service_name)
                 d.addErrback(trap_deadref)
                 d.addErrback(log.err, format="server errored during subscribe",
                              facility="tahoe.introducer",
@@ -147,6 +177,23 @@ class IntroducerClient(service.Service, Referenceable):
 
 
     def remote_announce(self, announcements):
+        self._process_announcements(announcements)
+        self._save_cache()
+
+    def remote_announce_delta(self, service_name, announcements, version):
+        self._process_announcements(announcements)
+        old_version = self._announcement_versions.get(service_name)
+        if old_version and old_version[0] == version[0]:
+            # this is the introducer we heard from before (perhaps in an
+            # earlier run), and it has only told us about the changes since
+            # then, so all the rest of what we know is still current
+            for index in self._unconfirmed.keys():
+                if index[0] == service_name:
+                    del self._unconfirmed[index]
+        self._announcement_versions[service_name] = version
+        self._save_cache()
+
+    def _process_announcements(self, announcements):
         self.log("received %d announcements" % len(announcements))
         self._debug_counts["inbound_message"] += 1
         for ann in announcements:
@@ -170,6 +217,24 @@ class IntroducerClient(service.Service, Referenceable):
             return
         self.log("announcement for [%s]: %s" % (service_name, ann),
                  umid="BoKEag")
+        (index, ann_d) = self._unpack_announcement(ann)
+        nodeid_s = idlib.shortnodeid_b2a(index[1])
+        self._unconfirmed.pop(index, None)
+        if self._current_announcements.get(index, None) == ann_d:
+            self.log("reannouncement for [%(service)s]:%(nodeid)s, ignoring",
+                     service=service_name, nodeid=nodeid_s,
+                     level=log.UNUSUAL, umid="B1MIdA")
+            self._debug_counts["duplicate_announcement"] += 1
+            return
+        if index in self._current_announcements:
+            self._debug_counts["update"] += 1
+        else:
+            self._debug_counts["new_announcement"] += 1
+
+        self._add_announcement(index, ann_d, ann)
+
+    def _unpack_announcement(self, ann):
+        (furl, service_name, ri_name, nickname_utf8, ver, oldest) = ann
         assert type(furl) is str
         assert type(service_name) is str
         assert type(ri_name) is str
@@ -180,7 +245,6 @@ class IntroducerClient(service.Service, Referenceable):
         assert type(oldest) is str
 
         nodeid = b32decode(SturdyRef(furl).tubID.upper())
-        nodeid_s = idlib.shortnodeid_b2a(nodeid)
 
         ann_d = { "version": 0,
                   "service-name": service_name,
@@ -193,23 +257,74 @@ class IntroducerClient(service.Service, Referenceable):
                   }
 
         index = (service_name, nodeid)
-        if self._current_announcements.get(index, None) == ann_d:
-            self.log("reannouncement for [%(service)s]:%(nodeid)s, ignoring",
-                     service=service_name, nodeid=nodeid_s,
-                     level=log.UNUSUAL, umid="B1MIdA")
-            self._debug_counts["duplicate_announcement"] += 1
-            return
-        if index in self._current_announcements:
-            self._debug_counts["update"] += 1
-        else:
-            self._debug_counts["new_announcement"] += 1
+        return (index, ann_d)
 
+    def _add_announcement(self, index, ann_d, ann):
         self._current_announcements[index] = ann_d
+        self._raw_announcements[index] = ann
         # note: we never forget an index, but we might update its value
 
         for (service_name2,cb,args,kwargs) in self._local_subscribers:
-            if service_name2 == service_name:
-                eventually(cb, nodeid, ann_d, *args, **kwargs)
+            if service_name2 == index[0]:
+                eventually(cb, index[1], ann_d, *args, **kwargs)
+
+    def _load_cache(self):
+        if not self._cache_filename:
+            return
+        try:
+            cache = simplejson.loads(fileutil.read(self._cache_filename))
+        except EnvironmentError:
+            return # we have never been told about any servers
+        except ValueError:
+            self.log("announcement cache %s is corrupt, ignoring"
+                     % (self._cache_filename,), level=log.WEIRD,
+                     umid="hJCrKg")
+            return
+        for (service_name, version) in cache["versions"].items():
+            if service_name.encode("utf-8") not in self._announcement_versions:
+                self._announcement_versions[service_name.encode("utf-8")] = \
+                    (version[0].encode("utf-8"), version[1])
+        for (ann, when) in cache["announcements"]:
+            (furl, service_name, ri_name, nickname, ver, oldest) = ann
+            ann = (furl.encode("utf-8"), service_name.encode("utf-8"),
+                   ri_name.encode("utf-8"), nickname.encode("utf-8"),
+                   ver.encode("utf-8"), oldest.encode("utf-8"))
+            try:
+                (index, ann_d) = self._unpack_announcement(ann)
+            except:
+                log.err(format="unable to use cached announcement %(ann)s",
+                        ann=ann, level=log.WEIRD, umid="Tqv3Ng")
+                continue
+            if index in self._current_announcements:
+                continue # the introducer beat us to it
+            self._unconfirmed[index] = when
+            self._add_announcement(index, ann_d, ann)
+        self.log("loaded %d cached announcements" % len(self._unconfirmed))
+
+    def _save_cache(self):
+        if not self._cache_filename:
+            return
+        now = time.time()
+        announcements = []
+        for (index, ann) in self._raw_announcements.items():
+            when = self._unconfirmed.get(index, now)
+            if now - when > self.CACHE_LIFETIME:
+                continue
+            (furl, service_name, ri_name, nickname_utf8, ver, oldest) = ann
+            ann = (furl, service_name, ri_name, nickname_utf8.decode("utf-8"),
+                   ver, oldest)
+            announcements.append((ann, when))
+        cache = { "versions": self._announcement_versions,
+                  "announcements": announcements,
+                  }
+        tmpfile = self._cache_filename + ".tmp"
+        try:
+            fileutil.write(tmpfile, simplejson.dumps(cache))
+            fileutil.move_into_place(tmpfile, self._cache_filename)
+        except EnvironmentError:
+            log.err(format="unable to write announcement cache %(filename)s",
+                    filename=self._cache_filename, level=log.UNUSUAL,
+                    umid="pB0ojA")
 
     def remote_set_encoding_parameters(self, parameters):
         self.encoding_parameters = parameters
@@ -17,6 +17,15 @@ FURL = StringConstraint(1000)
 Announcement = TupleOf(FURL, str, str,
                        str, str, str)
 
+# An AnnouncementVersion is (introducer_epoch, seqnum). The introducer numbers
+# each new or updated announcement it accepts, and tells subscribers how far
+# along that sequence they are. A subscriber that reconnects hands the last
+# version it saw back, and only hears about the announcements that have
+# changed since then. The epoch is chosen afresh each time the introducer
+# starts, so that its subscribers can tell when its numbering has started
+# over.
+AnnouncementVersion = TupleOf(str, int)
+
 class RIIntroducerSubscriberClient(RemoteInterface):
     __remote_name__ = "RIIntroducerSubscriberClient.tahoe.allmydata.com"
 
@@ -24,6 +33,15 @@ class RIIntroducerSubscriberClient(RemoteInterface):
         """I accept announcements from the publisher."""
         return None
 
+    def announce_delta(service_name=str,
+                       announcements=SetOf(Announcement),
+                       version=AnnouncementVersion):
+        """I accept the announcements for 'service_name' that have been
+        published or changed since the last version that I was sent, along
+        with the version they bring me up to. 'announcements' may be empty.
+        This is only used after I have subscribed with subscribe_delta()."""
+        return None
+
     def set_encoding_parameters(parameters=(int, int, int)):
         """Advise the client of the recommended k-of-n encoding parameters
         for this grid. 'parameters' is a tuple of (k, desired, n), where 'n'
@@ -74,6 +92,14 @@ class RIIntroducerPublisherAndSubscriberService(RemoteInterface):
         return None
     def subscribe(subscriber=RIIntroducerSubscriberClient, service_name=str):
         return None
+    def subscribe_delta(subscriber=RIIntroducerSubscriberClient,
+                        service_name=str, last_seen=AnnouncementVersion):
+        """Like subscribe(), but the subscriber will get announce_delta()
+        messages, starting with the announcements that have changed since
+        'last_seen' (or all of them, if 'last_seen' is from some other
+        epoch). This is only available from introducers that list
+        'delta-subscriptions' in their v1 version dictionary."""
+        return None
 
 class IIntroducerClient(Interface):
     """I provide service introduction facilities for a node. I help nodes
@@ -3,10 +3,11 @@ import time, os.path
 from base64 import b32decode
 from zope.interface import implements
 from twisted.application import service
+from twisted.internet import reactor
 from foolscap.api import Referenceable, SturdyRef
 import allmydata
 from allmydata import node
-from allmydata.util import log, rrefutil
+from allmydata.util import base32, log, rrefutil
 from allmydata.introducer.interfaces import \
      RIIntroducerPublisherAndSubscriberService
 
@@ -52,16 +53,37 @@ class IntroducerService(service.MultiService, Referenceable):
     implements(RIIntroducerPublisherAndSubscriberService)
     name = "introducer"
     VERSION = { "http://allmydata.org/tahoe/protocols/introducer/v1":
-                 { },
+                 { "delta-subscriptions": True,
+                   },
                 "application-version": str(allmydata.__full_version__),
                 }
+    # New announcements are collected for this many seconds, and then sent
+    # to each subscriber in a single message, so that a burst of servers
+    # (re)starting costs one message per subscriber instead of one per
+    # server per subscriber.
+    BATCH_DELAY = 1.0
 
-    def __init__(self, basedir="."):
+    def __init__(self, basedir=".", clock=None):
         service.MultiService.__init__(self)
         self.introducer_url = None
+        # the unit tests may give us a twisted.internet.task.Clock, to
+        # control when batches are sent
+        self._clock = clock or reactor
         # 'index' is (service_name, tubid)
         self._announcements = {} # dict of index -> (announcement, timestamp)
         self._subscribers = {} # dict of (rref->timestamp) dicts
+        # every new or updated announcement gets the next seqnum. A
+        # subscriber that has seen seqnum N needs to be sent the
+        # announcements whose latest change has a seqnum above N. We only
+        # remember the latest seqnum of each announcement, so older changes
+        # to it are forgotten as soon as they are superseded.
+        self._epoch = base32.b2a(os.urandom(10))
+        self._last_seqnum = 0
+        self._seqnums = {} # dict of index -> seqnum of its latest change
+        # dict of (service_name, rref) -> the seqnum we have sent them up to
+        self._sent_seqnums = {}
+        self._delta_subscribers = set() # set of (service_name, rref)
+        self._flush_timer = None
         self._debug_counts = {"inbound_message": 0,
                               "inbound_duplicate": 0,
                               "inbound_update": 0,
@@ -74,6 +96,12 @@ class IntroducerService(service.MultiService, Referenceable):
             kwargs["facility"] = "tahoe.introducer"
         return log.msg(*args, **kwargs)
 
+    def stopService(self):
+        if self._flush_timer:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        return service.MultiService.stopService(self)
+
     def get_announcements(self):
         return self._announcements
     def get_subscribers(self):
@@ -108,18 +136,64 @@ class IntroducerService(service.MultiService, Referenceable):
                 self.log("old announcement being updated", level=log.NOISY)
                 self._debug_counts["inbound_update"] += 1
         self._announcements[index] = (announcement, time.time())
-
-        for s in self._subscribers.get(service_name, []):
-            self._debug_counts["outbound_message"] += 1
-            self._debug_counts["outbound_announcements"] += 1
-            d = s.callRemote("announce", set([announcement]))
-            d.addErrback(rrefutil.trap_deadref)
-            d.addErrback(log.err,
-                         format="subscriber errored on announcement %(ann)s",
-                         ann=announcement, facility="tahoe.introducer",
-                         level=log.UNUSUAL, umid="jfGMXQ")
+        self._last_seqnum += 1
+        self._seqnums[index] = self._last_seqnum
+
+        if self._subscribers.get(service_name) and not self._flush_timer:
+            self._flush_timer = self._clock.callLater(self.BATCH_DELAY,
+                                                      self._flush)
+
+    def _get_changes(self, service_name, since):
+        # return the current announcements for 'service_name' that have
+        # changed after seqnum 'since'
+        announcements = set()
+        for (index, seqnum) in self._seqnums.iteritems():
+            if index[0] == service_name and seqnum > since:
+                announcements.add(self._announcements[index][0])
+        return announcements
+
+    def _flush(self):
+        self._flush_timer = None
+        seqnum = self._last_seqnum
+        for service_name, subscribers in self._subscribers.items():
+            # most subscribers are equally up-to-date
+            changes = {} # since -> set(announcement)
+            for subscriber in subscribers:
+                key = (service_name, subscriber)
+                since = self._sent_seqnums[key]
+                if since not in changes:
+                    changes[since] = self._get_changes(service_name, since)
+                if changes[since]:
+                    self._send(subscriber, service_name, changes[since],
+                               seqnum)
+
+    def _send(self, subscriber, service_name, announcements, seqnum):
+        key = (service_name, subscriber)
+        self._sent_seqnums[key] = seqnum
+        self._debug_counts["outbound_message"] += 1
+        self._debug_counts["outbound_announcements"] += len(announcements)
+        if key in self._delta_subscribers:
+            d = subscriber.callRemote("announce_delta", service_name,
+                                      announcements, (self._epoch, seqnum))
+        else:
+            d = subscriber.callRemote("announce", announcements)
+        d.addErrback(rrefutil.trap_deadref)
+        d.addErrback(log.err,
+                     format="subscriber errored on announcements %(anns)s",
+                     anns=announcements, facility="tahoe.introducer",
+                     level=log.UNUSUAL, umid="jfGMXQ")
 
     def remote_subscribe(self, subscriber, service_name):
+        self._subscribe(subscriber, service_name, 0, False)
+
+    def remote_subscribe_delta(self, subscriber, service_name, last_seen):
+        (epoch, since) = last_seen
+        if epoch != self._epoch or not 0 <= since <= self._last_seqnum:
+            # they were subscribed to some earlier incarnation of us
+            since = 0
+        self._subscribe(subscriber, service_name, since, True)
+
+    def _subscribe(self, subscriber, service_name, since, delta):
         self.log("introducer: subscription[%s] request at %s" % (service_name,
                                                                  subscriber))
         self._debug_counts["inbound_subscribe"] += 1
@@ -131,22 +205,21 @@ class IntroducerService(service.MultiService, Referenceable):
                      level=log.UNUSUAL)
             return
         subscribers[subscriber] = time.time()
+        key = (service_name, subscriber)
+        if delta:
+            self._delta_subscribers.add(key)
         def _remove():
             self.log("introducer: unsubscribing[%s] %s" % (service_name,
                                                            subscriber))
             subscribers.pop(subscriber, None)
+            self._sent_seqnums.pop(key, None)
+            self._delta_subscribers.discard(key)
         subscriber.notifyOnDisconnect(_remove)
 
-        announcements = set(
-            [ ann
-              for (sn2,nodeid),(ann,when) in self._announcements.items()
-              if sn2 == service_name] )
-
-        self._debug_counts["outbound_message"] += 1
-        self._debug_counts["outbound_announcements"] += len(announcements)
-        d = subscriber.callRemote("announce", announcements)
-        d.addErrback(rrefutil.trap_deadref)
-        d.addErrback(log.err,
-                     format="subscriber errored during subscribe %(anns)s",
-                     anns=announcements, facility="tahoe.introducer",
-                     level=log.UNUSUAL, umid="mtZepQ")
+        # a new subscriber gets everything they have not seen (which, unless
+        # they have subscribed to us before, is every announcement for this
+        # service) right away. We send this even when it is empty, so that
+        # they know they are subscribed.
+        announcements = self._get_changes(service_name, since)
+        self._send(subscriber, service_name, announcements,
+                   self._last_seqnum)
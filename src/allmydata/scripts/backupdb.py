@@ -6,8 +6,9 @@
 # "package")) must be installed. On debian, install python-pysqlite2
 
 import os.path, sys, time, random, stat
+import simplejson
 from allmydata.util.netstring import netstring
-from allmydata.util.hashutil import backupdb_dirhash
+from allmydata.util.hashutil import backupdb_dirhash, backupdb_excludehash
 from allmydata.util import base32
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.encodingutil import to_str
@@ -63,9 +64,29 @@ UPDATE_v1_to_v2 = TABLE_DIRECTORY + """
 UPDATE version SET version=2;
 """
 
+TABLE_LOCAL_DIRECTORIES = """
+
+CREATE TABLE local_directories -- added in v3
+(
+ path  VARCHAR(1024) PRIMARY KEY, -- absolute UTF-8-encoded local dirname
+ mtime NUMBER,          -- os.stat(dn)[stat.ST_MTIME]
+ nlink INTEGER,         -- os.stat(dn)[stat.ST_NLINK]
+ subdirs TEXT,          -- JSON list of the child directory names
+ excludehash VARCHAR(256), -- base32(excludehash) of the --exclude patterns
+ dirhash VARCHAR(256)   -- base32(dirhash), see the directories table
+);
+
+"""
+
+SCHEMA_v3 = SCHEMA_v2 + TABLE_LOCAL_DIRECTORIES
+
+UPDATE_v2_to_v3 = TABLE_LOCAL_DIRECTORIES + """
+UPDATE version SET version=3;
+"""
+
 
 def get_backupdb(dbfile, stderr=sys.stderr,
-                 create_version=(SCHEMA_v2, 2), just_create=False):
+                 create_version=(SCHEMA_v3, 3), just_create=False):
     # open or create the given backupdb file. The parent directory must
     # exist.
     try:
@@ -108,7 +129,11 @@ def get_backupdb(dbfile, stderr=sys.stderr,
         db.commit()
         version = 2
     if version == 2:
-        return BackupDB_v2(sqlite, db)
+        c.executescript(UPDATE_v2_to_v3)
+        db.commit()
+        version = 3
+    if version == 3:
+        return BackupDB_v3(sqlite, db)
     print >>stderr, "Unable to handle backupdb version %s" % version
     return None
 
@@ -160,15 +185,107 @@ class DirectoryResult:
     def did_check_healthy(self, results):
         self.bdb.did_check_directory_healthy(self.dircap, results)
 
+def _timed(method):
+    # charge the time spent in a BackupDB method to bdb.db_time
+    def _wrapper(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.db_time += time.time() - started
+    _wrapper.__name__ = method.__name__
+    _wrapper.__doc__ = method.__doc__
+    return _wrapper
+
+class LocalDirectoryResult:
+    def __init__(self, bdb, path, mtime, nlink, excludehash, subdirs, dirhash):
+        self.bdb = bdb
+        self.path = path
+        self.mtime = mtime
+        self.nlink = nlink
+        self.excludehash = excludehash
+        self.subdirs = subdirs
+        self.dirhash = dirhash
+
+    def is_unchanged(self):
+        """Return True if the directory has the same mtime and link count,
+        and was backed up with the same exclude patterns, as last time. Its
+        list of entries is then assumed to be unchanged too, so the
+        subdirectory names in self.subdirs are still current."""
+        return self.dirhash is not None
+
+    def did_backup(self, subdirs, dirhash):
+        self.bdb.did_backup_local_directory(self.path, self.mtime, self.nlink,
+                                            self.excludehash, subdirs, dirhash)
+
 class BackupDB_v2:
     VERSION = 2
     NO_CHECK_BEFORE = 1*MONTH
     ALWAYS_CHECK_AFTER = 2*MONTH
 
+    # Writes are batched into transactions: we commit after this many
+    # modifications, or when the oldest uncommitted one is this old,
+    # whichever comes first. Call commit() when you are done to flush the
+    # rest. Anything lost to a crash merely causes a re-upload next time.
+    COMMIT_AFTER_WRITES = 1000
+    COMMIT_AFTER_SECONDS = 10.0
+
     def __init__(self, sqlite_module, connection):
         self.sqlite_module = sqlite_module
         self.connection = connection
         self.cursor = connection.cursor()
+        self.db_time = 0.0
+        self.commits = 0
+        self._uncommitted_writes = 0
+        self._first_uncommitted = None
+        # after load_index(), these mirror the local_files table
+        # (path -> (size, mtime, ctime, fileid)) and the caps/last_upload
+        # tables (fileid -> (filecap, last_checked))
+        self._local_files = None
+        self._files = None
+
+    def _wrote(self):
+        # record a modification, and commit if the batch is full or old
+        now = time.time()
+        if not self._uncommitted_writes:
+            self._first_uncommitted = now
+        self._uncommitted_writes += 1
+        if (self._uncommitted_writes >= self.COMMIT_AFTER_WRITES
+            or now - self._first_uncommitted >= self.COMMIT_AFTER_SECONDS):
+            self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self.commits += 1
+        self._uncommitted_writes = 0
+        self._first_uncommitted = None
+
+    @_timed
+    def commit(self):
+        """Commit any writes that are still waiting for their batch to fill
+        up. Call this when a backup is finished (or abandoned)."""
+        if self._uncommitted_writes:
+            self._commit()
+
+    @_timed
+    def load_index(self):
+        """Read the local_files table (and the caps it refers to) into
+        memory, so that check_file() can answer from a dictionary instead of
+        issuing two queries per file. This costs memory proportional to the
+        number of files previously backed up."""
+        c = self.cursor
+        local_files = {}
+        c.execute("SELECT path,size,mtime,ctime,fileid FROM local_files")
+        for (path, size, mtime, ctime, fileid) in c.fetchall():
+            local_files[path] = (size, mtime, ctime, fileid)
+        files = {}
+        c.execute("SELECT caps.fileid, caps.filecap, last_upload.last_checked"
+                  " FROM caps,last_upload"
+                  " WHERE caps.fileid=last_upload.fileid")
+        for (fileid, filecap, last_checked) in c.fetchall():
+            files[fileid] = (filecap, last_checked)
+        self._local_files = local_files
+        self._files = files
 
     def check_file(self, path, use_timestamps=True):
         """I will tell you if a given local file needs to be uploaded or not,
@@ -210,24 +327,33 @@ class BackupDB_v2:
         size = s[stat.ST_SIZE]
         ctime = s[stat.ST_CTIME]
         mtime = s[stat.ST_MTIME]
+        return self._check_file(path, size, mtime, ctime, use_timestamps)
 
+    @_timed
+    def _check_file(self, path, size, mtime, ctime, use_timestamps):
         now = time.time()
         c = self.cursor
 
-        c.execute("SELECT size,mtime,ctime,fileid"
-                  " FROM local_files"
-                  " WHERE path=?",
-                  (path,))
-        row = self.cursor.fetchone()
+        if self._local_files is not None:
+            row = self._local_files.get(path)
+        else:
+            c.execute("SELECT size,mtime,ctime,fileid"
+                      " FROM local_files"
+                      " WHERE path=?",
+                      (path,))
+            row = self.cursor.fetchone()
         if not row:
             return FileResult(self, None, False, path, mtime, ctime, size)
         (last_size,last_mtime,last_ctime,last_fileid) = row
 
-        c.execute("SELECT caps.filecap, last_upload.last_checked"
-                  " FROM caps,last_upload"
-                  " WHERE caps.fileid=? AND last_upload.fileid=?",
-                  (last_fileid, last_fileid))
-        row2 = c.fetchone()
+        if self._files is not None:
+            row2 = self._files.get(last_fileid)
+        else:
+            c.execute("SELECT caps.filecap, last_upload.last_checked"
+                      " FROM caps,last_upload"
+                      " WHERE caps.fileid=? AND last_upload.fileid=?",
+                      (last_fileid, last_fileid))
+            row2 = c.fetchone()
 
         if ((last_size != size
              or not use_timestamps
@@ -236,7 +362,9 @@ class BackupDB_v2:
             or (not row2) # we somehow forgot where we put the file last time
             ):
             c.execute("DELETE FROM local_files WHERE path=?", (path,))
-            self.connection.commit()
+            if self._local_files is not None:
+                del self._local_files[path]
+            self._wrote()
             return FileResult(self, None, False, path, mtime, ctime, size)
 
         # at this point, we're allowed to assume the file hasn't been changed
@@ -253,7 +381,7 @@ class BackupDB_v2:
 
     def get_or_allocate_fileid_for_cap(self, filecap):
         # find an existing fileid for this filecap, or insert a new one. The
-        # caller is required to commit() afterwards.
+        # caller is required to call _wrote() afterwards.
 
         # mysql has "INSERT ... ON DUPLICATE KEY UPDATE", but not sqlite
         # sqlite has "INSERT ON CONFLICT REPLACE", but not mysql
@@ -271,6 +399,7 @@ class BackupDB_v2:
         fileid = foundrow[0]
         return fileid
 
+    @_timed
     def did_upload_file(self, filecap, path, mtime, ctime, size):
         now = time.time()
         fileid = self.get_or_allocate_fileid_for_cap(filecap)
@@ -290,8 +419,12 @@ class BackupDB_v2:
                                 " SET size=?, mtime=?, ctime=?, fileid=?"
                                 " WHERE path=?",
                                 (size, mtime, ctime, fileid, path))
-        self.connection.commit()
+        if self._local_files is not None:
+            self._local_files[path] = (size, mtime, ctime, fileid)
+            self._files[fileid] = (filecap, now)
+        self._wrote()
 
+    @_timed
     def did_check_file_healthy(self, filecap, results):
         now = time.time()
         fileid = self.get_or_allocate_fileid_for_cap(filecap)
@@ -299,8 +432,11 @@ class BackupDB_v2:
                             " SET last_checked=?"
                             " WHERE fileid=?",
                             (now, fileid))
-        self.connection.commit()
+        if self._files is not None and fileid in self._files:
+            self._files[fileid] = (filecap, now)
+        self._wrote()
 
+    @_timed
     def check_directory(self, contents):
         """I will tell you if a new directory needs to be created for a given
         set of directory contents, or if I know of an existing (immutable)
@@ -328,7 +464,6 @@ class BackupDB_v2:
         r.did_create(dircap) when you're done.
         """
 
-        now = time.time()
         entries = []
         for name in contents:
             entries.append( [name.encode("utf-8"), contents[name]] )
@@ -337,6 +472,10 @@ class BackupDB_v2:
                         for (name_utf8,cap) in entries])
         dirhash = backupdb_dirhash(data)
         dirhash_s = base32.b2a(dirhash)
+        return self._check_dirhash(dirhash_s)
+
+    def _check_dirhash(self, dirhash_s):
+        now = time.time()
         c = self.cursor
         c.execute("SELECT dircap, last_checked"
                   " FROM directories WHERE dirhash=?", (dirhash_s,))
@@ -353,6 +492,7 @@ class BackupDB_v2:
 
         return DirectoryResult(self, dirhash_s, to_str(dircap), should_check)
 
+    @_timed
     def did_create_directory(self, dircap, dirhash):
         now = time.time()
         # if the dirhash is already present (i.e. we've re-uploaded an
@@ -360,12 +500,74 @@ class BackupDB_v2:
         # update the record in place. Otherwise create a new record.)
         self.cursor.execute("REPLACE INTO directories VALUES (?,?,?,?)",
                             (dirhash, dircap, now, now))
-        self.connection.commit()
+        self._wrote()
 
+    @_timed
     def did_check_directory_healthy(self, dircap, results):
         now = time.time()
         self.cursor.execute("UPDATE directories"
                             " SET last_checked=?"
                             " WHERE dircap=?",
                             (now, dircap))
-        self.connection.commit()
+        self._wrote()
+
+class BackupDB_v3(BackupDB_v2):
+    VERSION = 3
+
+    def get_excludehash(self, exclude_patterns):
+        """Return a string which identifies a set of --exclude patterns, for
+        use with check_local_directory()."""
+        patterns = [pat.encode("utf-8") for pat in exclude_patterns]
+        patterns.sort()
+        data = "".join([netstring(pat) for pat in patterns])
+        return base32.b2a(backupdb_excludehash(data))
+
+    @_timed
+    def check_local_directory(self, path, excludehash):
+        """I will tell you if a local directory can be assumed to have the
+        same entries as when it was last backed up, without listing it.
+
+        I stat the directory and compare its mtime and link count (which,
+        on POSIX, counts its subdirectories) against my records. Adding,
+        removing or renaming an entry changes the mtime, but modifying a
+        file in place does not, so this is only a safe shortcut for trees
+        whose files are never rewritten in place.
+
+        I return a LocalDirectoryResult. If r.is_unchanged() returns True,
+        r.subdirs lists the names of the subdirectories that were backed
+        up, and r.dirhash can be handed to check_dirhash() to find the
+        dircap created for it. Otherwise, back up the directory as usual and
+        then call r.did_backup(subdirs, dirhash) so I can update my
+        database.
+        """
+        path = abspath_expanduser_unicode(path)
+        s = os.stat(path)
+        mtime = s.st_mtime
+        nlink = s.st_nlink
+
+        c = self.cursor
+        c.execute("SELECT mtime,nlink,excludehash,subdirs,dirhash"
+                  " FROM local_directories WHERE path=?", (path,))
+        row = c.fetchone()
+        if (not row
+            or (row[0], row[1], row[2]) != (mtime, nlink, excludehash)):
+            return LocalDirectoryResult(self, path, mtime, nlink, excludehash,
+                                        None, None)
+        subdirs = simplejson.loads(row[3])
+        return LocalDirectoryResult(self, path, mtime, nlink, excludehash,
+                                    subdirs, to_str(row[4]))
+
+    @_timed
+    def check_dirhash(self, dirhash):
+        """Like check_directory(), but for a dirhash that was returned by
+        check_local_directory() rather than computed from the contents."""
+        return self._check_dirhash(dirhash)
+
+    @_timed
+    def did_backup_local_directory(self, path, mtime, nlink, excludehash,
+                                   subdirs, dirhash):
+        self.cursor.execute("REPLACE INTO local_directories"
+                            " VALUES (?,?,?,?,?,?)",
+                            (path, mtime, nlink, simplejson.dumps(subdirs),
+                             excludehash, dirhash))
+        self._wrote()
@@ -330,6 +330,10 @@ class BackupOptions(VDriveOptions):
     optFlags = [
         ("verbose", "v", "Be noisy about what is happening."),
         ("ignore-timestamps", None, "Do not use backupdb timestamps to decide whether a local file is unchanged."),
+        ("trust-directory-mtimes", None, "Re-use the previous backup of any directory tree in which no directory's mtime has changed, without looking at its files."),
+        ]
+    optParameters = [
+        ("jobs", "j", 1, "Upload up to this many files concurrently.", int),
         ]
 
     vcs_patterns = ('CVS', 'RCS', 'SCCS', '.git', '.gitignore', '.cvsignore',
@@ -345,6 +349,11 @@ class BackupOptions(VDriveOptions):
         self.from_dir = argv_to_unicode(localdir)
         self.to_dir = argv_to_unicode(topath)
 
+        if self['jobs'] < 1:
+            raise usage.UsageError("--jobs must be at least 1, not %d" % self['jobs'])
+        if self['trust-directory-mtimes'] and self['ignore-timestamps']:
+            raise usage.UsageError("--trust-directory-mtimes and --ignore-timestamps are mutually exclusive")
+
     def getSynopsis(self):
         return "Usage:  %s backup [options] FROM ALIAS:TO" % (self.command_name,)
 
@@ -1,13 +1,16 @@
 
-import os.path
+import os.path, sys
 import time
 import urllib
+import threading, Queue
+from collections import deque
 import simplejson
 import datetime
 from allmydata.scripts.common import get_alias, escape_path, DEFAULT_ALIAS, \
                                      UnknownAliasError
 from allmydata.scripts.common_http import do_http, HTTPError, format_http_error
 from allmydata.util import time_format
+from allmydata.util.abbreviate import abbreviate_space
 from allmydata.scripts import backupdb
 from allmydata.util.encodingutil import listdir_unicode, quote_output, \
      to_str, FilenameEncodingError, unicode_to_url
@@ -59,7 +62,91 @@ def put_child(dirurl, childname, childcap):
 class BackupProcessingError(Exception):
     pass
 
+class UploadJob:
+    """I represent a single call that may run on an UploadPool worker
+    thread. wait() blocks until the call has finished, then returns its
+    result or re-raises its exception in the calling thread."""
+    def __init__(self, f, *args):
+        self._f = f
+        self._args = args
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self._f(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._exc_info:
+            exc_type, exc_value, exc_tb = self._exc_info
+            self._exc_info = None
+            raise exc_type, exc_value, exc_tb
+        return self._result
+
+class UploadPool:
+    """I run UploadJobs on a fixed number of worker threads, so that
+    'tahoe backup --jobs=N' can keep up to N file PUTs in flight at once.
+
+    Only the HTTP upload itself runs in a worker: the backupdb (an sqlite
+    connection owned by the main thread) is consulted before a job is
+    submitted and updated after it has been waited upon. submit() blocks
+    once 'jobs' calls are already queued, so a huge directory does not
+    queue up an unbounded number of open files."""
+    def __init__(self, jobs):
+        self._queue = Queue.Queue(jobs)
+        self._workers = []
+        for i in range(jobs):
+            t = threading.Thread(target=self._run_worker,
+                                 name="backup-upload-%d" % i)
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def _run_worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, f, *args):
+        job = UploadJob(f, *args)
+        self._queue.put(job)
+        return job
+
+    def stop(self):
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+class PendingDirectory:
+    """I am a local directory whose file uploads have been started, but
+    which has not been created in the grid yet. Once it has been created,
+    I only remember its dircap."""
+    def __init__(self, localpath, ldr):
+        self.localpath = localpath
+        self.ldr = ldr # LocalDirectoryResult, or None
+        self.files = [] # (childname, childpath, finish_upload)
+        self.subdirs = [] # (childname, metadata, dircap or PendingDirectory)
+        self.skipped = False # True if we could not back up an entry
+        self.dircap = None # set by finish_directory()
+        self.complete = None
+
 class BackerUpper:
+    # how far the walk may run ahead of the directories that it has created:
+    # once more directories than this have been scanned but not created, or
+    # they hold more files than this, we finish the oldest of them before
+    # scanning any further
+    MAX_UNFINISHED_DIRECTORIES = 100
+    MAX_UNFINISHED_FILES = 1000
+
     def __init__(self, options):
         self.options = options
         self.files_uploaded = 0
@@ -70,6 +157,14 @@ class BackerUpper:
         self.directories_reused = 0
         self.directories_checked = 0
         self.directories_skipped = 0
+        self.bytes_uploaded = 0
+        self.upload_time = 0.0
+        self.pool = None
+        self.excludehash = None
+        self.local_directories = {} # localpath -> LocalDirectoryResult
+        self.unchanged_subtrees = {} # localpath -> bool
+        self.unfinished = deque() # scanned PendingDirectory, children first
+        self.unfinished_files = 0
 
     def run(self):
         options = self.options
@@ -91,6 +186,8 @@ class BackerUpper:
         if not self.backupdb:
             print >>stderr, "ERROR: Unable to load backup db."
             return 1
+        self.backupdb.load_index()
+        self.excludehash = self.backupdb.get_excludehash(options['exclude'])
 
         try:
             rootcap, path = get_alias(options.aliases, options.to_dir, DEFAULT_ALIAS)
@@ -114,8 +211,19 @@ class BackerUpper:
                 print >>stderr, format_http_error("Unable to create target directory", resp)
                 return 1
 
-        # second step: process the tree
-        new_backup_dircap = self.process(options.from_dir)
+        # second step: process the tree. With --jobs > 1, file uploads are
+        # handed to a pool of worker threads. The walk starts uploads in
+        # later directories while earlier ones are still in flight, and each
+        # directory waits only for its own children before it is created.
+        if options["jobs"] > 1:
+            self.pool = UploadPool(options["jobs"])
+        try:
+            new_backup_dircap = self.process(options.from_dir)
+        finally:
+            if self.pool:
+                self.pool.stop()
+                self.pool = None
+            self.backupdb.commit()
 
         # third: attach the new backup to the list
         now = time_format.iso_utc(int(time.time()), sep="_") + "Z"
@@ -141,6 +249,21 @@ class BackerUpper:
                 print >>stdout, (" %d files checked, %d directories checked"
                                  % (self.files_checked,
                                     self.directories_checked))
+            if self.files_uploaded:
+                elapsed = end_timestamp - start_timestamp
+                elapsed_s = (elapsed.days*86400 + elapsed.seconds
+                             + elapsed.microseconds/1e6)
+                elapsed_s = max(elapsed_s, 0.001)
+                print >>stdout, (" %s uploaded (%s/s, %.1f files/s, "
+                                 "%.2fs per file, %d jobs)"
+                                 % (abbreviate_space(self.bytes_uploaded),
+                                    abbreviate_space(self.bytes_uploaded
+                                                     / elapsed_s),
+                                    self.files_uploaded / elapsed_s,
+                                    self.upload_time / self.files_uploaded,
+                                    options["jobs"]))
+            print >>stdout, (" %.2fs spent in the backupdb (%d commits)"
+                             % (self.backupdb.db_time, self.backupdb.commits))
             print >>stdout, " backup done, elapsed time: %s" % elapsed_time
 
         # The command exits with code 2 if files or directories were skipped
@@ -162,19 +285,42 @@ class BackerUpper:
     def process(self, localpath):
         precondition(isinstance(localpath, unicode), localpath)
         # returns newdircap
-
+        pd = self.scan_directory(localpath)
+        while self.unfinished:
+            self.finish_oldest_directory()
+        newdircap, complete = self.finish_directory(pd)
+        return newdircap
+
+    def scan_directory(self, localpath):
+        # Walk the tree below 'localpath', starting the upload of every file
+        # that needs one, without waiting for them, so that the uploads of
+        # sibling and child directories can overlap. Returns a dircap if the
+        # directory can be reused as it is, otherwise a PendingDirectory for
+        # finish_directory(). Scanned directories are finished oldest-first
+        # whenever too many of them are waiting, so memory does not grow
+        # with the size of the tree, and an interrupted run leaves the
+        # directories that it created in the backupdb.
         self.verboseprint("processing %s" % quote_output(localpath))
-        create_contents = {} # childname -> (type, rocap, metadata)
-        compare_contents = {} # childname -> rocap
+
+        # stat the directory before listing it, so that anything added while
+        # we work will change the mtime that we record
+        ldr = self.check_local_directory(localpath)
+        if ldr and self.options["trust-directory-mtimes"]:
+            dircap = self.reuse_unchanged_directory(localpath, ldr)
+            if dircap:
+                return dircap
+        pd = PendingDirectory(localpath, ldr)
 
         try:
             children = listdir_unicode(localpath)
         except EnvironmentError:
             self.directories_skipped += 1
+            pd.skipped = True
             self.warn("WARNING: permission denied on directory %s" % quote_output(localpath))
             children = []
         except FilenameEncodingError:
             self.directories_skipped += 1
+            pd.skipped = True
             self.warn("WARNING: could not list directory %s due to a filename encoding error" % quote_output(localpath))
             children = []
 
@@ -185,39 +331,134 @@ class BackerUpper:
             if os.path.isdir(childpath) and not os.path.islink(childpath):
                 metadata = get_local_metadata(childpath)
                 # recurse on the child directory
-                childcap = self.process(childpath)
-                assert isinstance(childcap, str)
-                create_contents[child] = ("dirnode", childcap, metadata)
-                compare_contents[child] = childcap
+                pd.subdirs.append((child, metadata,
+                                   self.scan_directory(childpath)))
             elif os.path.isfile(childpath) and not os.path.islink(childpath):
                 try:
-                    childcap, metadata = self.upload(childpath)
-                    assert isinstance(childcap, str)
-                    create_contents[child] = ("filenode", childcap, metadata)
-                    compare_contents[child] = childcap
+                    finish_upload = self.start_upload(childpath)
+                    pd.files.append((child, childpath, finish_upload))
                 except EnvironmentError:
                     self.files_skipped += 1
+                    pd.skipped = True
                     self.warn("WARNING: permission denied on file %s" % quote_output(childpath))
             else:
                 self.files_skipped += 1
+                pd.skipped = True
                 if os.path.islink(childpath):
                     self.warn("WARNING: cannot backup symlink %s" % quote_output(childpath))
                 else:
                     self.warn("WARNING: cannot backup special file %s" % quote_output(childpath))
 
+        # every subdirectory was queued before us, so the queue can always
+        # be finished from the front
+        self.unfinished.append(pd)
+        self.unfinished_files += len(pd.files)
+        while (len(self.unfinished) > self.MAX_UNFINISHED_DIRECTORIES or
+               self.unfinished_files > self.MAX_UNFINISHED_FILES):
+            self.finish_oldest_directory()
+        return pd
+
+    def finish_oldest_directory(self):
+        pd = self.unfinished.popleft()
+        self.unfinished_files -= len(pd.files)
+        self.finish_directory(pd)
+
+    def finish_directory(self, pd):
+        # Wait for the uploads that scan_directory() started, create the
+        # directory once all of its children have caps, and return
+        # (newdircap, complete), where 'complete' is False if anything below
+        # it was skipped.
+        if isinstance(pd, str):
+            return pd, True
+        if pd.dircap is not None:
+            return pd.dircap, pd.complete
+        create_contents = {} # childname -> (type, rocap, metadata)
+        compare_contents = {} # childname -> rocap
+        complete = not pd.skipped
+
+        for (child, metadata, subdir) in pd.subdirs:
+            childcap, subdir_complete = self.finish_directory(subdir)
+            assert isinstance(childcap, str)
+            create_contents[child] = ("dirnode", childcap, metadata)
+            compare_contents[child] = childcap
+            complete = complete and subdir_complete
+
+        for (child, childpath, finish_upload) in pd.files:
+            try:
+                childcap, metadata = finish_upload()
+                assert isinstance(childcap, str)
+                create_contents[child] = ("filenode", childcap, metadata)
+                compare_contents[child] = childcap
+            except EnvironmentError:
+                self.files_skipped += 1
+                complete = False
+                self.warn("WARNING: permission denied on file %s" % quote_output(childpath))
+
         must_create, r = self.check_backupdb_directory(compare_contents)
         if must_create:
-            self.verboseprint(" creating directory for %s" % quote_output(localpath))
+            self.verboseprint(" creating directory for %s" % quote_output(pd.localpath))
             newdircap = mkdir(create_contents, self.options)
             assert isinstance(newdircap, str)
             if r:
                 r.did_create(newdircap)
             self.directories_created += 1
-            return newdircap
         else:
-            self.verboseprint(" re-using old directory for %s" % quote_output(localpath))
+            self.verboseprint(" re-using old directory for %s" % quote_output(pd.localpath))
             self.directories_reused += 1
-            return r.was_created()
+            newdircap = r.was_created()
+
+        # only remember subtrees that were backed up completely, otherwise a
+        # later --trust-directory-mtimes run would never retry the skipped
+        # entries
+        if pd.ldr and r and complete:
+            subdirs = [subdir[0] for subdir in pd.subdirs]
+            pd.ldr.did_backup(subdirs, r.dirhash)
+        pd.dircap = newdircap
+        pd.complete = complete
+        pd.files = pd.subdirs = None
+        return newdircap, complete
+
+    def check_local_directory(self, localpath):
+        if not self.backupdb:
+            return None
+        if localpath not in self.local_directories:
+            try:
+                ldr = self.backupdb.check_local_directory(localpath,
+                                                          self.excludehash)
+            except EnvironmentError:
+                ldr = None
+            self.local_directories[localpath] = ldr
+        return self.local_directories[localpath]
+
+    def subtree_unchanged(self, localpath, ldr):
+        # True if this directory and every directory below it still have
+        # the mtimes that we recorded, which we check without listing any of
+        # them. The answers are cached, since a changed directory deep in the
+        # tree causes each of its ancestors to ask about their other
+        # children again.
+        if localpath not in self.unchanged_subtrees:
+            unchanged = ldr.is_unchanged()
+            if unchanged:
+                for child in ldr.subdirs:
+                    childpath = os.path.join(localpath, child)
+                    child_ldr = self.check_local_directory(childpath)
+                    if not (child_ldr and
+                            self.subtree_unchanged(childpath, child_ldr)):
+                        unchanged = False
+                        break
+            self.unchanged_subtrees[localpath] = unchanged
+        return self.unchanged_subtrees[localpath]
+
+    def reuse_unchanged_directory(self, localpath, ldr):
+        if not self.subtree_unchanged(localpath, ldr):
+            return None
+        must_create, r = self.check_backupdb_directory_result(
+            self.backupdb.check_dirhash(ldr.dirhash))
+        if must_create:
+            return None
+        self.verboseprint(" re-using unchanged directory for %s" % quote_output(localpath))
+        self.directories_reused += 1
+        return r.was_created()
 
     def check_backupdb_file(self, childpath):
         if not self.backupdb:
@@ -257,7 +498,9 @@ class BackerUpper:
         if not self.backupdb:
             return True, None
         r = self.backupdb.check_directory(compare_contents)
+        return self.check_backupdb_directory_result(r)
 
+    def check_backupdb_directory_result(self, r):
         if not r.was_created():
             return True, r
 
@@ -288,6 +531,14 @@ class BackerUpper:
 
     # This function will raise an IOError exception when called on an unreadable file
     def upload(self, childpath):
+        return self.start_upload(childpath)()
+
+    def start_upload(self, childpath):
+        """Begin backing up a single file. I consult the backupdb and, if the
+        file must be uploaded, start the PUT (on the upload pool, if there
+        is one). I return a function which waits for the upload to finish,
+        records it in the backupdb, and returns (filecap, metadata).
+        Either step may raise EnvironmentError for an unreadable file."""
         precondition(isinstance(childpath, unicode), childpath)
 
         #self.verboseprint("uploading %s.." % quote_output(childpath))
@@ -296,29 +547,51 @@ class BackerUpper:
         # we can use the backupdb here
         must_upload, bdb_results = self.check_backupdb_file(childpath)
 
-        if must_upload:
-            self.verboseprint("uploading %s.." % quote_output(childpath))
-            infileobj = open(childpath, "rb")
-            url = self.options['node-url'] + "uri"
-            resp = do_http("PUT", url, infileobj)
-            if resp.status not in (200, 201):
-                raise HTTPError("Error during file PUT", resp)
+        if not must_upload:
+            self.verboseprint("skipping %s.." % quote_output(childpath))
+            self.files_reused += 1
+            filecap = bdb_results.was_uploaded()
+            return lambda: (filecap, metadata)
 
-            filecap = resp.read().strip()
-            self.verboseprint(" %s -> %s" % (quote_output(childpath, quotemarks=False),
-                                             quote_output(filecap, quotemarks=False)))
+        self.verboseprint("uploading %s.." % quote_output(childpath))
+        if self.pool:
+            job = self.pool.submit(self.put_file, childpath)
+        else:
+            job = UploadJob(self.put_file, childpath)
+            job.run()
+
+        def _finish():
+            filecap, size, elapsed = job.wait()
+            self.verboseprint(" %s -> %s (%s in %.2fs)"
+                              % (quote_output(childpath, quotemarks=False),
+                                 quote_output(filecap, quotemarks=False),
+                                 abbreviate_space(size), elapsed))
             #self.verboseprint(" metadata: %s" % (quote_output(metadata, quotemarks=False),))
 
             if bdb_results:
                 bdb_results.did_upload(filecap)
 
             self.files_uploaded += 1
+            self.bytes_uploaded += size
+            self.upload_time += elapsed
             return filecap, metadata
+        return _finish
 
-        else:
-            self.verboseprint("skipping %s.." % quote_output(childpath))
-            self.files_reused += 1
-            return bdb_results.was_uploaded(), metadata
+    def put_file(self, childpath):
+        # This may run in an UploadPool worker thread, so it must not touch
+        # the backupdb or the counters. Returns (filecap, size, elapsed).
+        started = time.time()
+        infileobj = open(childpath, "rb")
+        try:
+            size = os.fstat(infileobj.fileno()).st_size
+            url = self.options['node-url'] + "uri"
+            resp = do_http("PUT", url, infileobj)
+            if resp.status not in (200, 201):
+                raise HTTPError("Error during file PUT", resp)
+            filecap = resp.read().strip()
+        finally:
+            infileobj.close()
+        return filecap, size, time.time() - started
 
 def backup(options):
     bu = BackerUpper(options)
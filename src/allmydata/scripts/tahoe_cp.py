@@ -48,16 +48,6 @@ def mkdir(targeturl):
         return resp.read().strip()
     raise HTTPError("Error during mkdir", resp)
 
-def make_tahoe_subdirectory(nodeurl, parent_writecap, name):
-    url = nodeurl + "/".join(["uri",
-                              urllib.quote(parent_writecap),
-                              urllib.quote(unicode_to_url(name)),
-                              ]) + "?t=mkdir"
-    resp = do_http("POST", url)
-    if resp.status in (200, 201):
-        return resp.read().strip()
-    raise HTTPError("Error during mkdir", resp)
-
 
 class LocalFileSource:
     def __init__(self, pathname):
@@ -157,6 +147,9 @@ class LocalDirectoryTarget:
         pathname = os.path.join(self.pathname, name)
         fileutil.put_file(pathname, inf)
 
+    def link_new_subdirectories(self):
+        pass
+
     def set_children(self):
         pass
 
@@ -293,6 +286,7 @@ class TahoeDirectoryTarget:
         self.cache = cache
         self.progressfunc = progressfunc
         self.new_children = {}
+        self.new_subdirectories = {}
 
     def init_from_parsed(self, parsed):
         nodetype, d = parsed
@@ -375,13 +369,27 @@ class TahoeDirectoryTarget:
             self.populate(False)
         if name in self.children:
             return self.children[name]
-        writecap = make_tahoe_subdirectory(self.nodeurl, self.writecap, name)
+        # create the new subdirectory unlinked, and attach it with its new
+        # siblings in link_new_subdirectories(), rather than publishing this
+        # directory once for each subdirectory
+        writecap = mkdir(self.nodeurl + "uri")
         child = TahoeDirectoryTarget(self.nodeurl, self.cache,
                                      self.progressfunc)
         child.just_created(writecap)
         self.children[name] = child
+        self.new_subdirectories[name] = writecap
         return child
 
+    def link_new_subdirectories(self):
+        # The Copier calls this as soon as it has asked for all of our new
+        # subdirectories, before it copies anything into them, so that a
+        # copy that fails later does not leave them unlinked. Only a failure
+        # between mkdir() and here can still leak them.
+        if not self.new_subdirectories:
+            return
+        self._set_children(self.new_subdirectories)
+        self.new_subdirectories = {}
+
     def put_file(self, name, inf):
         url = self.nodeurl + "uri"
         if not hasattr(inf, "seek"):
@@ -407,14 +415,18 @@ class TahoeDirectoryTarget:
     def set_children(self):
         if not self.new_children:
             return
+        self._set_children(self.new_children)
+
+    def _set_children(self, children):
         url = (self.nodeurl + "uri/" + urllib.quote(self.writecap)
                + "?t=set_children")
         set_data = {}
-        for (name, filecap) in self.new_children.items():
+        for (name, filecap) in children.items():
             # it just so happens that ?t=set_children will accept both file
             # read-caps and write-caps as ['rw_uri'], and will handle either
             # correctly. So don't bother trying to figure out whether the one
-            # we have is read-only or read-write.
+            # we have is read-only or read-write. The type is ignored, so
+            # this works for the write-caps of new subdirectories too.
             # TODO: think about how this affects forward-compatibility for
             # unknown caps
             set_data[name] = ["filenode", {"rw_uri": filecap}]
@@ -687,14 +699,19 @@ class Copier:
         # copy everything in the source into the target
         assert isinstance(source, (LocalDirectorySource, TahoeDirectorySource))
 
+        subdirs = []
         for name, child in source.children.items():
             if isinstance(child, (LocalDirectorySource, TahoeDirectorySource)):
                 # we will need a target directory for this one
-                subtarget = target.get_child_target(name)
-                self.assign_targets(child, subtarget)
+                subdirs.append((child, target.get_child_target(name)))
             else:
                 assert isinstance(child, (LocalFileSource, TahoeFileSource))
                 self.attach_to_target(child, name, target)
+        # link any new subdirectories into the target with a single update,
+        # before we recurse into them
+        target.link_new_subdirectories()
+        for (child, subtarget) in subdirs:
+            self.assign_targets(child, subtarget)
 
 
 
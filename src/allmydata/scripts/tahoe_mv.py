@@ -50,6 +50,13 @@ def mv(options, mode="move"):
         # "mv foo.txt bar/" == "mv foo.txt bar/foo.txt"
         to_url += escape_path(from_path[from_path.rfind("/")+1:])
 
+    if mode == "move" and from_path and path:
+        (from_parent_url, from_name) = from_url.rsplit("/", 1)
+        (to_parent_url, to_name) = to_url.rsplit("/", 1)
+        if from_parent_url == to_parent_url:
+            # a rename within one directory is a single atomic update
+            return rename(from_parent_url, from_name, to_name, stdout, stderr)
+
     to_url += "?t=uri&replace=only-files"
 
     resp = do_http("PUT", to_url, cap)
@@ -72,3 +79,20 @@ def mv(options, mode="move"):
 
     print >>stdout, "OK"
     return 0
+
+def rename(parent_url, from_name, to_name, stdout, stderr):
+    from_name = urllib.unquote(from_name).decode("utf-8")
+    to_name = urllib.unquote(to_name).decode("utf-8")
+    body = simplejson.dumps({to_name: ["rename", {"from": from_name}]})
+    resp = do_http("POST", parent_url + "?t=set_children&replace=only-files",
+                   body)
+    status = resp.status
+    if not re.search(r'^2\d\d$', str(status)):
+        if status == 409:
+            print >>stderr, "Error: You can't overwrite a directory with a file"
+        else:
+            print >>stderr, format_http_error("Error", resp)
+        return 1
+
+    print >>stdout, "OK"
+    return 0
@@ -0,0 +1,124 @@
+
+import os, re, struct
+
+from zope.interface import implements
+from allmydata.interfaces import IStorageBackend
+from allmydata.util import fileutil
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.mutable import MutableShareFile, \
+     create_mutable_sharefile
+from allmydata.storage.immutable import ShareFile, BucketWriter
+
+# storage/
+# storage/shares/incoming
+#   incoming/ holds temp dirs named $START/$STORAGEINDEX/$SHARENUM which will
+#   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
+# storage/shares/$START/$STORAGEINDEX
+# storage/shares/$START/$STORAGEINDEX/$SHARENUM
+
+# Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
+# base-32 chars).
+
+# $SHARENUM matches this regex:
+NUM_RE=re.compile("^[0-9]+$")
+
+
+class DiskBackend:
+    """I store each share in its own file, in the layout described above.
+    Immutable shares use the ShareFile container, mutable shares use
+    MutableShareFile."""
+    implements(IStorageBackend)
+
+    def __init__(self, storedir):
+        self.storedir = storedir
+        self.sharedir = os.path.join(storedir, "shares")
+        fileutil.make_dirs(self.sharedir)
+        self.incomingdir = os.path.join(self.sharedir, 'incoming')
+        self._clean_incomplete()
+        fileutil.make_dirs(self.incomingdir)
+
+    def _clean_incomplete(self):
+        fileutil.rm_dir(self.incomingdir)
+
+    def get_bucket_shares(self, storage_index):
+        """Return a list of (shnum, pathname) tuples for files that hold
+        shares for this storage_index. In each tuple, 'shnum' will always be
+        the integer form of the last component of 'pathname'."""
+        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+        try:
+            for f in os.listdir(storagedir):
+                if NUM_RE.match(f):
+                    filename = os.path.join(storagedir, f)
+                    yield (int(f), filename)
+        except OSError:
+            # Commonly caused by there being no buckets at all.
+            pass
+
+    def get_shares(self, storage_index, parent=None):
+        for shnum, filename in self.get_bucket_shares(storage_index):
+            f = open(filename, 'rb')
+            header = f.read(32)
+            f.close()
+            if header[:32] == MutableShareFile.MAGIC:
+                sf = MutableShareFile(filename, parent)
+                # note: if the share has been migrated, the renew_lease()
+                # call will throw an exception, with information to help the
+                # client update the lease.
+            elif header[:4] == struct.pack(">L", 1):
+                sf = ShareFile(filename)
+            else:
+                continue # non-sharefile
+            yield (shnum, sf)
+
+    def get_immutable_shares(self, storage_index):
+        for shnum, filename in self.get_bucket_shares(storage_index):
+            yield (shnum, ShareFile(filename))
+
+    def is_receiving(self, storage_index, shnum):
+        incominghome = os.path.join(self.incomingdir,
+                                    storage_index_to_dir(storage_index),
+                                    "%d" % shnum)
+        return os.path.exists(incominghome)
+
+    def make_bucket_writer(self, ss, storage_index, shnum, max_size,
+                           lease_info, canary):
+        si_dir = storage_index_to_dir(storage_index)
+        incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
+        finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
+        fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+        return BucketWriter(ss, incominghome, finalhome, max_size,
+                            lease_info, canary)
+
+    def get_mutable_shares(self, storage_index, parent=None):
+        # shares exist if there is a file for them
+        shares = {}
+        for shnum, filename in self.get_bucket_shares(storage_index):
+            shares[shnum] = MutableShareFile(filename, parent)
+        return shares
+
+    def create_mutable_share(self, storage_index, shnum, my_nodeid,
+                             write_enabler, parent=None):
+        bucketdir = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index))
+        fileutil.make_dirs(bucketdir)
+        filename = os.path.join(bucketdir, "%d" % shnum)
+        return create_mutable_sharefile(filename, my_nodeid, write_enabler,
+                                        parent)
+
+    def remove_empty_bucket(self, storage_index):
+        bucketdir = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index))
+        if os.path.isdir(bucketdir) and not os.listdir(bucketdir):
+            os.rmdir(bucketdir)
+
+    def list_packed_buckets(self, prefix):
+        return []
+
+    def get_packed_shares(self, storage_index):
+        return []
+
+    def flush(self):
+        pass
+
+    def compact(self, max_bytes=None):
+        return (0, 0)
@@ -0,0 +1,73 @@
+
+from allmydata.util.bloom import BloomFilter
+from allmydata.storage.common import si_b2a
+
+class _Generation:
+    def __init__(self, capacity):
+        self.prefixes = set()
+        self.buckets = BloomFilter(capacity)
+
+class BucketIndex:
+    """I remember which storage indexes this server holds shares for, so
+    that a query for a bucket we do not have (the usual answer to a
+    downloader's DYHB) can be answered without looking at the disk.
+
+    The BucketCountingCrawler tells me about the buckets in each prefix it
+    lists, and the StorageServer tells me about each bucket that it adds
+    shares to. Until the crawler has listed a prefix since this server
+    started, I cannot say anything about the buckets in it. Buckets are kept
+    in a BloomFilter, so I may wrongly think that a bucket exists (and the
+    caller must then look for its shares as usual), but never the other way
+    around. Removed buckets are forgotten when the crawler starts its next
+    cycle, at which point I start a new filter (sized by the number of
+    buckets seen in the last one), and switch over to it once the cycle is
+    done.
+
+    Shares that are added to the share directory by hand (and not through
+    the StorageServer) will not be found until the crawler has listed their
+    prefix again."""
+
+    MIN_CAPACITY = 10000
+    # leave room for the buckets that will be added before the next cycle
+    GROWTH_FACTOR = 2
+
+    def __init__(self):
+        self.current = None
+        self.next = None
+
+    def start_cycle(self, expected_buckets=None):
+        capacity = max(self.MIN_CAPACITY,
+                       self.GROWTH_FACTOR * (expected_buckets or 0))
+        self.next = _Generation(capacity)
+
+    def add_prefix(self, prefix, buckets, expected_buckets=None):
+        """Record the (base32) storage indexes of all buckets in 'prefix'.
+        'expected_buckets' is what the crawler would have passed to
+        start_cycle(), in case it resumed a cycle after a restart."""
+        if self.next is None:
+            # the crawler resumed a cycle that was interrupted by a restart
+            self.start_cycle(expected_buckets)
+        for storage_index_b32 in buckets:
+            self.next.buckets.add(storage_index_b32)
+        self.next.prefixes.add(prefix)
+
+    def finish_cycle(self):
+        if self.next is not None:
+            self.current = self.next
+            self.next = None
+
+    def add_bucket(self, storage_index):
+        storage_index_b32 = si_b2a(storage_index)
+        for generation in (self.current, self.next):
+            if generation is not None:
+                generation.buckets.add(storage_index_b32)
+
+    def may_have_bucket(self, storage_index):
+        """Return False if this server is known to hold no shares for
+        'storage_index', and True if it might."""
+        storage_index_b32 = si_b2a(storage_index)
+        prefix = storage_index_b32[:2]
+        for generation in (self.next, self.current):
+            if generation is not None and prefix in generation.prefixes:
+                return storage_index_b32 in generation.buckets
+        return True
@@ -1,14 +1,63 @@
 
-import os, time, struct
+import os, time, struct, threading
 import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
+from twisted.python import threadpool
 from twisted.application import service
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.util import fileutil, log
 
 class TimeSliceExceeded(Exception):
     pass
 
+class IOBudget:
+    """I limit the rate at which crawler worker threads touch the disk, in
+    operations per second (each stat, listdir, or share read counts as one)
+    and/or bytes per second. Workers call charge() before doing the I/O it
+    describes, and charge() sleeps (in the worker thread) until the budget
+    allows it. The budget is shared by all workers, and unused budget is not
+    saved up, so an idle crawler cannot make a burst of I/O later. Work
+    done in the reactor thread, which must not sleep, can be charged with
+    wait=False: the workers then wait for it instead.
+
+    A limit of None means that rate is not limited."""
+
+    def __init__(self, iops=None, bytes_per_second=None,
+                 clock=time.time, sleep=time.sleep):
+        self.iops = iops
+        self.bytes_per_second = bytes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._next_free = 0.0
+
+    def get_cost(self, ops, nbytes):
+        cost = 0.0
+        if self.iops:
+            cost = max(cost, float(ops) / self.iops)
+        if self.bytes_per_second:
+            cost = max(cost, float(nbytes) / self.bytes_per_second)
+        return cost
+
+    def charge(self, ops=1, nbytes=0, wait=True):
+        """Wait until 'ops' operations reading 'nbytes' bytes fit in the
+        budget. Returns the number of seconds I waited (or, with wait=False,
+        should have waited)."""
+        cost = self.get_cost(ops, nbytes)
+        if not cost:
+            return 0.0
+        self._lock.acquire()
+        try:
+            now = self.clock()
+            start = max(now, self._next_free)
+            self._next_free = start + cost
+        finally:
+            self._lock.release()
+        delay = start - now
+        if delay > 0 and wait:
+            self.sleep(delay)
+        return delay
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -35,14 +84,16 @@ class ShareCrawler(service.MultiService):
 
     To use a crawler, create a subclass which implements the process_bucket()
     method. It will be called with a prefixdir and a base32 storage index
-    string. process_bucket() must run synchronously. Any keys added to
-    self.state will be preserved. Override add_initial_state() to set up
-    initial state keys. Override finished_cycle() to perform additional
-    processing when the cycle is complete. Any status that the crawler
-    produces should be put in the self.state dictionary. Status renderers
-    (like a web page which describes the accomplishments of your crawler)
-    will use crawler.get_state() to retrieve this dictionary; they can
-    present the contents as they see fit.
+    string. If the server's backend keeps some shares outside of the bucket
+    directories (see IStorageBackend.get_packed_shares), that bucket
+    directory might not exist. process_bucket() must run synchronously. Any
+    keys added to self.state will be preserved. Override add_initial_state()
+    to set up initial state keys. Override finished_cycle() to perform
+    additional processing when the cycle is complete. Any status that the
+    crawler produces should be put in the self.state dictionary. Status
+    renderers (like a web page which describes the accomplishments of your
+    crawler) will use crawler.get_state() to retrieve this dictionary; they
+    can present the contents as they see fit.
 
     Then create an instance, with a reference to a StorageServer and a
     filename where it can store persistent state. The statefile is used to
@@ -55,8 +106,30 @@ class ShareCrawler(service.MultiService):
     middle of a time slice will lose progress: the next time the node is
     started, the crawler will repeat some unknown amount of work.
 
+    Crawlers which set journaled=True avoid this: each bucket is recorded in
+    an append-only journal (statefile + ".journal") as soon as it has been
+    processed, and the statefile itself is only rewritten (and the journal
+    emptied) once the journal has grown larger than the statefile, or at
+    the start and end of each cycle, or when stopService() is called. Such
+    crawlers must make all of their per-bucket changes to self.state by
+    passing a 'delta' to update_state(), and implement apply_delta(), which
+    is used again to replay the journal when the crawler is next loaded.
+
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    If worker_threads= is set to a positive number, the crawler instead runs
+    each cycle without yielding to a CPU budget: it lists prefixdirs and
+    calls examine_bucket() in a pool of that many threads, paced only by an
+    I/O budget of max_iops= operations and/or max_bytes_per_second= bytes
+    per second (see IOBudget). The results are passed to
+    process_bucket_result() in the reactor thread, in the same sorted order
+    as the serial crawler would use, so the statefile (and resumption after
+    a restart) works the same way in both modes, and the statefile is saved
+    after each prefixdir. In this mode process_prefixdir() is not used.
+    Subclasses must do all their reading in examine_bucket(), and all their
+    state changes (and any writes to shares, which might race with the
+    storage server) in process_bucket_result().
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,12 +137,20 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    # these are only used when worker_threads is nonzero, and must be set
+    # before startService() is called
+    worker_threads = 0 # 0 means crawl serially, in the reactor thread
+    max_iops = None # disk operations per second, None means unlimited
+    max_bytes_per_second = None
+    journaled = False # subclasses which use update_state() can set this
+    min_compaction_size = 1000000 # don't rewrite the statefile more often
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
         if allowed_cpu_percentage is not None:
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
+        self.backend = server.backend
         self.sharedir = server.sharedir
         self.statefile = statefile
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
@@ -83,6 +164,12 @@ class ShareCrawler(service.MultiService):
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.threadpool = None
+        self.io_budget = IOBudget() # unlimited unless we use threads
+        self.threaded_crawl = None # Deferred that fires when it stops
+        self.journalfile = statefile + ".journal"
+        self.journal = None
+        self.bucket_deltas = []
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -190,6 +277,10 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
+        #  ["journal-generation"]: int, incremented each time a journaled
+        #                          crawler saves the statefile. The journal
+        #                          is only replayed if its first record has
+        #                          the same generation number.
         try:
             f = open(self.statefile, "rb")
             state = pickle.load(f)
@@ -209,6 +300,86 @@ class ShareCrawler(service.MultiService):
         else:
             self.last_complete_prefix_index = self.prefixes.index(lcp)
         self.add_initial_state()
+        try:
+            self.statefile_size = os.path.getsize(self.statefile)
+        except EnvironmentError:
+            self.statefile_size = 0
+        self.close_journal()
+        self.journal_size = None # None means the journal must be rewritten
+        if self.journaled:
+            self.replay_journal()
+
+    def read_journal(self):
+        # returns a list of records, and the length of the part of the file
+        # that holds them. A SIGKILL in the middle of append_to_journal()
+        # can leave a partial record at the end, which we ignore.
+        records = []
+        length = 0
+        try:
+            f = open(self.journalfile, "rb")
+        except EnvironmentError:
+            return records, length
+        try:
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                (size,) = struct.unpack(">L", header)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                try:
+                    records.append(pickle.loads(data))
+                except Exception:
+                    break
+                length += 4 + size
+        finally:
+            f.close()
+        return records, length
+
+    def replay_journal(self):
+        records, length = self.read_journal()
+        generation = self.state.get("journal-generation", 0)
+        if not records or records[0] != ("generation", generation):
+            # this journal is missing, or was written before the statefile
+            # was last saved
+            return
+        for record in records[1:]:
+            if record[0] == "bucket":
+                (ign, bucket, deltas) = record
+                for delta in deltas:
+                    self.apply_delta(delta)
+                self.state["last-complete-bucket"] = bucket
+            elif record[0] == "prefix":
+                self.last_complete_prefix_index = record[1]
+        self.journal_size = length
+
+    def append_to_journal(self, record):
+        if self.journal is None:
+            if self.journal_size is None:
+                self.start_journal()
+            else:
+                # drop any partial record left behind by a crash
+                self.journal = open(self.journalfile, "r+b", 0)
+                self.journal.truncate(self.journal_size)
+                self.journal.seek(self.journal_size)
+        data = pickle.dumps(record, 2)
+        # a single write(), so the record is in the kernel (and will
+        # survive SIGKILL) as soon as we return
+        self.journal.write(struct.pack(">L", len(data)) + data)
+        self.journal_size += 4 + len(data)
+
+    def start_journal(self):
+        self.close_journal()
+        self.journal = open(self.journalfile, "wb", 0)
+        self.journal_size = 0
+        self.append_to_journal(("generation",
+                                self.state.get("journal-generation", 0)))
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
 
     def add_initial_state(self):
         """Hook method to add extra keys to self.state when first loaded.
@@ -229,11 +400,33 @@ class ShareCrawler(service.MultiService):
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
+        if self.journaled:
+            # this makes the old journal obsolete
+            self.state["journal-generation"] = \
+                self.state.get("journal-generation", 0) + 1
         tmpfile = self.statefile + ".tmp"
         f = open(tmpfile, "wb")
         pickle.dump(self.state, f)
+        self.statefile_size = f.tell()
         f.close()
         fileutil.move_into_place(tmpfile, self.statefile)
+        if self.journaled:
+            self.close_journal()
+            self.journal_size = None
+
+    def checkpoint(self):
+        """Make sure a SIGKILL would not lose the work done so far. A
+        journaled crawler has already recorded everything, so it only
+        rewrites the statefile when the journal has grown large enough to
+        make that worthwhile."""
+        if not self.journaled:
+            self.save_state()
+            return
+        if self.journal_size is None:
+            return # nothing has been journaled since the last save_state()
+        if self.journal_size >= max(self.min_compaction_size,
+                                    self.statefile_size):
+            self.save_state()
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -241,15 +434,38 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = True
         self.current_sleep_time = self.slow_start
         self.next_wake_time = time.time() + self.slow_start
-        self.timer = reactor.callLater(self.slow_start, self.start_slice)
+        if self.worker_threads:
+            self.io_budget = IOBudget(self.max_iops, self.max_bytes_per_second)
+            self.threadpool = threadpool.ThreadPool(self.worker_threads,
+                                                    self.worker_threads,
+                                                    name=self.__class__.__name__)
+            self.threadpool.start()
+            self.timer = reactor.callLater(self.slow_start,
+                                           self.start_threaded_cycle)
+        else:
+            self.timer = reactor.callLater(self.slow_start, self.start_slice)
         service.MultiService.startService(self)
 
     def stopService(self):
         if self.timer:
             self.timer.cancel()
             self.timer = None
-        self.save_state()
-        return service.MultiService.stopService(self)
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        if self.threaded_crawl:
+            # now that self.running is False, no new work will be started,
+            # but let the workers finish the buckets they are examining, so
+            # their results are recorded before we save the state
+            crawl = self.threaded_crawl
+            d.addCallback(lambda ign: crawl)
+        def _stopped(res):
+            if self.threadpool:
+                self.threadpool.stop()
+                self.threadpool = None
+            self.save_state()
+            self.close_journal()
+            return res
+        d.addCallback(_stopped)
+        return d
 
     def start_slice(self):
         start_slice = time.time()
@@ -262,7 +478,7 @@ class ShareCrawler(service.MultiService):
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
-        self.save_state()
+        self.checkpoint()
         if not self.running:
             # someone might have used stopService() to shut us down
             return
@@ -292,16 +508,7 @@ class ShareCrawler(service.MultiService):
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
     def start_current_prefix(self, start_slice):
-        state = self.state
-        if state["current-cycle"] is None:
-            self.last_cycle_started_time = time.time()
-            state["current-cycle-start-time"] = self.last_cycle_started_time
-            if state["last-cycle-finished"] is None:
-                state["current-cycle"] = 0
-            else:
-                state["current-cycle"] = state["last-cycle-finished"] + 1
-            self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+        cycle = self.maybe_start_cycle()
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
             # if we want to yield earlier, just raise TimeSliceExceeded()
@@ -310,28 +517,82 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.list_prefixdir(prefixdir)
+                buckets = self.add_packed_buckets(prefix, buckets)
                 self.bucket_cache = (i, buckets)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
-            self.last_complete_prefix_index = i
-
-            now = time.time()
-            if self.last_prefix_finished_time is not None:
-                elapsed = now - self.last_prefix_finished_time
-                self.last_prefix_elapsed_time = elapsed
-            self.last_prefix_finished_time = now
-
-            self.finished_prefix(cycle, prefix)
+            self.finish_prefix(cycle, i)
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
+        self.finish_cycle(cycle)
+
+    def maybe_start_cycle(self):
+        state = self.state
+        if state["current-cycle"] is None:
+            self.last_cycle_started_time = time.time()
+            state["current-cycle-start-time"] = self.last_cycle_started_time
+            if state["last-cycle-finished"] is None:
+                state["current-cycle"] = 0
+            else:
+                state["current-cycle"] = state["last-cycle-finished"] + 1
+            self.started_cycle(state["current-cycle"])
+            if self.journaled:
+                self.save_state()
+        return state["current-cycle"]
+
+    def list_prefixdir(self, prefixdir):
+        try:
+            buckets = os.listdir(prefixdir)
+            buckets.sort()
+        except EnvironmentError:
+            buckets = []
+        return buckets
+
+    def add_packed_buckets(self, prefix, buckets):
+        # some backends keep shares outside of the bucket directories. Their
+        # index lives with the storage server, in the reactor thread.
+        packed = self.backend.list_packed_buckets(prefix)
+        if not packed:
+            return buckets
+        return sorted(set(buckets) | set(packed))
+
+    def finish_prefix(self, cycle, i):
+        self.last_complete_prefix_index = i
+
+        now = time.time()
+        if self.last_prefix_finished_time is not None:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed
+        self.last_prefix_finished_time = now
+
+        if self.journaled:
+            self.append_to_journal(("prefix", i))
+        self.finished_prefix(cycle, self.prefixes[i])
+
+    def finish_bucket(self, storage_index_b32):
+        self.state["last-complete-bucket"] = storage_index_b32
+        if self.journaled:
+            self.append_to_journal(("bucket", storage_index_b32,
+                                    self.bucket_deltas))
+            self.bucket_deltas = []
+
+    def update_state(self, delta):
+        """Apply a change to self.state, by passing 'delta' to
+        apply_delta(). If I am journaled, the delta will be recorded in the
+        journal along with the bucket that is being processed, and applied
+        again if the node is restarted before the statefile is next saved.
+        'delta' must be picklable."""
+        self.apply_delta(delta)
+        if self.journaled:
+            self.bucket_deltas.append(delta)
+
+    def finish_cycle(self, cycle):
+        state = self.state
         self.last_complete_prefix_index = -1
+        self.bucket_cache = (None, []) # the next cycle must list it again
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
         if self.last_cycle_started_time is not None:
@@ -342,6 +603,133 @@ class ShareCrawler(service.MultiService):
         self.finished_cycle(cycle)
         self.save_state()
 
+    def start_threaded_cycle(self):
+        self.timer = None
+        self.sleeping_between_cycles = False
+        self.current_sleep_time = None
+        self.next_wake_time = None
+        cycle = self.maybe_start_cycle()
+        d = self.crawl_prefixes_in_threads(cycle)
+        def _done(finished_cycle):
+            self.threaded_crawl = None
+            if not finished_cycle or not self.running:
+                # stopService() is waiting for us, and will save the state
+                return
+            self.finish_cycle(cycle)
+            if not self.running:
+                # finished_cycle() might have stopped us
+                return
+            self.sleeping_between_cycles = True
+            sleep_time = self.minimum_cycle_time
+            self.current_sleep_time = sleep_time
+            self.next_wake_time = time.time() + sleep_time
+            self.yielding(sleep_time)
+            self.timer = reactor.callLater(sleep_time,
+                                           self.start_threaded_cycle)
+        d.addCallback(_done)
+        def _failed(f):
+            self.threaded_crawl = None
+            log.err(f, "%s failed" % self.__class__.__name__,
+                    facility="tahoe.storage.crawler")
+            if not self.running:
+                return
+            # try again later, resuming from the last completed bucket. Like
+            # start_slice(), don't wait more than 5 minutes.
+            self.checkpoint()
+            sleep_time = 299
+            self.current_sleep_time = sleep_time
+            self.next_wake_time = time.time() + sleep_time
+            self.timer = reactor.callLater(sleep_time,
+                                           self.start_threaded_cycle)
+        d.addErrback(_failed)
+        self.threaded_crawl = d
+
+    def defer_to_worker(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.threadpool, f, *args)
+
+    def crawl_prefixes_in_threads(self, cycle):
+        """Examine the rest of the current cycle with my worker threads.
+        Returns a Deferred that fires with True when the cycle is complete,
+        or False if stopService() was called first."""
+        finished = defer.Deferred()
+        def _next_prefix(ignored=None):
+            i = self.last_complete_prefix_index + 1
+            if i >= len(self.prefixes):
+                finished.callback(True)
+                return
+            if not self.running:
+                finished.callback(False)
+                return
+            prefix = self.prefixes[i]
+            prefixdir = os.path.join(self.sharedir, prefix)
+            d = self.defer_to_worker(self._list_prefixdir_in_thread, prefixdir)
+            d.addCallback(lambda buckets:
+                          self.add_packed_buckets(prefix, buckets))
+            d.addCallback(lambda buckets:
+                          self.crawl_buckets_in_threads(cycle, prefix,
+                                                        prefixdir, buckets))
+            def _crawled(complete):
+                if not complete:
+                    finished.callback(False)
+                    return
+                self.finish_prefix(cycle, i)
+                self.checkpoint()
+                # avoid recursion when prefixdirs are empty
+                reactor.callLater(0, _next_prefix)
+            d.addCallback(_crawled)
+            d.addErrback(finished.errback)
+        _next_prefix()
+        return finished
+
+    def _list_prefixdir_in_thread(self, prefixdir):
+        self.io_budget.charge(1)
+        return self.list_prefixdir(prefixdir)
+
+    def crawl_buckets_in_threads(self, cycle, prefix, prefixdir, buckets):
+        # examine up to 2*worker_threads buckets at once, so no worker is
+        # left idle, but process the results in sorted order so that
+        # ["last-complete-bucket"] remains a safe place to resume from.
+        # Returns a Deferred that fires with True once every bucket has been
+        # processed, or False if we were stopped first.
+        todo = [b for b in buckets if b > self.state["last-complete-bucket"]]
+        todo.reverse()
+        in_flight = []
+        finished = defer.Deferred()
+        def _fill():
+            if finished.called:
+                return
+            while todo and self.running and \
+                      len(in_flight) < 2*self.worker_threads:
+                bucket = todo.pop()
+                d = self.defer_to_worker(self.examine_bucket,
+                                         prefixdir, bucket)
+                # every examination gets an errback as soon as it starts,
+                # so a failure that is not at the head of the queue stops
+                # the crawl instead of going unhandled
+                d.addErrback(_failed)
+                in_flight.append( (bucket, d) )
+            if not in_flight:
+                finished.callback(not todo)
+                return
+            (bucket, d) = in_flight[0]
+            d.addCallback(_examined, bucket)
+            d.addErrback(_failed)
+        def _examined(result, bucket):
+            if finished.called:
+                # an earlier failure abandoned this prefix: the bucket will
+                # be examined again when the crawl resumes
+                return
+            in_flight.pop(0)
+            self.process_bucket_result(cycle, prefix, prefixdir, bucket,
+                                       result)
+            self.finish_bucket(bucket)
+            _fill()
+        def _failed(f):
+            if not finished.called:
+                finished.errback(f)
+        _fill()
+        return finished
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
         base32-encoded) in sorted order.
@@ -358,7 +746,7 @@ class ShareCrawler(service.MultiService):
             if bucket <= self.state["last-complete-bucket"]:
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
-            self.state["last-complete-bucket"] = bucket
+            self.finish_bucket(bucket)
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
 
@@ -381,6 +769,7 @@ class ShareCrawler(service.MultiService):
         duplicated, according to when self.save_state() was last called. By
         default, save_state() is called at the end of each timeslice, and
         after finished_cycle() returns, and when stopService() is called.
+        Journaled crawlers (see update_state()) lose no work at all.
 
         To reduce the chance of duplicate work (i.e. to avoid adding multiple
         records to a database), you can call save_state() at the end of your
@@ -394,6 +783,39 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
+    def apply_delta(self, delta):
+        """Apply a change that was passed to update_state() to self.state.
+        This is called once by update_state(), and again for each delta in
+        the journal when a journaled crawler is loaded, so it must use
+        nothing but 'delta' and self.state.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
+    def examine_bucket(self, prefixdir, storage_index_b32):
+        """Look at a single bucket, in a worker thread, and return whatever
+        process_bucket_result() needs to know about it. This is only used
+        when worker_threads is nonzero. Call self.io_budget.charge() before
+        each disk access. Do not modify self.state or any shares here: this
+        runs concurrently with the reactor and with other workers.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return None
+
+    def process_bucket_result(self, cycle, prefix, prefixdir,
+                              storage_index_b32, result):
+        """Handle the return value of examine_bucket(), in the reactor
+        thread, updating self.state as necessary. This is only used when
+        worker_threads is nonzero. By default this calls process_bucket(),
+        so crawlers which do not split their work into the two halves will
+        still run correctly (if not much faster) with worker threads.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        self.process_bucket(cycle, prefix, prefixdir, storage_index_b32)
+
     def finished_prefix(self, cycle, prefix):
         """Notify a subclass that the crawler has just finished processing a
         prefix directory (all buckets with the same two-character/10bit
@@ -459,11 +881,18 @@ class BucketCountingCrawler(ShareCrawler):
         self.state.setdefault("last-complete-bucket-count", None)
         self.state.setdefault("storage-index-samples", {})
 
+    def started_cycle(self, cycle):
+        # while we list every prefix, the server's BucketIndex is rebuilt
+        expected = self.state["last-complete-bucket-count"]
+        self.server.bucket_index.start_cycle(expected)
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         # we override process_prefixdir() because we don't want to look at
         # the individual buckets. We'll save state after each one. On my
         # laptop, a mostly-empty storage server can process about 70
         # prefixdirs in a 1.0s slice.
+        expected = self.state["last-complete-bucket-count"]
+        self.server.bucket_index.add_prefix(prefix, buckets, expected)
         if cycle not in self.state["bucket-counts"]:
             self.state["bucket-counts"][cycle] = {}
         self.state["bucket-counts"][cycle][prefix] = len(buckets)
@@ -471,6 +900,7 @@ class BucketCountingCrawler(ShareCrawler):
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
 
     def finished_cycle(self, cycle):
+        self.server.bucket_index.finish_cycle()
         last_counts = self.state["bucket-counts"].get(cycle, [])
         if len(last_counts) == len(self.prefixes):
             # great, we have a whole cycle.
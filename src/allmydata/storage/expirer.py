@@ -2,8 +2,20 @@ import time, os, pickle, struct
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
-from twisted.python import log as twlog
+     UnknownImmutableContainerVersionError, si_a2b
+from twisted.python import log as twlog, failure
+
+# reading a share's header or its leases costs at least one disk page
+PAGE_SIZE = 4096
+
+class PackedShareStat:
+    # what increment_space() needs to know about a share that has no file
+    # of its own: with no st_blocks, its disk bytes are its share bytes,
+    # unless we know better
+    def __init__(self, size, diskbytes=None):
+        self.st_size = size
+        if diskbytes is not None:
+            self.diskbytes = diskbytes
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
@@ -47,6 +59,13 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    # our cycle-to-date state is too large to rewrite after every slice, so
+    # each bucket's contribution is journaled instead
+    journaled = True
+    # how many bytes of packed shares to move out of mostly-dead segments
+    # after each bucket. This is done in the reactor thread, so it must be
+    # small enough not to hold up the server for long.
+    compaction_bytes_per_bucket = 256*1024
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -97,6 +116,23 @@ class LeaseCheckingCrawler(ShareCrawler):
                   }
         return so_far
 
+    def create_empty_delta(self):
+        # the same shape as the cycle-to-date dict, but only holding the
+        # changes made by a single bucket
+        return {"corrupt-shares": [],
+                "space-recovered": {},
+                "lease-age-histogram": {},
+                "leases-per-share-histogram": {},
+                }
+
+    def apply_delta(self, delta):
+        so_far = self.state["cycle-to-date"]
+        so_far["corrupt-shares"].extend(delta["corrupt-shares"])
+        for k in ("space-recovered", "lease-age-histogram",
+                  "leases-per-share-histogram"):
+            for (key, value) in delta[k].items():
+                self.increment(so_far[k], key, value)
+
     def create_empty_recovered_dict(self):
         recovered = {}
         for a in ("actual", "original", "configured", "examined"):
@@ -113,34 +149,109 @@ class LeaseCheckingCrawler(ShareCrawler):
         return os.stat(fn)
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        result = self.examine_bucket(prefixdir, storage_index_b32)
+        self.process_bucket_result(cycle, prefix, prefixdir,
+                                   storage_index_b32, result)
+
+    def examine_bucket(self, prefixdir, storage_index_b32):
+        # This runs in a worker thread if we have any, so it only reads: we
+        # return the bucket's stat() and a list of (shnum, sharefile,
+        # sharetype, stat, leases) tuples, with sharetype=None if the share
+        # could not be parsed. process_bucket_result() does the rest.
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
-        would_keep_shares = []
-        wks = None
-
-        for fn in os.listdir(bucketdir):
+        shares = []
+        self.io_budget.charge(2) # stat and listdir
+        try:
+            s = self.stat(bucketdir)
+        except OSError:
+            # no bucket directory, because all of its shares are packed
+            return (None, shares)
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            # the bucket was deleted after we stat()ed it
+            return (None, shares)
+        for fn in filenames:
             try:
                 shnum = int(fn)
             except ValueError:
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
+            # stat, then read the header and the leases
+            self.io_budget.charge(3, 2*PAGE_SIZE)
             try:
-                wks = self.process_share(sharefile)
+                shares.append(self.examine_share(shnum, sharefile))
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
+                shares.append( (shnum, sharefile, None, failure.Failure(),
+                                None) )
+            except EnvironmentError:
+                # the share was deleted while we were looking at it
+                pass
+        return (s, shares)
+
+    def examine_share(self, shnum, sharefile):
+        sf = get_share_file(sharefile)
+        s = self.stat(sharefile)
+        return (shnum, sharefile, sf.sharetype, s, list(sf.get_leases()))
+
+    def examine_packed_shares(self, storage_index_b32):
+        # the backend's index is only used from the reactor thread. Reading
+        # it does not touch the share data, so we charge nothing here.
+        shares = []
+        storage_index = si_a2b(storage_index_b32)
+        for (shnum, sf) in self.backend.get_packed_shares(storage_index):
+            shares.append( (shnum, sf, sf.sharetype,
+                            PackedShareStat(sf.get_length()),
+                            list(sf.get_leases())) )
+        return shares
+
+    def get_share(self, sharefile):
+        # 'sharefile' is a filename, or a share object from
+        # examine_packed_shares()
+        if isinstance(sharefile, str):
+            return get_share_file(sharefile)
+        return sharefile
+
+    def process_bucket_result(self, cycle, prefix, prefixdir,
+                              storage_index_b32, result):
+        (s, shares) = result
+        shares = shares + self.examine_packed_shares(storage_index_b32)
+        so_far = self.create_empty_delta()
+        would_keep_shares = []
+        wks = None
+
+        for (shnum, sharefile, sharetype, share_s, leases) in shares:
+            if sharetype is None:
                 twlog.msg("lease-checker error processing %s" % sharefile)
-                twlog.err()
+                twlog.err(share_s)
                 which = (storage_index_b32, shnum)
-                self.state["cycle-to-date"]["corrupt-shares"].append(which)
+                so_far["corrupt-shares"].append(which)
                 wks = (1, 1, 1, "unknown")
+            else:
+                wks = self.process_share(so_far, sharefile, sharetype,
+                                         share_s, leases)
             would_keep_shares.append(wks)
 
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
             sharetype = wks[3]
-        rec = self.state["cycle-to-date"]["space-recovered"]
+        rec = so_far["space-recovered"]
+        if self.expiration_enabled:
+            # deleting packed shares only gives their space back once their
+            # segment is deleted or compacted, which we count here. The
+            # copy is made in this (the reactor) thread, so the worker
+            # threads wait out its share of the I/O budget instead.
+            (copied, compacted) = self.backend.compact(
+                self.compaction_bytes_per_bucket)
+            if copied:
+                self.io_budget.charge(2, 2*copied, wait=False)
+            if compacted:
+                self.server.space.space_freed(compacted)
+                self.increment(rec, "actual-diskbytes", compacted)
+                self.increment(rec, "actual-diskbytes-immutable", compacted)
         self.increment(rec, "examined-buckets", 1)
         if sharetype:
             self.increment(rec, "examined-buckets-"+sharetype, 1)
@@ -148,92 +259,107 @@ class LeaseCheckingCrawler(ShareCrawler):
         try:
             bucket_diskbytes = s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
+            # no stat().st_blocks on windows, and no bucket directory (s is
+            # None) if every share is packed
+            bucket_diskbytes = 0
         if sum([wks[0] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("original", bucket_diskbytes, sharetype)
+            self.increment_bucketspace(so_far, "original", bucket_diskbytes,
+                                       sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
+            self.increment_bucketspace(so_far, "configured", bucket_diskbytes,
+                                       sharetype)
         if sum([wks[2] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
+            self.increment_bucketspace(so_far, "actual", bucket_diskbytes,
+                                       sharetype)
+        self.update_state(so_far)
+
+    def is_expired(self, li, sharetype):
+        # expired-or-not according to our configured age limit
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return li.get_age() > age_limit
+        else:
+            assert self.mode == "cutoff-date"
+            return li.get_grant_renew_time_time() < self.cutoff_date
 
-    def process_share(self, sharefilename):
-        # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
-        sharetype = sf.sharetype
+    def process_share(self, so_far, sharefilename, sharetype, s, leases):
         now = time.time()
-        s = self.stat(sharefilename)
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
-        expired_leases_configured = []
+        num_expired_leases_configured = 0
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
-            age = li.get_age()
-            self.add_lease_age_to_histogram(age)
+            self.add_lease_age_to_histogram(so_far, li.get_age())
 
             #  expired-or-not according to original expiration time
             if original_expiration_time > now:
                 num_valid_leases_original += 1
 
-            #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
-                expired_leases_configured.append(li)
+            if self.is_expired(li, sharetype):
+                num_expired_leases_configured += 1
             else:
                 num_valid_leases_configured += 1
 
-        so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
-        self.increment_space("examined", s, sharetype)
+        self.increment_space(so_far, "examined", s, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
-
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+        freed = 0
+
+        if self.expiration_enabled and num_expired_leases_configured:
+            # the leases we looked at might have been read in a worker
+            # thread, and renewed since then, so read them again (here in
+            # the reactor thread, where the storage server changes them)
+            # before cancelling any. The share might also have been deleted
+            # since then, in which case there is nothing left to cancel.
+            try:
+                sf = self.get_share(sharefilename)
+                for li in list(sf.get_leases()):
+                    if self.is_expired(li, sharetype):
+                        freed += sf.cancel_lease(li.cancel_secret)
+            except EnvironmentError:
+                pass
+            self.server.space.space_freed(freed)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space(so_far, "original", s, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
+            self.increment_space(so_far, "configured", s, sharetype)
             if self.expiration_enabled:
                 would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+                if not isinstance(sharefilename, str):
+                    # a packed share only frees what cancel_lease() said
+                    s = PackedShareStat(s.st_size, freed)
+                self.increment_space(so_far, "actual", s, sharetype)
 
         return would_keep_share
 
-    def increment_space(self, a, s, sharetype):
+    def increment_space(self, so_far, a, s, sharetype):
         sharebytes = s.st_size
-        try:
-            # note that stat(2) says that st_blocks is 512 bytes, and that
-            # st_blksize is "optimal file sys I/O ops blocksize", which is
-            # independent of the block-size that st_blocks uses.
-            diskbytes = s.st_blocks * 512
-        except AttributeError:
-            # the docs say that st_blocks is only on linux. I also see it on
-            # MacOS. But it isn't available on windows.
-            diskbytes = sharebytes
-        so_far_sr = self.state["cycle-to-date"]["space-recovered"]
+        # a packed share knows how much disk its removal really gave back
+        diskbytes = getattr(s, "diskbytes", None)
+        if diskbytes is None:
+            try:
+                # note that stat(2) says that st_blocks is 512 bytes, and
+                # that st_blksize is "optimal file sys I/O ops blocksize",
+                # which is independent of the block-size that st_blocks uses.
+                diskbytes = s.st_blocks * 512
+            except AttributeError:
+                # the docs say that st_blocks is only on linux. I also see
+                # it on MacOS. But it isn't available on windows.
+                diskbytes = sharebytes
+        so_far_sr = so_far["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
         self.increment(so_far_sr, a+"-diskbytes", diskbytes)
@@ -242,8 +368,8 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
             self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
 
-    def increment_bucketspace(self, a, bucket_diskbytes, sharetype):
-        rec = self.state["cycle-to-date"]["space-recovered"]
+    def increment_bucketspace(self, so_far, a, bucket_diskbytes, sharetype):
+        rec = so_far["space-recovered"]
         self.increment(rec, a+"-diskbytes", bucket_diskbytes)
         self.increment(rec, a+"-buckets", 1)
         if sharetype:
@@ -255,13 +381,13 @@ class LeaseCheckingCrawler(ShareCrawler):
             d[k] = 0
         d[k] += delta
 
-    def add_lease_age_to_histogram(self, age):
+    def add_lease_age_to_histogram(self, so_far, age):
         bucket_interval = 24*60*60
         bucket_number = int(age/bucket_interval)
         bucket_start = bucket_number * bucket_interval
         bucket_end = bucket_start + bucket_interval
         k = (bucket_start, bucket_end)
-        self.increment(self.state["cycle-to-date"]["lease-age-histogram"], k, 1)
+        self.increment(so_far["lease-age-histogram"], k, 1)
 
     def convert_lease_age_histogram(self, lah):
         # convert { (minage,maxage) : count } into [ (minage,maxage,count) ]
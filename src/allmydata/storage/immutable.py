@@ -1,4 +1,5 @@
-import os, stat, struct, time
+import os, sys, stat, struct, time, mmap, weakref, itertools
+from collections import OrderedDict
 
 from foolscap.api import Referenceable
 
@@ -36,6 +37,10 @@ from allmydata.storage.common import UnknownImmutableContainerVersionError, \
 # then the value stored in this field will be the actual share data length
 # modulo 2**32.
 
+# On Windows, a share file cannot be deleted while it is mapped, which would
+# get in the way of lease expiration.
+MMAP_SHARES = not sys.platform.startswith("win")
+
 class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
@@ -92,6 +97,38 @@ class ShareFile:
         f.seek(seekpos)
         return f.read(actuallength)
 
+    def get_data_length(self):
+        return self._lease_offset - self._data_offset
+
+    def open_mapping(self):
+        """Return a read-only mmap of my header and share data (but not my
+        leases, which may change), to be handed to read_mapped_share_data().
+        Return None if there is no share data, or if the mapping could not be
+        made, in which case callers should use read_share_data() instead."""
+        if self._lease_offset <= self._data_offset:
+            return None
+        f = open(self.home, 'rb')
+        try:
+            try:
+                return mmap.mmap(f.fileno(), self._lease_offset,
+                                 access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError), e:
+                log.msg("unable to mmap share %s: %s" % (self.home, e),
+                        level=log.UNUSUAL)
+                return None
+        finally:
+            f.close()
+
+    def read_mapped_share_data(self, mapping, offset, length):
+        # the same as read_share_data(), but served from the page cache
+        # without a seek and read for each call
+        precondition(offset >= 0)
+        seekpos = self._data_offset+offset
+        actuallength = max(0, min(length, self._lease_offset-seekpos))
+        if actuallength == 0:
+            return ""
+        return mapping[seekpos:seekpos+actuallength]
+
     def write_share_data(self, offset, data):
         length = len(data)
         precondition(offset >= 0, offset)
@@ -227,8 +264,7 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         start = time.time()
 
-        fileutil.make_dirs(os.path.dirname(self.finalhome))
-        fileutil.rename(self.incominghome, self.finalhome)
+        filelen = self._move_into_place()
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -257,11 +293,17 @@ class BucketWriter(Referenceable):
         self.closed = True
         self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
         self.ss.bucket_writer_closed(self, filelen)
         self.ss.add_latency("close", time.time() - start)
         self.ss.count("close")
 
+    def _move_into_place(self):
+        # the share in self.incominghome is complete. Move it to wherever
+        # it will be read from, and return the number of bytes it uses there.
+        fileutil.make_dirs(os.path.dirname(self.finalhome))
+        fileutil.rename(self.incominghome, self.finalhome)
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
     def _disconnected(self):
         if not self.closed:
             self._abort()
@@ -293,14 +335,70 @@ class BucketWriter(Referenceable):
         self.ss.bucket_writer_closed(self, 0)
 
 
+MAX_MAPPED_SHARES = 200
+
+class MappedShares:
+    """I limit how many BucketReaders may hold a mapping of their share at
+    once. Each mapping keeps its share file open and uses address space
+    until its reader is released, which happens only when the downloader
+    drops its reference. When a new mapping would exceed the limit, the
+    reader that has gone longest without a read loses its mapping, and
+    serves the rest of its reads with read_share_data()."""
+
+    def __init__(self, max_mappings=MAX_MAPPED_SHARES):
+        self.max_mappings = max_mappings
+        self._readers = OrderedDict() # key -> weakref to BucketReader, LRU first
+        self._keys = itertools.count()
+
+    def __len__(self):
+        return len(self._readers)
+
+    def add(self, reader):
+        """Make room for, and start tracking, the mapping of 'reader'.
+        Return a key to pass to used() and remove()."""
+        while self._readers and len(self._readers) >= self.max_mappings:
+            (oldkey, ref) = self._readers.popitem(last=False)
+            evicted = ref()
+            if evicted is not None:
+                evicted.drop_mapping()
+        key = self._keys.next()
+        # a released reader takes its mapping with it, and the callback
+        # frees its slot
+        self._readers[key] = weakref.ref(reader,
+                                         lambda ref: self.remove(key))
+        return key
+
+    def used(self, key):
+        ref = self._readers.pop(key, None)
+        if ref is not None:
+            self._readers[key] = ref
+
+    def remove(self, key):
+        self._readers.pop(key, None)
+
+
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, share, storage_index=None, shnum=None,
+                 mmap_threshold=None):
+        # 'share' is a ShareFile (or an immutable share from some other
+        # backend), or the filename of a ShareFile. If 'mmap_threshold' is
+        # not None, a ShareFile with at least that much data is mmapped when
+        # it is first read, and later reads are served from the mapping,
+        # as long as ss.mapped_shares leaves us a place for it.
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if isinstance(share, str):
+            share = ShareFile(share)
+        self._share_file = share
         self.storage_index = storage_index
         self.shnum = shnum
+        self._mapping = None
+        self._mapping_key = None
+        self._use_mapping = (mmap_threshold is not None
+                             and MMAP_SHARES
+                             and isinstance(share, ShareFile)
+                             and share.get_data_length() >= mmap_threshold)
 
     def __repr__(self):
         return "<%s %s %s>" % (self.__class__.__name__,
@@ -309,11 +407,31 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
+        if self._use_mapping and self._mapping is None:
+            self._mapping = self._share_file.open_mapping()
+            self._use_mapping = self._mapping is not None
+            if self._mapping is not None:
+                self._mapping_key = self.ss.mapped_shares.add(self)
+        elif self._mapping is not None:
+            self.ss.mapped_shares.used(self._mapping_key)
+        if self._mapping is not None:
+            data = self._share_file.read_mapped_share_data(self._mapping,
+                                                           offset, length)
+        else:
+            data = self._share_file.read_share_data(offset, length)
         self.ss.add_latency("read", time.time() - start)
         self.ss.count("read")
         return data
 
+    def drop_mapping(self):
+        # called by MappedShares when it needs our place. Later reads use
+        # read_share_data(), rather than taking a place from someone else.
+        self._use_mapping = False
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+            self.ss.mapped_shares.remove(self._mapping_key)
+
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
                                                    self.storage_index,
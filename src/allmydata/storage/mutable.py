@@ -50,6 +50,13 @@ class MutableShareFile:
     assert len(MAGIC) == 32
     MAX_SIZE = 2*1000*1000*1000 # 2GB, kind of arbitrary
     # TODO: decide upon a policy for max share size
+    # When the data outgrows its container, we enlarge the container by
+    # this much more than is needed (as a fraction of the new size, up to
+    # MAX_PREALLOCATION bytes), so that a share which grows a little at a
+    # time (like a directory) does not need its extra leases moved on every
+    # write.
+    PREALLOCATION_FRACTION = 0.5
+    MAX_PREALLOCATION = 1000*1000
 
     def __init__(self, filename, parent=None):
         self.home = filename
@@ -98,6 +105,11 @@ class MutableShareFile:
         (data_length,) = struct.unpack(">Q", f.read(8))
         return data_length
 
+    def _read_data_length_and_extra_lease_offset(self, f):
+        # these are adjacent, so one read gets both
+        f.seek(self.DATA_LENGTH_OFFSET)
+        return struct.unpack(">QQ", f.read(16))
+
     def _write_data_length(self, f, data_length):
         f.seek(self.DATA_LENGTH_OFFSET)
         f.write(struct.pack(">Q", data_length))
@@ -161,11 +173,16 @@ class MutableShareFile:
         f.write(extra_lease_data)
         self._write_extra_lease_offset(f, new_extra_lease_offset)
 
+    def _get_preallocated_size(self, needed_size):
+        extra = min(int(needed_size * self.PREALLOCATION_FRACTION),
+                    self.MAX_PREALLOCATION)
+        return max(min(needed_size + extra, self.MAX_SIZE), needed_size)
+
     def _write_share_data(self, f, offset, data):
         length = len(data)
         precondition(offset >= 0)
-        data_length = self._read_data_length(f)
-        extra_lease_offset = self._read_extra_lease_offset(f)
+        (data_length, extra_lease_offset) = \
+                      self._read_data_length_and_extra_lease_offset(f)
 
         if offset+length >= data_length:
             # They are expanding their data size.
@@ -177,8 +194,10 @@ class MutableShareFile:
                 # Their new data won't fit in the current container, so we
                 # have to move the leases. With luck, they're expanding it
                 # more than the size of the extra lease block, which will
-                # minimize the corrupt-the-share window
-                self._change_container_size(f, offset+length)
+                # minimize the corrupt-the-share window. We leave room to
+                # grow, so this will not be needed again for a while.
+                self._change_container_size(f,
+                             self._get_preallocated_size(offset+length))
                 extra_lease_offset = self._read_extra_lease_offset(f)
 
                 # an interrupt here is ok.. the container has been enlarged
@@ -203,6 +222,38 @@ class MutableShareFile:
         f.write(data)
         return
 
+    def _get_lease_offset(self, extra_lease_offset, lease_number):
+        if lease_number < 4:
+            return self.HEADER_SIZE + lease_number * self.LEASE_SIZE
+        return extra_lease_offset + 4 + (lease_number-4)*self.LEASE_SIZE
+
+    def _read_lease_slots(self, f):
+        # Return (extra_lease_offset, slots), where slots has a LeaseInfo
+        # (or None, if it is empty) for each lease slot. This reads the
+        # four leases in the header along with the extra lease offset which
+        # precedes them, and then all of the extra leases, so it takes two
+        # seeks however many leases there are.
+        f.seek(self.EXTRA_LEASE_OFFSET)
+        data = f.read(8 + 4*self.LEASE_SIZE)
+        (extra_lease_offset,) = struct.unpack(">Q", data[:8])
+        f.seek(extra_lease_offset)
+        (num_extra_leases,) = struct.unpack(">L", f.read(4))
+        data = data[8:] + f.read(num_extra_leases * self.LEASE_SIZE)
+        slots = []
+        for i in range(len(data) // self.LEASE_SIZE):
+            start = i * self.LEASE_SIZE
+            lease_info = LeaseInfo().from_mutable_data(
+                data[start:start+self.LEASE_SIZE])
+            if lease_info.owner_num == 0:
+                lease_info = None
+            slots.append(lease_info)
+        return (extra_lease_offset, slots)
+
+    def _write_lease_at(self, f, offset, lease_info):
+        f.seek(offset)
+        assert f.tell() == offset
+        f.write(lease_info.to_mutable_data())
+
     def _write_lease_record(self, f, lease_number, lease_info):
         extra_lease_offset = self._read_extra_lease_offset(f)
         num_extra_leases = self._read_num_extra_leases(f)
@@ -242,21 +293,6 @@ class MutableShareFile:
             return None
         return lease_info
 
-    def _get_num_lease_slots(self, f):
-        # how many places do we have allocated for leases? Not all of them
-        # are filled.
-        num_extra_leases = self._read_num_extra_leases(f)
-        return 4+num_extra_leases
-
-    def _get_first_empty_lease_slot(self, f):
-        # return an int with the index of an empty slot, or None if we do not
-        # currently have an empty slot
-
-        for i in range(self._get_num_lease_slots(f)):
-            if self._read_lease_record(f, i) is None:
-                return i
-        return None
-
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
         f = open(self.home, 'rb')
@@ -265,35 +301,42 @@ class MutableShareFile:
         f.close()
 
     def _enumerate_leases(self, f):
-        for i in range(self._get_num_lease_slots(f)):
-            try:
-                data = self._read_lease_record(f, i)
-                if data is not None:
-                    yield i,data
-            except IndexError:
-                return
+        (extra_lease_offset, slots) = self._read_lease_slots(f)
+        for i, lease in enumerate(slots):
+            if lease is not None:
+                yield i, lease
 
     def add_lease(self, lease_info):
         precondition(lease_info.owner_num != 0) # 0 means "no lease here"
         f = open(self.home, 'rb+')
-        num_lease_slots = self._get_num_lease_slots(f)
-        empty_slot = self._get_first_empty_lease_slot(f)
-        if empty_slot is not None:
-            self._write_lease_record(f, empty_slot, lease_info)
+        (extra_lease_offset, slots) = self._read_lease_slots(f)
+        if None in slots:
+            lease_number = slots.index(None)
         else:
-            self._write_lease_record(f, num_lease_slots, lease_info)
+            # must add an extra lease record
+            lease_number = len(slots)
+            f.seek(extra_lease_offset)
+            f.write(struct.pack(">L", lease_number+1-4))
+        self._write_lease_at(f, self._get_lease_offset(extra_lease_offset,
+                                                       lease_number),
+                             lease_info)
         f.close()
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
         f = open(self.home, 'rb+')
-        for (leasenum,lease) in self._enumerate_leases(f):
+        (extra_lease_offset, slots) = self._read_lease_slots(f)
+        for (leasenum,lease) in enumerate(slots):
+            if lease is None:
+                continue
             if constant_time_compare(lease.renew_secret, renew_secret):
                 # yup. See if we need to update the owner time.
                 if new_expire_time > lease.expiration_time:
                     # yes
                     lease.expiration_time = new_expire_time
-                    self._write_lease_record(f, leasenum, lease)
+                    offset = self._get_lease_offset(extra_lease_offset,
+                                                    leasenum)
+                    self._write_lease_at(f, offset, lease)
                 f.close()
                 return
             accepting_nodeids.add(lease.nodeid)
@@ -332,10 +375,14 @@ class MutableShareFile:
                                 expiration_time=0,
                                 nodeid="\x00"*20)
         f = open(self.home, 'rb+')
-        for (leasenum,lease) in self._enumerate_leases(f):
+        (extra_lease_offset, slots) = self._read_lease_slots(f)
+        for (leasenum,lease) in enumerate(slots):
+            if lease is None:
+                continue
             accepting_nodeids.add(lease.nodeid)
             if constant_time_compare(lease.cancel_secret, cancel_secret):
-                self._write_lease_record(f, leasenum, blank_lease)
+                offset = self._get_lease_offset(extra_lease_offset, leasenum)
+                self._write_lease_at(f, offset, blank_lease)
                 modified += 1
             else:
                 remaining += 1
@@ -369,11 +416,29 @@ class MutableShareFile:
         return (write_enabler, write_enabler_nodeid)
 
     def readv(self, readv):
-        datav = []
+        # clients (like the servermap updater) often ask for several small
+        # adjacent or overlapping pieces, so we read each run of them with a
+        # single seek and read, and look at the data length just once
         f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+        try:
+            data_length = self._read_data_length(f)
+            spans, pieces = coalesce_readv(readv, data_length)
+            span_data = []
+            for (offset, length) in spans:
+                f.seek(self.DATA_OFFSET+offset)
+                span_data.append(f.read(length))
+        finally:
+            f.close()
+        datav = []
+        for (spannum, start, length) in pieces:
+            if not length:
+                datav.append("")
+                continue
+            data = span_data[spannum]
+            if start == 0 and length == len(data):
+                datav.append(data) # the common case: no need to copy it
+            else:
+                datav.append(data[start:start+length])
         return datav
 
 #    def remote_get_length(self):
@@ -425,6 +490,33 @@ class MutableShareFile:
                 # self._change_container_size() here.
         f.close()
 
+def coalesce_readv(readv, data_length):
+    """Turn a read vector (a list of (offset, length) tuples) into a sorted
+    list of non-overlapping (offset, length) spans that cover all of it, and
+    a list with a (spannum, start, length) tuple for each entry of the read
+    vector, saying where in which span its data lies. Reads are truncated
+    at 'data_length', just as _read_share_data() does it. Reads that are
+    left empty have a length of 0. Spans that overlap or touch are merged."""
+    clipped = []
+    for (offset, length) in readv:
+        precondition(offset >= 0)
+        length = max(0, min(length, data_length-offset))
+        clipped.append( (offset, length) )
+    order = sorted([i for i in range(len(clipped)) if clipped[i][1]],
+                   key=lambda i: clipped[i])
+    spans = []
+    pieces = [(0, 0, 0)] * len(clipped)
+    for i in order:
+        (offset, length) = clipped[i]
+        if spans and offset <= spans[-1][0] + spans[-1][1]:
+            (span_offset, span_length) = spans[-1]
+            spans[-1] = (span_offset,
+                         max(span_length, offset+length-span_offset))
+        else:
+            spans.append( (offset, length) )
+        pieces[i] = (len(spans)-1, offset-spans[-1][0], length)
+    return spans, pieces
+
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
     if op == "lt":
@@ -0,0 +1,616 @@
+
+import os
+
+from twisted.internet import defer, reactor
+from allmydata.util import fileutil
+from allmydata.util.assertutil import precondition
+from allmydata.util.hashutil import constant_time_compare
+from allmydata.storage.common import si_b2a, storage_index_to_dir
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.immutable import ShareFile, BucketWriter
+from allmydata.storage.backends import DiskBackend
+
+try:
+    import sqlite3
+    sqlite = sqlite3 # pyflakes whines about 'import sqlite3 as sqlite' ..
+except ImportError:
+    from pysqlite2 import dbapi2
+    sqlite = dbapi2 # .. when this clause does it too
+    # This import should never fail, because setuptools requires that the
+    # "pysqlite" distribution is present at start time (if on Python < 2.5).
+
+# The packed backend keeps immutable shares in a few large files instead of
+# one file per share, so a server with millions of small shares does not
+# need millions of inodes, directory entries, and seeks. Mutable shares,
+# and so mutable directories, are not packed: they still take a file each.
+# The packed layout is:
+#
+# storage/packed/index.sqlite
+# storage/packed/segments/$SEGNUM
+#
+# Each segment is an append-only file of up to SEGMENT_SIZE bytes (it may
+# grow beyond that by a single share), holding the share data of each share
+# back to back, without any header. The index records where each share
+# lives, and holds its leases. Changes are committed in groups: each append
+# is written to the segment without an fsync, and its index row (like every
+# lease change) is added to the open transaction. Once COMMIT_BATCH_SIZE
+# changes are waiting, or COMMIT_DELAY seconds after the first of them, the
+# segment is fsynced (if anything was appended to it) and then the
+# transaction is committed, and only then are uploaders told that their
+# shares are closed, and are emptied segment files deleted. A crash can
+# therefore leave unreferenced bytes at the end of a segment, or a segment
+# file that no row refers to (which we delete at startup), but never an
+# index row that points to missing data.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26), -- base32
+ shnum         INTEGER,
+ segment       INTEGER,
+ offset        INTEGER,
+ length        INTEGER,
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index   VARCHAR(26),
+ shnum           INTEGER,
+ owner_num       INTEGER,
+ renew_secret    BLOB,
+ cancel_secret   BLOB,
+ expiration_time INTEGER
+);
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+
+CREATE TABLE segments
+(
+ segment    INTEGER PRIMARY KEY,
+ live_bytes INTEGER -- bytes still referenced by the shares table
+);
+"""
+
+SEGMENT_SIZE = 64*1024*1024
+# shares larger than this are stored in their own files: they would gain
+# little from packing, and copying them into a segment costs a second write
+MAX_PACKED_SHARE_SIZE = 64*1024
+COMMIT_BATCH_SIZE = 100
+COMMIT_DELAY = 0.05
+# a full segment whose live shares fill less than this fraction of it is
+# compacted: they are copied to the current segment and it is deleted
+COMPACTION_THRESHOLD = 0.5
+
+class PackedStore:
+    """I hold immutable share data in append-only segment files below
+    'packeddir', and an index of shares and leases in a SQLite database
+    next to them. The space of deleted shares is only given back to the
+    filesystem when a whole segment file is deleted, so compact() moves the
+    live shares out of mostly-dead segments, a few at a time."""
+
+    COPY_CHUNK_SIZE = 64*1024
+
+    def __init__(self, packeddir, segment_size=SEGMENT_SIZE,
+                 commit_batch_size=COMMIT_BATCH_SIZE,
+                 commit_delay=COMMIT_DELAY,
+                 compaction_threshold=COMPACTION_THRESHOLD):
+        self.packeddir = packeddir
+        self.segmentdir = os.path.join(packeddir, "segments")
+        self.segment_size = segment_size
+        self.commit_batch_size = commit_batch_size
+        self.commit_delay = commit_delay
+        self._segfile = None # the current segment, open for appending
+        self._segment_dirty = False # appended to since the last fsync
+        self._pending = 0 # changes in the open transaction
+        self._waiting = [] # Deferreds that fire at the next commit
+        self._doomed = [] # segment files to delete after the next commit
+        self._commit_timer = None
+        self.compaction_threshold = compaction_threshold
+        self._compactable = set() # full segments that compact() should visit
+        self._copied_out = {} # maps segnum to bytes compact() moved out of it
+        self.deleted_segments = 0 # PackedShares look again after each one
+        fileutil.make_dirs(self.segmentdir)
+        dbfile = os.path.join(packeddir, "index.sqlite")
+        must_create = not os.path.exists(dbfile)
+        self.db = sqlite.connect(dbfile)
+        self.cursor = self.db.cursor()
+        if must_create:
+            self.cursor.executescript(SCHEMA_v1)
+            self.cursor.execute("INSERT INTO version (version) VALUES (1)")
+            self.db.commit()
+        self.cursor.execute("SELECT version FROM version")
+        version = self.cursor.fetchone()[0]
+        if version != 1:
+            raise ValueError("packed share index %s had version %d but we "
+                             "wanted 1" % (dbfile, version))
+        self.cursor.execute("SELECT MAX(segment) FROM segments")
+        self.current_segment = self.cursor.fetchone()[0]
+        if self.current_segment is None:
+            self._start_segment(0)
+            self._commit()
+        self._find_compactable_segments()
+
+    def _find_compactable_segments(self):
+        # delete any segment that a compaction emptied, but did not get to
+        # delete before we crashed, and note the segments that are due to
+        # be compacted
+        self.cursor.execute("SELECT segment, live_bytes FROM segments")
+        live = dict(self.cursor.fetchall())
+        for name in os.listdir(self.segmentdir):
+            try:
+                segnum = int(name)
+            except ValueError:
+                continue
+            if segnum not in live and segnum < self.current_segment:
+                fileutil.remove_if_possible(self.get_segment_filename(segnum))
+        for (segnum, live_bytes) in live.items():
+            self._check_compactable(segnum, live_bytes)
+
+    def _check_compactable(self, segnum, live_bytes):
+        if segnum == self.current_segment:
+            return
+        try:
+            size = os.path.getsize(self.get_segment_filename(segnum))
+        except OSError:
+            return
+        if live_bytes < size * self.compaction_threshold:
+            self._compactable.add(segnum)
+
+    def _start_segment(self, segnum):
+        self.cursor.execute("INSERT INTO segments (segment, live_bytes)"
+                            " VALUES (?,0)", (segnum,))
+        self.current_segment = segnum
+
+    def get_segment_filename(self, segnum):
+        return os.path.join(self.segmentdir, "%08d" % segnum)
+
+    def _sync_segment(self):
+        if self._segfile is not None and self._segment_dirty:
+            self._segfile.flush()
+            os.fsync(self._segfile.fileno())
+        self._segment_dirty = False
+
+    def _close_segment(self):
+        if self._segfile is not None:
+            self._sync_segment()
+            self._segfile.close()
+            self._segfile = None
+
+    def _append(self, f, length):
+        # copy 'length' bytes from the file-like object 'f' onto the end of
+        # the current segment, and return the (segnum, offset) they landed
+        # at. Missing bytes (a share that was never completely written) are
+        # filled with zeros, just as ShareFile leaves holes. The bytes are
+        # visible to read() at once, but are not fsynced until _commit().
+        if self._segfile is None:
+            self._segfile = open(self.get_segment_filename(
+                self.current_segment), "ab")
+        out = self._segfile
+        out.seek(0, 2)
+        if out.tell() and out.tell() + length > self.segment_size:
+            self._close_segment()
+            sealed = self.current_segment
+            self._start_segment(sealed + 1)
+            # shares that were removed while we appended to it may already
+            # have left it mostly dead
+            self.cursor.execute("SELECT live_bytes FROM segments"
+                                " WHERE segment=?", (sealed,))
+            self._check_compactable(sealed, self.cursor.fetchone()[0])
+            self._segfile = open(self.get_segment_filename(
+                self.current_segment), "ab")
+            out = self._segfile
+            out.seek(0, 2)
+        offset = out.tell()
+        remaining = length
+        while remaining:
+            data = f.read(min(remaining, self.COPY_CHUNK_SIZE))
+            if not data:
+                data = "\x00" * min(remaining, self.COPY_CHUNK_SIZE)
+            out.write(data)
+            remaining -= len(data)
+        out.flush()
+        self._segment_dirty = True
+        return (self.current_segment, offset)
+
+    def _commit(self):
+        # every change to the index is committed through here, so that no
+        # committed row can refer to segment bytes that are not yet on disk
+        if self._commit_timer is not None:
+            if self._commit_timer.active():
+                self._commit_timer.cancel()
+            self._commit_timer = None
+        self._sync_segment()
+        self.db.commit()
+        self._pending = 0
+        doomed, self._doomed = self._doomed, []
+        for filename in doomed:
+            fileutil.remove_if_possible(filename)
+            self.deleted_segments += 1
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def _commit_soon(self):
+        # add one change to the group that the next commit will cover
+        self._pending += 1
+        if self._pending >= self.commit_batch_size:
+            self._commit()
+        elif self._commit_timer is None:
+            self._commit_timer = reactor.callLater(self.commit_delay,
+                                                   self._commit)
+
+    def flush(self):
+        """Commit any changes that are waiting for a group commit."""
+        if self._pending:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._close_segment()
+        self.db.close()
+
+    def add_share(self, storage_index, shnum, f, length, leases):
+        """Copy 'length' bytes of share data from 'f' into the store, and
+        record the share with the given leases. Return a Deferred that fires
+        once the share has been committed. The share can be read at once,
+        but will not survive a crash until then."""
+        si_s = si_b2a(storage_index)
+        (segnum, offset) = self._append(f, length)
+        c = self.cursor
+        c.execute("INSERT INTO shares"
+                  " (storage_index, shnum, segment, offset, length)"
+                  " VALUES (?,?,?,?,?)",
+                  (si_s, shnum, segnum, offset, length))
+        for lease_info in leases:
+            self._insert_lease(si_s, shnum, lease_info)
+        c.execute("UPDATE segments SET live_bytes=live_bytes+?"
+                  " WHERE segment=?", (length, segnum))
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self._commit_soon()
+        return d
+
+    def get_shares(self, storage_index):
+        """Return a list of (shnum, PackedShare) tuples, for every share of
+        this storage_index that I hold."""
+        self.cursor.execute("SELECT shnum, segment, offset, length"
+                            " FROM shares WHERE storage_index=?"
+                            " ORDER BY shnum", (si_b2a(storage_index),))
+        return [(shnum, PackedShare(self, storage_index, shnum,
+                                    segnum, offset, length))
+                for (shnum, segnum, offset, length) in self.cursor.fetchall()]
+
+    def list_buckets(self, prefix):
+        """Return a sorted list of the base32-encoded storage indexes that
+        start with 'prefix' and have at least one share in the store."""
+        # every base32 character sorts below "~", so this range holds
+        # exactly the storage indexes that start with the prefix, and can
+        # be found through the primary-key index
+        self.cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?"
+                            " ORDER BY storage_index", (prefix, prefix+"~"))
+        return [str(si_s) for (si_s,) in self.cursor.fetchall()]
+
+    def read(self, segnum, offset, length):
+        f = open(self.get_segment_filename(segnum), "rb")
+        try:
+            f.seek(offset)
+            return f.read(length)
+        finally:
+            f.close()
+
+    def _insert_lease(self, si_s, shnum, lease_info):
+        self.cursor.execute("INSERT INTO leases"
+                            " (storage_index, shnum, owner_num, renew_secret,"
+                            "  cancel_secret, expiration_time)"
+                            " VALUES (?,?,?,?,?,?)",
+                            (si_s, shnum, lease_info.owner_num,
+                             buffer(lease_info.renew_secret),
+                             buffer(lease_info.cancel_secret),
+                             lease_info.expiration_time))
+
+    def _get_lease_rows(self, si_s, shnum):
+        self.cursor.execute("SELECT rowid, owner_num, renew_secret,"
+                            " cancel_secret, expiration_time"
+                            " FROM leases WHERE storage_index=? AND shnum=?"
+                            " ORDER BY rowid", (si_s, shnum))
+        return [(rowid, LeaseInfo(owner_num, str(renew_secret),
+                                  str(cancel_secret), expiration_time))
+                for (rowid, owner_num, renew_secret, cancel_secret,
+                     expiration_time) in self.cursor.fetchall()]
+
+    def get_leases(self, si_s, shnum):
+        return [lease for (rowid, lease) in self._get_lease_rows(si_s, shnum)]
+
+    # lease changes, like shares, are committed with the next group
+
+    def add_lease(self, si_s, shnum, lease_info):
+        self._insert_lease(si_s, shnum, lease_info)
+        self._commit_soon()
+
+    def renew_lease(self, si_s, shnum, renew_secret, new_expire_time):
+        for (rowid, lease) in self._get_lease_rows(si_s, shnum):
+            if constant_time_compare(lease.renew_secret, renew_secret):
+                if new_expire_time > lease.expiration_time:
+                    self.cursor.execute("UPDATE leases SET expiration_time=?"
+                                        " WHERE rowid=?",
+                                        (new_expire_time, rowid))
+                    self._commit_soon()
+                return
+        raise IndexError("unable to renew non-existent lease")
+
+    def cancel_lease(self, si_s, shnum, cancel_secret):
+        rows = self._get_lease_rows(si_s, shnum)
+        removed = [rowid for (rowid, lease) in rows
+                   if constant_time_compare(lease.cancel_secret, cancel_secret)]
+        if not removed:
+            raise IndexError("unable to find matching lease to cancel")
+        for rowid in removed:
+            self.cursor.execute("DELETE FROM leases WHERE rowid=?", (rowid,))
+        # leases live in the index, which does not shrink when they are
+        # removed, so only a deleted segment file frees any space
+        space_freed = 0
+        if len(removed) == len(rows):
+            space_freed = self._remove_share(si_s, shnum)
+        self._commit_soon()
+        return space_freed
+
+    def remove_share(self, si_s, shnum):
+        self._remove_share(si_s, shnum)
+        self._commit_soon()
+
+    def _remove_share(self, si_s, shnum):
+        # the bytes stay in their segment until it is empty, at which point
+        # we delete it (unless we are still appending to it), or until it
+        # is compacted. Return the size of the segment file we will delete,
+        # if any. It is deleted once its row is gone for good, after the
+        # next commit.
+        c = self.cursor
+        c.execute("SELECT segment, length FROM shares"
+                  " WHERE storage_index=? AND shnum=?", (si_s, shnum))
+        row = c.fetchone()
+        c.execute("DELETE FROM leases WHERE storage_index=? AND shnum=?",
+                  (si_s, shnum))
+        if row is None:
+            return 0
+        (segnum, length) = row
+        c.execute("DELETE FROM shares WHERE storage_index=? AND shnum=?",
+                  (si_s, shnum))
+        c.execute("UPDATE segments SET live_bytes=live_bytes-?"
+                  " WHERE segment=?", (length, segnum))
+        c.execute("SELECT live_bytes FROM segments WHERE segment=?", (segnum,))
+        (live_bytes,) = c.fetchone()
+        if live_bytes == 0 and segnum != self.current_segment:
+            return self._delete_segment(segnum)
+        self._check_compactable(segnum, live_bytes)
+        return 0
+
+    def _delete_segment(self, segnum):
+        # forget an empty segment, and return the number of bytes that
+        # deleting it will give back: its size, less anything that
+        # compact() had to copy out of it first
+        self.cursor.execute("DELETE FROM segments WHERE segment=?", (segnum,))
+        self._compactable.discard(segnum)
+        copied = self._copied_out.pop(segnum, 0)
+        filename = self.get_segment_filename(segnum)
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
+        self._doomed.append(filename)
+        return max(0, size - copied)
+
+    def compact(self, max_bytes=None):
+        """Move the live shares out of the full segments that are mostly
+        dead, stopping once I have copied at least 'max_bytes' bytes (or
+        when none are left, if it is None). A segment is deleted once it is
+        empty, at the next group commit. Return a tuple of (the number of
+        bytes I copied, the number of bytes that deleting segments will give
+        back to the filesystem)."""
+        c = self.cursor
+        copied = 0
+        freed = 0
+        while self._compactable:
+            if max_bytes is not None and copied >= max_bytes:
+                break
+            segnum = min(self._compactable)
+            c.execute("SELECT storage_index, shnum, offset, length"
+                      " FROM shares WHERE segment=? ORDER BY offset",
+                      (segnum,))
+            rows = c.fetchall()
+            try:
+                f = open(self.get_segment_filename(segnum), "rb")
+            except EnvironmentError:
+                self._compactable.discard(segnum)
+                continue
+            moved = 0
+            try:
+                for (si_s, shnum, offset, length) in rows:
+                    if max_bytes is not None and copied >= max_bytes:
+                        break
+                    f.seek(offset)
+                    (newsegnum, newoffset) = self._append(f, length)
+                    c.execute("UPDATE shares SET segment=?, offset=?"
+                              " WHERE storage_index=? AND shnum=?",
+                              (newsegnum, newoffset, si_s, shnum))
+                    c.execute("UPDATE segments SET live_bytes=live_bytes+?"
+                              " WHERE segment=?", (length, newsegnum))
+                    c.execute("UPDATE segments SET live_bytes=live_bytes-?"
+                              " WHERE segment=?", (length, segnum))
+                    self._copied_out[segnum] = (self._copied_out.get(segnum, 0)
+                                                + length)
+                    copied += length
+                    moved += 1
+            finally:
+                f.close()
+            if moved == len(rows):
+                # the old segment stays readable until it is deleted, after
+                # the moves have been committed
+                freed += self._delete_segment(segnum)
+        if copied or freed:
+            self._commit_soon()
+        return (copied, freed)
+
+    def locate(self, si_s, shnum):
+        """Return the (segnum, offset) of a share, or None if I no longer
+        hold it."""
+        self.cursor.execute("SELECT segment, offset FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        return self.cursor.fetchone()
+
+
+class PackedShare:
+    """I am an immutable share held in a PackedStore. I offer the same
+    read and lease methods as ShareFile."""
+    LEASE_SIZE = ShareFile.LEASE_SIZE
+    sharetype = "immutable"
+
+    def __init__(self, store, storage_index, shnum, segnum, offset, length):
+        self._store = store
+        self._si_s = si_b2a(storage_index)
+        self._shnum = shnum
+        self._segnum = segnum
+        self._offset = offset
+        self._length = length
+        self._deleted_segments = store.deleted_segments
+
+    def get_length(self):
+        return self._length
+
+    def unlink(self):
+        self._store.remove_share(self._si_s, self._shnum)
+
+    def read_share_data(self, offset, length):
+        precondition(offset >= 0)
+        # reads beyond the end of the data are truncated. Reads that start
+        # beyond the end of the data return an empty string.
+        actuallength = max(0, min(length, self._length-offset))
+        if actuallength == 0:
+            return ""
+        if self._deleted_segments != self._store.deleted_segments:
+            # compact() may have moved us out of a segment that is gone
+            self._deleted_segments = self._store.deleted_segments
+            location = self._store.locate(self._si_s, self._shnum)
+            if location is not None:
+                (self._segnum, self._offset) = location
+        return self._store.read(self._segnum, self._offset+offset,
+                                actuallength)
+
+    def get_leases(self):
+        """Yields a LeaseInfo instance for all leases."""
+        return iter(self._store.get_leases(self._si_s, self._shnum))
+
+    def add_lease(self, lease_info):
+        self._store.add_lease(self._si_s, self._shnum, lease_info)
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        self._store.renew_lease(self._si_s, self._shnum,
+                                renew_secret, new_expire_time)
+
+    def add_or_renew_lease(self, lease_info):
+        try:
+            self.renew_lease(lease_info.renew_secret,
+                             lease_info.expiration_time)
+        except IndexError:
+            self.add_lease(lease_info)
+
+    def cancel_lease(self, cancel_secret):
+        """Remove a lease with the given cancel_secret. If the last lease is
+        cancelled, the share will be removed. Return the number of bytes
+        that were given back to the filesystem, which is 0 unless removing
+        the share emptied its segment. Raise IndexError if there was no
+        lease with the given cancel_secret."""
+        return self._store.cancel_lease(self._si_s, self._shnum,
+                                        cancel_secret)
+
+
+class PackedBucketWriter(BucketWriter):
+    """I receive a share into an ordinary ShareFile in the incoming/
+    directory, then copy it into a PackedStore when it is closed. My
+    remote_close() returns a Deferred that fires once the store has
+    committed the share."""
+
+    def __init__(self, ss, store, storage_index, shnum, incominghome,
+                 max_size, lease_info, canary):
+        BucketWriter.__init__(self, ss, incominghome, None, max_size,
+                              lease_info, canary)
+        self._store = store
+        self._storage_index = storage_index
+        self._shnum = shnum
+        self._committed = None
+
+    def remote_close(self):
+        BucketWriter.remote_close(self)
+        return self._committed
+
+    def _move_into_place(self):
+        sf = self._sharefile
+        leases = list(sf.get_leases())
+        f = open(self.incominghome, "rb")
+        try:
+            f.seek(sf._data_offset)
+            self._committed = self._store.add_share(self._storage_index,
+                                                    self._shnum, f,
+                                                    self._max_size, leases)
+        finally:
+            f.close()
+        os.unlink(self.incominghome)
+        return self._max_size
+
+
+class PackedBackend(DiskBackend):
+    """I keep immutable shares of up to 'max_share_size' bytes (or all of
+    them, if it is None) in a PackedStore below storage/packed/. Mutable
+    shares (including every mutable directory), larger immutable shares,
+    and any immutable shares that were stored while the server used a
+    DiskBackend, stay in the DiskBackend layout, one file per share."""
+
+    def __init__(self, storedir, segment_size=SEGMENT_SIZE,
+                 max_share_size=MAX_PACKED_SHARE_SIZE):
+        DiskBackend.__init__(self, storedir)
+        self.store = PackedStore(os.path.join(storedir, "packed"),
+                                 segment_size)
+        self.max_share_size = max_share_size
+
+    def get_shares(self, storage_index, parent=None):
+        for (shnum, sf) in DiskBackend.get_shares(self, storage_index, parent):
+            yield (shnum, sf)
+        for (shnum, sf) in self.store.get_shares(storage_index):
+            yield (shnum, sf)
+
+    def get_immutable_shares(self, storage_index):
+        for (shnum, sf) in DiskBackend.get_immutable_shares(self,
+                                                            storage_index):
+            yield (shnum, sf)
+        for (shnum, sf) in self.store.get_shares(storage_index):
+            yield (shnum, sf)
+
+    def list_packed_buckets(self, prefix):
+        return self.store.list_buckets(prefix)
+
+    def flush(self):
+        self.store.flush()
+
+    def compact(self, max_bytes=None):
+        return self.store.compact(max_bytes)
+
+    def get_packed_shares(self, storage_index):
+        return self.store.get_shares(storage_index)
+
+    def make_bucket_writer(self, ss, storage_index, shnum, max_size,
+                           lease_info, canary):
+        if self.max_share_size is not None and max_size > self.max_share_size:
+            return DiskBackend.make_bucket_writer(self, ss, storage_index,
+                                                  shnum, max_size,
+                                                  lease_info, canary)
+        incominghome = os.path.join(self.incomingdir,
+                                    storage_index_to_dir(storage_index),
+                                    "%d" % shnum)
+        return PackedBucketWriter(ss, self.store, storage_index, shnum,
+                                  incominghome, max_size, lease_info, canary)
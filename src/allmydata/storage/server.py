@@ -1,4 +1,4 @@
-import os, re, weakref, struct, time
+import os, time
 
 from foolscap.api import Referenceable
 from twisted.application import service
@@ -6,29 +6,25 @@ from twisted.application import service
 from zope.interface import implements
 from allmydata.interfaces import RIStorageServer, IStatsProducer
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import WindowedHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
-     create_mutable_sharefile
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.mutable import EmptyShare
+from allmydata.storage.immutable import BucketReader, MappedShares, \
+     MAX_MAPPED_SHARES
+from allmydata.storage.backends import DiskBackend
+from allmydata.storage.space import SpaceTracker
+from allmydata.storage.bucketindex import BucketIndex
 from allmydata.storage.crawler import BucketCountingCrawler
 from allmydata.storage.expirer import LeaseCheckingCrawler
 
-# storage/
-# storage/shares/incoming
-#   incoming/ holds temp dirs named $START/$STORAGEINDEX/$SHARENUM which will
-#   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
-# storage/shares/$START/$STORAGEINDEX
-# storage/shares/$START/$STORAGEINDEX/$SHARENUM
-
-# Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
-# base-32 chars).
-
-# $SHARENUM matches this regex:
-NUM_RE=re.compile("^[0-9]+$")
+# The storage_server.latencies.* stats cover this window, which matches the
+# usual munin polling interval. Stats for the other windows are published as
+# storage_server.latencies_$WINDOW.* .
+DEFAULT_LATENCY_WINDOW = "5m"
 
 
 
@@ -36,6 +32,9 @@ class StorageServer(service.MultiService, Referenceable):
     implements(RIStorageServer, IStatsProducer)
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
+    # latency stats are kept for each of these windows (name -> seconds), and
+    # for the lifetime of the server
+    LATENCY_WINDOWS = {"1m": 60, "5m": 300}
 
     def __init__(self, storedir, nodeid, reserved_space=0,
                  discard_storage=False, readonly_storage=False,
@@ -44,28 +43,38 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 expiration_threads=0,
+                 expiration_max_iops=None,
+                 expiration_max_bytes_per_second=None,
+                 backend=None,
+                 mmap_threshold=None,
+                 max_mapped_shares=MAX_MAPPED_SHARES):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
         self.my_nodeid = nodeid
         self.storedir = storedir
-        sharedir = os.path.join(storedir, "shares")
-        fileutil.make_dirs(sharedir)
-        self.sharedir = sharedir
+        if backend is None:
+            backend = DiskBackend(storedir)
+        self.backend = backend
+        self.sharedir = backend.sharedir
+        self.incomingdir = backend.incomingdir
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
         self.reserved_space = int(reserved_space)
+        self.mmap_threshold = mmap_threshold
+        self.mapped_shares = MappedShares(max_mapped_shares)
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
         self.stats_provider = stats_provider
         if self.stats_provider:
             self.stats_provider.register_producer(self)
-        self.incomingdir = os.path.join(sharedir, 'incoming')
-        self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
-        self._active_writers = weakref.WeakKeyDictionary()
+        self.space = SpaceTracker(self.sharedir, self.reserved_space)
+        self.space.setServiceParent(self)
+        self._active_writers = self.space.active_writers
+        self.bucket_index = BucketIndex()
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -73,17 +82,12 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", "get", # immutable
+                         "writev", "readv", # mutable
+                         "add-lease", "renew", "cancel", # both
+                         ]:
+            self.latencies[category] = WindowedHistogram(self.LATENCY_WINDOWS)
         self.add_bucket_counter()
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
@@ -94,11 +98,18 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
+        self.lease_checker.worker_threads = expiration_threads
+        self.lease_checker.max_iops = expiration_max_iops
+        self.lease_checker.max_bytes_per_second = expiration_max_bytes_per_second
         self.lease_checker.setServiceParent(self)
 
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    def stopService(self):
+        self.backend.flush()
+        return service.MultiService.stopService(self)
+
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
@@ -109,47 +120,54 @@ class StorageServer(service.MultiService, Referenceable):
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
-    def get_latencies(self):
+    def get_latencies(self, window=DEFAULT_LATENCY_WINDOW):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
+        latency numbers for each category, computed over the operations
+        that finished during the given window: one of the names in
+        LATENCY_WINDOWS, or "lifetime" for every operation since the server
+        started. If there are sufficient samples
         for unambiguous interpretation, each dict will contain the
         following keys: mean, 01_0_percentile, 10_0_percentile,
         50_0_percentile (median), 90_0_percentile, 95_0_percentile,
         99_0_percentile, 99_9_percentile.  If there are insufficient
         samples for a given percentile to be interpreted unambiguously
-        that percentile will be reported as None. If no samples have been
-        collected for the given category, then that category name will
-        not be present in the return value. """
+        that percentile will be reported as None. If no samples have ever
+        been collected for the given category, then that category name will
+        not be present in the return value.
+
+        The percentiles come from a histogram with 1% wide buckets, so they
+        are accurate to within 1%. 'samplesize' and 'mean' are exact."""
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
+        orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
+                         (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
+                         (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
+                         (0.999, "99_9_percentile", 1000)]
         output = {}
+        now = time.time()
         for category in self.latencies:
-            if not self.latencies[category]:
+            if not self.latencies[category].lifetime.count:
                 continue
+            histogram = self.latencies[category].get(window, now)
             stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
+            count = histogram.count
             stats["samplesize"] = count
-            samples.sort()
             if count > 1:
-                stats["mean"] = sum(samples) / count
+                stats["mean"] = histogram.get_mean()
             else:
                 stats["mean"] = None
 
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
+            wanted = [(int(percentile*count), percentilestring)
+                      for (percentile, percentilestring, minnumtoobserve)
+                      in orderstatlist
+                      if count >= minnumtoobserve]
+            values = histogram.get_order_statistics([rank for (rank, name)
+                                                     in wanted])
             for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
+                stats[percentilestring] = None
+            for ((rank, percentilestring), value) in zip(wanted, values):
+                stats[percentilestring] = value
 
             output[category] = stats
         return output
@@ -159,9 +177,6 @@ class StorageServer(service.MultiService, Referenceable):
             kwargs["facility"] = "tahoe.storage"
         return log.msg(*args, **kwargs)
 
-    def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
-
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
         # contains numeric values.
@@ -170,9 +185,17 @@ class StorageServer(service.MultiService, Referenceable):
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
-
-        try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+        for window in sorted(self.LATENCY_WINDOWS) + ["lifetime"]:
+            if window == DEFAULT_LATENCY_WINDOW:
+                continue
+            for category,ld in self.get_latencies(window).items():
+                for name,v in ld.items():
+                    stats['storage_server.latencies_%s.%s.%s'
+                          % (window, category, name)] = v
+
+        # these come from the SpaceTracker, which reads them periodically
+        disk = self.space.get_disk_stats()
+        if disk is not None:
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -181,11 +204,10 @@ class StorageServer(service.MultiService, Referenceable):
             stats['storage_server.disk_free_for_root'] = disk['free_for_root']
             stats['storage_server.disk_free_for_nonroot'] = disk['free_for_nonroot']
             stats['storage_server.disk_avail'] = disk['avail']
-        except AttributeError:
-            writeable = True
-        except EnvironmentError:
-            log.msg("OS call to get disk statistics failed", level=log.UNUSUAL)
-            writeable = False
+        else:
+            # no disk stats API means we can't tell, so we keep going, but
+            # a failed OS call means something is wrong with the disk
+            writeable = not self.space.disk_error
 
         if self.readonly_storage:
             stats['storage_server.disk_avail'] = 0
@@ -204,13 +226,10 @@ class StorageServer(service.MultiService, Referenceable):
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        return self.space.get_available_space()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self.space.allocated
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -240,7 +259,6 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("allocate")
         alreadygot = set()
         bucketwriters = {} # k: shnum, v: BucketWriter
-        si_dir = storage_index_to_dir(storage_index)
         si_s = si_b2a(storage_index)
 
         log.msg("storage: allocate_buckets %s" % si_s)
@@ -260,8 +278,8 @@ class StorageServer(service.MultiService, Referenceable):
         limited = remaining_space is not None
         if limited:
             # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
+            # may already have been written to disk, where the next refresh
+            # of the disk statistics will count it again.
             remaining_space -= self.allocated_size()
         # self.readonly_storage causes remaining_space <= 0
 
@@ -269,18 +287,15 @@ class StorageServer(service.MultiService, Referenceable):
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
-        for (shnum, fn) in self._get_bucket_shares(storage_index):
+        for (shnum, sf) in self._get_immutable_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
             sf.add_or_renew_lease(lease_info)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in alreadygot:
                 # great! we already have it. easy.
                 pass
-            elif os.path.exists(incominghome):
+            elif self.backend.is_receiving(storage_index, shnum):
                 # Note that we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
                 # occurs while the first is still in progress, the second
@@ -288,38 +303,38 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
-                bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                self.bucket_index.add_bucket(storage_index)
+                bw = self.backend.make_bucket_writer(self, storage_index,
+                                                     shnum,
+                                                     max_space_per_bucket,
+                                                     lease_info, canary)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self.space.add_writer(bw)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
-
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
+    def _get_immutable_shares(self, storage_index):
+        # most queries are for buckets we don't have, and the index can
+        # tell us so without touching the disk
+        if not self.bucket_index.may_have_bucket(storage_index):
+            return []
+        return self.backend.get_immutable_shares(storage_index)
+
+    def _get_mutable_shares(self, storage_index):
+        if not self.bucket_index.may_have_bucket(storage_index):
+            return {}
+        return self.backend.get_mutable_shares(storage_index, self)
+
     def _iter_share_files(self, storage_index):
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
-                # note: if the share has been migrated, the renew_lease()
-                # call will throw an exception, with information to help the
-                # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
-            else:
-                continue # non-sharefile
+        for (shnum, sf) in self.backend.get_shares(storage_index, self):
             yield sf
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
@@ -350,21 +365,7 @@ class StorageServer(service.MultiService, Referenceable):
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
-
-    def _get_bucket_shares(self, storage_index):
-        """Return a list of (shnum, pathname) tuples for files that hold
-        shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        self.space.writer_closed(bw, consumed_size)
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
@@ -372,9 +373,10 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+        for shnum, sf in self._get_immutable_shares(storage_index):
+            bucketreaders[shnum] = BucketReader(self, sf,
+                                                storage_index, shnum,
+                                                self.mmap_threshold)
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
@@ -388,8 +390,7 @@ class StorageServer(service.MultiService, Referenceable):
         # since all shares get the same lease data, we just grab the leases
         # from the first share
         try:
-            shnum, filename = self._get_bucket_shares(storage_index).next()
-            sf = ShareFile(filename)
+            shnum, sf = self.backend.get_immutable_shares(storage_index).next()
             return sf.get_leases()
         except StopIteration:
             return iter([])
@@ -402,21 +403,10 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
-        si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        shares = self.backend.get_mutable_shares(storage_index, self)
+        for msf in shares.values():
+            msf.check_write_enabler(write_enabler, si_s)
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -454,12 +444,15 @@ class StorageServer(service.MultiService, Referenceable):
                 (testv, datav, new_length) = test_and_write_vectors[sharenum]
                 if new_length == 0:
                     if sharenum in shares:
+                        freed = os.stat(shares[sharenum].home).st_size
                         shares[sharenum].unlink()
+                        self.space.space_freed(freed)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
                         allocated_size = 2000 # arbitrary, really
-                        share = self._allocate_slot_share(bucketdir, secrets,
+                        share = self._allocate_slot_share(storage_index,
+                                                          secrets,
                                                           sharenum,
                                                           allocated_size,
                                                           owner_num=0)
@@ -470,23 +463,20 @@ class StorageServer(service.MultiService, Referenceable):
 
             if new_length == 0:
                 # delete empty bucket directories
-                if not os.listdir(bucketdir):
-                    os.rmdir(bucketdir)
+                self.backend.remove_empty_bucket(storage_index)
 
 
         # all done
         self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
-    def _allocate_slot_share(self, bucketdir, secrets, sharenum,
+    def _allocate_slot_share(self, storage_index, secrets, sharenum,
                              allocated_size, owner_num=0):
         (write_enabler, renew_secret, cancel_secret) = secrets
-        my_nodeid = self.my_nodeid
-        fileutil.make_dirs(bucketdir)
-        filename = os.path.join(bucketdir, "%d" % sharenum)
-        share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
-        return share
+        self.bucket_index.add_bucket(storage_index)
+        return self.backend.create_mutable_share(storage_index, sharenum,
+                                                 self.my_nodeid,
+                                                 write_enabler, self)
 
     def remote_slot_readv(self, storage_index, shares, readv):
         start = time.time()
@@ -494,21 +484,9 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
-            self.add_latency("readv", time.time() - start)
-            return {}
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum, msf in self._get_mutable_shares(storage_index).items():
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
                 datavs[sharenum] = msf.readv(readv)
         log.msg("returning shares %s" % (datavs.keys(),),
                 facility="tahoe.storage", level=log.NOISY, parent=lp)
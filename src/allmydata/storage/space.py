@@ -0,0 +1,100 @@
+
+import weakref
+
+from twisted.application import service
+from twisted.internet import task
+from allmydata.util import fileutil, log
+
+class SpaceTracker(service.Service):
+    """I keep track of how much space a StorageServer may still allocate to
+    new shares, so that remote_allocate_buckets() needs neither a statvfs()
+    nor a walk over every open BucketWriter.
+
+    I read the disk statistics for 'sharedir' when I am created, and again
+    every 'refresh_interval' seconds while I am running. In between, I
+    adjust them by the bytes that newly closed shares have consumed and
+    deleted shares have freed. Separately, I add up the space promised to
+    each open BucketWriter, until it is closed, aborted, or garbage
+    collected."""
+
+    refresh_interval = 60
+
+    def __init__(self, sharedir, reserved_space=0):
+        self.sharedir = sharedir
+        self.reserved_space = reserved_space
+        self.allocated = 0
+        # maps weakref(BucketWriter) to the space allocated to it
+        self.active_writers = {}
+        self.timer = None
+        self.refresh()
+
+    def startService(self):
+        service.Service.startService(self)
+        self.timer = task.LoopingCall(self.refresh)
+        self.timer.start(self.refresh_interval, now=False)
+
+    def stopService(self):
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+        return service.Service.stopService(self)
+
+    def refresh(self):
+        # self.disk is a fileutil.get_disk_stats() dict, or None if the
+        # platform has no API for them (self.disk_error=False) or if the OS
+        # call failed (self.disk_error=True)
+        self.consumed = 0
+        self.disk_error = False
+        try:
+            self.disk = fileutil.get_disk_stats(self.sharedir,
+                                                self.reserved_space)
+        except AttributeError:
+            self.disk = None
+        except EnvironmentError:
+            log.msg("OS call to get disk statistics failed", level=log.UNUSUAL)
+            self.disk = None
+            self.disk_error = True
+
+    def get_disk_stats(self):
+        """Return the last disk statistics, adjusted for the shares that
+        have been added and deleted since, or None if there are none."""
+        if self.disk is None:
+            return None
+        disk = self.disk.copy()
+        for k in ("free_for_root", "free_for_nonroot"):
+            if k in disk:
+                disk[k] -= self.consumed
+        if "used" in disk:
+            disk["used"] += self.consumed
+        disk["avail"] = max(disk["avail"] - self.consumed, 0)
+        return disk
+
+    def get_available_space(self):
+        """Return the space available for shares (including space that has
+        been allocated to open BucketWriters), 0 if the disk statistics
+        could not be read, or None if this platform has no API for them."""
+        if self.disk_error:
+            return 0
+        disk = self.get_disk_stats()
+        if disk is None:
+            return None
+        return disk["avail"]
+
+    def add_writer(self, bw):
+        size = bw.allocated_size()
+        def _collected(ref):
+            self._release(ref)
+        self.active_writers[weakref.ref(bw, _collected)] = size
+        self.allocated += size
+
+    def _release(self, ref):
+        size = self.active_writers.pop(ref, None)
+        if size is not None:
+            self.allocated -= size
+
+    def writer_closed(self, bw, consumed_size):
+        self._release(weakref.ref(bw))
+        self.consumed += consumed_size
+
+    def space_freed(self, freed_size):
+        self.consumed -= freed_size
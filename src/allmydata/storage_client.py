@@ -29,14 +29,15 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import time
+import time, heapq
 from zope.interface import implements, Interface
-from foolscap.api import eventually
+from twisted.application import service
 from allmydata.interfaces import IStorageBroker
 from allmydata.util import idlib, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
 from allmydata.util.hashutil import sha1
+from allmydata.util.histogram import LogHistogram
 
 # who is responsible for de-duplication?
 #  both?
@@ -62,6 +63,9 @@ class StorageFarmBroker:
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
     """
+    # how many recent permuted server lists to remember
+    PERMUTED_CACHE_SIZE = 100
+
     def __init__(self, tub, permute_peers):
         self.tub = tub
         assert permute_peers # False not implemented yet
@@ -72,15 +76,27 @@ class StorageFarmBroker:
         # them for it.
         self.servers = {}
         self.introducer_client = None
+        # this decides when to try to connect to each of them. The Client
+        # makes it our child, so it is started once the Tub is running.
+        self.connection_manager = ConnectionManager(tub)
+        # these caches are emptied by _servers_changed() whenever a server
+        # is added, replaced, connected or disconnected
+        self._connected_servers = None
+        # maps peer_selection_index to the sorted list of connected servers
+        self._permuted_servers = {}
+        self._permuted_psis = [] # oldest first
 
     # these two are used in unit tests
     def test_add_rref(self, serverid, rref):
         s = NativeStorageServer(serverid, {})
         s.rref = rref
+        s.on_status_changed(self._servers_changed)
         self.servers[serverid] = s
+        self._servers_changed()
 
     def test_add_server(self, serverid, s):
         self.servers[serverid] = s
+        self._servers_changed()
 
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
@@ -99,35 +115,64 @@ class StorageFarmBroker:
             old.stop_connecting()
             # now we forget about them and start using the new one
         dsc = NativeStorageServer(serverid, ann_d)
+        dsc.on_status_changed(self._servers_changed)
         self.servers[serverid] = dsc
-        dsc.start_connecting(self.tub, self._trigger_connections)
-        # the descriptor will manage their own Reconnector, and each time we
-        # need servers, we'll ask them if they're connected or not.
-
-    def _trigger_connections(self):
-        # when one connection is established, reset the timers on all others,
-        # to trigger a reconnection attempt in one second. This is intended
-        # to accelerate server connections when we've been offline for a
-        # while. The goal is to avoid hanging out for a long time with
-        # connections to only a subset of the servers, which would increase
-        # the chances that we'll put shares in weird places (and not update
-        # existing shares of mutable files). See #374 for more details.
-        for dsc in self.servers.values():
-            dsc.try_to_connect()
+        self._servers_changed()
+        dsc.start_connecting(self.connection_manager)
+        # the ConnectionManager will (re)connect to them when it can, and
+        # each time we need servers, we'll ask them if they're connected or
+        # not.
+
+    def _servers_changed(self):
+        self._connected_servers = None
+        self._permuted_servers.clear()
+        self._permuted_psis = []
+
+    def _get_permutation_keys(self, peer_selection_index):
+        # return a list of (sortkey, server) tuples for all connected servers
+        assert self.permute_peers == True
+        prefix = sha1(peer_selection_index)
+        keyed = []
+        for server in self.get_connected_servers():
+            h = prefix.copy()
+            h.update(server.get_permutation_seed())
+            keyed.append( (h.digest(), server) )
+        return keyed
 
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
-        assert self.permute_peers == True
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            return sha1(peer_selection_index + seed).digest()
-        return sorted(self.get_connected_servers(), key=_permuted)
+        servers = self._permuted_servers.get(peer_selection_index)
+        if servers is None:
+            keyed = self._get_permutation_keys(peer_selection_index)
+            keyed.sort()
+            servers = [server for (key, server) in keyed]
+            if len(self._permuted_psis) >= self.PERMUTED_CACHE_SIZE:
+                del self._permuted_servers[self._permuted_psis.pop(0)]
+            self._permuted_servers[peer_selection_index] = servers
+            self._permuted_psis.append(peer_selection_index)
+        return list(servers)
+
+    def iter_servers_for_psi(self, peer_selection_index):
+        # like get_servers_for_psi(), but the servers are only put in order
+        # as they are asked for
+        servers = self._permuted_servers.get(peer_selection_index)
+        if servers is not None:
+            return iter(list(servers))
+        return self._iter_permuted(self._get_permutation_keys(peer_selection_index))
+
+    def _iter_permuted(self, keyed):
+        heapq.heapify(keyed)
+        while keyed:
+            yield heapq.heappop(keyed)[1]
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
 
     def get_connected_servers(self):
-        return frozenset([s for s in self.servers.values() if s.get_rref()])
+        if self._connected_servers is None:
+            self._connected_servers = frozenset([s for s in self.servers.values()
+                                                 if s.get_rref()])
+        return self._connected_servers
 
     def get_known_servers(self):
         return frozenset(self.servers.values())
@@ -137,14 +182,293 @@ class StorageFarmBroker:
             return self.servers[serverid].get_nickname()
         return None
 
+    def get_connection_manager(self):
+        return self.connection_manager
+
+class ConnectionManager(service.Service):
+    """I establish (and re-establish) the connections to storage servers,
+    instead of letting each one have its own foolscap Reconnector. I make at
+    most MAX_CONCURRENT_CONNECTS connection attempts at a time, so that
+    coming back from a network outage does not start hundreds of TLS
+    handshakes at once, and when more servers are waiting than that, I try
+    the ones we have been reading shares from most recently first, then the
+    ones we were most recently connected to.
+
+    A server that I fail to reach is tried again after a delay that grows
+    with each failure, up to MAX_RETRY_DELAY. Whenever a connection
+    succeeds, the network is evidently working again, so every server that
+    is still waiting is tried as soon as there is room for it. This keeps us
+    from hanging out for a long time with connections to only a subset of
+    the servers, which would increase the chances that we'll put shares in
+    weird places (and not update existing shares of mutable files). See
+    #374 for more details.
+
+    I also keep histograms of how long each connection attempt took
+    ('handshake_latencies') and of how long it took to get a connection
+    back after losing it ('reconnect_latencies')."""
+
+    MAX_CONCURRENT_CONNECTS = 10
+    # an attempt that has not finished after this long stops counting
+    # against MAX_CONCURRENT_CONNECTS (but we still use it if it succeeds)
+    ATTEMPT_TIMEOUT = 30
+    INITIAL_RETRY_DELAY = 1.0
+    RETRY_FACTOR = 2.7182818284590451 # like foolscap's Reconnector
+    MAX_RETRY_DELAY = 60
+
+    def __init__(self, tub, clock=None):
+        self.tub = tub
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self._servers = set()
+        # maps server to the time of its next attempt, for each server that
+        # is neither connected nor being connected to
+        self._waiting = {}
+        # maps server to the time that its current attempt started
+        self._attempts = {}
+        # maps server to the delay before its next attempt, if the current
+        # one fails
+        self._retry_delays = {}
+        # maps server to the time that we lost our connection to it
+        self._lost_times = {}
+        self._timer = None
+        self.handshake_latencies = LogHistogram(precision=0.05, minimum=1e-3)
+        self.reconnect_latencies = LogHistogram(precision=0.05, minimum=1e-3)
+
+    def startService(self):
+        service.Service.startService(self)
+        self._schedule()
+
+    def stopService(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        return service.Service.stopService(self)
+
+    def add_server(self, server):
+        self._servers.add(server)
+        self._retry_delays[server] = self.INITIAL_RETRY_DELAY
+        self._waiting[server] = self._clock.seconds()
+        self._schedule()
+
+    def remove_server(self, server):
+        self._servers.discard(server)
+        self._waiting.pop(server, None)
+        self._attempts.pop(server, None)
+        self._retry_delays.pop(server, None)
+        self._lost_times.pop(server, None)
+        self._schedule()
+
+    def connection_lost(self, server):
+        if server not in self._servers:
+            return
+        now = self._clock.seconds()
+        self._lost_times[server] = now
+        self._retry_delays[server] = self.INITIAL_RETRY_DELAY
+        self._waiting[server] = now + self.INITIAL_RETRY_DELAY
+        self._schedule()
+
+    def hurry(self, server):
+        """Try to connect to 'server' as soon as there is room, instead of
+        waiting for its next retry."""
+        if server in self._waiting:
+            self._waiting[server] = self._clock.seconds()
+            self._retry_delays[server] = self.INITIAL_RETRY_DELAY
+            self._schedule()
+
+    def get_waiting_count(self):
+        return len(self._waiting)
+
+    def get_connecting_count(self):
+        return len(self._attempts)
+
+    def _get_priority(self, server):
+        # lower sorts first
+        last_used = server.get_performance().last_used or 0
+        last_connected = server.get_last_connect_time() or 0
+        return (-last_used, -last_connected, server.get_serverid())
+
+    def _schedule(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self.running:
+            return
+        now = self._clock.seconds()
+        active = [started for started in self._attempts.values()
+                  if now - started < self.ATTEMPT_TIMEOUT]
+        room = self.MAX_CONCURRENT_CONNECTS - len(active)
+        ready = [server for (server, when) in self._waiting.items()
+                 if when <= now]
+        if room > 0 and ready:
+            ready.sort(key=self._get_priority)
+            for server in ready[:room]:
+                self._start_attempt(server, now)
+            room -= len(ready[:room])
+        # wake up when the next server is due, or, if there is no room for
+        # it, when the oldest attempt stops counting against the limit
+        wakeup = []
+        if room > 0:
+            wakeup.extend([when for when in self._waiting.values()
+                           if when > now])
+        elif self._waiting:
+            wakeup.extend([started + self.ATTEMPT_TIMEOUT
+                           for started in active])
+        if wakeup:
+            delay = max(min(wakeup) - now, 0)
+            self._timer = self._clock.callLater(delay, self._timer_expired)
+
+    def _timer_expired(self):
+        self._timer = None
+        self._schedule()
+
+    def _start_attempt(self, server, now):
+        del self._waiting[server]
+        self._attempts[server] = now
+        furl = server.get_announcement()["FURL"]
+        d = self.tub.getReference(furl)
+        d.addCallbacks(self._connected, self._failed,
+                       callbackArgs=(server, now), errbackArgs=(server, now))
+        d.addErrback(log.err, format="ConnectionManager._start_attempt",
+                     facility="tahoe.storage_broker", umid="N6R4Ug")
+
+    def _attempt_finished(self, server, started):
+        # returns False if the result is no longer wanted
+        if not self.running or self._attempts.get(server) != started:
+            return False
+        del self._attempts[server]
+        return True
+
+    def _connected(self, rref, server, started):
+        if not self._attempt_finished(server, started):
+            return
+        now = self._clock.seconds()
+        self.handshake_latencies.add(now - started)
+        if server in self._lost_times:
+            self.reconnect_latencies.add(now - self._lost_times.pop(server))
+        self._retry_delays[server] = self.INITIAL_RETRY_DELAY
+        rref.notifyOnDisconnect(self.connection_lost, server)
+        server._got_connection(rref)
+        # the network is working, so don't make the others wait out their
+        # backoff
+        for waiting in self._waiting:
+            self._waiting[waiting] = min(self._waiting[waiting], now)
+        self._schedule()
+
+    def _failed(self, f, server, started):
+        if not self._attempt_finished(server, started):
+            return
+        log.msg(format="unable to connect to %(name)s: %(f)s",
+                name=server.get_name(), f=str(f.value),
+                facility="tahoe.storage_broker", level=log.NOISY,
+                umid="bL8vKA")
+        delay = self._retry_delays[server]
+        self._retry_delays[server] = min(delay * self.RETRY_FACTOR,
+                                         self.MAX_RETRY_DELAY)
+        self._waiting[server] = self._clock.seconds() + delay
+        self._schedule()
+
+class ServerPerformance:
+    """I remember how quickly a server has answered our requests, so that
+    downloads can prefer the servers that are likely to be fastest. I keep
+    exponentially-weighted moving averages of the round-trip time (from
+    small requests), the transfer rate (from large ones) and the fraction of
+    requests that failed, and I count the requests that are in flight.
+
+    Callers report each request with request_started(), and then either
+    request_finished() or request_failed(). DYHB queries are timed
+    separately from share reads, since they are much quicker and would
+    otherwise make us hedge reads too eagerly."""
+
+    # the weight of each new sample
+    ALPHA = 0.2
+    # responses with fewer bytes than this only tell us about latency
+    MIN_THROUGHPUT_SAMPLE = 8*1024
+    # a request that takes longer than this fraction of all the responses
+    # we have seen is worth hedging, once we have seen enough of them
+    HEDGE_PERCENTILE = 0.95
+    MIN_HEDGE_SAMPLES = 20
+
+    def __init__(self):
+        self.last_used = None # when we last read share data from it
+        self.rtt = None # seconds
+        self.throughput = None # bytes per second
+        self.error_rate = 0.0
+        self.outstanding = 0
+        self.requests = 0
+        self.latencies = LogHistogram(precision=0.05, minimum=1e-4)
+        self.dyhb_latencies = LogHistogram(precision=0.05, minimum=1e-4)
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return (1 - self.ALPHA) * old + self.ALPHA * new
+
+    def request_started(self):
+        self.outstanding += 1
+
+    def request_finished(self, elapsed, size=0, dyhb=False):
+        self.outstanding = max(0, self.outstanding - 1)
+        self.requests += 1
+        self.error_rate = self._average(self.error_rate, 0.0)
+        if dyhb:
+            self.dyhb_latencies.add(elapsed)
+        else:
+            self.latencies.add(elapsed)
+        if size:
+            self.last_used = time.time()
+        if size < self.MIN_THROUGHPUT_SAMPLE or self.rtt is None:
+            self.rtt = self._average(self.rtt, elapsed)
+            return
+        # whatever took longer than a round trip was spent moving data
+        transfer_time = max(elapsed - self.rtt, elapsed / 10.0)
+        self.throughput = self._average(self.throughput,
+                                        size / max(transfer_time, 1e-6))
+
+    def request_failed(self):
+        self.outstanding = max(0, self.outstanding - 1)
+        self.requests += 1
+        self.error_rate = self._average(self.error_rate, 1.0)
+
+    def get_expected_time(self, size=0):
+        """Return the number of seconds that a new request for 'size' bytes
+        is likely to take, counting the requests already in flight and the
+        chance of having to ask again elsewhere, or None if I have not seen
+        this server answer anything yet."""
+        if self.rtt is None:
+            return None
+        expected = self.rtt
+        if self.throughput:
+            expected += (self.outstanding + 1) * size / self.throughput
+        return expected / max(1.0 - self.error_rate, 0.05)
+
+    def get_hedge_delay(self, size=0):
+        """Return how long a request for 'size' bytes may be outstanding
+        before it is worth asking another server as well, or None if I have
+        not seen enough share reads to say."""
+        if self.latencies.count < self.MIN_HEDGE_SAMPLES:
+            return None
+        return max(self.latencies.get_percentile(self.HEDGE_PERCENTILE),
+                   self.get_expected_time(size))
+
 class IServer(Interface):
     """I live in the client, and represent a single server."""
-    def start_connecting(tub, trigger_cb):
+    def start_connecting(connection_manager):
         pass
     def get_nickname():
         pass
     def get_rref():
         pass
+    def get_performance():
+        """Return the ServerPerformance that tracks how quickly this server
+        has been answering us."""
+    def get_available_space():
+        """Return the size (in bytes) of the largest immutable share that I
+        expect this server to accept."""
+    def note_share_refused(size):
+        """Remember that this server has just refused to hold a share of
+        'size' bytes, because it did not have room for it."""
 
 class NativeStorageServer:
     """I hold information about a storage server that we want to connect to.
@@ -173,6 +497,10 @@ class NativeStorageServer:
         "application-version": "unknown: no get_version()",
         }
 
+    # once a server has refused a share for lack of space, we do not offer
+    # it shares of that size (or larger) for this many seconds
+    FULL_HINT_LIFETIME = 10*60
+
     def __init__(self, serverid, ann_d, min_shares=1):
         self.serverid = serverid
         self._tubid = serverid
@@ -185,8 +513,11 @@ class NativeStorageServer:
         self.last_loss_time = None
         self.remote_host = None
         self.rref = None
-        self._reconnector = None
-        self._trigger_cb = None
+        self._connection_manager = None
+        self._status_changed_cbs = []
+        self.performance = ServerPerformance()
+        self._refused_share_size = None
+        self._refused_time = None
 
     def __repr__(self):
         return "<NativeStorageServer for %s>" % self.get_name()
@@ -219,18 +550,44 @@ class NativeStorageServer:
         return self.last_loss_time
     def get_announcement_time(self):
         return self.announcement_time
-
-    def start_connecting(self, tub, trigger_cb):
-        furl = self.announcement["FURL"]
-        self._trigger_cb = trigger_cb
-        self._reconnector = tub.connectTo(furl, self._got_connection)
+    def get_performance(self):
+        return self.performance
+
+    def get_available_space(self):
+        # the server tells us how much space it had when we connected, and
+        # we remember when it has refused a share since then
+        version = self.get_version() or self.VERSION_DEFAULTS
+        v1 = version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        maxsize = v1["maximum-immutable-share-size"]
+        if self._refused_share_size is not None:
+            if time.time() - self._refused_time < self.FULL_HINT_LIFETIME:
+                maxsize = min(maxsize, self._refused_share_size - 1)
+            else:
+                self._refused_share_size = None
+        return maxsize
+
+    def note_share_refused(self, size):
+        if self.get_available_space() >= size:
+            self._refused_share_size = size
+            self._refused_time = time.time()
+
+    def on_status_changed(self, cb):
+        # 'cb' will be called, synchronously, whenever we connect or
+        # disconnect
+        self._status_changed_cbs.append(cb)
+
+    def _status_changed(self):
+        for cb in self._status_changed_cbs:
+            cb()
+
+    def start_connecting(self, connection_manager):
+        self._connection_manager = connection_manager
+        connection_manager.add_server(self)
 
     def _got_connection(self, rref):
         lp = log.msg(format="got connection to %(name)s, getting versions",
                      name=self.get_name(),
                      facility="tahoe.storage_broker", umid="coUECQ")
-        if self._trigger_cb:
-            eventually(self._trigger_cb)
         default = self.VERSION_DEFAULTS
         d = add_version_to_remote_reference(rref, default)
         d.addCallback(self._got_versioned_service, lp)
@@ -246,7 +603,10 @@ class NativeStorageServer:
         self.last_connect_time = time.time()
         self.remote_host = rref.getPeer()
         self.rref = rref
+        # the new version dict tells us how much space is free now
+        self._refused_share_size = None
         rref.notifyOnDisconnect(self._lost)
+        self._status_changed()
 
     def get_rref(self):
         return self.rref
@@ -257,14 +617,15 @@ class NativeStorageServer:
         self.last_loss_time = time.time()
         self.rref = None
         self.remote_host = None
+        self._status_changed()
 
     def stop_connecting(self):
         # used when this descriptor has been superceded by another
-        self._reconnector.stopConnecting()
+        self._connection_manager.remove_server(self)
 
     def try_to_connect(self):
-        # used when the broker wants us to hurry up
-        self._reconnector.reset()
+        # used when someone wants us to hurry up
+        self._connection_manager.hurry(self)
 
 class UnknownServerTypeError(Exception):
     pass
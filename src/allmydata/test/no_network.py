@@ -23,6 +23,7 @@ from base64 import b32encode
 from allmydata import uri as tahoe_uri
 from allmydata.client import Client
 from allmydata.storage.server import StorageServer, storage_index_to_dir
+from allmydata.storage_client import ServerPerformance
 from allmydata.util import fileutil, idlib, hashutil
 from allmydata.util.hashutil import sha1
 from allmydata.test.common_web import HTTPClientGETFactory
@@ -123,6 +124,8 @@ class NoNetworkServer:
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        self.performance = ServerPerformance()
+        self.refused_sizes = []
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     def get_serverid(self):
@@ -144,6 +147,15 @@ class NoNetworkServer:
         return self.rref
     def get_version(self):
         return self.rref.version
+    def get_performance(self):
+        return self.performance
+    def get_available_space(self):
+        v1 = self.rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+        return v1["maximum-immutable-share-size"]
+    def note_share_refused(self, size):
+        # many tests change which servers are full between uploads, so we
+        # always ask, but remember the refusal so tests can look for it
+        self.refused_sizes.append(size)
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
@@ -152,6 +164,8 @@ class NoNetworkStorageBroker:
             seed = server.get_permutation_seed()
             return sha1(peer_selection_index + seed).digest()
         return sorted(self.get_connected_servers(), key=_permuted)
+    def iter_servers_for_psi(self, peer_selection_index):
+        return iter(self.get_servers_for_psi(peer_selection_index))
     def get_connected_servers(self):
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
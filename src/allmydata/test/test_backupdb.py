@@ -33,7 +33,7 @@ class BackupDB(unittest.TestCase):
         dbfile = os.path.join(basedir, "dbfile")
         bdb = self.create_or_skip(dbfile)
         self.failUnless(bdb)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
 
     def test_upgrade_v1_v2(self):
         self.basedir = basedir = os.path.join("backupdb", "upgrade_v1_v2")
@@ -50,7 +50,7 @@ class BackupDB(unittest.TestCase):
         # now we should have a v1 database on disk
         bdb = self.create_or_skip(dbfile)
         self.failUnless(bdb)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
 
     def test_fail(self):
         self.basedir = basedir = os.path.join("backupdb", "fail")
@@ -159,6 +159,125 @@ class BackupDB(unittest.TestCase):
         r = bdb.check_file(foo_fn)
         self.failUnlessEqual(r.was_uploaded(), False)
 
+    def test_index_and_batching(self):
+        self.basedir = basedir = os.path.join("backupdb", "index_and_batching")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create_or_skip(dbfile)
+        self.failUnless(bdb)
+
+        foo_fn = self.writeto("foo.txt", "foo.txt")
+        bar_fn = self.writeto("bar.txt", "bar.txt")
+
+        r = bdb.check_file(foo_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        r.did_upload("foo-cap")
+        # nothing is committed until the batch fills up
+        self.failUnlessEqual(bdb.commits, 0)
+        bdb.commit()
+        self.failUnlessEqual(bdb.commits, 1)
+        bdb.commit() # nothing new to commit
+        self.failUnlessEqual(bdb.commits, 1)
+
+        bdb.COMMIT_AFTER_WRITES = 2
+        r = bdb.check_file(bar_fn)
+        r.did_upload("bar-cap")
+        self.failUnlessEqual(bdb.commits, 1)
+        bdb.check_directory({u"foo.txt": "foo-cap"}).did_create("dir-cap")
+        self.failUnlessEqual(bdb.commits, 2)
+        self.failUnless(bdb.db_time > 0)
+
+        # a fresh connection sees the committed data, through the index
+        bdb2 = self.create_or_skip(dbfile)
+        bdb2.load_index()
+        self.failUnlessEqual(sorted(bdb2._local_files.keys()),
+                             sorted([os.path.abspath(foo_fn),
+                                     os.path.abspath(bar_fn)]))
+        # make sure we don't go to the database for these
+        bdb2.cursor = None
+        r = bdb2.check_file(foo_fn)
+        self.failUnlessEqual(r.was_uploaded(), "foo-cap")
+        self.failUnlessEqual(r.should_check(), False)
+        r = bdb2.check_file(bar_fn)
+        self.failUnlessEqual(r.was_uploaded(), "bar-cap")
+        bdb2.cursor = bdb2.connection.cursor()
+
+        # changes are reflected in the index
+        time.sleep(1.0) # make sure the timestamp changes
+        self.writeto("foo.txt", "NEW")
+        r = bdb2.check_file(foo_fn)
+        self.failUnlessEqual(r.was_uploaded(), False)
+        self.failIf(os.path.abspath(foo_fn) in bdb2._local_files)
+        r.did_upload("new-cap")
+        r = bdb2.check_file(foo_fn)
+        self.failUnlessEqual(r.was_uploaded(), "new-cap")
+
+        bdb2.NO_CHECK_BEFORE = 0
+        bdb2.ALWAYS_CHECK_AFTER = 0.1
+        time.sleep(1.0)
+        r = bdb2.check_file(bar_fn)
+        self.failUnlessEqual(r.should_check(), True)
+        r.did_check_healthy("results")
+        bdb2.NO_CHECK_BEFORE = 200
+        bdb2.ALWAYS_CHECK_AFTER = 400
+        r = bdb2.check_file(bar_fn)
+        self.failUnlessEqual(r.should_check(), False)
+        bdb2.commit()
+
+    def test_upgrade_v2_v3(self):
+        self.basedir = basedir = os.path.join("backupdb", "upgrade_v2_v3")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        stderr = StringIO()
+        created = backupdb.get_backupdb(dbfile, stderr=stderr,
+                                        create_version=(backupdb.SCHEMA_v2, 2),
+                                        just_create=True)
+        if not created:
+            if "I was unable to import a python sqlite library" in stderr.getvalue():
+                raise unittest.SkipTest("sqlite unavailable, skipping test")
+            self.fail("unable to create v2 backupdb")
+        bdb = self.create_or_skip(dbfile)
+        self.failUnless(bdb)
+        self.failUnlessEqual(bdb.VERSION, 3)
+        bdb.cursor.execute("SELECT COUNT(*) FROM local_directories")
+        self.failUnlessEqual(bdb.cursor.fetchone()[0], 0)
+
+    def test_local_directory(self):
+        self.basedir = basedir = os.path.join("backupdb", "local_directory")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create_or_skip(dbfile)
+        self.failUnless(bdb)
+
+        self.writeto("top/sub/foo.txt", "foo.txt")
+        top = os.path.join(unicode(basedir), u"top")
+        excludehash = bdb.get_excludehash([u"*~"])
+        self.failIfEqual(excludehash, bdb.get_excludehash([]))
+        self.failUnlessEqual(excludehash, bdb.get_excludehash(set([u"*~"])))
+
+        r = bdb.check_local_directory(top, excludehash)
+        self.failIf(r.is_unchanged())
+        dr = bdb.check_directory({u"sub": "URI:DIR2-CHK:sub"})
+        dr.did_create("URI:DIR2-CHK:top")
+        r.did_backup([u"sub"], dr.dirhash)
+
+        r = bdb.check_local_directory(top, excludehash)
+        self.failUnless(r.is_unchanged())
+        self.failUnlessEqual(r.subdirs, [u"sub"])
+        dr = bdb.check_dirhash(r.dirhash)
+        self.failUnlessEqual(dr.was_created(), "URI:DIR2-CHK:top")
+        self.failUnlessEqual(dr.should_check(), False)
+
+        # different exclude patterns mean different contents
+        r = bdb.check_local_directory(top, bdb.get_excludehash([]))
+        self.failIf(r.is_unchanged())
+
+        # a new entry changes the directory's mtime
+        time.sleep(1.0)
+        self.writeto("top/bar.txt", "bar.txt")
+        r = bdb.check_local_directory(top, excludehash)
+        self.failIf(r.is_unchanged())
+
     def test_wrong_version(self):
         self.basedir = basedir = os.path.join("backupdb", "wrong_version")
         fileutil.make_dirs(basedir)
@@ -2,7 +2,7 @@
 import os.path
 from twisted.trial import unittest
 from cStringIO import StringIO
-import urllib, re
+import urllib, re, threading
 import simplejson
 
 from mock import patch
@@ -1756,10 +1756,13 @@ class Mv(GridTestMixin, CLITestMixin, unittest.TestCase):
         d = self.do_cli("create-alias", "tahoe")
         d.addCallback(lambda res:
             self.do_cli("cp", fn1, "tahoe:"))
+        d.addCallback(lambda res:
+            self.do_cli("mkdir", "tahoe:directory"))
 
-        # do mv file1 file2
+        # do mv file1 directory/file2 (a rename within one directory would
+        # not need a DELETE)
         d.addCallback(lambda res:
-            self.do_cli("mv", "tahoe:file1", "tahoe:file2"))
+            self.do_cli("mv", "tahoe:file1", "tahoe:directory/file2"))
         def _check( (rc, out, err) ):
             self.failIfIn("OK", out, "mv printed 'OK' even though the DELETE failed")
             self.failUnlessEqual(rc, 2)
@@ -1771,6 +1774,50 @@ class Mv(GridTestMixin, CLITestMixin, unittest.TestCase):
         d.addBoth(_restore_do_http)
         return d
 
+    def test_mv_rename_is_one_request(self):
+        self.basedir = "cli/Mv/mv_rename_is_one_request"
+        self.set_up_grid()
+        fn1 = os.path.join(self.basedir, "file1")
+        DATA1 = "Nuclear launch codes"
+        fileutil.write(fn1, DATA1)
+
+        original_do_http = tahoe_mv.do_http
+        self.requests = []
+        def mock_do_http(method, url, body=""):
+            self.requests.append(method)
+            return original_do_http(method, url, body=body)
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res:
+            self.do_cli("mkdir", "tahoe:directory"))
+        d.addCallback(lambda res:
+            self.do_cli("cp", fn1, "tahoe:directory/file1"))
+        def _mock(res):
+            tahoe_mv.do_http = mock_do_http
+        d.addCallback(_mock)
+
+        d.addCallback(lambda res:
+            self.do_cli("mv", "tahoe:directory/file1", "tahoe:directory/file2"))
+        def _check( (rc, out, err) ):
+            self.failUnlessReallyEqual(rc, 0, err)
+            self.failUnlessIn("OK", out)
+            # one GET to look at the source, and one POST to rename it
+            self.failUnlessEqual(self.requests, ["GET", "POST"])
+        d.addCallback(_check)
+
+        def _restore_do_http(res):
+            tahoe_mv.do_http = original_do_http
+            return res
+        d.addBoth(_restore_do_http)
+        d.addCallback(lambda res:
+            self.do_cli("get", "tahoe:directory/file2"))
+        d.addCallback(lambda (rc, out, err):
+            self.failUnlessReallyEqual(out, DATA1))
+        d.addCallback(lambda res:
+            self.do_cli("ls", "tahoe:directory"))
+        d.addCallback(lambda (rc, out, err):
+            self.failUnlessReallyEqual(out, "file2\n"))
+        return d
+
     def test_mv_without_alias(self):
         # doing 'tahoe mv' without explicitly specifying an alias or
         # creating the default 'tahoe' alias should fail with a useful
@@ -1990,6 +2037,46 @@ class Cp(GridTestMixin, CLITestMixin, unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_cp_failure_links_subdirectories(self):
+        # the subdirectories that 'tahoe cp -r' creates are linked into
+        # their parents before any files are copied, so they are not left
+        # unlinked when the copy fails
+        self.basedir = "cli/Cp/cp_failure_links_subdirectories"
+        self.set_up_grid()
+        source = os.path.join(self.basedir, "src")
+        fileutil.make_dirs(os.path.join(source, "sub1"))
+        fileutil.make_dirs(os.path.join(source, "sub2", "sub3"))
+        fileutil.write(os.path.join(source, "sub1", "file1"), "file1")
+        fileutil.write(os.path.join(source, "sub2", "sub3", "file3"), "file3")
+
+        original_PUT = tahoe_cp.PUT
+        def failing_PUT(url, data):
+            raise common.TahoeError("PUT failed")
+        d = self.do_cli("create-alias", "tahoe")
+        def _break(res):
+            tahoe_cp.PUT = failing_PUT
+        d.addCallback(_break)
+        d.addCallback(lambda res: self.do_cli("cp", "-r", source, "tahoe:dst"))
+        def _restore(res):
+            tahoe_cp.PUT = original_PUT
+            return res
+        d.addBoth(_restore)
+        def _failed((rc, out, err)):
+            self.failUnlessReallyEqual(rc, 1)
+            self.failUnlessIn("PUT failed", err)
+        d.addCallback(_failed)
+        d.addCallback(lambda res: self.do_cli("ls", "tahoe:dst"))
+        def _check_src((rc, out, err)):
+            self.failUnlessReallyEqual(rc, 0, err)
+            self.failUnlessReallyEqual(sorted(out.split()), ["sub1", "sub2"])
+        d.addCallback(_check_src)
+        d.addCallback(lambda res: self.do_cli("ls", "tahoe:dst/sub2"))
+        def _check_sub2((rc, out, err)):
+            self.failUnlessReallyEqual(rc, 0, err)
+            self.failUnlessReallyEqual(out.split(), ["sub3"])
+        d.addCallback(_check_sub2)
+        return d
+
     def test_unicode_dirnames(self):
         self.basedir = "cli/Cp/unicode_dirnames"
 
@@ -2614,6 +2701,229 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
     # and check4a takes 6s, as does the backup before check4b.
     test_backup.timeout = 3000
 
+    def test_backup_jobs(self):
+        self.basedir = "cli/Backup/backup_jobs"
+        self.set_up_grid()
+
+        source = os.path.join(self.basedir, "home")
+        self.writeto("parent/subdir/foo.txt", "foo")
+        self.writeto("parent/subdir/bar.txt", "bar\n" * 1000)
+        self.writeto("parent/blah.txt", "blah")
+        self.writeto("top.txt", "top")
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: self.do_cli("backup", "--jobs=3", "--verbose",
+                                              source, "tahoe:backups"))
+        def _check0((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual(fu, 4)
+            self.failUnlessReallyEqual(fs, 0)
+            # home, home/parent, home/parent/subdir
+            self.failUnlessReallyEqual(dc, 3)
+            self.failUnlessIn("3 jobs)", out)
+        d.addCallback(_check0)
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/parent/subdir/bar.txt"))
+        def _check1((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            self.failUnlessReallyEqual(out, "bar\n" * 1000)
+        d.addCallback(_check1)
+        d.addCallback(lambda res: self.do_cli("ls", "tahoe:backups/Latest"))
+        def _check2((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            self.failUnlessReallyEqual(sorted(out.split()), ["parent", "top.txt"])
+        d.addCallback(_check2)
+        return d
+
+    @patch('allmydata.scripts.tahoe_backup.mkdir')
+    def test_jobs_overlap_directories(self, mock_mkdir):
+        # with --jobs=3, the uploads of three files that each sit in their
+        # own directory must all be in flight at the same time: a directory
+        # only waits for its own children when it is created
+        basedir = "cli/Backup/jobs_overlap_directories"
+        fileutil.make_dirs(basedir)
+        fileutil.write(os.path.join(basedir, 'node.url'), 'http://example.net:2357/')
+        source = os.path.join(basedir, "home")
+        for name in ("a", "b", "c"):
+            fileutil.make_dirs(os.path.join(source, name))
+            fileutil.write(os.path.join(source, name, "file.txt"), name)
+        mock_mkdir.return_value = "URI:DIR2-CHK:fake"
+
+        options = cli.BackupOptions()
+        options.parseOptions(['--jobs', '3', '--node-directory', basedir,
+                              'from', 'to'])
+        options.stdout = StringIO()
+        options.stderr = StringIO()
+        bu = tahoe_backup.BackerUpper(options)
+        bu.verbosity = 0
+        bu.backupdb = None
+
+        lock = threading.Lock()
+        in_flight = []
+        all_started = threading.Event()
+        def put_file(childpath):
+            lock.acquire()
+            in_flight.append(childpath)
+            if len(in_flight) == 3:
+                all_started.set()
+            lock.release()
+            # if each directory waited for its own uploads before the next
+            # directory's were started, this would time out
+            all_started.wait(10)
+            lock.acquire()
+            in_flight.remove(childpath)
+            lock.release()
+            return ("URI:CHK:fake", 1, 0.0)
+        bu.put_file = put_file
+
+        bu.pool = tahoe_backup.UploadPool(3)
+        try:
+            dircap = bu.process(abspath_expanduser_unicode(unicode(source)))
+        finally:
+            bu.pool.stop()
+        self.failUnless(all_started.isSet(), in_flight)
+        self.failUnlessReallyEqual(dircap, "URI:DIR2-CHK:fake")
+        self.failUnlessReallyEqual(bu.files_uploaded, 3)
+        # home/a, home/b, home/c, and home
+        self.failUnlessReallyEqual(mock_mkdir.call_count, 4)
+
+    @patch('allmydata.scripts.tahoe_backup.mkdir')
+    def test_bounded_lookahead(self, mock_mkdir):
+        # the walk creates scanned directories before it has started the
+        # uploads of the whole tree, once too many of them are waiting
+        basedir = "cli/Backup/bounded_lookahead"
+        fileutil.make_dirs(basedir)
+        fileutil.write(os.path.join(basedir, 'node.url'), 'http://example.net:2357/')
+        source = os.path.join(basedir, "home")
+        for name in ("a", "b", "c", "d"):
+            fileutil.make_dirs(os.path.join(source, name))
+            fileutil.write(os.path.join(source, name, "file.txt"), name)
+
+        options = cli.BackupOptions()
+        options.parseOptions(['--node-directory', basedir, 'from', 'to'])
+        options.stdout = StringIO()
+        options.stderr = StringIO()
+        bu = tahoe_backup.BackerUpper(options)
+        bu.verbosity = 0
+        bu.backupdb = None
+        bu.MAX_UNFINISHED_DIRECTORIES = 2
+
+        events = []
+        def put_file(childpath):
+            events.append(("put", os.path.basename(os.path.dirname(childpath))))
+            return ("URI:CHK:fake", 1, 0.0)
+        bu.put_file = put_file
+        def mkdir(contents, options):
+            events.append(("mkdir", sorted(contents.keys())))
+            return "URI:DIR2-CHK:fake"
+        mock_mkdir.side_effect = mkdir
+
+        dircap = bu.process(abspath_expanduser_unicode(unicode(source)))
+        self.failUnlessReallyEqual(dircap, "URI:DIR2-CHK:fake")
+        # the third scanned directory pushes the first one out of the
+        # queue, before the fourth directory is scanned
+        self.failUnlessReallyEqual([kind for (kind, what) in events],
+                                   ["put", "put", "put", "mkdir",
+                                    "put", "mkdir", "mkdir", "mkdir",
+                                    "mkdir"])
+        self.failUnlessReallyEqual(events[3][1], [u"file.txt"])
+        self.failUnlessReallyEqual(events[-1][1], [u"a", u"b", u"c", u"d"])
+        self.failUnlessReallyEqual(len(bu.unfinished), 0)
+        self.failUnlessReallyEqual(bu.unfinished_files, 0)
+
+    def test_backup_trust_directory_mtimes(self):
+        self.basedir = "cli/Backup/backup_trust_directory_mtimes"
+        self.set_up_grid()
+
+        source = os.path.join(self.basedir, "home")
+        self.writeto("parent/subdir/foo.txt", "foo")
+        self.writeto("parent/blah.txt", "blah")
+        self.writeto("other/bar.txt", "bar")
+
+        def do_backup(*options):
+            return self.do_cli("backup", *(options + (source, "tahoe:backups")))
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: do_backup())
+        def _check0((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual(fu, 3)
+            # home, parent, subdir, other
+            self.failUnlessReallyEqual(dc, 4)
+        d.addCallback(_check0)
+
+        # nothing changed: the whole tree is re-used without looking at any
+        # files
+        d.addCallback(self.stall, 1.1)
+        d.addCallback(lambda res: do_backup("--trust-directory-mtimes"))
+        def _check1((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            self.failUnlessReallyEqual((fu, fr, fs), (0, 0, 0))
+            self.failUnlessReallyEqual((dc, dr, ds), (0, 1, 0))
+        d.addCallback(_check1)
+
+        # adding a file changes subdir's mtime, so subdir and its ancestors
+        # are processed again, but other/ is re-used as a whole
+        def _modify(res):
+            self.writeto("parent/subdir/new.txt", "new")
+            return do_backup("--trust-directory-mtimes", "--verbose")
+        d.addCallback(_modify)
+        def _check2((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            fu, fr, fs, dc, dr, ds = self.count_output(out)
+            # new.txt
+            self.failUnlessReallyEqual(fu, 1)
+            # foo.txt, blah.txt
+            self.failUnlessReallyEqual(fr, 2)
+            # home, parent, subdir
+            self.failUnlessReallyEqual(dc, 3)
+            # other
+            self.failUnlessReallyEqual(dr, 1)
+            self.failUnlessIn("re-using unchanged directory", out)
+        d.addCallback(_check2)
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/parent/subdir/new.txt"))
+        def _check3((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            self.failUnlessReallyEqual(out, "new")
+        d.addCallback(_check3)
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/other/bar.txt"))
+        def _check4((rc, out, err)):
+            self.failUnlessReallyEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            self.failUnlessReallyEqual(out, "bar")
+        d.addCallback(_check4)
+        return d
+
+    def test_jobs_option(self):
+        basedir = "cli/Backup/jobs_option"
+        fileutil.make_dirs(basedir)
+        fileutil.write(os.path.join(basedir, 'node.url'), 'http://example.net:2357/')
+
+        backup_options = cli.BackupOptions()
+        backup_options.parseOptions(['--node-directory', basedir, 'from', 'to'])
+        self.failUnlessReallyEqual(backup_options['jobs'], 1)
+        backup_options = cli.BackupOptions()
+        backup_options.parseOptions(['--jobs', '4', '--node-directory',
+                                     basedir, 'from', 'to'])
+        self.failUnlessReallyEqual(backup_options['jobs'], 4)
+        backup_options = cli.BackupOptions()
+        self.failUnlessRaises(usage.UsageError, backup_options.parseOptions,
+                              ['--jobs', '0', '--node-directory', basedir,
+                               'from', 'to'])
+        backup_options = cli.BackupOptions()
+        self.failUnlessRaises(usage.UsageError, backup_options.parseOptions,
+                              ['--trust-directory-mtimes', '--ignore-timestamps',
+                               '--node-directory', basedir, 'from', 'to'])
+
     def _check_filtering(self, filtered, all, included, excluded):
         filtered = set(filtered)
         all = set(all)
@@ -1,11 +1,15 @@
 import os
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
+from twisted.internet.task import Clock
 
 import allmydata
 from allmydata.node import OldConfigError
 from allmydata import client
-from allmydata.storage_client import StorageFarmBroker
+from allmydata.storage_client import StorageFarmBroker, ServerPerformance, \
+     ConnectionManager
+from allmydata.storage.packed import PackedBackend
 from allmydata.util import base32, fileutil
 from allmydata.interfaces import IFilesystemNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, IDirectoryNode
@@ -22,6 +26,43 @@ BASECONFIG_I = ("[client]\n"
               "introducer.furl = %s\n"
               )
 
+class FakeTub:
+    def __init__(self):
+        self.attempts = {} # maps furl to Deferred
+    def getReference(self, furl):
+        d = defer.Deferred()
+        self.attempts[furl] = d
+        return d
+
+class FakeRemoteReference:
+    def __init__(self):
+        self.disconnect_cbs = []
+    def notifyOnDisconnect(self, cb, *args):
+        self.disconnect_cbs.append((cb, args))
+    def disconnect(self):
+        for (cb, args) in self.disconnect_cbs:
+            cb(*args)
+
+class FakeServer:
+    def __init__(self, name, last_used=None, last_connect_time=None):
+        self.name = name
+        self.performance = ServerPerformance()
+        self.performance.last_used = last_used
+        self.last_connect_time = last_connect_time
+        self.rref = None
+    def get_serverid(self):
+        return self.name
+    def get_name(self):
+        return self.name
+    def get_announcement(self):
+        return {"FURL": "furl-" + self.name}
+    def get_performance(self):
+        return self.performance
+    def get_last_connect_time(self):
+        return self.last_connect_time
+    def _got_connection(self, rref):
+        self.rref = rref
+
 class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
     def test_loadable(self):
         basedir = "test_client.Basic.test_loadable"
@@ -135,6 +176,60 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         c = client.Client(basedir)
         self.failUnlessEqual(c.getServiceNamed("storage").reserved_space, 0)
 
+    def test_expire_threads(self):
+        basedir = "client.Basic.test_expire_threads"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "expire.threads = 4\n" + \
+                           "expire.max_iops = 200\n" + \
+                           "expire.max_bytes_per_second = 5MB\n")
+        c = client.Client(basedir)
+        lc = c.getServiceNamed("storage").lease_checker
+        self.failUnlessEqual(lc.worker_threads, 4)
+        self.failUnlessEqual(lc.max_iops, 200)
+        self.failUnlessEqual(lc.max_bytes_per_second, 5*1000*1000)
+
+    def test_mmap_threshold(self):
+        basedir = "client.Basic.test_mmap_threshold"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "mmap_threshold = 1MB\n" + \
+                           "mmap_max_shares = 50\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnlessEqual(ss.mmap_threshold, 1000*1000)
+        self.failUnlessEqual(ss.mapped_shares.max_mappings, 50)
+
+    def test_storage_backend(self):
+        basedir = "client.Basic.test_storage_backend"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "backend = packed\n" + \
+                           "packed.max_share_size = 4KiB\n")
+        c = client.Client(basedir)
+        ss = c.getServiceNamed("storage")
+        self.failUnless(isinstance(ss.backend, PackedBackend), ss.backend)
+        self.failUnlessEqual(ss.backend.max_share_size, 4096)
+        self.failUnlessEqual(ss.mmap_threshold, None)
+
+        basedir = "client.Basic.test_storage_backend_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), \
+                           BASECONFIG + \
+                           "[storage]\n" + \
+                           "enabled = true\n" + \
+                           "backend = tape\n")
+        self.failUnlessRaises(ValueError, client.Client, basedir)
+
     def _permute(self, sb, key):
         return [ s.get_serverid() for s in sb.get_servers_for_psi(key) ]
 
@@ -146,8 +241,159 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
         self.failUnlessReallyEqual(self._permute(sb, "two"), ['0','4','2','1','3'])
         sb.servers.clear()
+        sb._servers_changed()
         self.failUnlessReallyEqual(self._permute(sb, "one"), [])
 
+    def test_server_performance(self):
+        perf = ServerPerformance()
+        self.failUnlessEqual(perf.get_expected_time(1000), None)
+        perf.request_started()
+        perf.request_finished(0.1)
+        self.failUnlessEqual(perf.outstanding, 0)
+        self.failUnlessAlmostEqual(perf.rtt, 0.1)
+        self.failUnlessEqual(perf.throughput, None)
+        self.failUnlessAlmostEqual(perf.get_expected_time(1000), 0.1)
+        # small responses only tell us about the latency
+        perf.request_finished(0.2, 100)
+        self.failUnlessAlmostEqual(perf.rtt, 0.12)
+        # large ones tell us about the transfer rate
+        perf.request_finished(1.12, 100*1000)
+        self.failUnlessAlmostEqual(perf.rtt, 0.12)
+        self.failUnlessAlmostEqual(perf.throughput, 100*1000)
+        self.failUnlessAlmostEqual(perf.get_expected_time(50*1000), 0.62)
+        # requests in flight will slow down the next one
+        perf.request_started()
+        self.failUnlessAlmostEqual(perf.get_expected_time(50*1000), 1.12)
+        perf.request_failed()
+        self.failUnlessEqual(perf.outstanding, 0)
+        self.failUnlessAlmostEqual(perf.error_rate, 0.2)
+        self.failUnlessAlmostEqual(perf.get_expected_time(50*1000), 0.62/0.8)
+        self.failUnlessEqual(perf.requests, 4)
+
+    def test_server_performance_hedge_delay(self):
+        perf = ServerPerformance()
+        for i in range(100):
+            perf.request_finished(0.2 + i * 0.001)
+        delay = perf.get_hedge_delay(0)
+        self.failUnless(0.28 < delay < 0.31, delay)
+        # quick DYHB answers must not make us hedge share reads sooner
+        for i in range(1000):
+            perf.request_finished(0.01, dyhb=True)
+        self.failUnlessEqual(perf.dyhb_latencies.count, 1000)
+        self.failUnlessEqual(perf.latencies.count, 100)
+        delay = perf.get_hedge_delay(0)
+        self.failUnless(0.28 < delay < 0.31, delay)
+
+    def test_permute_cache(self):
+        sb = StorageFarmBroker(None, True)
+        for k in ["%d" % i for i in range(5)]:
+            sb.test_add_rref(k, "rref")
+        def _iter_permute(key):
+            return [ s.get_serverid() for s in sb.iter_servers_for_psi(key) ]
+
+        self.failUnlessReallyEqual(_iter_permute("one"), ['3','1','0','4','2'])
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
+        self.failUnlessReallyEqual(_iter_permute("one"), ['3','1','0','4','2'])
+        self.failUnlessIdentical(sb.get_connected_servers(),
+                                 sb.get_connected_servers())
+        # callers may modify the lists they get
+        sb.get_servers_for_psi("one").pop()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
+
+        # losing a connection, or gaining a server, empties the caches
+        sb.servers["4"]._lost()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','2'])
+        self.failUnlessReallyEqual(_iter_permute("one"), ['3','1','0','2'])
+        self.failUnlessReallyEqual(len(sb.get_connected_servers()), 4)
+        sb.test_add_rref("4", "rref")
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['3','1','0','4','2'])
+
+        # only the most recent lists are kept
+        sb.PERMUTED_CACHE_SIZE = 2
+        for key in ["one", "two", "three"]:
+            self._permute(sb, key)
+        self.failUnlessReallyEqual(sorted(sb._permuted_servers.keys()),
+                                   ["three", "two"])
+
+    def test_connection_manager(self):
+        tub = FakeTub()
+        clock = Clock()
+        cm = ConnectionManager(tub, clock)
+        cm.MAX_CONCURRENT_CONNECTS = 2
+        servers = [FakeServer("s0"), FakeServer("s1", last_connect_time=5),
+                   FakeServer("s2"), FakeServer("s3", last_used=10),
+                   FakeServer("s4", last_used=20)]
+        for s in servers:
+            cm.add_server(s)
+        # nothing happens until we are started
+        self.failUnlessEqual(tub.attempts, {})
+        cm.startService()
+        # recently-used servers come first
+        self.failUnlessEqual(sorted(tub.attempts), ["furl-s3", "furl-s4"])
+        self.failUnlessEqual(cm.get_waiting_count(), 3)
+
+        # a failure makes room for the next one, and is retried later
+        tub.attempts.pop("furl-s4").errback(Exception("no route"))
+        self.failUnlessEqual(sorted(tub.attempts), ["furl-s1", "furl-s3"])
+        clock.advance(cm.INITIAL_RETRY_DELAY)
+        self.failUnlessEqual(sorted(tub.attempts), ["furl-s1", "furl-s3"])
+
+        # a success means the network works, so the others (including the
+        # one that just failed) are tried as soon as there is room
+        clock.advance(0.5)
+        rref3 = FakeRemoteReference()
+        tub.attempts.pop("furl-s3").callback(rref3)
+        self.failUnlessIdentical(servers[3].rref, rref3)
+        self.failUnlessEqual(cm.handshake_latencies.count, 1)
+        self.failUnlessAlmostEqual(cm.handshake_latencies.max, 1.5, 1)
+        self.failUnlessEqual(sorted(tub.attempts), ["furl-s1", "furl-s4"])
+
+        # an attempt that takes too long stops holding up the others
+        clock.advance(cm.ATTEMPT_TIMEOUT)
+        self.failUnlessEqual(sorted(tub.attempts),
+                             ["furl-s0", "furl-s1", "furl-s2", "furl-s4"])
+        self.failUnlessEqual(cm.get_waiting_count(), 0)
+        # but if it finishes, we still use it
+        rref1 = FakeRemoteReference()
+        tub.attempts.pop("furl-s1").callback(rref1)
+        self.failUnlessIdentical(servers[1].rref, rref1)
+
+        tub.attempts.pop("furl-s2").callback(FakeRemoteReference())
+        tub.attempts.pop("furl-s4").callback(FakeRemoteReference())
+
+        # lost connections are re-established
+        rref3.disconnect()
+        self.failUnlessEqual(cm.get_waiting_count(), 1)
+        clock.advance(cm.INITIAL_RETRY_DELAY)
+        self.failUnless("furl-s3" in tub.attempts)
+        clock.advance(2)
+        tub.attempts.pop("furl-s3").callback(FakeRemoteReference())
+        self.failUnlessEqual(cm.reconnect_latencies.count, 1)
+        self.failUnlessAlmostEqual(cm.reconnect_latencies.max, 3.0, 1)
+
+        # servers that keep failing back off, up to MAX_RETRY_DELAY
+        delays = []
+        for i in range(6):
+            tub.attempts.pop("furl-s0").errback(Exception("no route"))
+            start = clock.seconds()
+            while "furl-s0" not in tub.attempts:
+                clock.advance(0.5)
+            delays.append(clock.seconds() - start)
+        self.failUnlessEqual(delays[0], cm.INITIAL_RETRY_DELAY)
+        self.failUnless(delays[2] > delays[1] > delays[0], delays)
+        self.failUnlessEqual(max(delays), cm.MAX_RETRY_DELAY)
+
+        # removed servers are forgotten, even if an attempt finishes later
+        cm.remove_server(servers[0])
+        tub.attempts.pop("furl-s0").callback(FakeRemoteReference())
+        self.failUnlessEqual(servers[0].rref, None)
+
+        d = defer.maybeDeferred(cm.stopService)
+        def _stopped(res):
+            self.failIf(clock.getDelayedCalls())
+        d.addCallback(_stopped)
+        return d
+
     def test_versions(self):
         basedir = "test_client.Basic.test_versions"
         os.mkdir(basedir)
@@ -1,5 +1,5 @@
 
-import time
+import time, threading
 import os.path
 from twisted.trial import unittest
 from twisted.application import service
@@ -8,7 +8,8 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     IOBudget
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -82,6 +83,59 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ThreadedCrawler(ShareCrawler):
+    slow_start = 0
+    worker_threads = 3
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+        self.examined_in_reactor_thread = False
+        self.finished_d = defer.Deferred()
+        self.stop_after = None
+    def examine_bucket(self, prefixdir, storage_index_b32):
+        if threading.currentThread() is self.reactor_thread:
+            self.examined_in_reactor_thread = True
+        self.io_budget.charge(1)
+        return os.listdir(os.path.join(prefixdir, storage_index_b32))
+    def process_bucket_result(self, cycle, prefix, prefixdir,
+                              storage_index_b32, result):
+        self.all_buckets.append(storage_index_b32)
+        if self.stop_after is not None and \
+               len(self.all_buckets) == self.stop_after:
+            self.stop_after = None
+            self.stopped_d = self.disownServiceParent()
+    def finished_cycle(self, cycle):
+        eventually(self.finished_d.callback, None)
+
+class JournaledCrawler(ShareCrawler):
+    cpu_slice = 500 # make sure it can complete in a single slice
+    slow_start = 0
+    journaled = True
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.countdown = None
+    def add_initial_state(self):
+        self.state.setdefault("buckets", [])
+    def started_cycle(self, cycle):
+        self.state["buckets"] = []
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        self.update_state([storage_index_b32])
+        if self.countdown is not None:
+            self.countdown -= 1
+            if self.countdown == 0:
+                raise KeyboardInterrupt("simulated SIGKILL")
+    def apply_delta(self, delta):
+        self.state["buckets"].extend(delta)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+    def time(self):
+        return self.now
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -379,6 +433,199 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_done)
         return d
 
+    def test_threaded(self):
+        self.basedir = "crawler/Basic/threaded"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(30)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        c.reactor_thread = threading.currentThread()
+        c.max_iops = 1000
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            # results are processed in the same order as the serial crawler
+            self.failUnlessEqual(sorted(sis), c.all_buckets)
+            self.failIf(c.examined_in_reactor_thread)
+            self.failUnlessEqual(c.io_budget.iops, 1000)
+            s = c.get_state()
+            self.failUnlessEqual(s["last-cycle-finished"], 0)
+            self.failUnlessEqual(s["current-cycle"], None)
+            self.failUnless(c.sleeping_between_cycles)
+            self.failUnless(c.timer)
+        d.addCallback(_check)
+        return d
+
+    def test_threaded_stop_and_resume(self):
+        self.basedir = "crawler/Basic/threaded_stop_and_resume"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(30)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        c.reactor_thread = threading.currentThread()
+        c.stop_after = 10
+        c.setServiceParent(self.s)
+
+        def _stopped():
+            return getattr(c, "stopped_d", None) is not None
+        d = self.poll(_stopped)
+        d.addCallback(lambda ign: c.stopped_d)
+        def _check_stopped(ignored):
+            self.failIf(c.threadpool)
+            first = c.all_buckets
+            # the workers might have finished a few more buckets before
+            # they noticed they were being stopped
+            self.failUnless(len(first) >= 10, len(first))
+            self.failUnlessEqual(first, sorted(sis)[:len(first)])
+            s = c.get_state()
+            self.failUnlessEqual(s["current-cycle"], 0)
+            self.failUnlessEqual(s["last-complete-bucket"], first[-1])
+
+            # a new crawler resumes where the first one stopped
+            c2 = ThreadedCrawler(ss, statefile)
+            c2.reactor_thread = threading.currentThread()
+            c2.setServiceParent(self.s)
+            d2 = c2.finished_d
+            d2.addCallback(lambda ign: first + c2.all_buckets)
+            return d2
+        d.addCallback(_check_stopped)
+        def _check_resumed(all_buckets):
+            self.failUnlessEqual(all_buckets, sorted(sis))
+        d.addCallback(_check_resumed)
+        return d
+
+    def test_threaded_failure(self):
+        self.basedir = "crawler/Basic/threaded_failure"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        # examine buckets with Deferreds that we fire by hand
+        examinations = {}
+        def _defer_to_worker(f, prefixdir, bucket):
+            examinations[bucket] = defer.Deferred()
+            return examinations[bucket]
+        c.defer_to_worker = _defer_to_worker
+        c.running = True
+        d = c.crawl_buckets_in_threads(0, "aa", "prefixdir",
+                                       ["aa1", "aa2", "aa3", "aa4"])
+        self.failUnlessEqual(sorted(examinations.keys()),
+                             ["aa1", "aa2", "aa3", "aa4"])
+        failures = []
+        d.addErrback(failures.append)
+
+        # a failure behind the head of the queue stops the crawl at once.
+        # Later failures are absorbed rather than left unhandled, and later
+        # results are not processed.
+        examinations["aa2"].errback(ValueError("first"))
+        self.failUnlessEqual(len(failures), 1)
+        self.failUnless(failures[0].check(ValueError))
+        examinations["aa3"].errback(ValueError("second"))
+        examinations["aa1"].callback([])
+        examinations["aa4"].callback([])
+        self.failUnlessEqual(c.all_buckets, [])
+        self.failUnlessEqual(c.state["last-complete-bucket"], None)
+
+    def test_journal(self):
+        self.basedir = "crawler/Basic/journal"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = []
+        for i in range(10):
+            for tail in range(4):
+                sis.append(self.write(i, ss, serverid, tail))
+        sis.sort()
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = JournaledCrawler(ss, statefile)
+        c.countdown = 6
+        # the crawler dies in the middle of the sixth bucket, without any
+        # chance to save its state
+        self.failUnlessRaises(KeyboardInterrupt,
+                              c.start_current_prefix, time.time())
+        c.close_journal()
+        self.failUnlessEqual(c.state["buckets"], sis[:6])
+        statefile_size = os.path.getsize(statefile)
+
+        # a new crawler replays the journal, and resumes after the last
+        # bucket that was finished
+        c = JournaledCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["buckets"], sis[:5])
+        self.failUnlessEqual(c.state["last-complete-bucket"], sis[4])
+
+        # a partial record at the end (from a crash in the middle of a
+        # write) is ignored, and overwritten by the next record
+        f = open(c.journalfile, "ab")
+        f.write("\x00\x00\x01\x00partial")
+        f.close()
+        c = JournaledCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["buckets"], sis[:5])
+        c.countdown = 10
+        self.failUnlessRaises(KeyboardInterrupt,
+                              c.start_current_prefix, time.time())
+        c.close_journal()
+        c = JournaledCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["buckets"], sis[:14])
+
+        # checkpoint() leaves the statefile alone while the journal is
+        # small, and rewrites it once the journal is larger than it
+        c.checkpoint()
+        self.failUnlessEqual(os.path.getsize(statefile), statefile_size)
+        c.min_compaction_size = 0
+        c.checkpoint()
+        self.failUnless(os.path.getsize(statefile) > statefile_size)
+        # the old journal is obsolete once the statefile has been saved, so
+        # it must not be replayed again
+        c = JournaledCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["buckets"], sis[:14])
+
+        # finish the cycle
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(c.state["buckets"], sis)
+        self.failUnlessEqual(c.state["last-cycle-finished"], 0)
+        c.close_journal()
+        c = JournaledCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["buckets"], sis)
+        self.failUnlessEqual(c.state["current-cycle"], None)
+
+    def test_io_budget(self):
+        clock = FakeClock()
+        b = IOBudget(clock=clock.time, sleep=clock.sleep)
+        self.failUnlessEqual(b.charge(1000, 10**9), 0.0)
+        self.failUnlessEqual(clock.sleeps, [])
+
+        b = IOBudget(iops=100, bytes_per_second=1000,
+                     clock=clock.time, sleep=clock.sleep)
+        self.failUnlessEqual(b.charge(1), 0.0)
+        # each charge waits for the ones before it
+        self.failUnlessAlmostEqual(b.charge(1), 0.01)
+        self.failUnlessAlmostEqual(b.charge(10), 0.02)
+        # the byte limit is used when it is the stricter one
+        self.failUnlessAlmostEqual(b.charge(1, 500), 0.12)
+        self.failUnlessAlmostEqual(b.charge(1), 0.62)
+        # unused budget is not saved up
+        clock.now += 100
+        self.failUnlessEqual(b.charge(1), 0.0)
+        self.failUnlessAlmostEqual(b.charge(1), 0.01)
+        # work that cannot wait is still charged, and delays the next one
+        sleeps = len(clock.sleeps)
+        self.failUnlessAlmostEqual(b.charge(1, 1000, wait=False), 0.02)
+        self.failUnlessEqual(len(clock.sleeps), sleeps)
+        self.failUnlessAlmostEqual(b.charge(1), 1.02)
+
     def test_empty_subclass(self):
         self.basedir = "crawler/Basic/empty_subclass"
         fileutil.make_dirs(self.basedir)
@@ -14,6 +14,7 @@ from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
      MDMF_VERSION, SDMF_VERSION
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.common import UncoordinatedWriteError
+from allmydata.mutable.publish import MutableData
 from allmydata.util import hashutil, base32
 from allmydata.util.netstring import split_netstring
 from allmydata.monitor import Monitor
@@ -1346,6 +1347,151 @@ class Dirnode(GridTestMixin, unittest.TestCase,
         self.set_up_grid()
         return self._do_create_subdirectory_test(version=MDMF_VERSION)
 
+    def test_copy_tree(self):
+        self.basedir = "dirnode/Dirnode/test_copy_tree"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        # root/
+        # root/small  (LIT)
+        # root/mutable
+        # root/sub/
+        # root/sub/loop -> root/sub
+        # root/shared -> root/sub
+        # root/snapshot/  (immutable)
+        d = c.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            return n.add_file(u"small", upload.Data("small", None))
+        d.addCallback(_created_root)
+        d.addCallback(lambda ign: c.create_mutable_file(MutableData("mutable")))
+        d.addCallback(lambda n: self.root.set_node(u"mutable", n))
+        d.addCallback(lambda ign: self.root.create_subdirectory(u"sub"))
+        def _created_sub(sub):
+            self.sub = sub
+            d = sub.set_node(u"loop", sub)
+            d.addCallback(lambda ign: self.root.set_node(u"shared", sub))
+            return d
+        d.addCallback(_created_sub)
+        d.addCallback(lambda ign: c.create_immutable_dirnode({}))
+        def _created_snapshot(n):
+            self.snapshot = n
+            return self.root.set_node(u"snapshot", n)
+        d.addCallback(_created_snapshot)
+        d.addCallback(lambda ign:
+                      self.root.start_copy_tree(mutable_version=MDMF_VERSION).when_done())
+        def _check_copy(res):
+            self.failUnlessReallyEqual(res["count-files-linked"], 1)
+            self.failUnlessReallyEqual(res["count-files-copied"], 1)
+            self.failUnlessReallyEqual(res["count-directories-linked"], 1)
+            self.failUnlessReallyEqual(res["count-directories-created"], 2)
+            self.failUnlessReallyEqual(res["count-skipped"], 1)
+            self.failUnless(res["mutable"])
+            self.failUnless(res["root"].startswith("URI:DIR2-MDMF:"), res["root"])
+            copy = c.create_node_from_uri(res["root"])
+            d = copy.list()
+            def _check_children(children):
+                self.failUnlessEqual(sorted(children.keys()),
+                                     [u"mutable", u"shared", u"small",
+                                      u"snapshot", u"sub"])
+                # the shared subdirectory is copied once, and the loop is
+                # left out
+                new_sub = children[u"sub"][0]
+                self.failUnlessReallyEqual(children[u"shared"][0].get_uri(),
+                                           new_sub.get_uri())
+                self.failIfEqual(new_sub.get_uri(), self.sub.get_uri())
+                self.failUnlessReallyEqual(children[u"snapshot"][0].get_uri(),
+                                           self.snapshot.get_uri())
+                self.failIf(children[u"mutable"][0].is_mutable())
+                d = new_sub.list()
+                d.addCallback(lambda kids: self.failUnlessEqual(kids, {}))
+                d.addCallback(lambda ign:
+                              children[u"mutable"][0].download_best_version())
+                return d
+            d.addCallback(_check_children)
+            d.addCallback(self.failUnlessReallyEqual, "mutable")
+            return d
+        d.addCallback(_check_copy)
+        d.addCallback(lambda ign:
+                      self.root.start_copy_tree(mutable=False).when_done())
+        def _check_snapshot(res):
+            self.failIf(res["mutable"])
+            self.failUnlessReallyEqual(res["count-directories-created"], 2)
+            copy = c.create_node_from_uri(res["root"])
+            self.failIf(copy.is_mutable())
+            self.failUnless(copy.is_allowed_in_immutable_directory())
+            return copy.get_child_at_path(u"mutable")
+        d.addCallback(_check_snapshot)
+        d.addCallback(lambda n: n.download_best_version())
+        d.addCallback(self.failUnlessReallyEqual, "mutable")
+        return d
+
+    def test_set_nodes_batch(self):
+        self.basedir = "dirnode/Dirnode/test_set_nodes_batch"
+        self.set_up_grid()
+        c = self.g.clients[0]
+        nm = c.nodemaker
+        one = nm.create_from_cap(one_uri)
+        setup_py = nm.create_from_cap(setup_py_uri)
+        d = c.create_dirnode({u"a": (one, {"key": "a"}),
+                              u"b": (one, {}),
+                              u"c": (one, {}),
+                              u"subdir": (c.create_node_from_uri(empty_litdir_uri), {}),
+                              })
+        def _created(n):
+            self.node = n
+            self.publishes = []
+            original_modify = n._node.modify
+            def _modify(modifier, *args, **kwargs):
+                self.publishes.append(modifier)
+                return original_modify(modifier, *args, **kwargs)
+            n._node.modify = _modify
+            # a -> a2 -> a3, b is removed, c is replaced, d is added
+            return n.set_nodes({u"c": (setup_py, None), u"d": (one, None)},
+                               deletes=[u"b"],
+                               renames=[(u"a", u"a2"), (u"a2", u"a3")])
+        d.addCallback(_created)
+        d.addCallback(lambda ign: self.node.list())
+        def _check(children):
+            self.failUnlessReallyEqual(len(self.publishes), 1)
+            self.failUnlessEqual(sorted(children.keys()),
+                                 [u"a3", u"c", u"d", u"subdir"])
+            self.failUnlessEqual(children[u"a3"][1]["key"], "a")
+            self.failUnlessReallyEqual(children[u"c"][0].get_uri(), setup_py_uri)
+        d.addCallback(_check)
+
+        # a missing name fails the whole batch
+        d.addCallback(lambda ign:
+                      self.shouldFail(NoSuchChildError, "batch-missing", "b",
+                                      self.node.set_nodes, {u"e": (one, None)},
+                                      deletes=[u"b"]))
+        d.addCallback(lambda ign:
+                      self.shouldFail(ExistingChildError, "batch-no-overwrite",
+                                      "child 'subdir' already exists",
+                                      self.node.set_nodes, {},
+                                      renames=[(u"d", u"subdir")],
+                                      overwrite="only-files"))
+        d.addCallback(lambda ign: self.node.list())
+        d.addCallback(lambda children:
+                      self.failUnlessEqual(sorted(children.keys()),
+                                           [u"a3", u"c", u"d", u"subdir"]))
+
+        # a rename within one directory is a single publish
+        def _rename(ign):
+            self.publishes = []
+            return self.node.move_child_to(u"d", self.node, u"e")
+        d.addCallback(_rename)
+        d.addCallback(lambda ign: self.node.list())
+        def _check_renamed(children):
+            self.failUnlessReallyEqual(len(self.publishes), 1)
+            self.failUnlessEqual(sorted(children.keys()),
+                                 [u"a3", u"c", u"e", u"subdir"])
+        d.addCallback(_check_renamed)
+        # and renaming a child to its own name leaves it in place
+        d.addCallback(lambda ign: self.node.move_child_to(u"e", self.node))
+        d.addCallback(lambda ign: self.node.has_child(u"e"))
+        d.addCallback(self.failUnless)
+        return d
+
     def test_create_mdmf(self):
         self.basedir = "dirnode/Dirnode/test_mdmf"
         self.set_up_grid()
@@ -3,7 +3,7 @@
 # a previous run. This asserts that the current code is capable of decoding
 # shares from a previous version.
 
-import os
+import os, time
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
 from allmydata import uri
@@ -1304,6 +1304,9 @@ class FakeNode:
         self.failed = None
         self.processed = None
         self._si_prefix = "si_prefix"
+        self.segment_size = None
+        self.guessed_segment_size = 3000
+        self._download_status = DownloadStatus("si", 1000)
     def want_more_shares(self):
         self.want_more += 1
     def fetch_failed(self, fetcher, f):
@@ -1619,3 +1622,167 @@ class Selection(unittest.TestCase):
                                                       2: "block-2"}) )
         d.addCallback(_check4)
         return d
+
+    def test_prefer_fast_servers(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 2, None)
+        servers = make_servers(["peer-A", "peer-B", "peer-C"])
+        # peer-A answered this DYHB first, but has been slow for earlier
+        # downloads. peer-C has been fast, but is already busy.
+        perf = servers["peer-A"].get_performance()
+        for i in range(10):
+            perf.request_finished(0.5)
+        perf = servers["peer-B"].get_performance()
+        perf.request_finished(0.1)
+        perf.request_finished(1.1, 100*1000)
+        perf = servers["peer-C"].get_performance()
+        perf.request_finished(0.05)
+        perf.request_finished(0.15, 100*1000)
+        for i in range(100):
+            perf.request_started()
+        shares = [MyShare(0, servers["peer-A"], 0.0),
+                  MyShare(1, servers["peer-B"], 1.0),
+                  MyShare(2, servers["peer-C"], 2.0),
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[2]])
+        d.addCallback(_check1)
+        return d
+
+    def test_hedge(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 2, None)
+        servers = make_servers(["peer-A", "peer-B", "peer-C", "peer-D"])
+        shares = [MyShare(0, servers["peer-A"], 0.0),
+                  MyShare(1, servers["peer-B"], 1.0),
+                  MyShare(2, servers["peer-C"], 2.0),
+                  MyShare(3, servers["peer-D"], 3.0),
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[1]])
+            # sh0 is slow, so we ask sh2 as well
+            sf._hedge(shares[0], 0)
+            self.failUnlessEqual(node._download_status.hedges_issued, 1)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[1], shares[2]])
+            # hedging a request that has already been answered does nothing
+            sf._block_request_activity(shares[1], 1, COMPLETE, "block-1")
+            sf._hedge(shares[1], 1)
+            self.failUnlessEqual(node._download_status.hedges_issued, 1)
+            sf._block_request_activity(shares[2], 2, COMPLETE, "block-2")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(node.processed, (0, {1: "block-1",
+                                                      2: "block-2"}) )
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[1], shares[2]])
+            self.failUnlessEqual(node._download_status.hedges_won, 1)
+        d.addCallback(_check3)
+        return d
+
+    def test_hedge_both_complete(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 2, None)
+        servers = make_servers(["peer-A", "peer-B", "peer-C", "peer-D"])
+        shares = [MyShare(0, servers["peer-A"], 0.0),
+                  MyShare(1, servers["peer-B"], 1.0),
+                  MyShare(2, servers["peer-C"], 2.0),
+                  MyShare(3, servers["peer-D"], 3.0),
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            sf._hedge(shares[0], 0)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[1], shares[2]])
+            # the hedged request and its hedge both arrive before the loop
+            # gets to run: we must still hand over exactly k blocks
+            sf._block_request_activity(shares[1], 1, COMPLETE, "block-1")
+            sf._block_request_activity(shares[0], 0, COMPLETE, "block-0")
+            sf._block_request_activity(shares[2], 2, COMPLETE, "block-2")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(node.processed, (0, {0: "block-0",
+                                                      1: "block-1"}) )
+            self.failUnlessEqual(node._download_status.hedges_issued, 1)
+            self.failUnlessEqual(node._download_status.hedges_won, 0)
+        d.addCallback(_check3)
+        return d
+
+    def test_hedge_dead(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 2, None)
+        servers = make_servers(["peer-A", "peer-B", "peer-C", "peer-D"])
+        shares = [MyShare(0, servers["peer-A"], 0.0),
+                  MyShare(1, servers["peer-B"], 1.0),
+                  MyShare(2, servers["peer-C"], 2.0),
+                  MyShare(3, servers["peer-D"], 3.0),
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            sf._hedge(shares[0], 0)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            # a hedged request that fails was not beaten by its hedge
+            sf._block_request_activity(shares[0], 0, DEAD)
+            sf._block_request_activity(shares[1], 1, COMPLETE, "block-1")
+            sf._block_request_activity(shares[2], 2, COMPLETE, "block-2")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(node.processed, (0, {1: "block-1",
+                                                      2: "block-2"}) )
+            self.failUnlessEqual(node._download_status.hedges_won, 0)
+        d.addCallback(_check3)
+        return d
+
+    def test_hedge_timer(self):
+        node = FakeNode()
+        sf = SegmentFetcher(node, 0, 2, None)
+        server = make_server("peer-A")
+        class FakeObserver:
+            def subscribe(self, *args, **kwargs):
+                pass
+            def cancel(self):
+                pass
+        class FakeShare(MyShare):
+            def get_block(self, segnum):
+                return FakeObserver()
+        share = FakeShare(0, server, 0.0)
+        sf._start_share(share, 0)
+        t = sf._hedge_timers[share]
+        self.failUnlessEqual(t.getTime() - time.time() > 4.0, True)
+        sf.stop()
+        self.failIf(t.active())
+        self.failUnlessEqual(sf._hedge_timers, {})
+
+        # once we know a server, we hedge requests that take longer than
+        # most of its responses
+        perf = server.get_performance()
+        for i in range(100):
+            perf.request_finished(0.2 + i * 0.001)
+        delay = perf.get_hedge_delay(0)
+        self.failUnless(0.28 < delay < 0.31, delay)
+        sf = SegmentFetcher(node, 0, 2, None)
+        sf._start_share(share, 0)
+        t = sf._hedge_timers[share]
+        self.failUnless(t.getTime() - time.time() < 0.35)
+        sf._block_request_activity(share, 0, COMPLETE, "block-0")
+        self.failIf(t.active())
+        sf.stop()
@@ -1,6 +1,7 @@
 import os
 from twisted.trial import unittest
 from twisted.application import service
+from twisted.internet import defer
 
 from foolscap.api import Tub, fireEventually, flushEventualQueue
 
@@ -85,6 +86,73 @@ def upload_data(uploader, data, convergence):
     u = upload.Data(data, convergence=convergence)
     return uploader.upload(u)
 
+class Admission(unittest.TestCase):
+    def tearDown(self):
+        return flushEventualQueue()
+
+    def test_fairness(self):
+        q = offloaded.AdmissionQueue(2)
+        granted = []
+        def _acquire(client, name, amount=1):
+            d = q.acquire(client, amount)
+            d.addCallback(lambda res: granted.append(name))
+        for name in ["a1", "a2", "a3", "a4"]:
+            _acquire("alice", name)
+        _acquire("bob", "b1")
+        _acquire("carol", "c1")
+        d = flushEventualQueue()
+        def _check1(res):
+            self.failUnlessEqual(granted, ["a1", "a2"])
+            self.failUnlessEqual(q.get_queue_length(), 4)
+            q.release(1)
+            q.release(1)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(res):
+            # alice was first in line, but the other clients take their
+            # turns before she goes again
+            self.failUnlessEqual(granted, ["a1", "a2", "a3", "b1"])
+            q.release(1)
+            q.release(1)
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(res):
+            self.failUnlessEqual(granted, ["a1", "a2", "a3", "b1", "c1", "a4"])
+            self.failUnlessEqual(q.get_queue_length(), 0)
+            self.failUnlessEqual(q.wait_times.count, 6)
+        d.addCallback(_check3)
+        return d
+
+    def test_oversized(self):
+        q = offloaded.AdmissionQueue(100)
+        granted = []
+        for (name, amount) in [("small", 10), ("huge", 500), ("next", 10)]:
+            d = q.acquire("alice", amount)
+            d.addCallback(lambda res, name=name: granted.append(name))
+        d = flushEventualQueue()
+        def _check1(res):
+            self.failUnlessEqual(granted, ["small"])
+            # something too large to ever fit is let in once nothing else
+            # is using any, and blocks the others meanwhile
+            q.release(10)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(res):
+            self.failUnlessEqual(granted, ["small", "huge"])
+            q.release(500)
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        d.addCallback(lambda res:
+                      self.failUnlessEqual(granted, ["small", "huge", "next"]))
+        return d
+
+    def test_unlimited(self):
+        q = offloaded.AdmissionQueue(None)
+        for i in range(10):
+            q.acquire("alice", 10**12)
+        self.failUnlessEqual(q.used, 10*10**12)
+        self.failUnlessEqual(q.get_queue_length(), 0)
+
 class AssistedUpload(unittest.TestCase):
     timeout = 240 # It takes longer than 120 seconds on Francois's arm box.
     def setUp(self):
@@ -101,12 +169,12 @@ class AssistedUpload(unittest.TestCase):
         # bogus host/port
         t.setLocation("bogus:1234")
 
-    def setUpHelper(self, basedir):
+    def setUpHelper(self, basedir, **kwargs):
         fileutil.make_dirs(basedir)
         self.helper = h = offloaded.Helper(basedir,
                                            self.storage_broker,
                                            self.secret_holder,
-                                           None, None)
+                                           None, None, **kwargs)
         h.chk_upload_helper_class = CHKUploadHelper_fake
         self.helper_furl = self.tub.registerReference(h)
 
@@ -221,3 +289,105 @@ class AssistedUpload(unittest.TestCase):
         d.addCallback(_check_empty)
 
         return d
+
+    def _record_fetch_window(self):
+        # remember the largest number of reads that the helper had
+        # outstanding at once
+        self.max_pending = 0
+        original_request = offloaded.CHKCiphertextFetcher._request
+        def _request(fetcher, reader, offset, length):
+            self.max_pending = max(self.max_pending, len(fetcher._pending))
+            return original_request(fetcher, reader, offset, length)
+        self.patch(offloaded.CHKCiphertextFetcher, "_request", _request)
+
+    def test_pipelined_fetch(self):
+        self.basedir = "helper/AssistedUpload/test_pipelined_fetch"
+        self.setUpHelper(self.basedir)
+        self._record_fetch_window()
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        BIG = DATA * 30 # several chunks
+
+        d = wait_a_few_turns()
+        d.addCallback(lambda res: upload_data(u, BIG, convergence="pipelined"))
+        def _uploaded(results):
+            self.failUnless("CHK" in results.uri)
+            self.failUnlessEqual(results.ciphertext_fetched, len(BIG))
+            self.failUnlessEqual(self.max_pending, self.helper.fetch_window)
+        d.addCallback(_uploaded)
+        return d
+
+    def test_fetch_from_old_client(self):
+        # clients that do not say they can handle several reads at once are
+        # asked for one chunk at a time
+        self.basedir = "helper/AssistedUpload/test_fetch_from_old_client"
+        self.setUpHelper(self.basedir)
+        self._record_fetch_window()
+        self.patch(upload.RemoteEncryptedUploadable, "remote_get_version",
+                   None)
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        BIG = DATA * 30
+
+        d = wait_a_few_turns()
+        d.addCallback(lambda res: upload_data(u, BIG, convergence="old"))
+        def _uploaded(results):
+            self.failUnlessEqual(results.ciphertext_fetched, len(BIG))
+            self.failUnlessEqual(self.max_pending, 1)
+        d.addCallback(_uploaded)
+        return d
+
+    def test_concurrent_uploads(self):
+        # two uploads of the same file at the same time share a
+        # single upload, and the ciphertext is only fetched once
+        self.basedir = "helper/AssistedUpload/test_concurrent_uploads"
+        self.setUpHelper(self.basedir)
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        BIG = DATA * 30
+
+        d = wait_a_few_turns()
+        def _ready(res):
+            return defer.gatherResults([
+                upload_data(u, BIG, convergence="shared"),
+                upload_data(u, BIG, convergence="shared")])
+        d.addCallback(_ready)
+        def _uploaded((results1, results2)):
+            self.failUnlessEqual(results1.uri, results2.uri)
+            stats = self.helper.get_stats()
+            self.failUnlessEqual(stats["chk_upload_helper.upload_requests"], 2)
+            self.failUnlessEqual(stats["chk_upload_helper.upload_joined"], 1)
+            self.failUnlessEqual(stats["chk_upload_helper.fetched_bytes"],
+                                 len(BIG))
+        d.addCallback(_uploaded)
+        return d
+
+    def test_limits(self):
+        # uploads that exceed the helper's limits wait their turn
+        self.basedir = "helper/AssistedUpload/test_limits"
+        self.setUpHelper(self.basedir, max_encodes=1,
+                         max_temp_space=len(DATA) * 15)
+        u = upload.Uploader(self.helper_furl)
+        u.setServiceParent(self.s)
+        BIG = DATA * 10
+
+        d = wait_a_few_turns()
+        def _ready(res):
+            return defer.gatherResults([
+                upload_data(u, BIG, convergence="limits %d" % i)
+                for i in range(3)])
+        d.addCallback(_ready)
+        def _uploaded(results):
+            self.failUnlessEqual(len(set([r.uri for r in results])), 3)
+            h = self.helper
+            self.failUnlessEqual(h.fetch_queue.wait_times.count, 3)
+            self.failUnlessEqual(h.encode_queue.wait_times.count, 3)
+            stats = h.get_stats()
+            self.failUnlessEqual(stats["chk_upload_helper.temp_space_reserved"], 0)
+            self.failUnlessEqual(stats["chk_upload_helper.active_encodes"], 0)
+            self.failUnlessEqual(stats["chk_upload_helper.fetch_queue_length"], 0)
+            self.failUnlessEqual(stats["chk_upload_helper.encode_queue_length"], 0)
+            self.failUnlessEqual(stats["chk_upload_helper.fetched_bytes"],
+                                 3*len(BIG))
+        d.addCallback(_uploaded)
+        return d
@@ -15,6 +15,7 @@ from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable.upload import Data
 from allmydata.immutable.downloader import finder
+from allmydata.storage_client import ServerPerformance
 
 class MockNode(object):
     def __init__(self, check_reneging, check_fetch_failed):
@@ -110,6 +111,8 @@ class TestShareFinder(unittest.TestCase):
                 return "name-%s" % self.serverid
             def get_version(self):
                 return self.rref.version
+            def get_performance(self):
+                return ServerPerformance()
 
         mockserver1 = MockServer({1: mock.Mock(), 2: mock.Mock()})
         mockserver2 = MockServer({})
@@ -118,7 +121,7 @@ class TestShareFinder(unittest.TestCase):
         servers = [ MockIServer("ms1", mockserver1),
                     MockIServer("ms2", mockserver2),
                     MockIServer("ms3", mockserver3), ]
-        mockstoragebroker.get_servers_for_psi.return_value = servers
+        mockstoragebroker.iter_servers_for_psi.return_value = iter(servers)
         mockdownloadstatus = mock.Mock()
         mocknode = MockNode(check_reneging=True, check_fetch_failed=True)
 
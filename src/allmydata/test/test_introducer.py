@@ -4,6 +4,7 @@ from base64 import b32decode
 
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.python import log
 
 from foolscap.api import Tub, Referenceable, fireEventually, flushEventualQueue
@@ -13,7 +14,7 @@ from allmydata.introducer.client import IntroducerClient
 from allmydata.introducer.server import IntroducerService
 # test compatibility with old introducer .tac files
 from allmydata.introducer import IntroducerNode
-from allmydata.util import pollmixin
+from allmydata.util import pollmixin, base32
 import allmydata.test.common_util as testutil
 
 class LoggingMultiService(service.MultiService):
@@ -73,6 +74,183 @@ class Introducer(ServiceMixin, unittest.TestCase, pollmixin.PollMixin):
         self.failUnlessEqual(len(i.get_announcements()), 2)
         self.failUnlessEqual(len(i.get_subscribers()), 0)
 
+class FakeSubscriber:
+    def __init__(self):
+        self.messages = []
+        self.disconnect_cbs = []
+    def callRemote(self, methname, *args):
+        self.messages.append((methname,) + args)
+        return defer.succeed(None)
+    def notifyOnDisconnect(self, cb):
+        self.disconnect_cbs.append(cb)
+
+class Batching(unittest.TestCase):
+    def make_announcement(self, i, version="ver23"):
+        furl = "pb://%s@127.0.0.1:36106/swissnum" % base32.b2a("%020d" % i)
+        return (furl, "storage", "RIStorage", "nick%d" % i, version, "ver0")
+
+    def test_batch(self):
+        clock = Clock()
+        i = IntroducerService(clock=clock)
+        old = FakeSubscriber()
+        new = FakeSubscriber()
+        i.remote_subscribe(old, "storage")
+        i.remote_subscribe_delta(new, "storage", ("", 0))
+        # both get an empty table right away
+        self.failUnlessEqual(old.messages, [("announce", set())])
+        self.failUnlessEqual(new.messages, [("announce_delta", "storage",
+                                             set(), (i._epoch, 0))])
+
+        anns = [self.make_announcement(n) for n in range(5)]
+        for ann in anns:
+            i.remote_publish(ann)
+        i.remote_publish(anns[0]) # duplicates are not sent again
+        self.failUnlessEqual(len(old.messages), 1)
+        clock.advance(i.BATCH_DELAY)
+        self.failUnlessEqual(old.messages[1], ("announce", set(anns)))
+        self.failUnlessEqual(new.messages[1], ("announce_delta", "storage",
+                                               set(anns), (i._epoch, 5)))
+        # nothing changed, so nothing more is sent
+        clock.advance(i.BATCH_DELAY)
+        self.failUnlessEqual(len(old.messages), 2)
+        self.failUnlessEqual(len(new.messages), 2)
+        self.failIf(clock.getDelayedCalls())
+
+        # an update replaces the older announcement from the same server
+        ann0b = self.make_announcement(0, "ver24")
+        i.remote_publish(ann0b)
+        clock.advance(i.BATCH_DELAY)
+        self.failUnlessEqual(new.messages[2], ("announce_delta", "storage",
+                                               set([ann0b]), (i._epoch, 6)))
+        self.failUnlessEqual(i._debug_counts["outbound_message"], 6)
+
+        # a subscriber that comes back only hears about what it missed
+        for cb in new.disconnect_cbs:
+            cb()
+        ann5 = self.make_announcement(5)
+        i.remote_publish(ann5)
+        self.failUnlessEqual(len(new.messages), 3)
+        new2 = FakeSubscriber()
+        i.remote_subscribe_delta(new2, "storage", (i._epoch, 5))
+        self.failUnlessEqual(new2.messages, [("announce_delta", "storage",
+                                              set([ann0b, ann5]),
+                                              (i._epoch, 7))])
+        clock.advance(i.BATCH_DELAY)
+        self.failUnlessEqual(len(new2.messages), 1)
+        self.failUnlessEqual(old.messages[-1], ("announce", set([ann5])))
+
+        # versions from some other introducer mean "send everything"
+        new3 = FakeSubscriber()
+        i.remote_subscribe_delta(new3, "storage", ("someone-else", 3))
+        self.failUnlessEqual(new3.messages, [("announce_delta", "storage",
+                                              set([ann0b, ann5] + anns[1:]),
+                                              (i._epoch, 7))])
+
+    def test_superseded_changes(self):
+        # a server that keeps updating its announcement must not make the
+        # introducer remember every old version of it
+        clock = Clock()
+        i = IntroducerService(clock=clock)
+        new = FakeSubscriber()
+        i.remote_subscribe_delta(new, "storage", ("", 0))
+        i.remote_publish(self.make_announcement(1))
+        for n in range(100):
+            i.remote_publish(self.make_announcement(0, "ver%d" % n))
+        clock.advance(i.BATCH_DELAY)
+        self.failUnlessEqual(len(i._seqnums), 2)
+        self.failUnlessEqual(new.messages[-1],
+                             ("announce_delta", "storage",
+                              set([self.make_announcement(1),
+                                   self.make_announcement(0, "ver99")]),
+                              (i._epoch, 101)))
+        # a subscriber that saw the first few updates only gets the latest
+        new2 = FakeSubscriber()
+        i.remote_subscribe_delta(new2, "storage", (i._epoch, 50))
+        self.failUnlessEqual(new2.messages,
+                             [("announce_delta", "storage",
+                               set([self.make_announcement(0, "ver99")]),
+                               (i._epoch, 101))])
+
+class FakeTub:
+    def connectTo(self, furl, cb):
+        return None
+    def getReference(self, furl):
+        return defer.Deferred()
+
+class AnnouncementCache(ServiceMixin, unittest.TestCase):
+    def make_client(self, cache_filename):
+        ic = IntroducerClient(FakeTub(), "introducer.furl", u"my_nickname",
+                              "my_version", "oldest_version",
+                              cache_filename=cache_filename)
+        received = {}
+        def _got(nodeid, ann_d):
+            received[nodeid] = ann_d
+        ic.subscribe_to("storage", _got)
+        return (ic, received)
+
+    def test_cache(self):
+        basedir = "introducer/AnnouncementCache/test_cache"
+        os.makedirs(basedir)
+        cache_filename = os.path.join(basedir, "announcements.json")
+        anns = [Batching().make_announcement(n) for n in range(3)]
+
+        (ic, received) = self.make_client(cache_filename)
+        ic.setServiceParent(self.parent)
+        ic.remote_announce_delta("storage", set(anns), ("epoch1", 3))
+        self.failUnless(os.path.exists(cache_filename))
+
+        # a client that starts later knows about the same servers before it
+        # has heard from the introducer
+        (ic2, received2) = self.make_client(cache_filename)
+        ic2.setServiceParent(self.parent)
+        d = flushEventualQueue()
+        def _loaded(res):
+            self.failUnlessEqual(received2, received)
+            self.failUnlessEqual(len(received2), 3)
+            self.failUnlessEqual(ic2._announcement_versions,
+                                 {"storage": ("epoch1", 3)})
+            self.failUnlessEqual(ic2._debug_counts["new_announcement"], 0)
+            self.failUnlessEqual(len(ic2._unconfirmed), 3)
+
+            # an empty delta from the same introducer confirms all of them
+            ic2.remote_announce_delta("storage", set(), ("epoch1", 3))
+            self.failUnlessEqual(len(ic2._unconfirmed), 0)
+
+            # a full set from a new introducer only confirms what it has
+            # sent, and the rest are dropped once they have gone unconfirmed
+            # for too long
+            (ic3, received3) = self.make_client(cache_filename)
+            ic3.setServiceParent(self.parent)
+            ic3.remote_announce_delta("storage", set(anns[:2]), ("epoch2", 2))
+            self.failUnlessEqual(ic3._debug_counts["duplicate_announcement"],
+                                 2)
+            self.failUnlessEqual(len(ic3._unconfirmed), 1)
+            index = ic3._unconfirmed.keys()[0]
+            ic3._unconfirmed[index] -= ic3.CACHE_LIFETIME + 1
+            ic3.remote_announce(set())
+            (ic4, received4) = self.make_client(cache_filename)
+            ic4.setServiceParent(self.parent)
+            self.failUnlessEqual(len(ic4._current_announcements), 2)
+            self.failIf(index in ic4._current_announcements)
+            self.failUnlessEqual(ic4._announcement_versions,
+                                 {"storage": ("epoch2", 2)})
+        d.addCallback(_loaded)
+        return d
+
+    def test_corrupt_cache(self):
+        basedir = "introducer/AnnouncementCache/test_corrupt_cache"
+        os.makedirs(basedir)
+        cache_filename = os.path.join(basedir, "announcements.json")
+        open(cache_filename, "w").write("not json")
+        (ic, received) = self.make_client(cache_filename)
+        ic.setServiceParent(self.parent)
+        self.failUnlessEqual(len(ic._current_announcements), 0)
+        ann = Batching().make_announcement(0)
+        ic.remote_announce(set([ann]))
+        (ic2, received2) = self.make_client(cache_filename)
+        ic2.setServiceParent(self.parent)
+        self.failUnlessEqual(len(ic2._current_announcements), 1)
+
 class SystemTestMixin(ServiceMixin, pollmixin.PollMixin):
 
     def create_tub(self, portnum=0):
@@ -189,9 +367,10 @@ class SystemTest(SystemTestMixin, unittest.TestCase):
         # force an introducer reconnect, by shutting down the Tub it's using
         # and starting a new Tub (with the old introducer). Everybody should
         # reconnect and republish, but the introducer should ignore the
-        # republishes as duplicates. However, because the server doesn't know
-        # what each client does and does not know, it will send them a copy
-        # of the current announcement table anyway.
+        # republishes as duplicates. Each client tells the introducer which
+        # version of the announcement table it has already seen, so the
+        # introducer sends each of them a single message with no
+        # announcements in it.
 
         d.addCallback(lambda _ign: log.msg("shutting down introducer's Tub"))
         d.addCallback(lambda _ign: self.central_tub.disownServiceParent())
@@ -254,16 +433,19 @@ class SystemTest(SystemTestMixin, unittest.TestCase):
                                  introducer._debug0 + len(subscribing_clients))
             for c in clients:
                 self.failUnless(c.connected_to_introducer())
+            self.failUnlessEqual(dc["outbound_announcements"],
+                                 NUM_SERVERS*len(subscribing_clients))
             for c in subscribing_clients:
                 cdc = c._debug_counts
-                self.failUnlessEqual(cdc["duplicate_announcement"], NUM_SERVERS)
+                self.failUnlessEqual(cdc["duplicate_announcement"], 0)
         d.addCallback(_check2)
 
         # Then force an introducer restart, by shutting down the Tub,
         # destroying the old introducer, and starting a new Tub+Introducer.
         # Everybody should reconnect and republish, and the (new) introducer
-        # will distribute the new announcements, but the clients should
-        # ignore the republishes as duplicates.
+        # will distribute the new announcements (it cannot know what the
+        # clients saw from its predecessor), but the clients should ignore
+        # the republishes as duplicates.
 
         d.addCallback(lambda _ign: log.msg("shutting down introducer"))
         d.addCallback(lambda _ign: self.central_tub.disownServiceParent())
@@ -323,11 +505,10 @@ class SystemTest(SystemTestMixin, unittest.TestCase):
                 self.failUnless(cdc["inbound_message"] > c._debug2)
                 # there should have been no new announcements
                 self.failUnlessEqual(cdc["new_announcement"], c._debug3)
-                # and the right number of duplicate ones. There were
-                # NUM_SERVERS from the servertub restart, and there should be
-                # another NUM_SERVERS now
+                # and the right number of duplicate ones: there were none
+                # from the servertub restart, and NUM_SERVERS now
                 self.failUnlessEqual(cdc["duplicate_announcement"],
-                                     2*NUM_SERVERS)
+                                     NUM_SERVERS)
 
         d.addCallback(_check3)
         return d
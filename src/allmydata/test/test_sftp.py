@@ -986,6 +986,38 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    def test_openFile_write_many(self):
+        d = self._set_up("openFile_write_many")
+        d.addCallback(lambda ign: self._set_up_tree())
+
+        # files closed at the same time in the same directory are linked by
+        # fewer updates of the directory than there are files
+        def _count_modifies(ign):
+            self.modifies = 0
+            original_modify = self.root._node.modify
+            def _modify(*args, **kwargs):
+                self.modifies += 1
+                return original_modify(*args, **kwargs)
+            self.root._node.modify = _modify
+        d.addCallback(_count_modifies)
+
+        names = ["many%d" % (i,) for i in range(5)]
+        d.addCallback(lambda ign:
+                      defer.gatherResults([self.handler.openFile(name, sftp.FXF_WRITE | sftp.FXF_CREAT, {})
+                                           for name in names]))
+        def _write_and_close(wfs):
+            d2 = defer.gatherResults([wf.writeChunk(0, name) for (wf, name) in zip(wfs, names)])
+            d2.addCallback(lambda ign: defer.gatherResults([wf.close() for wf in wfs]))
+            return d2
+        d.addCallback(_write_and_close)
+        d.addCallback(lambda ign: self.failUnless(0 < self.modifies < len(names), self.modifies))
+        for name in names:
+            d.addCallback(lambda ign, name=name: self.root.get(unicode(name)))
+            d.addCallback(lambda node: download_to_data(node))
+            d.addCallback(lambda data, name=name: self.failUnlessReallyEqual(data, name))
+        d.addCallback(lambda ign: self.failUnlessReallyEqual(sftpd.all_directory_linkers, {}))
+        return d
+
     def test_removeFile(self):
         d = self._set_up("removeFile")
         d.addCallback(lambda ign: self._set_up_tree())
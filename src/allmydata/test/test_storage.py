@@ -11,12 +11,15 @@ import itertools
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
-from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.packed import PackedBackend, PackedShare, SEGMENT_SIZE
+from allmydata.storage.mutable import MutableShareFile, coalesce_readv
+from allmydata.storage.immutable import BucketWriter, BucketReader, \
+     MappedShares
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.bucketindex import BucketIndex
 from allmydata.storage.expirer import LeaseCheckingCrawler
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
@@ -32,6 +35,7 @@ from allmydata.interfaces import BadWriteEnablerError
 from allmydata.test.common import LoggingServiceParent, ShouldFailMixin
 from allmydata.test.common_web import WebRenderingMixin
 from allmydata.test.no_network import NoNetworkServer
+from allmydata.test.common_util import StallMixin
 from allmydata.web.storage import StorageStatus, remove_prefix
 
 class Marker:
@@ -58,6 +62,9 @@ class FakeStatsProvider:
         pass
 
 class Bucket(unittest.TestCase):
+    def setUp(self):
+        self.mapped_shares = MappedShares()
+
     def make_workdir(self, name):
         basedir = os.path.join("storage", "Bucket", name)
         incoming = os.path.join(basedir, "tmp", "bucket")
@@ -106,6 +113,60 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_mapped_read(self):
+        incoming, final = self.make_workdir("test_mapped_read")
+        bw = BucketWriter(self, incoming, final, 50, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome, mmap_threshold=1000)
+        self.failUnlessEqual(br.remote_read(0, 25), "a"*25)
+        self.failUnlessEqual(br._mapping, None)
+
+        br = BucketReader(self, bw.finalhome, mmap_threshold=50)
+        if not br._use_mapping:
+            raise unittest.SkipTest("shares are not mapped on this platform")
+        self.failUnlessEqual(br.remote_read(0, 25), "a"*25)
+        self.failIfEqual(br._mapping, None)
+        self.failUnlessEqual(br.remote_read(20, 10), "a"*5 + "b"*5)
+        # leases added after the share was mapped are not visible
+        br._share_file.add_lease(self.make_lease())
+        self.failUnlessEqual(br.remote_read(40, 100), "b"*10)
+        self.failUnlessEqual(br.remote_read(50, 10), "")
+        self.failUnlessEqual(br.remote_read(500, 10), "")
+        self.failUnlessEqual(len(self.mapped_shares), 1)
+        # releasing the reader releases its mapping, and its place
+        del br
+        self.failUnlessEqual(len(self.mapped_shares), 0)
+
+    def test_mapped_read_limit(self):
+        incoming, final = self.make_workdir("test_mapped_read_limit")
+        bw = BucketWriter(self, incoming, final, 50, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*50)
+        bw.remote_close()
+        self.mapped_shares = MappedShares(2)
+
+        readers = [BucketReader(self, bw.finalhome, mmap_threshold=50)
+                   for i in range(3)]
+        if not readers[0]._use_mapping:
+            raise unittest.SkipTest("shares are not mapped on this platform")
+        readers[0].remote_read(0, 10)
+        readers[1].remote_read(0, 10)
+        readers[0].remote_read(10, 10)
+        # the third mapping unmaps the reader that has waited longest
+        self.failUnlessEqual(readers[2].remote_read(0, 10), "a"*10)
+        self.failUnlessEqual(len(self.mapped_shares), 2)
+        self.failIfEqual(readers[0]._mapping, None)
+        self.failUnlessEqual(readers[1]._mapping, None)
+        self.failIfEqual(readers[2]._mapping, None)
+        # which goes on reading without one
+        self.failUnlessEqual(readers[1].remote_read(40, 20), "a"*10)
+        self.failUnlessEqual(readers[1]._mapping, None)
+        self.failUnlessEqual(len(self.mapped_shares), 2)
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -760,6 +821,410 @@ class Server(unittest.TestCase):
         self.failUnlessIn("This share tastes like dust.", report)
 
 
+class Space(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def allocate(self, ss, storage_index, sharenums, size):
+        renew_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cancel_secret = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        return ss.remote_allocate_buckets(storage_index,
+                                          renew_secret, cancel_secret,
+                                          sharenums, size, FakeCanary(True))
+
+    @mock.patch('allmydata.util.fileutil.get_disk_stats')
+    def test_cached(self, mock_get_disk_stats):
+        mock_get_disk_stats.return_value = {
+            'total': 20000,
+            'free_for_root': 16000,
+            'free_for_nonroot': 15000,
+            'used': 4000,
+            'avail': 5000,
+            }
+        basedir = "storage/Space/cached"
+        ss = StorageServer(basedir, "\x00" * 20, reserved_space=10000)
+        ss.setServiceParent(self.sparent)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, 1)
+
+        # allocations do not look at the disk
+        already,writers = self.allocate(ss, "si1", [0,1,2], 1000)
+        self.failUnlessEqual(len(writers), 3)
+        self.failUnlessEqual(ss.allocated_size(), 3000)
+        already2,writers2 = self.allocate(ss, "si2", [0,1,2], 1001)
+        self.failUnlessEqual(len(writers2), 1)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, 1)
+
+        # abandoned writers release their allocation, closed ones turn it
+        # into used space
+        del writers
+        self.failUnlessEqual(ss.allocated_size(), 1001)
+        writers2[0].remote_write(0, "a"*25)
+        writers2[0].remote_close()
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        used = 1001 + 3*4 + 4+32+32+4
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.disk_used"], 4000 + used)
+        self.failUnlessEqual(stats["storage_server.disk_avail"], 5000 - used)
+        self.failUnlessEqual(ss.get_available_space(), 5000 - used)
+
+        # deleting a share gives its space back
+        secrets = tuple([hashutil.tagged_hash("blah", x)
+                         for x in ("we", "rs", "cs")])
+        ss.remote_slot_testv_and_readv_and_writev("si3", secrets,
+                                                  {0: ([], [(0,"data")], None)},
+                                                  [])
+        # (but the growth of mutable shares waits for the next refresh)
+        self.failUnlessEqual(ss.get_available_space(), 5000 - used)
+        shares = ss.backend.get_mutable_shares("si3")
+        size = os.stat(shares[0].home).st_size
+        ss.remote_slot_testv_and_readv_and_writev("si3", secrets,
+                                                  {0: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.get_available_space(), 5000 - used + size)
+        self.failUnlessEqual(mock_get_disk_stats.call_count, 1)
+
+        # the periodic refresh reads the disk again
+        mock_get_disk_stats.return_value = {
+            'total': 20000,
+            'free_for_root': 12000,
+            'free_for_nonroot': 11000,
+            'used': 8000,
+            'avail': 1000,
+            }
+        ss.space.refresh()
+        self.failUnlessEqual(mock_get_disk_stats.call_count, 2)
+        self.failUnlessEqual(ss.get_available_space(), 1000)
+        already,writers = self.allocate(ss, "si4", [0,1], 600)
+        self.failUnlessEqual(len(writers), 1)
+
+
+class PackedServer(unittest.TestCase, StallMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "PackedServer", name)
+        return basedir
+
+    def create(self, name, segment_size=SEGMENT_SIZE):
+        workdir = self.workdir(name)
+        backend = PackedBackend(workdir, segment_size)
+        ss = StorageServer(workdir, "\x00" * 20,
+                           stats_provider=FakeStatsProvider(),
+                           backend=backend)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def secrets(self):
+        return (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+    def allocate(self, ss, storage_index, sharenums, size, secrets=None):
+        if secrets is None:
+            secrets = self.secrets()
+        rs, cs = secrets
+        return ss.remote_allocate_buckets(storage_index, rs, cs,
+                                          sharenums, size, FakeCanary())
+
+    def test_allocate(self):
+        ss = self.create("test_allocate")
+        already,writers = self.allocate(ss, "allocate", [0,1,2], 75)
+        self.failUnlessEqual(already, set())
+        self.failUnlessEqual(set(writers.keys()), set([0,1,2]))
+
+        # while they are being written, a second allocation is refused
+        already2,writers2 = self.allocate(ss, "allocate", [0,1,2,3], 75)
+        self.failUnlessEqual(already2, set())
+        self.failUnlessEqual(set(writers2.keys()), set([3]))
+        writers2[3].remote_abort()
+
+        for i,wb in writers.items():
+            wb.remote_write(0, "%25d" % i)
+            wb.remote_close()
+
+        # no per-share files were left behind
+        sharedir = os.path.join(self.workdir("test_allocate"), "shares")
+        self.failUnlessEqual(os.listdir(sharedir), ["incoming"])
+        self.failUnlessEqual(os.listdir(os.path.join(sharedir, "incoming")),
+                             [])
+
+        b = ss.remote_get_buckets("allocate")
+        self.failUnlessEqual(set(b.keys()), set([0,1,2]))
+        self.failUnlessEqual(b[0].remote_read(0, 25), "%25d" % 0)
+        # the unwritten tail of the share reads as zeros, and reads past the
+        # end are truncated
+        self.failUnlessEqual(b[1].remote_read(20, 100),
+                             "%5d" % 1 + "\x00" * 50)
+        self.failUnlessEqual(b[2].remote_read(75, 10), "")
+
+        already,writers = self.allocate(ss, "allocate", [0,1,2,3], 75)
+        self.failUnlessEqual(already, set([0,1,2]))
+        self.failUnlessEqual(set(writers.keys()), set([3]))
+
+    def test_restart(self):
+        ss = self.create("test_restart")
+        already,writers = self.allocate(ss, "si1", [0,1], 10)
+        for i,wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        ss.disownServiceParent()
+
+        ss = self.create("test_restart")
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(set(b.keys()), set([0,1]))
+        self.failUnlessEqual(b[1].remote_read(0, 10), "%10d" % 1)
+
+    def test_segments(self):
+        ss = self.create("test_segments", segment_size=100)
+        for i in range(5):
+            already,writers = self.allocate(ss, "si%d" % i, [0], 40)
+            writers[0].remote_write(0, "%40d" % i)
+            writers[0].remote_close()
+        segdir = os.path.join(self.workdir("test_segments"),
+                              "packed", "segments")
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000000", "00000001", "00000002"])
+        for i in range(5):
+            b = ss.remote_get_buckets("si%d" % i)
+            self.failUnlessEqual(b[0].remote_read(0, 40), "%40d" % i)
+
+    def test_group_commit(self):
+        ss = self.create("test_group_commit")
+        store = ss.backend.store
+        store.commit_batch_size = 3
+        closed = []
+        for i in range(4):
+            already,writers = self.allocate(ss, "si%d" % i, [0], 10)
+            writers[0].remote_write(0, "%10d" % i)
+            d = writers[0].remote_close()
+            d.addCallback(lambda ign, i=i: closed.append(i))
+            # the share can be read before it has been committed
+            b = ss.remote_get_buckets("si%d" % i)
+            self.failUnlessEqual(b[0].remote_read(0, 10), "%10d" % i)
+        # the third share filled a group, the fourth waits for the next one
+        self.failUnlessEqual(closed, [0, 1, 2])
+        self.failUnless(store._commit_timer.active())
+        d = fireEventually()
+        d.addCallback(self.stall, store.commit_delay*2)
+        def _committed(ign):
+            self.failUnlessEqual(closed, [0, 1, 2, 3])
+            self.failUnlessEqual(store._commit_timer, None)
+            # stopping the server commits anything that is still waiting
+            already,writers = self.allocate(ss, "si4", [0], 10)
+            writers[0].remote_close().addCallback(lambda ign:
+                                                  closed.append(4))
+            return ss.disownServiceParent()
+        d.addCallback(_committed)
+        def _stopped(ign):
+            self.failUnlessEqual(closed, [0, 1, 2, 3, 4])
+            ss = self.create("test_group_commit")
+            b = ss.remote_get_buckets("si4")
+            self.failUnlessEqual(b[0].remote_read(0, 10), "\x00" * 10)
+        d.addCallback(_stopped)
+        return d
+
+    def test_leases(self):
+        ss = self.create("test_leases", segment_size=100)
+        rs0,cs0 = self.secrets()
+        already,writers = self.allocate(ss, "si0", [0,1], 60, (rs0,cs0))
+        # each share fills most of a segment
+        writers[0].remote_close()
+        writers[1].remote_close()
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0])
+
+        # a second lease, through allocate and through add_lease
+        rs1,cs1 = self.secrets()
+        already,writers = self.allocate(ss, "si0", [0,1], 60, (rs1,cs1))
+        self.failUnlessEqual(already, set([0,1]))
+        store = ss.backend.store
+        ss.backend.flush()
+        rs2,cs2 = self.secrets()
+        ss.remote_add_lease("si0", rs2, cs2)
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0, rs1, rs2])
+        # lease changes wait for the next group commit, like shares do
+        self.failUnlessEqual(store._pending, 2)
+        self.failUnless(store._commit_timer.active())
+        ss.backend.flush()
+        self.failUnlessEqual(store._pending, 0)
+
+        # renewal only ever extends the lease
+        expiration = leases[0].expiration_time
+        ss.remote_renew_lease("si0", rs0)
+        leases = list(ss.get_leases("si0"))
+        self.failUnless(leases[0].expiration_time >= expiration)
+        self.failUnlessRaises(IndexError,
+                              ss.remote_renew_lease, "si0", self.secrets()[0])
+
+        # cancelling every lease removes the share, and the segment that
+        # held nothing else. The segment we are still appending to is kept.
+        # Only the deleted segment counts as freed space.
+        shares = dict(ss.backend.get_immutable_shares("si0"))
+        self.failUnlessRaises(IndexError, shares[0].cancel_lease, "nope")
+        for cs in (cs0, cs1):
+            self.failUnlessEqual(shares[0].cancel_lease(cs), 0)
+        self.failUnlessEqual(shares[0].cancel_lease(cs2), 60)
+        self.failUnlessEqual(ss.remote_get_buckets("si0").keys(), [1])
+        # the segment file is deleted once its removal has been committed
+        segdir = os.path.join(self.workdir("test_leases"),
+                              "packed", "segments")
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000000", "00000001"])
+        ss.backend.flush()
+        self.failUnlessEqual(sorted(os.listdir(segdir)), ["00000001"])
+        shares[1].unlink()
+        ss.backend.flush()
+        self.failUnlessEqual(sorted(os.listdir(segdir)), ["00000001"])
+        self.failUnlessEqual(ss.remote_get_buckets("si0"), {})
+
+    def test_compaction(self):
+        ss = self.create("test_compaction", segment_size=100)
+        cancel_secrets = []
+        for i in range(6):
+            rs,cs = self.secrets()
+            already,writers = self.allocate(ss, "si%d" % i, [0], 30, (rs,cs))
+            writers[0].remote_write(0, "%30d" % i)
+            writers[0].remote_close()
+            cancel_secrets.append(cs)
+        segdir = os.path.join(self.workdir("test_compaction"),
+                              "packed", "segments")
+        # si0-si2 fill segment 0, si3-si5 are in segment 1
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000000", "00000001"])
+        b = ss.remote_get_buckets("si2")
+
+        # deleting two of the shares in segment 0 frees nothing yet, but
+        # leaves it due for compaction
+        self.failUnlessEqual(ss.backend.compact(), (0, 0))
+        for i in (0, 1):
+            sf = dict(ss.backend.get_immutable_shares("si%d" % i))[0]
+            self.failUnlessEqual(sf.cancel_lease(cancel_secrets[i]), 0)
+        # compaction copies si2 to the end of the current segment, which
+        # makes us start segment 2, and deletes segment 0 once that has
+        # been committed
+        self.failUnlessEqual(ss.backend.compact(), (30, 60))
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000000", "00000001", "00000002"])
+        ss.backend.flush()
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000001", "00000002"])
+        self.failUnlessEqual(ss.backend.compact(), (0, 0))
+        # a reader that was opened before the move still works
+        self.failUnlessEqual(b[0].remote_read(0, 30), "%30d" % 2)
+        for i in range(2, 6):
+            b = ss.remote_get_buckets("si%d" % i)
+            self.failUnlessEqual(b[0].remote_read(0, 30), "%30d" % i)
+
+        # if we crash after a compaction is committed but before its
+        # segment is deleted, the segment is deleted when we restart
+        fileutil.write(os.path.join(segdir, "00000000"), "x" * 90)
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss = self.create("test_compaction", segment_size=100)
+            self.failUnlessEqual(sorted(os.listdir(segdir)),
+                                 ["00000001", "00000002"])
+            b = ss.remote_get_buckets("si2")
+            self.failUnlessEqual(b[0].remote_read(0, 30), "%30d" % 2)
+        d.addCallback(_restart)
+        return d
+
+    def test_compaction_chunks(self):
+        ss = self.create("test_compaction_chunks", segment_size=100)
+        cancel_secrets = []
+        for i in range(10):
+            rs,cs = self.secrets()
+            already,writers = self.allocate(ss, "si%d" % i, [0], 20, (rs,cs))
+            writers[0].remote_write(0, "%20d" % i)
+            writers[0].remote_close()
+            cancel_secrets.append(cs)
+        segdir = os.path.join(self.workdir("test_compaction_chunks"),
+                              "packed", "segments")
+        # si0-si4 fill segment 0, si5-si9 fill segment 1
+        for i in range(3):
+            sf = dict(ss.backend.get_immutable_shares("si%d" % i))[0]
+            self.failUnlessEqual(sf.cancel_lease(cancel_secrets[i]), 0)
+        b = ss.remote_get_buckets("si4")
+        # each call copies about as much as it is allowed to, so the two
+        # live shares of segment 0 are moved one at a time
+        self.failUnlessEqual(ss.backend.compact(15), (20, 0))
+        self.failUnlessEqual(ss.backend.compact(15), (20, 60))
+        self.failUnlessEqual(ss.backend.compact(15), (0, 0))
+        ss.backend.flush()
+        self.failUnlessEqual(sorted(os.listdir(segdir)),
+                             ["00000001", "00000002"])
+        self.failUnlessEqual(b[0].remote_read(0, 20), "%20d" % 4)
+        for i in range(3, 10):
+            b = ss.remote_get_buckets("si%d" % i)
+            self.failUnlessEqual(b[0].remote_read(0, 20), "%20d" % i)
+
+    def test_max_share_size(self):
+        workdir = self.workdir("test_max_share_size")
+        ss = StorageServer(workdir, "\x00" * 20,
+                           backend=PackedBackend(workdir, max_share_size=50))
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "small", [0], 50)
+        writers[0].remote_write(0, "a" * 50)
+        writers[0].remote_close()
+        already,writers = self.allocate(ss, "large", [0], 51)
+        writers[0].remote_write(0, "b" * 51)
+        writers[0].remote_close()
+
+        self.failUnlessEqual([shnum for (shnum, sf)
+                              in ss.backend.get_packed_shares("small")], [0])
+        self.failUnlessEqual(ss.backend.get_packed_shares("large"), [])
+        self.failUnless(os.path.exists(os.path.join(workdir, "shares",
+                                                    storage_index_to_dir("large"),
+                                                    "0")))
+        self.failUnlessEqual(ss.backend.list_packed_buckets(base32.b2a("small")[:2]),
+                             [base32.b2a("small")])
+        self.failUnlessEqual(ss.remote_get_buckets("small")[0].remote_read(0, 50),
+                             "a" * 50)
+        self.failUnlessEqual(ss.remote_get_buckets("large")[0].remote_read(0, 51),
+                             "b" * 51)
+
+    def test_disk_shares(self):
+        # immutable shares written before the switch to the packed backend
+        # are still served, and mutable shares are still kept on disk
+        workdir = self.workdir("test_disk_shares")
+        ss = StorageServer(workdir, "\x00" * 20)
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "si1", [0], 10)
+        writers[0].remote_write(0, "%10d" % 0)
+        writers[0].remote_close()
+        ss.disownServiceParent()
+
+        ss = self.create("test_disk_shares")
+        already,writers = self.allocate(ss, "si1", [0,1], 10)
+        self.failUnlessEqual(already, set([0]))
+        writers[1].remote_write(0, "%10d" % 1)
+        writers[1].remote_close()
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 10), "%10d" % 0)
+        self.failUnlessEqual(b[1].remote_read(0, 10), "%10d" % 1)
+
+        secrets = ("we1", "rs1", "cs1")
+        rc = ss.remote_slot_testv_and_readv_and_writev("si2", secrets,
+                                                       {0: ([], [(0,"data")],
+                                                            None)},
+                                                       [])
+        self.failUnlessEqual(rc, (True, {}))
+        self.failUnless(os.path.exists(os.path.join(workdir, "shares",
+                                                    storage_index_to_dir("si2"),
+                                                    "0")))
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [0], [(0, 4)]),
+                             {0: ["data"]})
+
+
 
 class MutableServer(unittest.TestCase):
 
@@ -822,6 +1287,86 @@ class MutableServer(unittest.TestCase):
         self.failUnlessIn(" had magic ", str(e))
         self.failUnlessIn(" but we wanted ", str(e))
 
+    def test_preallocation(self):
+        ss = self.create("test_preallocation")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0]), 100)
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        # give the share some extra leases, which live after the data
+        for i in range(6):
+            ss.remote_add_lease("si1", self.renew_secret("extra-%d" % i),
+                                self.cancel_secret("extra-%d" % i))
+        sf = ss.backend.get_mutable_shares("si1")[0]
+        def get_container_size():
+            f = open(sf.home, "rb")
+            size = sf._read_extra_lease_offset(f) - sf.DATA_OFFSET
+            f.close()
+            return size
+
+        data = "a" * 1000
+        rstaraw("si1", secrets, {0: ([], [(0,data)], None)}, [])
+        self.failUnlessEqual(get_container_size(), 1500)
+
+        # growing within the container does not move the extra leases
+        rstaraw("si1", secrets, {0: ([], [(1000,"b"*400)], None)}, [])
+        self.failUnlessEqual(get_container_size(), 1500)
+        rstaraw("si1", secrets, {0: ([], [(1400,"c"*200)], None)}, [])
+        self.failUnlessEqual(get_container_size(), 2400)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0, 2000)]),
+                             {0: [data + "b"*400 + "c"*200]})
+
+        # and the leases (one from allocate(), six extra ones, and one from
+        # the writes) survived the move, so they can still be renewed and
+        # cancelled
+        leases = list(sf.get_leases())
+        self.failUnlessEqual(len(leases), 8)
+        ss.remote_renew_lease("si1", self.renew_secret("extra-5"))
+        self.failUnlessEqual(sf.cancel_lease(self.cancel_secret("extra-5")), 0)
+        self.failUnlessEqual(len(list(sf.get_leases())), 7)
+        # the empty slot is reused
+        ss.remote_add_lease("si1", self.renew_secret("extra-6"),
+                            self.cancel_secret("extra-6"))
+        leases = list(sf.get_leases())
+        self.failUnlessEqual(len(leases), 8)
+        self.failUnlessEqual(leases[6].renew_secret,
+                             self.renew_secret("extra-6"))
+
+        # the preallocation is limited, both in size and by MAX_SIZE
+        self.failUnlessEqual(sf._get_preallocated_size(10*1000*1000),
+                             11*1000*1000)
+        self.failUnlessEqual(sf._get_preallocated_size(sf.MAX_SIZE - 10),
+                             sf.MAX_SIZE)
+        self.failUnlessEqual(sf._get_preallocated_size(sf.MAX_SIZE + 10),
+                             sf.MAX_SIZE + 10)
+
+    def test_coalesced_readv(self):
+        ss = self.create("test_coalesced_readv")
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(),
+                      set([0]), 100)
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        data = "".join([chr(i) for i in range(256)])
+        rstaraw("si1", secrets, {0: ([], [(0,data)], None)}, [])
+        # out of order, overlapping, adjacent, repeated, empty, and past the
+        # end of the data
+        readv = [(200, 10), (0, 5), (3, 4), (7, 3), (0, 5), (50, 0),
+                 (250, 10), (300, 5), (100, 20)]
+        answer = ss.remote_slot_readv("si1", [0], readv)
+        self.failUnlessEqual(answer,
+                             {0: [data[o:o+l] for (o,l) in readv]})
+
+        self.failUnlessEqual(coalesce_readv(readv, 256),
+                             ([(0, 10), (100, 20), (200, 10), (250, 6)],
+                              [(2, 0, 10), (0, 0, 5), (0, 3, 4), (0, 7, 3),
+                               (0, 0, 5), (0, 0, 0), (3, 0, 6), (0, 0, 0),
+                               (1, 0, 20)]))
+        self.failUnlessEqual(coalesce_readv([], 256), ([], []))
+
     def test_container_size(self):
         ss = self.create("test_container_size")
         self.allocate(ss, "si1", "we1", self._lease_secret.next(),
@@ -2789,6 +3334,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # percentiles come from a histogram with 1%-wide buckets
+        self.failUnless(abs(value - expected) <= 0.01 * expected + 1e-6,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2805,47 +3355,48 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        # every sample is counted: none are discarded after the first 1000
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"],  100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2855,6 +3406,38 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.latencies.allocate.samplesize"], 10000)
+        self.failUnlessEqual(stats["storage_server.latencies_1m.allocate.samplesize"], 10000)
+        self.failUnlessEqual(stats["storage_server.latencies_lifetime.allocate.samplesize"], 10000)
+        self.failIfIn("storage_server.latencies.read.samplesize", stats)
+
+    def test_latency_windows(self):
+        ss = self.create("test_latency_windows")
+        now = time.time()
+        # an old batch of slow operations, then a recent batch of fast ones
+        for i in range(100):
+            ss.latencies["readv"].add(1.0, now=now - 200)
+        for i in range(100):
+            ss.latencies["readv"].add(0.001, now=now - 10)
+
+        output = ss.get_latencies("1m")
+        self.failUnlessEqual(output["readv"]["samplesize"], 100)
+        self.failUnlessClose(output["readv"]["99_0_percentile"], 0.001, output)
+        output = ss.get_latencies("5m")
+        self.failUnlessEqual(output["readv"]["samplesize"], 200)
+        self.failUnlessClose(output["readv"]["90_0_percentile"], 1.0, output)
+
+        # once the slow batch is more than five minutes old, only the
+        # lifetime numbers still include it
+        ss.latencies["readv"].add(0.001, now=now + 200)
+        output = ss.latencies["readv"].get("5m", now=now + 200)
+        self.failUnlessEqual(output.count, 101)
+        self.failUnlessEqual(len(ss.latencies["readv"].slots), 2)
+        output = ss.get_latencies("lifetime")
+        self.failUnlessEqual(output["readv"]["samplesize"], 201)
+        self.failUnlessClose(output["readv"]["90_0_percentile"], 1.0, output)
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3018,6 +3601,88 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         ss.setServiceParent(self.s)
         return d
 
+    def test_bucket_index(self):
+        basedir = "storage/BucketCounter/bucket_index"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.bucket_counter.slow_start = 0
+        ss.bucket_counter.cpu_slice = 100.0
+        index = ss.bucket_index
+        rs, cs = hashutil.tagged_hash("blah", "rs"), hashutil.tagged_hash("blah", "cs")
+        secrets = (hashutil.tagged_hash("blah", "we"), rs, cs)
+        def add_immutable(si):
+            already, writers = ss.remote_allocate_buckets(si, rs, cs, [0], 10,
+                                                          FakeCanary(True))
+            writers[0].remote_write(0, "a"*10)
+            writers[0].remote_close()
+        def add_mutable(si):
+            ss.remote_slot_testv_and_readv_and_writev(si, secrets,
+                                                      {0: ([], [(0, "b"*10)],
+                                                           None)},
+                                                      [])
+        add_immutable("si1")
+        add_mutable("si2")
+        # before the crawler has been everywhere, we know nothing
+        self.failUnless(index.may_have_bucket("si3"))
+
+        ss.setServiceParent(self.s)
+        def _watch():
+            return ss.bucket_counter.get_state()["last-cycle-finished"] is not None
+        d = self.poll(_watch)
+        def _check(ignored):
+            self.failUnless(index.may_have_bucket("si1"))
+            self.failUnless(index.may_have_bucket("si2"))
+            self.failIf(index.may_have_bucket("si3"))
+            # queries for buckets we don't have must not touch the backend
+            def _fail(*args):
+                self.fail("looked for shares that are not there")
+            ss.backend.get_immutable_shares = _fail
+            ss.backend.get_mutable_shares = _fail
+            self.failUnlessEqual(ss.remote_get_buckets("si3"), {})
+            self.failUnlessEqual(ss.remote_slot_readv("si3", [], [(0, 10)]),
+                                 {})
+            del ss.backend.get_immutable_shares
+            del ss.backend.get_mutable_shares
+            self.failUnlessEqual(ss.remote_get_buckets("si1").keys(), [0])
+            self.failUnlessEqual(ss.remote_slot_readv("si2", [], [(0, 10)]),
+                                 {0: ["b"*10]})
+
+            # new shares are found right away
+            add_immutable("si3")
+            add_mutable("si4")
+            self.failUnlessEqual(ss.remote_get_buckets("si3").keys(), [0])
+            self.failUnlessEqual(ss.remote_slot_readv("si4", [], [(0, 10)]),
+                                 {0: ["b"*10]})
+            # and they stay in the index through the next cycle
+            index.start_cycle(4)
+            add_immutable("si5")
+            for prefix in ss.bucket_counter.prefixes:
+                index.add_prefix(prefix, [])
+            index.finish_cycle()
+            self.failUnless(index.may_have_bucket("si5"))
+            self.failIf(index.may_have_bucket("si1"))
+        d.addCallback(_check)
+        return d
+
+    def test_bucket_index_resumed(self):
+        # a crawler that resumes a cycle after a restart never calls
+        # start_cycle(), so add_prefix() sizes the new filter from the
+        # bucket count of the last complete cycle, not from one prefix
+        index = BucketIndex()
+        buckets = [base32.b2a("si%d" % i) for i in range(100)]
+        index.add_prefix("aa", buckets, 10)
+        self.failUnlessEqual(index.next.buckets.capacity,
+                             BucketIndex.MIN_CAPACITY)
+        index = BucketIndex()
+        index.add_prefix("aa", buckets, 50000)
+        self.failUnlessEqual(index.next.buckets.capacity,
+                             50000 * BucketIndex.GROWTH_FACTOR)
+        # without a complete cycle to go by, use the minimum
+        index = BucketIndex()
+        index.add_prefix("aa", buckets)
+        self.failUnlessEqual(index.next.buckets.capacity,
+                             BucketIndex.MIN_CAPACITY)
+
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
@@ -3421,6 +4086,253 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_journal_replay(self):
+        basedir = "storage/LeaseCrawler/journal_replay"
+        fileutil.make_dirs(basedir)
+        ss = InstrumentedStorageServer(basedir, "\x00" * 20)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.cpu_slice = 500
+        lc.stop_after_first_bucket = True
+        self.make_shares(ss)
+        ss.setServiceParent(self.s)
+
+        def _first_bucket_done():
+            return lc.state["last-complete-bucket"] is not None
+        d = self.poll(_first_bucket_done)
+        def _check(ignored):
+            # the first slice was too short to be worth rewriting the
+            # statefile, but a crawler loaded from it (as after a SIGKILL)
+            # gets the same state back from the journal
+            lc2 = LeaseCheckingCrawler(ss, lc.statefile, lc.historyfile,
+                                       False, "age", None, None,
+                                       ("mutable", "immutable"))
+            lc2.close_journal()
+            self.failUnlessEqual(lc2.state["last-complete-bucket"],
+                                 lc.state["last-complete-bucket"])
+            so_far = lc2.state["cycle-to-date"]
+            self.failUnlessEqual(so_far, lc.state["cycle-to-date"])
+            self.failUnlessEqual(so_far["space-recovered"]["examined-buckets"],
+                                 1)
+        d.addCallback(_check)
+        return d
+
+    def test_expire_age_threaded(self):
+        basedir = "storage/LeaseCrawler/expire_age_threaded"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_threads=2,
+                           expiration_max_iops=10000)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def count_leases(si):
+            return len(list(_get_sharefile(si).get_leases()))
+
+        now = time.time()
+        self.backdate_lease(_get_sharefile(immutable_si_0),
+                            self.renew_secrets[0], now - 1000)
+        self.backdate_lease(_get_sharefile(immutable_si_1),
+                            self.renew_secrets[1], now - 1000)
+        self.backdate_lease(_get_sharefile(mutable_si_2),
+                            self.renew_secrets[3], now - 1000)
+        self.backdate_lease(_get_sharefile(mutable_si_3),
+                            self.renew_secrets[4], now - 1000)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_share_deleted_while_threaded(self):
+        basedir = "storage/LeaseCrawler/share_deleted_while_threaded"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_threads=2,
+                           expiration_max_iops=10000)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        si_0_b32 = base32.b2a(immutable_si_0)
+
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        self.backdate_lease(_get_sharefile(immutable_si_0),
+                            self.renew_secrets[0], time.time() - 1000)
+
+        # delete the expired share after a worker thread has examined it,
+        # but before the reactor thread gets to cancel its lease
+        orig_process_bucket_result = lc.process_bucket_result
+        def process_bucket_result(cycle, prefix, prefixdir, storage_index_b32,
+                                  result):
+            if storage_index_b32 == si_0_b32:
+                (s, shares) = result
+                self.failUnlessEqual(len(shares), 1)
+                os.unlink(shares[0][1])
+            return orig_process_bucket_result(cycle, prefix, prefixdir,
+                                              storage_index_b32, result)
+        lc.process_bucket_result = process_bucket_result
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(list(ss._iter_share_files(immutable_si_0)),
+                                 [])
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(last["corrupt-shares"], [])
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_threaded_cycle_failure(self):
+        basedir = "storage/LeaseCrawler/threaded_cycle_failure"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_threads=2)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.make_shares(ss)
+
+        # a worker thread hits an error that examine_bucket() doesn't handle
+        examined = []
+        def examine_bucket(prefixdir, storage_index_b32):
+            examined.append(storage_index_b32)
+            raise OSError("disk on fire")
+        lc.examine_bucket = examine_bucket
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return (examined and lc.threaded_crawl is None
+                    and lc.timer is not None)
+        d = self.poll(_wait)
+        def _failed(ignored):
+            self.failUnlessEqual(len(self.flushLoggedErrors(OSError)), 1)
+            # the crawler will try again later, instead of stopping for good
+            self.failUnless(lc.timer.active())
+            self.failUnlessEqual(lc.get_state()["last-cycle-finished"], None)
+        d.addCallback(_failed)
+        return d
+
+    def backdate_packed_lease(self, sf, renew_secret, new_expire_time):
+        # as with backdate_lease(), we have to reach inside the store
+        store = sf._store
+        store.cursor.execute("UPDATE leases SET expiration_time=?"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND renew_secret=?",
+                             (new_expire_time, sf._si_s, sf._shnum,
+                              buffer(renew_secret)))
+        store.db.commit()
+
+    def _test_expire_packed(self, basedir, threads):
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_threads=threads,
+                           backend=PackedBackend(basedir))
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        bc = ss.bucket_counter
+        bc.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+        def count_leases(si):
+            return len(list(_get_sharefile(si).get_leases()))
+
+        # the immutable shares were packed, so they have no bucket directory
+        sf0 = _get_sharefile(immutable_si_0)
+        self.failUnless(isinstance(sf0, PackedShare), sf0)
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir(immutable_si_0))))
+
+        now = time.time()
+        self.backdate_packed_lease(sf0, self.renew_secrets[0], now - 1000)
+        self.backdate_packed_lease(_get_sharefile(immutable_si_1),
+                                   self.renew_secrets[1], now - 1000)
+        self.backdate_lease(_get_sharefile(mutable_si_2),
+                            self.renew_secrets[3], now - 1000)
+        self.backdate_lease(_get_sharefile(mutable_si_3),
+                            self.renew_secrets[4], now - 1000)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None and
+                        bc.get_state()["last-complete-bucket-count"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            self.failUnlessEqual(bc.get_state()["last-complete-bucket-count"],
+                                 4)
+            self.failUnlessEqual(count_shares(immutable_si_0), 0)
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 1)
+            self.failUnlessEqual(count_shares(mutable_si_2), 0)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["examined-shares-immutable"], 2)
+            self.failUnlessEqual(rec["examined-sharebytes-immutable"], 2000)
+            self.failUnlessEqual(rec["actual-buckets"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-sharebytes-immutable"], 1000)
+            # the expired share was in the segment that we are still
+            # appending to, so deleting it gave no disk space back
+            self.failUnlessEqual(rec["actual-diskbytes-immutable"], 0)
+        d.addCallback(_after_first_cycle)
+        return d
+
+    def test_expire_packed(self):
+        return self._test_expire_packed("storage/LeaseCrawler/expire_packed",
+                                        0)
+
+    def test_expire_packed_threaded(self):
+        return self._test_expire_packed("storage/LeaseCrawler/"
+                                        "expire_packed_threaded", 2)
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -3975,7 +4887,17 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             s = remove_tags(html)
             self.failUnlessIn("Accepting new shares: Yes", s)
             self.failUnlessIn("Reserved space: - 0 B (0)", s)
+            self.failUnlessIn("No operations yet.", s)
         d.addCallback(_check_html)
+        def _add_latencies(ign):
+            for i in range(10):
+                ss.add_latency("readv", 0.020)
+            return self.render1(w)
+        d.addCallback(_add_latencies)
+        def _check_latencies(html):
+            s = remove_tags(html)
+            self.failUnlessIn("readv 10 20ms 20ms 20ms", s)
+        d.addCallback(_check_latencies)
         d.addCallback(lambda ign: self.render_json(w))
         def _check_json(json):
             data = simplejson.loads(json)
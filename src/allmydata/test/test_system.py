@@ -312,6 +312,12 @@ class SystemTest(SystemTestMixin, RunBinTahoeMixin, unittest.TestCase):
                           log.msg("wait_for_connections", level=log.NOISY,
                                   facility="tahoe.test.test_system"))
             d.addCallback(lambda res: self.wait_for_connections())
+            # the storage servers reconnect within a second, but the helper
+            # connection has its own Reconnector, which may take longer
+            def _helper_connected():
+                uploader = self.extra_node.getServiceNamed("uploader")
+                return uploader.get_helper_info()[1]
+            d.addCallback(lambda res: self.poll(_helper_connected))
 
 
             d.addCallback(lambda res:
@@ -17,7 +17,7 @@ from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
 from allmydata.test.common_util import ShouldFailMixin
 from allmydata.util.happinessutil import servers_of_happiness, \
-                                         shares_by_server, merge_servers
+     shares_by_server, merge_servers, HappinessMatching
 from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
 
@@ -114,6 +114,15 @@ class FakeStorageServer:
                              "application-version": str(allmydata.__full_version__),
                              }
 
+    def get_version(self):
+        if self.mode == "full":
+            # the version we were connected with is stale: we have filled up
+            # since then
+            return { "http://allmydata.org/tahoe/protocols/storage/v1" :
+                     { "maximum-immutable-share-size": 0 },
+                     "application-version": str(allmydata.__full_version__),
+                     }
+        return self.version
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
@@ -145,6 +154,9 @@ class FakeStorageServer:
                           for shnum in sharenums]),
                     )
 
+    def get_buckets(self, storage_index):
+        return {}
+
 class FakeBucketWriter:
     # a diagnostic version of storageserver.BucketWriter
     def __init__(self, size):
@@ -629,6 +641,77 @@ class ServerSelection(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_parallel_queries(self):
+        # the first pass should ask all ten servers at once, rather than
+        # waiting for each one to answer before asking the next
+        self.make_client(10)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 7, 10)
+        sent = []
+        in_flight = []
+        def _watch(s):
+            original_callRemote = s.callRemote
+            original_allocate = s.allocate_buckets
+            def _callRemote(methname, *args, **kwargs):
+                sent.append(methname)
+                return original_callRemote(methname, *args, **kwargs)
+            def _allocate(*args, **kwargs):
+                in_flight.append(len(sent))
+                return original_allocate(*args, **kwargs)
+            s.callRemote = _callRemote
+            s.allocate_buckets = _allocate
+        for s in self.node.last_servers:
+            _watch(s)
+        d = upload_data(self.u, data)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(res):
+            self.failUnlessEqual(in_flight[0], 10)
+            for s in self.node.last_servers:
+                self.failUnlessEqual(len(s.allocated), 1)
+                self.failUnlessEqual(s.queries, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_skip_full_servers(self):
+        # once a server has told us that it is full, later uploads should
+        # not ask it to hold shares of the same size
+        mode = dict([(i,{0:"good",1:"full"}[i%2]) for i in range(20)])
+        self.node = FakeClient(mode, num_servers=20)
+        self.u = upload.Uploader()
+        self.u.running = True
+        self.u.parent = self.node
+        self.set_encoding_parameters(3, 5, 10)
+        full_servers = [s for s in self.node.last_servers
+                        if s.mode == "full"]
+
+        d = upload_data(self.u, self.get_data(SIZE_LARGE))
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _uploaded(res):
+            self.queries = [s.queries for s in full_servers]
+            self.failUnless(sum(self.queries) > 0, self.queries)
+            for server in self.node.storage_broker.get_connected_servers():
+                if server.get_rref().queries:
+                    self.failUnlessEqual(server.get_available_space() < 2**32,
+                                         server.get_rref().mode == "full")
+            return upload_data(self.u, self.get_data(SIZE_LARGE))
+        d.addCallback(_uploaded)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(res):
+            # the second upload uses a new random key, and so a different
+            # storage index: it may offer shares to full servers that the
+            # first one never asked
+            for (s, queries) in zip(full_servers, self.queries):
+                if queries:
+                    self.failUnlessEqual(s.queries, queries)
+            total_allocated = sum([len(s.allocated)
+                                   for s in self.node.last_servers])
+            self.failUnlessEqual(total_allocated, 20)
+        d.addCallback(_check)
+        return d
+
 
 class StorageIndex(unittest.TestCase):
     def test_params_must_matter(self):
@@ -725,6 +808,24 @@ def is_happy_enough(servertoshnums, h, k):
     # print "HAAPP{Y"
     return True
 
+def naive_happiness(sharemap):
+    """ I return the size of a maximum matching between the shares and the
+    servers of sharemap (shnum -> set(serverid)), found with one simple
+    augmenting-path search per share. HappinessMatching should agree. """
+    share_on = {} # serverid -> the shnum that we matched it with
+    def _augment(shnum, seen):
+        for serverid in sharemap[shnum]:
+            if serverid in seen:
+                continue
+            seen.add(serverid)
+            if serverid not in share_on or _augment(share_on[serverid], seen):
+                share_on[serverid] = shnum
+                return True
+        return False
+    for shnum in sharemap:
+        _augment(shnum, set())
+    return len(share_on)
+
 class FakeServerTracker:
     def __init__(self, serverid, buckets):
         self._serverid = serverid
@@ -953,6 +1054,30 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
             self.failUnless(self._has_happy_share_distribution()))
         return d
 
+    def test_concurrent_identical_uploads(self):
+        # a server that is still receiving shares from one upload answers a
+        # second upload of the same file with an empty allocate_buckets()
+        # reply. That must not be mistaken for the server being full.
+        self.basedir = "upload/EncodingParameters/concurrent_identical_uploads"
+        self.set_up_grid(num_servers=10)
+        c = self.g.clients[0]
+        DATA = "kittens" * 10000
+        d = defer.DeferredList([c.upload(upload.Data(DATA, convergence=""))
+                                for i in range(2)],
+                               consumeErrors=True)
+        def _uploaded(results):
+            # one of the two uploads may fail to place its shares, but at
+            # least one of them must succeed
+            self.failUnless([s for (s, res) in results if s], results)
+            for server in c.storage_broker.get_connected_servers():
+                self.failUnlessEqual(server.refused_sizes, [])
+            # and a later upload of the same file can use every server
+            return c.upload(upload.Data(DATA, convergence=""))
+        d.addCallback(_uploaded)
+        d.addCallback(lambda ign:
+            self.failUnless(self._has_happy_share_distribution()))
+        return d
+
 
     def test_problem_layout_comment_52(self):
         def _basedir():
@@ -1190,7 +1315,6 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(lambda ign:
             self.failUnless(self._has_happy_share_distribution()))
         return d
-    test_problem_layout_ticket_1124.todo = "Fix this after 1.7.1 release."
 
     def test_happiness_with_some_readonly_servers(self):
         # Try the following layout
@@ -1502,6 +1626,47 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         self.failUnlessEqual(2, servers_of_happiness(test))
 
 
+    def test_happiness_matching(self):
+        # HappinessMatching should agree with a naive maximum matching as
+        # shares are placed and lost one at a time.
+        m = HappinessMatching()
+        self.failUnlessEqual(m.get_happiness(), 0)
+        m.add(1, "server1")
+        m.add(2, "server1")
+        m.add(3, "server1")
+        self.failUnlessEqual(m.get_happiness(), 1)
+        m.add(1, "server2")
+        self.failUnlessEqual(m.get_happiness(), 2)
+        # server2 can only take share 1, so server1 must now use 2 or 3
+        m.add(2, "server3")
+        m.add(3, "server3")
+        self.failUnlessEqual(m.get_happiness(), 3)
+        m.add(2, "server3") # adding the same share twice changes nothing
+        self.failUnlessEqual(m.get_happiness(), 3)
+        m.remove(1, "server2")
+        self.failUnlessEqual(m.get_happiness(), 2)
+        m.remove(4, "server4") # neither was ever added
+        self.failUnlessEqual(m.get_happiness(), 2)
+
+        sharemap = {}
+        m = HappinessMatching()
+        for i in xrange(300):
+            shnum = (i * 7) % 13
+            serverid = "server%d" % ((i * 5) % 11)
+            if i % 3 == 2:
+                m.remove(shnum, serverid)
+                sharemap.get(shnum, set()).discard(serverid)
+                if not sharemap.get(shnum, True):
+                    del sharemap[shnum]
+            else:
+                m.add(shnum, serverid)
+                sharemap.setdefault(shnum, set()).add(serverid)
+            self.failUnlessEqual(m.get_happiness(),
+                                 naive_happiness(sharemap))
+            self.failUnlessEqual(HappinessMatching(sharemap).get_happiness(),
+                                 m.get_happiness())
+
+
     def test_shares_by_server(self):
         test = dict([(i, set(["server%d" % i])) for i in xrange(1, 5)])
         sbs = shares_by_server(test)
@@ -1617,7 +1782,8 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         # the one that it wanted to allocate there. Though no shares will
         # be allocated in this request, it should still be called
         # productive, since it caused some homeless shares to be
-        # removed.
+        # removed. The other nine servers were asked at the same time, and
+        # each of them accepted a share.
         d.addCallback(_reset)
         d.addCallback(lambda ign:
             self._setup_and_upload())
@@ -1638,7 +1804,7 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(_next)
         d.addCallback(lambda c:
             self.shouldFail(UploadUnhappinessError, "test_query_counting",
-                            "1 queries placed some shares",
+                            "10 queries placed some shares, 0 placed none",
                             c.upload, upload.Data("data" * 10000,
                                                   convergence="")))
         return d
@@ -1885,17 +2051,14 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
             return client
 
         d.addCallback(_setup)
-        # Note: actually it should succeed! See
-        # test_problem_layout_ticket_1128. But ticket 1118 is just to
-        # make it realize that it has failed, so if it raises
-        # UploadUnhappinessError then we'll give it the green light
-        # for now.
-        d.addCallback(lambda ignored:
-            self.shouldFail(UploadUnhappinessError,
-                            "test_problem_layout_ticket_1118",
-                            "",
-                            self.g.clients[0].upload, upload.Data("data" * 10000,
-                                                       convergence="")))
+        # Ticket 1118 was about the uploader hitting an assertion instead
+        # of realizing that it had failed. Now that the first pass asks all
+        # four servers at once, it finds a happy layout, as it should (see
+        # test_problem_layout_ticket_1128).
+        d.addCallback(lambda client:
+            client.upload(upload.Data("data" * 10000, convergence="")))
+        d.addCallback(lambda ign:
+            self.failUnless(self._has_happy_share_distribution()))
         return d
 
     def test_problem_layout_ticket_1128(self):
@@ -1931,7 +2094,6 @@ class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
         d.addCallback(lambda ign:
             self.failUnless(self._has_happy_share_distribution()))
         return d
-    test_problem_layout_ticket_1128.todo = "Invent a smarter uploader that uploads successfully in this case."
 
     def test_upload_succeeds_with_some_homeless_shares(self):
         # If the upload is forced to stop trying to place shares before
@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, histogram, bloom
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 
@@ -311,6 +311,105 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class Histogram(unittest.TestCase):
+    def failUnlessClose(self, value, expected, precision=0.01):
+        self.failUnless(abs(value - expected) <= precision * expected,
+                        (value, expected))
+
+    def test_log_histogram(self):
+        h = histogram.LogHistogram()
+        self.failUnlessEqual(h.get_mean(), None)
+        self.failUnlessEqual(h.get_percentile(0.5), None)
+        samples = [0.0001 * i for i in range(1, 10001)]
+        for v in samples:
+            h.add(v)
+        self.failUnlessEqual(h.count, 10000)
+        self.failUnlessEqual((h.min, h.max), (0.0001, 1.0))
+        self.failUnlessClose(h.get_mean(), sum(samples) / 10000, 1e-9)
+        for fraction in [0.01, 0.1, 0.5, 0.9, 0.99, 0.999]:
+            self.failUnlessClose(h.get_percentile(fraction),
+                                 samples[int(fraction * 10000)])
+        # the extremes are exact
+        self.failUnlessEqual(h.get_order_statistics([0, 9999]), [0.0001, 1.0])
+        self.failUnlessEqual(h.get_order_statistics([9999, 10000]), [1.0, None])
+        # memory use depends upon the range of values, not the count
+        self.failUnless(len(h.buckets) < 1000, len(h.buckets))
+        for v in samples:
+            h.add(v)
+        self.failUnlessEqual(h.count, 20000)
+        self.failUnless(len(h.buckets) < 1000, len(h.buckets))
+
+    def test_small_values(self):
+        h = histogram.LogHistogram(minimum=1e-3)
+        h.add(0.0)
+        h.add(0.0005)
+        h.add(0.5)
+        # everything at or below the minimum is reported as the minimum
+        (a, b, c) = h.get_order_statistics([0, 1, 2])
+        self.failUnlessEqual((a, b), (0.001, 0.001))
+        self.failUnlessClose(c, 0.5)
+
+    def test_merge(self):
+        a = histogram.LogHistogram()
+        b = histogram.LogHistogram()
+        for i in range(100):
+            a.add(1.0)
+            b.add(2.0)
+        a.merge(b)
+        self.failUnlessEqual(a.count, 200)
+        self.failUnlessEqual((a.min, a.max), (1.0, 2.0))
+        (low, high) = a.get_order_statistics([99, 100])
+        self.failUnlessClose(low, 1.0)
+        self.failUnlessEqual(high, 2.0)
+
+    def test_windowed(self):
+        clock = [1000.0]
+        w = histogram.WindowedHistogram({"1m": 60, "5m": 300},
+                                        clock=lambda: clock[0])
+        self.failUnlessEqual(w.max_slots, 30)
+        for i in range(30):
+            w.add(float(i))
+            clock[0] += 10
+        now = clock[0] - 1
+        # the 1m window is the last six 10-second slots
+        self.failUnlessEqual(w.get("1m", now).count, 6)
+        self.failUnlessEqual(w.get("1m", now).min, 24.0)
+        self.failUnlessEqual(w.get("5m", now).count, 30)
+        self.failUnlessEqual(w.get().count, 30)
+        self.failUnlessEqual(w.get("lifetime").count, 30)
+        clock[0] += 300
+        w.add(100.0)
+        self.failUnlessEqual(len(w.slots), 1)
+        self.failUnlessEqual(w.get("5m").count, 1)
+        self.failUnlessEqual(w.get("lifetime").count, 31)
+        self.failUnlessEqual(w.get("lifetime").max, 100.0)
+        # a window with no recent samples is empty
+        clock[0] += 600
+        self.failUnlessEqual(w.get("5m").count, 0)
+        self.failUnlessEqual(w.get("5m").get_percentile(0.5), None)
+
+
+class Bloom(unittest.TestCase):
+    def test_bloom(self):
+        f = bloom.BloomFilter(1000)
+        self.failUnlessEqual(f.num_hashes, 7)
+        self.failUnless(9000 < f.num_bits < 10000, f.num_bits)
+        self.failIf("a" in f)
+        for i in range(1000):
+            f.add("in-%d" % i)
+        for i in range(1000):
+            self.failUnless(("in-%d" % i) in f)
+        false_positives = len([i for i in range(10000)
+                               if ("out-%d" % i) in f])
+        self.failUnless(false_positives < 300, false_positives)
+
+        # it still works when it is overfilled, just not as well
+        f = bloom.BloomFilter(0)
+        f.add("a")
+        f.add("b")
+        self.failUnless("a" in f)
+        self.failUnless("b" in f)
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -1554,6 +1554,81 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got_json)
         return d
 
+    def test_POST_DIRURL_copy_tree_no_ophandle(self):
+        d = self.shouldFail2(error.Error,
+                             "test_POST_DIRURL_copy_tree_no_ophandle",
+                             "400 Bad Request",
+                             "slow operation requires ophandle=",
+                             self.POST, self.public_url, t="start-copy-tree")
+        return d
+
+    def _check_copy_tree_results(self, res, mutable):
+        expected = {"count-files-linked": 4,
+                    "count-files-copied": 2,
+                    "count-directories-linked": 0,
+                    "count-directories-created": 3,
+                    "count-unknown-linked": 0,
+                    "count-skipped": 0,
+                    "finished": True,
+                    "mutable": mutable,
+                    }
+        for k,v in expected.iteritems():
+            self.failUnlessReallyEqual(res[k], v,
+                                       "res[%s] was %s, not %s" %
+                                       (k, res[k], v))
+        self.failUnlessReallyEqual(res["origin_si"],
+                                   base32.b2a(self._foo_node.get_storage_index()))
+        return to_str(res["root"])
+
+    def test_POST_DIRURL_copy_tree(self):
+        d = self.POST(self.public_url + "/foo/?t=start-copy-tree&ophandle=128",
+                      followRedirect=True)
+        d.addCallback(self.wait_for_operation, "128")
+        d.addCallback(self.get_operation_results, "128", "json")
+        d.addCallback(self._check_copy_tree_results, True)
+        def _check_root(root_uri):
+            self.failUnless(root_uri.startswith("URI:DIR2:"), root_uri)
+            self.failIfEqual(root_uri, self._foo_uri)
+            new_root = self.s.create_node_from_uri(root_uri)
+            d = new_root.list()
+            def _check_children(children):
+                self.failUnlessEqual(sorted(children.keys()),
+                                     [u"bar.txt", u"baz.txt", u"blockingfile",
+                                      u"empty", u"n\u00fc.txt", u"quux.txt",
+                                      u"sub"])
+                self.failUnlessReallyEqual(children[u"bar.txt"][0].get_uri(),
+                                           self._bar_txt_uri)
+                baz = children[u"baz.txt"][0]
+                self.failIf(baz.is_mutable())
+                self.failIfEqual(children[u"sub"][0].get_uri(), self._sub_uri)
+                return baz.download_best_version()
+            d.addCallback(_check_children)
+            d.addCallback(self.failUnlessReallyEqual, self.BAZ_CONTENTS)
+            # later changes to the original are not seen in the copy
+            d.addCallback(lambda ign: self._foo_node.delete(u"bar.txt"))
+            d.addCallback(lambda ign: new_root.has_child(u"bar.txt"))
+            d.addCallback(self.failUnless)
+            return d
+        d.addCallback(_check_root)
+        return d
+
+    def test_POST_DIRURL_copy_tree_snapshot(self):
+        d = self.POST(self.public_url +
+                      "/foo/?t=start-copy-tree&format=chk&ophandle=129",
+                      followRedirect=True)
+        d.addCallback(self.wait_for_operation, "129")
+        d.addCallback(self.get_operation_results, "129", "json")
+        d.addCallback(self._check_copy_tree_results, False)
+        def _check_root(root_uri):
+            self.failUnless(root_uri.startswith("URI:DIR2-CHK:"), root_uri)
+            new_root = self.s.create_node_from_uri(root_uri)
+            self.failIf(new_root.is_mutable())
+            return new_root.get_child_at_path(u"sub/baz.txt")
+        d.addCallback(_check_root)
+        d.addCallback(lambda n: self.failUnlessReallyEqual(n.get_uri(),
+                                                           self._baz_file_uri))
+        return d
+
     def test_POST_DIRURL_stream_manifest(self):
         d = self.POST(self.public_url + "/foo/?t=stream-manifest")
         def _check(res):
@@ -3147,6 +3222,80 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
     def test_POST_set_children_with_hyphen(self):
         return self.test_POST_set_children(command_name="set-children")
 
+    def test_POST_set_children_delete_and_rename(self):
+        contents9, n9, newuri9 = self.makefile(9)
+        reqbody = simplejson.dumps({
+            u"atomic_added_1": [ "filenode", { "rw_uri": newuri9 } ],
+            u"empty": None,
+            u"bar-renamed.txt": [ "rename", { "from": "bar.txt" } ],
+            })
+        url = self.webish_url + self.public_url + "/foo?t=set_children"
+        d = client.getPage(url, method="POST", postdata=reqbody)
+        def _then(res):
+            self.failUnlessURIMatchesROChild(newuri9, self._foo_node, u"atomic_added_1")
+            self.failUnlessURIMatchesROChild(self._bar_txt_uri, self._foo_node,
+                                             u"bar-renamed.txt")
+            self.failIfNodeHasChild(self._foo_node, u"bar.txt")
+            self.failIfNodeHasChild(self._foo_node, u"empty")
+            return self._foo_node.get_metadata_for(u"bar-renamed.txt")
+        d.addCallback(_then)
+        def _check_metadata(metadata):
+            # the renamed link keeps its creation time
+            self.failUnlessReallyEqual(metadata["tahoe"]["linkcrtime"],
+                                       self._bar_txt_metadata["tahoe"]["linkcrtime"])
+        d.addCallback(_check_metadata)
+        d.addErrback(self.dump_error)
+        return d
+
+    def test_POST_set_children_delete_missing(self):
+        contents9, n9, newuri9 = self.makefile(9)
+        reqbody = simplejson.dumps({
+            u"atomic_added_1": [ "filenode", { "rw_uri": newuri9 } ],
+            u"missing": None,
+            })
+        d = self.shouldFail2(error.Error, "POST_set_children_delete_missing",
+                             "404 Not Found", "No such child: missing",
+                             client.getPage,
+                             self.webish_url + self.public_url + "/foo?t=set_children",
+                             method="POST", postdata=reqbody)
+        # nothing was changed
+        d.addCallback(lambda ign:
+                      self.failIfNodeHasChild(self._foo_node, u"atomic_added_1"))
+        return d
+
+    def test_POST_set_children_rename_no_replace(self):
+        reqbody = simplejson.dumps({
+            u"sub": [ "rename", { "from": "bar.txt" } ],
+            })
+        d = self.shouldFail2(error.Error, "POST_set_children_rename_no_replace",
+                             "409 Conflict", "There was already a child by that name",
+                             client.getPage,
+                             self.webish_url + self.public_url +
+                             "/foo?t=set_children&replace=only-files",
+                             method="POST", postdata=reqbody)
+        d.addCallback(lambda ign:
+                      self.failUnlessNodeHasChild(self._foo_node, u"bar.txt"))
+        return d
+
+    def test_POST_set_children_malformed(self):
+        url = self.webish_url + self.public_url + "/foo?t=set_children"
+        d = defer.succeed(None)
+        for (which, child) in [("not-a-pair", [ "filenode" ]),
+                               ("not-a-list", "filenode"),
+                               ("mddict", [ "filenode", "URI:LIT:" ]),
+                               ("from", [ "rename", { "from": 7 } ])]:
+            reqbody = simplejson.dumps({ u"new": child, u"empty": None })
+            d.addCallback(lambda ign, which=which, reqbody=reqbody:
+                          self.shouldFail2(error.Error,
+                                           "POST_set_children_malformed-" + which,
+                                           "400 Bad Request", None,
+                                           client.getPage, url,
+                                           method="POST", postdata=reqbody))
+        # nothing was changed
+        d.addCallback(lambda ign:
+                      self.failUnlessNodeHasChild(self._foo_node, u"empty"))
+        return d
+
     def test_POST_link_uri(self):
         contents, n, newuri = self.makefile(8)
         d = self.POST(self.public_url + "/foo", t="uri", name="new.txt", uri=newuri)
@@ -0,0 +1,44 @@
+
+import math, struct, array
+
+from allmydata.util.hashutil import sha1
+
+class BloomFilter:
+    """I am a set of strings that can answer 'is this string in the set?'
+    with either 'no' (which is always right) or 'maybe'. I use a fixed
+    amount of memory, chosen when I am created: for up to 'capacity' strings
+    I answer 'maybe' for a string that was never added with a probability of
+    about 'error_rate'. Past that, I keep working, but the error rate grows.
+    Strings cannot be removed from me."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = max(8, int(math.ceil(num_bits)))
+        self.num_hashes = max(1, int(round(self.num_bits * math.log(2)
+                                           / capacity)))
+        self.bits = array.array("B", [0]) * ((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _get_positions(self, s):
+        # double hashing (Kirsch and Mitzenmacher): two 64-bit hashes are as
+        # good as 'num_hashes' independent ones
+        (h1, h2) = struct.unpack(">QQ", sha1(s).digest()[:16])
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, s):
+        bits = self.bits
+        for pos in self._get_positions(s):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, s):
+        bits = self.bits
+        for pos in self._get_positions(s):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
@@ -124,179 +124,114 @@ def servers_of_happiness(sharemap):
     as long as k <= 5, we can see that the layout above has
     servers_of_happiness = 5, which matches the results here.
     """
-    if sharemap == {}:
-        return 0
-    sharemap = shares_by_server(sharemap)
-    graph = flow_network_for(sharemap)
-    # This is an implementation of the Ford-Fulkerson method for finding
-    # a maximum flow in a flow network applied to a bipartite graph.
-    # Specifically, it is the Edmonds-Karp algorithm, since it uses a
-    # BFS to find the shortest augmenting path at each iteration, if one
-    # exists.
-    #
-    # The implementation here is an adapation of an algorithm described in
-    # "Introduction to Algorithms", Cormen et al, 2nd ed., pp 658-662.
-    dim = len(graph)
-    flow_function = [[0 for sh in xrange(dim)] for s in xrange(dim)]
-    residual_graph, residual_function = residual_network(graph, flow_function)
-    while augmenting_path_for(residual_graph):
-        path = augmenting_path_for(residual_graph)
-        # Delta is the largest amount that we can increase flow across
-        # all of the edges in path. Because of the way that the residual
-        # function is constructed, f[u][v] for a particular edge (u, v)
-        # is the amount of unused capacity on that edge. Taking the
-        # minimum of a list of those values for each edge in the
-        # augmenting path gives us our delta.
-        delta = min(map(lambda (u, v), rf=residual_function: rf[u][v],
-                        path))
-        for (u, v) in path:
-            flow_function[u][v] += delta
-            flow_function[v][u] -= delta
-        residual_graph, residual_function = residual_network(graph,
-                                                             flow_function)
-    num_servers = len(sharemap)
-    # The value of a flow is the total flow out of the source vertex
-    # (vertex 0, in our graph). We could just as well sum across all of
-    # f[0], but we know that vertex 0 only has edges to the servers in
-    # our graph, so we can stop after summing flow across those. The
-    # value of a flow computed in this way is the size of a maximum
-    # matching on the bipartite graph described above.
-    return sum([flow_function[0][v] for v in xrange(1, num_servers+1)])
-
-def flow_network_for(sharemap):
-    """
-    I take my argument, a dict of peerid -> set(shareid) mappings, and
-    turn it into a flow network suitable for use with Edmonds-Karp. I
-    then return the adjacency list representation of that network.
-
-    Specifically, I build G = (V, E), where:
-      V = { peerid in sharemap } U { shareid in sharemap } U {s, t}
-      E = {(s, peerid) for each peerid}
-          U {(peerid, shareid) if peerid is to store shareid }
-          U {(shareid, t) for each shareid}
-
-    s and t will be source and sink nodes when my caller starts treating
-    the graph I return like a flow network. Without s and t, the
-    returned graph is bipartite.
-    """
-    # Servers don't have integral identifiers, and we can't make any
-    # assumptions about the way shares are indexed -- it's possible that
-    # there are missing shares, for example. So before making a graph,
-    # we re-index so that all of our vertices have integral indices, and
-    # that there aren't any holes. We start indexing at 1, so that we
-    # can add a source node at index 0.
-    sharemap, num_shares = reindex(sharemap, base_index=1)
-    num_servers = len(sharemap)
-    graph = [] # index -> [index], an adjacency list
-    # Add an entry at the top (index 0) that has an edge to every server
-    # in sharemap
-    graph.append(sharemap.keys())
-    # For each server, add an entry that has an edge to every share that it
-    # contains (or will contain).
-    for k in sharemap:
-        graph.append(sharemap[k])
-    # For each share, add an entry that has an edge to the sink.
-    sink_num = num_servers + num_shares + 1
-    for i in xrange(num_shares):
-        graph.append([sink_num])
-    # Add an empty entry for the sink, which has no outbound edges.
-    graph.append([])
-    return graph
-
-def reindex(sharemap, base_index):
-    """
-    Given sharemap, I map peerids and shareids to integers that don't
-    conflict with each other, so they're useful as indices in a graph. I
-    return a sharemap that is reindexed appropriately, and also the
-    number of distinct shares in the resulting sharemap as a convenience
-    for my caller. base_index tells me where to start indexing.
-    """
-    shares  = {} # shareid  -> vertex index
-    num = base_index
-    ret = {} # peerid -> [shareid], a reindexed sharemap.
-    # Number the servers first
-    for k in sharemap:
-        ret[num] = sharemap[k]
-        num += 1
-    # Number the shares
-    for k in ret:
-        for shnum in ret[k]:
-            if not shares.has_key(shnum):
-                shares[shnum] = num
-                num += 1
-        ret[k] = map(lambda x: shares[x], ret[k])
-    return (ret, len(shares))
-
-def residual_network(graph, f):
-    """
-    I return the residual network and residual capacity function of the
-    flow network represented by my graph and f arguments. graph is a
-    flow network in adjacency-list form, and f is a flow in graph.
-    """
-    new_graph = [[] for i in xrange(len(graph))]
-    cf = [[0 for s in xrange(len(graph))] for sh in xrange(len(graph))]
-    for i in xrange(len(graph)):
-        for v in graph[i]:
-            if f[i][v] == 1:
-                # We add an edge (v, i) with cf[v,i] = 1. This means
-                # that we can remove 1 unit of flow from the edge (i, v)
-                new_graph[v].append(i)
-                cf[v][i] = 1
-                cf[i][v] = -1
+    return HappinessMatching(sharemap).get_happiness()
+
+class HappinessMatching:
+    """
+    I maintain a maximum matching in the bipartite graph of servers and
+    shares described in servers_of_happiness(), as edges (a server holding,
+    or about to hold, a share) are added and removed, so that the uploader
+    can ask for the current servers_of_happiness value after each response
+    without building and solving the whole graph again.
+
+    Adding an edge can make the maximum matching larger by at most one,
+    and removing an edge can make it smaller by at most one, so after each
+    change a single search for an augmenting path is enough to make the
+    matching maximum again. My constructor builds the initial matching with
+    the Hopcroft-Karp algorithm.
+    """
+
+    def __init__(self, sharemap=None):
+        self._servers = {} # serverid -> set(shareid) that it holds
+        self._server_match = {} # serverid -> shareid
+        self._share_match = {} # shareid -> serverid
+        if sharemap:
+            for shareid, serverids in sharemap.iteritems():
+                for serverid in serverids:
+                    self._servers.setdefault(serverid, set()).add(shareid)
+            self._maximize()
+
+    def get_happiness(self):
+        return len(self._server_match)
+
+    def add(self, shareid, serverid):
+        shares = self._servers.setdefault(serverid, set())
+        if shareid in shares:
+            return
+        shares.add(shareid)
+        if serverid not in self._server_match and \
+           shareid not in self._share_match:
+            self._match(serverid, shareid)
+        else:
+            self._maximize()
+
+    def remove(self, shareid, serverid):
+        shares = self._servers.get(serverid)
+        if not shares or shareid not in shares:
+            return
+        shares.remove(shareid)
+        if not shares:
+            del self._servers[serverid]
+        if self._server_match.get(serverid) == shareid:
+            del self._server_match[serverid]
+            del self._share_match[shareid]
+            self._maximize()
+
+    def _match(self, serverid, shareid):
+        self._server_match[serverid] = shareid
+        self._share_match[shareid] = serverid
+
+    def _maximize(self):
+        # Each iteration is one phase of Hopcroft-Karp: a BFS from all of
+        # the unmatched servers, alternating between unused and matched
+        # edges, to number the servers by their distance from an unmatched
+        # one, followed by a DFS from each unmatched server along those
+        # layers to find a set of disjoint augmenting paths.
+        while True:
+            free = [serverid for serverid in self._servers
+                    if serverid not in self._server_match]
+            layer = dict([(serverid, 0) for serverid in free])
+            queue = list(free)
+            found = False
+            i = 0
+            while i < len(queue):
+                serverid = queue[i]
+                i += 1
+                for shareid in self._servers[serverid]:
+                    other = self._share_match.get(shareid)
+                    if other is None:
+                        found = True
+                    elif other not in layer:
+                        layer[other] = layer[serverid] + 1
+                        queue.append(other)
+            if not found:
+                return
+            for serverid in free:
+                self._augment(serverid, layer)
+
+    def _augment(self, root, layer):
+        # an iterative DFS, so that long paths do not hit the recursion
+        # limit. stack[i] is a server on the path, and path[i] the share
+        # that we want to match it with.
+        stack = [(root, iter(self._servers[root]))]
+        path = []
+        while stack:
+            (serverid, shares) = stack[-1]
+            for shareid in shares:
+                other = self._share_match.get(shareid)
+                if other is None:
+                    path.append(shareid)
+                    for ((serverid, ign), shareid) in zip(stack, path):
+                        self._match(serverid, shareid)
+                    return True
+                if layer.get(other) == layer[serverid] + 1:
+                    path.append(shareid)
+                    stack.append((other, iter(self._servers[other])))
+                    break
             else:
-                # We add the edge (i, v), since we're not using it right
-                # now.
-                new_graph[i].append(v)
-                cf[i][v] = 1
-                cf[v][i] = -1
-    return (new_graph, cf)
-
-def augmenting_path_for(graph):
-    """
-    I return an augmenting path, if there is one, from the source node
-    to the sink node in the flow network represented by my graph argument.
-    If there is no augmenting path, I return False. I assume that the
-    source node is at index 0 of graph, and the sink node is at the last
-    index. I also assume that graph is a flow network in adjacency list
-    form.
-    """
-    bfs_tree = bfs(graph, 0)
-    if bfs_tree[len(graph) - 1]:
-        n = len(graph) - 1
-        path = [] # [(u, v)], where u and v are vertices in the graph
-        while n != 0:
-            path.insert(0, (bfs_tree[n], n))
-            n = bfs_tree[n]
-        return path
-    return False
-
-def bfs(graph, s):
-    """
-    Perform a BFS on graph starting at s, where graph is a graph in
-    adjacency list form, and s is a node in graph. I return the
-    predecessor table that the BFS generates.
-    """
-    # This is an adaptation of the BFS described in "Introduction to
-    # Algorithms", Cormen et al, 2nd ed., p. 532.
-    # WHITE vertices are those that we haven't seen or explored yet.
-    WHITE = 0
-    # GRAY vertices are those we have seen, but haven't explored yet
-    GRAY  = 1
-    # BLACK vertices are those we have seen and explored
-    BLACK = 2
-    color        = [WHITE for i in xrange(len(graph))]
-    predecessor  = [None for i in xrange(len(graph))]
-    distance     = [-1 for i in xrange(len(graph))]
-    queue = [s] # vertices that we haven't explored yet.
-    color[s] = GRAY
-    distance[s] = 0
-    while queue:
-        n = queue.pop(0)
-        for v in graph[n]:
-            if color[v] == WHITE:
-                color[v] = GRAY
-                distance[v] = distance[n] + 1
-                predecessor[v] = n
-                queue.append(v)
-        color[n] = BLACK
-    return predecessor
+                # there is no augmenting path through this server
+                layer[serverid] = None
+                stack.pop()
+                if path:
+                    path.pop()
+        return False
@@ -209,3 +209,7 @@ def constant_time_compare(a, b):
 BACKUPDB_DIRHASH_TAG = "allmydata_backupdb_dirhash_v1"
 def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
+
+BACKUPDB_EXCLUDEHASH_TAG = "allmydata_backupdb_excludehash_v1"
+def backupdb_excludehash(contents):
+    return tagged_hash(BACKUPDB_EXCLUDEHASH_TAG, contents)
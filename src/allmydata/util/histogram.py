@@ -0,0 +1,144 @@
+
+import math, time
+
+class LogHistogram:
+    """I count samples (such as latencies, in seconds) in logarithmically
+    sized buckets, so my size depends only upon the range of values seen,
+    not upon the number of samples. Each bucket is 'precision' wider (as a
+    fraction) than the one below it, so any value I report is within that
+    fraction of a real sample. Values at or below 'minimum' share the first
+    bucket.
+
+    The count, mean, smallest and largest values are exact."""
+
+    def __init__(self, precision=0.01, minimum=1e-6):
+        self.precision = precision
+        self.minimum = minimum
+        self._log_base = math.log(1.0 + precision)
+        self.buckets = {} # maps bucket index to count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def get_index(self, value):
+        if value <= self.minimum:
+            return 0
+        return 1 + int(math.log(value / self.minimum) / self._log_base)
+
+    def get_bucket_value(self, index):
+        # the geometric midpoint of the bucket
+        if index == 0:
+            return self.minimum
+        return self.minimum * (1.0 + self.precision) ** (index - 0.5)
+
+    def add(self, value, index=None):
+        if index is None:
+            index = self.get_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        assert (other.precision, other.minimum) == (self.precision, self.minimum)
+        for index, count in other.buckets.iteritems():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def get_mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def get_order_statistics(self, ranks):
+        """Return a list with the (approximate) value of the sample at each
+        of the given ranks (counting from 0) in sorted order. 'ranks' must
+        be in increasing order. This costs one pass over the buckets, no
+        matter how many samples I have seen."""
+        results = []
+        ranks = list(ranks)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while ranks and ranks[0] < seen:
+                ranks.pop(0)
+                value = self.get_bucket_value(index)
+                results.append(min(max(value, self.min), self.max))
+            if not ranks:
+                break
+        results.extend([None] * len(ranks))
+        return results
+
+    def get_percentile(self, fraction):
+        """Return the value of the sample that is larger than the given
+        fraction of all samples (using the same definition as
+        sorted(samples)[int(fraction*len(samples))]), or None if I have no
+        samples."""
+        if not self.count:
+            return None
+        return self.get_order_statistics([int(fraction * self.count)])[0]
+
+
+class WindowedHistogram:
+    """I keep a LogHistogram of all samples ever added to me, and can also
+    build one for just the samples added during each of the recent windows
+    named in 'windows' (a dict mapping window name to a length in seconds,
+    such as {"1m": 60}). To do this I keep a separate LogHistogram for each
+    'slot_length' seconds, and discard them once they are older than the
+    longest window, so my size does not depend upon the rate of samples.
+    Windows are measured to within 'slot_length' seconds."""
+
+    def __init__(self, windows, slot_length=10, precision=0.01,
+                 minimum=1e-6, clock=time.time):
+        self.windows = windows
+        self.slot_length = slot_length
+        self.precision = precision
+        self.minimum = minimum
+        self.clock = clock
+        self.max_slots = 1
+        for seconds in windows.values():
+            self.max_slots = max(self.max_slots,
+                                 int(math.ceil(float(seconds) / slot_length)))
+        self.lifetime = LogHistogram(precision, minimum)
+        self.slots = [] # list of (slot number, LogHistogram), oldest first
+
+    def add(self, value, now=None):
+        if now is None:
+            now = self.clock()
+        slot = int(now // self.slot_length)
+        if not self.slots or self.slots[-1][0] != slot:
+            self.slots.append( (slot, LogHistogram(self.precision, self.minimum)) )
+            self._expire(slot)
+        index = self.lifetime.get_index(value)
+        self.slots[-1][1].add(value, index)
+        self.lifetime.add(value, index)
+
+    def _expire(self, slot):
+        oldest = slot - self.max_slots + 1
+        while self.slots and self.slots[0][0] < oldest:
+            self.slots.pop(0)
+
+    def get(self, window=None, now=None):
+        """Return a LogHistogram for the named window, or for all samples
+        if 'window' is None or "lifetime"."""
+        if window is None or window == "lifetime":
+            return self.lifetime
+        if now is None:
+            now = self.clock()
+        slot = int(now // self.slot_length)
+        nslots = int(math.ceil(float(self.windows[window]) / self.slot_length))
+        oldest = slot - nslots + 1
+        h = LogHistogram(self.precision, self.minimum)
+        for (s, slot_h) in self.slots:
+            if oldest <= s <= slot:
+                h.merge(slot_h)
+        return h
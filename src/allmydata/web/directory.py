@@ -227,6 +227,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             d = self._POST_start_deep_stats(ctx)
         elif t == "stream-manifest":
             d = self._POST_stream_manifest(ctx)
+        elif t == "start-copy-tree":
+            d = self._POST_start_copy_tree(ctx)
         elif t == "set_children" or t == "set-children":
             d = self._POST_set_children(req)
         else:
@@ -504,6 +506,21 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         renderer = DeepStatsResults(self.client, monitor)
         return self._start_operation(monitor, renderer, ctx)
 
+    def _POST_start_copy_tree(self, ctx):
+        if not get_arg(ctx, "ophandle"):
+            raise NeedOperationHandleError("slow operation requires ophandle=")
+        # format=CHK makes an immutable snapshot, SDMF or MDMF make mutable
+        # directories of that type, and the default is mutable directories
+        # of the node's default type.
+        mutable, mt = True, None
+        if get_arg(ctx, "format", None):
+            file_format = get_format(ctx)
+            mutable = (file_format != "CHK")
+            mt = get_mutable_type(file_format)
+        monitor = self.node.start_copy_tree(mutable, mt)
+        renderer = CopyTreeResults(self.client, monitor)
+        return self._start_operation(monitor, renderer, ctx)
+
     def _POST_stream_manifest(self, ctx):
         walker = ManifestStreamer(ctx, self.node)
         monitor = self.node.deep_traverse(walker)
@@ -529,7 +546,7 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
         return d
 
     def _POST_set_children(self, req):
-        replace = boolean_of_arg(get_arg(req, "replace", "true"))
+        replace = parse_replace_arg(get_arg(req, "replace", "true"))
         req.content.seek(0)
         body = req.content.read()
         try:
@@ -538,9 +555,32 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             le.args = tuple(le.args + (body,))
             # TODO test handling of bad JSON
             raise
+        if not isinstance(children, dict):
+            raise WebError("t=set_children requires a JSON object",
+                           http.BAD_REQUEST)
         cs = {}
-        for name, (file_or_dir, mddict) in children.iteritems():
+        deletes = []
+        renames = []
+        for name, value in children.iteritems():
             name = unicode(name) # simplejson-2.0.1 returns str *or* unicode
+            if value is None:
+                deletes.append(name)
+                continue
+            if (not isinstance(value, list) or len(value) != 2
+                or not isinstance(value[1], dict)):
+                raise WebError("each child must be null or a "
+                               "[type, {...}] pair", http.BAD_REQUEST)
+            (file_or_dir, mddict) = value
+            if file_or_dir == "rename":
+                from_name = mddict.get('from')
+                if not from_name:
+                    raise WebError("a rename entry requires a 'from' name",
+                                   http.BAD_REQUEST)
+                if not isinstance(from_name, basestring):
+                    raise WebError("a rename entry's 'from' name must be "
+                                   "a string", http.BAD_REQUEST)
+                renames.append( (unicode(from_name), name) )
+                continue
             writecap = mddict.get('rw_uri')
             if writecap is not None:
                 writecap = str(writecap)
@@ -548,7 +588,8 @@ class DirectoryNodeHandler(RenderMixin, rend.Page, ReplaceMeMixin):
             if readcap is not None:
                 readcap = str(readcap)
             cs[name] = (writecap, readcap, mddict.get('metadata'))
-        d = self.node.set_children(cs, replace)
+        d = self.node.set_children(cs, replace, deletes=deletes,
+                                   renames=renames)
         d.addCallback(lambda res: "Okay so I did it.")
         # TODO: results
         return d
@@ -1076,6 +1117,21 @@ class DeepStatsResults(rend.Page):
         s["finished"] = self.monitor.is_finished()
         return simplejson.dumps(s, indent=1)
 
+class CopyTreeResults(rend.Page):
+    def __init__(self, client, monitor):
+        self.client = client
+        self.monitor = monitor
+
+    def renderHTTP(self, ctx):
+        # JSON only
+        inevow.IRequest(ctx).setHeader("content-type", "text/plain")
+        s = self.monitor.get_status().copy()
+        s["finished"] = self.monitor.is_finished()
+        s["origin_si"] = None
+        if self.monitor.origin_si:
+            s["origin_si"] = base32.b2a(self.monitor.origin_si)
+        return simplejson.dumps(s, indent=1)
+
 class ManifestStreamer(dirnode.DeepStats):
     implements(IPushProducer)
 
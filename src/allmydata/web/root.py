@@ -16,7 +16,8 @@ from allmydata.interfaces import IFileNode
 from allmydata.web import filenode, directory, unlinked, status, operations
 from allmydata.web import reliability, storage
 from allmydata.web.common import abbreviate_size, getxmlfile, WebError, \
-     get_arg, RenderMixin, get_format, get_mutable_type
+     get_arg, RenderMixin, get_format, get_mutable_type, abbreviate_time, \
+     abbreviate_rate
 
 
 class URIHandler(RenderMixin, rend.Page):
@@ -259,6 +260,30 @@ class Root(rend.Page):
         sb = self.client.get_storage_broker()
         return len(sb.get_connected_servers())
 
+    def render_connection_latencies(self, ctx, data):
+        cm = self.client.get_storage_broker().get_connection_manager()
+        histograms = [("handshake", cm.handshake_latencies),
+                      ("reconnect after loss", cm.reconnect_latencies)]
+        if not cm.handshake_latencies.count:
+            return ctx.tag
+        columns = [(0.5, "median"), (0.9, "90%"), (0.99, "99%")]
+        table = T.table(class_="connection-latencies")
+        table[T.tr[T.th["connection times"], T.th["count"], T.th["mean"],
+                   [T.th[label] for (fraction, label) in columns],
+                   T.th["max"]]]
+        for (name, h) in histograms:
+            table[T.tr[T.td[name], T.td[str(h.count)],
+                       T.td[abbreviate_time(h.get_mean())],
+                       [T.td[abbreviate_time(h.get_percentile(fraction))]
+                        for (fraction, label) in columns],
+                       T.td[abbreviate_time(h.max)]]]
+        waiting = cm.get_waiting_count()
+        connecting = cm.get_connecting_count()
+        return ctx.tag[table,
+                       T.div["%d connection attempts in progress, "
+                             "%d servers waiting to retry"
+                             % (connecting, waiting)]]
+
     def data_services(self, ctx, data):
         sb = self.client.get_storage_broker()
         return sorted(sb.get_known_servers(), key=lambda s: s.get_serverid())
@@ -296,6 +321,15 @@ class Root(rend.Page):
         ctx.fillSlots("version", version)
         ctx.fillSlots("service_name", service_name)
 
+        # how quickly this server has been answering our downloads
+        perf = server.get_performance()
+        ctx.fillSlots("rtt", abbreviate_time(perf.rtt))
+        ctx.fillSlots("throughput", abbreviate_rate(perf.throughput))
+        if perf.requests:
+            ctx.fillSlots("errors", "%d%%" % round(100 * perf.error_rate))
+        else:
+            ctx.fillSlots("errors", "")
+
         return ctx.tag
 
     def render_download_form(self, ctx, data):
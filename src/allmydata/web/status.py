@@ -647,6 +647,10 @@ class DownloadStatusPage(DownloadResultsRendererMixin, rend.Page):
     def render_status(self, ctx, data):
         return data.get_status()
 
+    def render_hedges(self, ctx, data):
+        return "%d (%d beaten by a later request)" % (data.hedges_issued,
+                                                      data.hedges_won)
+
 class DownloadStatusTimelinePage(rend.Page):
     docFactory = getxmlfile("download-status-timeline.xhtml")
 
@@ -1231,6 +1235,25 @@ class HelperStatus(rend.Page):
         return "%d bytes in %d files" % (data["chk_upload_helper.encoding_size"],
                                          data["chk_upload_helper.encoding_count"])
 
+    def _render_waits(self, data, name):
+        return "mean %s, 90%% %s, max %s" % (
+            abbreviate_time(data["chk_upload_helper.%s_wait_mean" % name]),
+            abbreviate_time(data["chk_upload_helper.%s_wait_90_0_percentile"
+                                 % name]),
+            abbreviate_time(data["chk_upload_helper.%s_wait_max" % name]))
+
+    def render_fetch_queue(self, ctx, data):
+        return "%d uploads (%d bytes reserved; waited %s)" % (
+            data["chk_upload_helper.fetch_queue_length"],
+            data["chk_upload_helper.temp_space_reserved"],
+            self._render_waits(data, "fetch"))
+
+    def render_encode_queue(self, ctx, data):
+        return "%d uploads (%d encoding; waited %s)" % (
+            data["chk_upload_helper.encode_queue_length"],
+            data["chk_upload_helper.active_encodes"],
+            self._render_waits(data, "encode"))
+
     def render_upload_requests(self, ctx, data):
         return str(data["chk_upload_helper.upload_requests"])
 
@@ -86,6 +86,30 @@ class StorageStatus(rend.Page):
         d.setdefault("disk_avail", None)
         return d
 
+    def render_latencies(self, ctx, storage):
+        latencies = self.storage.get_latencies()
+        if not latencies:
+            return ctx.tag["No operations yet."]
+        lifetime = self.storage.get_latencies("lifetime")
+        columns = [("50_0_percentile", "median"),
+                   ("90_0_percentile", "90%"),
+                   ("99_0_percentile", "99%"),
+                   ("99_9_percentile", "99.9%"),
+                   ]
+        table = T.table(border="1")
+        table[T.tr[T.th["operation"], T.th["count (5m)"], T.th["mean"],
+                   [T.th[label] for (key, label) in columns],
+                   T.th["count (total)"]]]
+        for category in sorted(latencies):
+            stats = latencies[category]
+            table[T.tr[T.td[category],
+                       T.td[str(stats["samplesize"])],
+                       T.td[abbreviate_time(stats["mean"])],
+                       [T.td[abbreviate_time(stats[key])]
+                        for (key, label) in columns],
+                       T.td[str(lifetime[category]["samplesize"])]]]
+        return ctx.tag[table]
+
     def data_last_complete_bucket_count(self, ctx, data):
         s = self.storage.bucket_counter.get_state()
         count = s.get("last-complete-bucket-count")